@@ -1,55 +1,254 @@
 import logging
+import os
+import queue
 import sys
+import threading
+import time
 
-from logging.handlers import RotatingFileHandler
-from PyQt5.QtCore import pyqtSignal, QObject
+from logging.handlers import QueueHandler, RotatingFileHandler
+from pc_reset_events import Signal
+from pc_reset_profile import NULL_PROFILER
 
-class CustomHandler(RotatingFileHandler, QObject):
+# What to do with a record when the queue of an asynchronous logger is full.
+POLICY_DROP = 'drop'
+POLICY_BLOCK = 'block'
+
+def write_batch(handler, records):
+    """
+    Writes records through a StreamHandler while taking its lock and
+    flushing its stream only once for the whole batch.
+    """
+    handler.acquire()
+    try:
+        if handler.stream is None:
+            handler.stream = handler._open()
+        for record in records:
+            if record.levelno < handler.level:
+                continue
+            try:
+                handler.stream.write(handler.format(record) + handler.terminator)
+            except Exception:
+                handler.handleError(record)
+        handler.flush()
+    finally:
+        handler.release()
+
+class CustomHandler(RotatingFileHandler):
     """
     This is a RotatingFileHandler that is capable of emitting a signal
     whenever a message is logged.
     """
-    sig_message_logged = pyqtSignal(str)
-    
     def __init__(self, name):
         """
         Name is the log file name.
         """
         RotatingFileHandler.__init__(self, filename=name, mode='a', maxBytes=5*1024*1024,
                          backupCount=2, encoding=None, delay=0)
-        QObject.__init__(self)
+
+        # Emitted with every formatted message, from the thread that writes it.
+        self.sig_message_logged = Signal()
+
+        # Time spent writing records (SECONDS), for the metrics.
+        self.busy_seconds = 0.0
+
+        # Times the formatting, signalling and writing of records when profiling is on.
+        self.profiler = NULL_PROFILER
 
     def emit(self, record):
         """Override of emit in RotatingFileHandler."""
-        
+        start = time.perf_counter()
+        profiler = self.profiler
+
         # Emit a signal that can be used by the GUI to display the log message.
-        message = self.format(record)
-        self.sig_message_logged.emit(message)
+        with profiler.span('log.format'):
+            message = self.format(record)
+        with profiler.span('log.signal'):
+            self.sig_message_logged.emit(message)
 
         # Call the normal logger handle.
-        super(CustomHandler, self).emit(record)
-        
-class CustomLogger(QObject):
+        with profiler.span('log.write'):
+            super(CustomHandler, self).emit(record)
+        self.busy_seconds += time.perf_counter() - start
+
+    def emit_batch(self, records):
+        """
+        Writes many records with one lock and one flush.  The rollover check
+        uses a running file size instead of seeking the file for every record.
+        """
+        start = time.perf_counter()
+        self.acquire()
+        try:
+            with self.profiler.span('log.batch', records=len(records)):
+                if self.stream is None:
+                    self.stream = self._open()
+                size = self.stream.seek(0, 2)
+
+                for record in records:
+                    if record.levelno < self.level:
+                        continue
+                    try:
+                        message = self.format(record)
+                        self.sig_message_logged.emit(message)
+
+                        line = message + self.terminator
+                        if self.maxBytes > 0 and size + len(line) >= self.maxBytes:
+                            self.stream.flush()
+                            self.doRollover()
+                            size = 0
+                        self.stream.write(line)
+                        size += len(line)
+                    except Exception:
+                        self.handleError(record)
+                self.flush()
+        finally:
+            self.busy_seconds += time.perf_counter() - start
+            self.release()
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Puts records on a bounded queue without formatting them, so logging on
+    the ping path costs no more than a queue put.
+    """
+    def __init__(self, record_queue, full_policy=POLICY_DROP):
+        super(BoundedQueueHandler, self).__init__(record_queue)
+        if full_policy not in (POLICY_DROP, POLICY_BLOCK):
+            raise ValueError("Unknown queue full policy: {}".format(full_policy))
+        self.full_policy = full_policy
+
+        # Number of records thrown away because the queue was full.
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Formatting is left to the writer thread, which runs in the same process."""
+        return record
+
+    def enqueue(self, record):
+        if self.full_policy == POLICY_BLOCK:
+            self.queue.put(record)
+            return
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class BatchWriter(threading.Thread):
+    """Background thread that drains queued records and writes them in batches."""
+
+    # Put on the queue to stop the writer.
+    STOP = object()
+
+    def __init__(self, record_queue, handlers, queue_handler, batch_size=256):
+        super(BatchWriter, self).__init__(name='BatchWriter', daemon=True)
+        self.queue = record_queue
+        self.handlers = handlers
+        self.queue_handler = queue_handler
+        self.batch_size = batch_size
+        self.dropped_reported = 0
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = BatchWriter.STOP in batch
+            records = [record for record in batch if record is not BatchWriter.STOP]
+            self.__report_dropped(records)
+            self.__write(records)
+
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                return
+
+    def __report_dropped(self, records):
+        """Adds a warning to the batch whenever records have been dropped since the last one."""
+        dropped = self.queue_handler.dropped
+        if dropped > self.dropped_reported:
+            records.append(logging.makeLogRecord({
+                'name': 'BatchWriter', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                'msg': "Log queue full, {} records dropped.".format(dropped - self.dropped_reported)}))
+            self.dropped_reported = dropped
+
+    def __write(self, records):
+        if not records:
+            return
+        for handler in self.handlers:
+            if hasattr(handler, 'emit_batch'):
+                handler.emit_batch(records)
+            else:
+                write_batch(handler, records)
+
+class CustomLogger(object):
     """
     Creates a logger that will rotate log files when they become too big.
     Output will also be logged to the console.
     """
-    def __init__(self, name):
+    def __init__(self, name, asynchronous=False, queue_size=1000, full_policy=POLICY_DROP):
         """
         Name will be used for the log file name.
+
+        In asynchronous mode records go on a queue of queue_size records and a
+        background thread writes them to the file and the console in batches.
+        Full_policy says whether a record is dropped or the caller blocks when
+        the queue is full.
         """
-        super(CustomLogger, self).__init__()
-        
-        self.log_name = '{}'.format(name.lower().replace(" ","_")) 
+        directory, base_name = os.path.split(name)
+        self.log_name = os.path.join(directory, base_name.lower().replace(" ","_"))
         self.handler = CustomHandler(self.log_name)
         formatter = logging.Formatter(fmt='%(asctime)s %(levelname)-8s %(message)s',
                                       datefmt='%Y-%m-%d %H:%M:%S')
         self.handler.setFormatter(formatter)
-        screen_handler = logging.StreamHandler(stream=sys.stdout)
-        screen_handler.setFormatter(formatter)
+        self.screen_handler = logging.StreamHandler(stream=sys.stdout)
+        self.screen_handler.setFormatter(formatter)
         self.logger = logging.getLogger(name)
         self.logger.setLevel(logging.DEBUG)
-        self.logger.addHandler(self.handler)
-        self.logger.addHandler(screen_handler)
 
-    
+        if asynchronous:
+            self.queue = queue.Queue(maxsize=queue_size)
+            self.queue_handler = BoundedQueueHandler(self.queue, full_policy)
+            self.writer = BatchWriter(self.queue, [self.handler, self.screen_handler], self.queue_handler)
+            self.writer.start()
+            self.logger.addHandler(self.queue_handler)
+        else:
+            self.queue = None
+            self.queue_handler = None
+            self.writer = None
+            self.logger.addHandler(self.handler)
+            self.logger.addHandler(self.screen_handler)
+
+    def flush(self):
+        """Waits until every queued record has been written."""
+        if self.queue is not None:
+            self.queue.join()
+
+    def reopen(self):
+        """
+        Closes the log file so the next message opens it again, for when
+        something else has rotated it.
+        """
+        self.handler.acquire()
+        try:
+            if self.handler.stream is not None:
+                self.handler.stream.close()
+                self.handler.stream = None
+        finally:
+            self.handler.release()
+
+    def close(self):
+        """Writes out anything still queued and closes the log file."""
+        if self.writer is not None:
+            self.logger.removeHandler(self.queue_handler)
+            self.queue.put(BatchWriter.STOP)
+            self.writer.join()
+            self.writer = None
+        else:
+            self.logger.removeHandler(self.handler)
+            self.logger.removeHandler(self.screen_handler)
+
+        self.handler.close()
+        self.screen_handler.flush()
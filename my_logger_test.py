@@ -0,0 +1,60 @@
+import logging
+import pytest
+import queue
+
+from my_logger import BoundedQueueHandler, CustomLogger
+
+@pytest.fixture(autouse=True)
+def log_dir(tmp_path, monkeypatch):
+    """Writes the log files of each test into its own directory."""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+def test_synchronous_log_written(log_dir):
+    """Messages are in the file as soon as they are logged."""
+    my_logger = CustomLogger("Sync test")
+
+    my_logger.logger.info("hello")
+
+    assert "INFO     hello" in (log_dir / 'sync_test').read_text()
+    my_logger.close()
+
+def test_asynchronous_log_written_on_close(log_dir):
+    """Every queued message reaches the file once the logger is closed."""
+    my_logger = CustomLogger("Async test", asynchronous=True)
+
+    for count in range(500):
+        my_logger.logger.info("message {}".format(count))
+    my_logger.close()
+
+    lines = (log_dir / 'async_test').read_text().splitlines()
+    assert len(lines) == 500
+    assert lines[-1].endswith("message 499")
+
+def test_asynchronous_signal_emitted(log_dir):
+    """The GUI still gets a signal for every message."""
+    my_logger = CustomLogger("Signal test", asynchronous=True)
+    messages = []
+    my_logger.handler.sig_message_logged.connect(messages.append)
+
+    my_logger.logger.error("oh no")
+    my_logger.flush()
+
+    assert len(messages) == 1
+    assert messages[0].endswith("ERROR    oh no")
+    my_logger.close()
+
+def test_drop_policy_counts_dropped():
+    """Records that do not fit on a full queue are dropped and counted."""
+    handler = BoundedQueueHandler(queue.Queue(maxsize=2), 'drop')
+
+    for count in range(5):
+        handler.emit(logging.makeLogRecord({'msg': count}))
+
+    assert handler.queue.qsize() == 2
+    assert handler.dropped == 3
+
+def test_unknown_policy():
+    """Only the drop and block policies exist."""
+    with pytest.raises(ValueError):
+        BoundedQueueHandler(queue.Queue(), 'explode')
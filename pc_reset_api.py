@@ -0,0 +1,237 @@
+"""
+Local JSON API for scripts that want to see or restart the PCs.
+
+    [Api]
+    listen = 127.0.0.1:9465
+
+listen is either HOST:PORT or the path of a Unix socket.  Requests and
+replies are JSON objects, one per line.  Every request has a "command" and
+may have an "id" that is echoed in its reply:
+
+    {"command": "status", "window": 3600}          every PC, with its history over window
+    {"command": "restart", "host": "rack1-node1"}  restart a PC as if its switch was pressed
+    {"command": "cancel", "host": "rack1-node1"}   stop a queued or running restart
+    {"command": "pause", "hosts": [...], "duration": 600}  leave PCs alone, all without hosts
+    {"command": "resume", "hosts": [...]}          end a pause, all PCs without hosts
+    {"command": "subscribe"}                       stream events on this connection
+
+Replies are {"ok": true, ...} or {"ok": false, "error": "..."}.  Once
+subscribed, a connection also gets {"event": ...} lines for every probe
+result and restart phase.  A subscriber that reads too slowly loses events,
+and is told how many with a "dropped" event, rather than slowing the monitor.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+
+# Events that can wait for a slow subscriber before newer ones are dropped.
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+# Longest request line accepted (bytes).
+MAX_REQUEST_SIZE = 65536
+
+class ApiError(Exception):
+    """A request that cannot be carried out, reported back to the client."""
+    pass
+
+class Subscriber(object):
+    """A connection that events are streamed to, from a queue of its own."""
+    def __init__(self, writer):
+        self.writer = writer
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.dropped = 0
+
+    def offer(self, line):
+        """Queues an encoded event, counting it as dropped if the subscriber is too far behind."""
+        try:
+            self.queue.put_nowait(line)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def run(self):
+        """Writes queued events until the connection goes away."""
+        try:
+            while True:
+                line = await self.queue.get()
+                if self.dropped:
+                    self.writer.write(encode({'event': 'dropped', 'count': self.dropped}))
+                    self.dropped = 0
+                self.writer.write(line)
+                await self.writer.drain()
+        except ConnectionError:
+            pass
+
+def encode(message):
+    return (json.dumps(message, separators=(',', ':')) + '\n').encode('utf-8')
+
+class ControlApi(object):
+    """
+    Serves the API from an asyncio loop in a background thread.  The
+    monitor's signals only hand events over to the loop, once per event
+    however many subscribers there are, so the ping cycle never waits on a
+    client.
+    """
+    def __init__(self, pingboy, listen):
+        """Listen is HOST:PORT, or the path of a Unix socket when it has a '/' in it."""
+        self.pingboy = pingboy
+        self.subscribers = set()
+
+        self.loop = asyncio.new_event_loop()
+        self.socket_path = None
+        if '/' in listen:
+            self.socket_path = listen
+            if os.path.exists(listen):
+                os.unlink(listen)
+            start = asyncio.start_unix_server(self.__serve, listen, limit=MAX_REQUEST_SIZE)
+        else:
+            host, _, port = listen.rpartition(':')
+            start = asyncio.start_server(self.__serve, host or '127.0.0.1', int(port), limit=MAX_REQUEST_SIZE)
+        try:
+            self.server = self.loop.run_until_complete(start)
+        except BaseException:
+            self.loop.close()
+            raise
+
+        self.thread = threading.Thread(target=self.loop.run_forever, name='ControlApi', daemon=True)
+        self.thread.start()
+
+        pingboy.sig_pinged_pc.connect(self.__on_pinged)
+        pingboy.sig_restart_phase.connect(self.__on_restart_phase)
+
+    @property
+    def address(self):
+        return self.server.sockets[0].getsockname()
+
+    def close(self):
+        """Stops serving and closes every connection."""
+        self.pingboy.sig_pinged_pc.disconnect(self.__on_pinged)
+        self.pingboy.sig_restart_phase.disconnect(self.__on_restart_phase)
+
+        async def shut_down():
+            self.server.close()
+            for task in [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]:
+                task.cancel()
+            await self.server.wait_closed()
+        asyncio.run_coroutine_threadsafe(shut_down(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+    def __on_pinged(self, results):
+        """Called on the ping thread once per cycle."""
+        if self.subscribers:
+            self.loop.call_soon_threadsafe(self.__publish_probes, results, time.time())
+
+    def __on_restart_phase(self, name, phase):
+        """Called on the restart engine's thread."""
+        if self.subscribers:
+            self.loop.call_soon_threadsafe(self.__publish,
+                                           {'event': 'restart_phase', 'host': name, 'phase': phase,
+                                            'time': time.time()})
+
+    def __publish_probes(self, results, sent_at):
+        names = {host.config['hostname']: host.name for host in self.pingboy.hosts}
+        for result in results:
+            self.__publish({'event': 'probe', 'host': names.get(result.host, result.host),
+                            'success': result.success, 'rtt': result.rtt, 'error': result.error,
+                            'time': sent_at})
+
+    def __publish(self, event):
+        """Hands an event to every subscriber.  It is encoded only once."""
+        line = encode(event)
+        for subscriber in self.subscribers:
+            subscriber.offer(line)
+
+    async def __serve(self, reader, writer):
+        """Answers the requests of one connection until it closes."""
+        subscriber = None
+        subscriber_task = None
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    writer.write(encode({'ok': False, 'error': 'request too long'}))
+                    break
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+
+                request_id = None
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ApiError('request must be an object')
+                    request_id = request.get('id')
+                    if request.get('command') == 'subscribe':
+                        if subscriber is None:
+                            subscriber = Subscriber(writer)
+                            subscriber_task = asyncio.ensure_future(subscriber.run())
+                            self.subscribers.add(subscriber)
+                        reply = {'ok': True}
+                    else:
+                        reply = self.__handle(request)
+                except ValueError as error:
+                    reply = {'ok': False, 'error': 'bad request: {}'.format(error)}
+                except ApiError as error:
+                    reply = {'ok': False, 'error': str(error)}
+
+                if request_id is not None:
+                    reply['id'] = request_id
+                writer.write(encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if subscriber is not None:
+                self.subscribers.discard(subscriber)
+                subscriber_task.cancel()
+            writer.close()
+
+    def __handle(self, request):
+        """Carries out a request other than subscribe and returns its reply."""
+        command = request.get('command')
+        try:
+            if command == 'status':
+                window = request.get('window')
+                if window is not None and (not isinstance(window, (int, float)) or window <= 0):
+                    raise ApiError('window must be a positive number of seconds')
+                return {'ok': True, 'hosts': self.pingboy.host_status(window)}
+
+            if command == 'restart':
+                return {'ok': True, 'status': self.pingboy.restart_host(self.__host(request))}
+
+            if command == 'cancel':
+                return {'ok': True, 'cancelled': self.pingboy.cancel_restart(self.__host(request))}
+
+            if command == 'pause':
+                duration = request.get('duration')
+                if duration is not None and (not isinstance(duration, (int, float)) or duration <= 0):
+                    raise ApiError('duration must be a positive number of seconds')
+                self.pingboy.pause(self.__hosts(request), duration)
+                return {'ok': True}
+
+            if command == 'resume':
+                self.pingboy.resume(self.__hosts(request))
+                return {'ok': True}
+        except KeyError as error:
+            raise ApiError('unknown host {}'.format(error))
+
+        raise ApiError('unknown command {!r}'.format(command))
+
+    def __host(self, request):
+        host = request.get('host')
+        if not isinstance(host, str):
+            raise ApiError('host must be a host name')
+        return host
+
+    def __hosts(self, request):
+        hosts = request.get('hosts')
+        if hosts is not None and not (isinstance(hosts, list) and all(isinstance(host, str) for host in hosts)):
+            raise ApiError('hosts must be a list of host names')
+        return hosts
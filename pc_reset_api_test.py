@@ -0,0 +1,155 @@
+import json
+import pytest
+import socket
+
+from pc_reset_api import ControlApi, SUBSCRIBER_QUEUE_SIZE
+from pc_reset_events import Signal
+from pc_reset_probe import ProbeResult
+
+class FakeHost(object):
+    def __init__(self, name):
+        self.name = name
+        self.config = {'hostname': name + '.lan'}
+
+class FakePingBoy(object):
+    """Just enough of a PingBoy to serve the API from, recording what it is asked."""
+    def __init__(self):
+        self.sig_pinged_pc = Signal()
+        self.sig_restart_phase = Signal()
+        self.hosts = [FakeHost('node1'), FakeHost('node2')]
+        self.calls = []
+
+    def host_status(self, window=None):
+        return [{'name': host.name, 'window': window} for host in self.hosts]
+
+    def restart_host(self, name):
+        self.__check(name)
+        self.calls.append(('restart', name))
+        return 'started'
+
+    def cancel_restart(self, name):
+        self.__check(name)
+        self.calls.append(('cancel', name))
+        return True
+
+    def pause(self, names=None, duration=None):
+        self.calls.append(('pause', names, duration))
+
+    def resume(self, names=None):
+        self.calls.append(('resume', names))
+
+    def __check(self, name):
+        if name not in [host.name for host in self.hosts]:
+            raise KeyError(name)
+
+class Client(object):
+    """Talks to the API one JSON line at a time."""
+    def __init__(self, address):
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.settimeout(5)
+        self.socket.connect(address)
+        self.file = self.socket.makefile('rb')
+
+    def send(self, request):
+        self.socket.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        return self.receive()
+
+    def receive(self):
+        return json.loads(self.file.readline())
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+@pytest.fixture()
+def pingboy():
+    return FakePingBoy()
+
+@pytest.fixture()
+def api(pingboy):
+    api = ControlApi(pingboy, '127.0.0.1:0')
+    yield api
+    api.close()
+
+@pytest.fixture()
+def client(api):
+    client = Client(api.address)
+    yield client
+    client.close()
+
+def test_bulk_status(client):
+    """Every PC comes back in one reply, and the id is echoed."""
+    reply = client.send({'command': 'status', 'window': 60, 'id': 7})
+
+    assert reply == {'ok': True, 'id': 7, 'hosts': [{'name': 'node1', 'window': 60},
+                                                     {'name': 'node2', 'window': 60}]}
+
+def test_restart_and_cancel(client, pingboy):
+    assert client.send({'command': 'restart', 'host': 'node1'}) == {'ok': True, 'status': 'started'}
+    assert client.send({'command': 'cancel', 'host': 'node1'}) == {'ok': True, 'cancelled': True}
+    assert pingboy.calls == [('restart', 'node1'), ('cancel', 'node1')]
+
+def test_pause_and_resume(client, pingboy):
+    assert client.send({'command': 'pause', 'hosts': ['node2'], 'duration': 600}) == {'ok': True}
+    assert client.send({'command': 'resume'}) == {'ok': True}
+    assert pingboy.calls == [('pause', ['node2'], 600), ('resume', None)]
+
+def test_errors(client):
+    """Bad requests are answered with an error and the connection stays usable."""
+    assert client.send({'command': 'restart', 'host': 'nobody'}) == {'ok': False, 'error': "unknown host 'nobody'"}
+    assert client.send({'command': 'pause', 'duration': -1})['ok'] == False
+    assert client.send({'command': 'reboot'})['ok'] == False
+    client.socket.sendall(b'not json\n')
+    assert client.receive()['ok'] == False
+    assert client.send({'command': 'status'})['ok'] == True
+
+def test_subscribers_get_events(api, pingboy):
+    """Every subscriber gets the probe results and restart phases."""
+    clients = [Client(api.address) for _ in range(3)]
+    try:
+        for client in clients:
+            assert client.send({'command': 'subscribe'}) == {'ok': True}
+
+        pingboy.sig_pinged_pc.emit([ProbeResult.ok('node1.lan', 0.002), ProbeResult.failed('node2.lan', 'timeout')])
+        pingboy.sig_restart_phase.emit('node2', 'power_off_press')
+
+        for client in clients:
+            first, second, third = client.receive(), client.receive(), client.receive()
+            assert (first['event'], first['host'], first['success'], first['rtt']) == ('probe', 'node1', True, 0.002)
+            assert (second['host'], second['success'], second['error']) == ('node2', False, 'timeout')
+            assert (third['event'], third['host'], third['phase']) == ('restart_phase', 'node2', 'power_off_press')
+    finally:
+        for client in clients:
+            client.close()
+
+def test_slow_subscriber_loses_events(api, pingboy):
+    """A subscriber that does not read is told how many events it missed instead of holding things up."""
+    client = Client(api.address)
+    try:
+        client.send({'command': 'subscribe'})
+        # Far more events than the queue and the socket buffers hold.
+        for _ in range(SUBSCRIBER_QUEUE_SIZE * 20):
+            pingboy.sig_restart_phase.emit('node1', 'recovering' + 'x' * 200)
+
+        seen = 0
+        while True:
+            event = client.receive()
+            if event['event'] == 'dropped':
+                assert event['count'] > 0
+                break
+            seen += 1
+        assert seen < SUBSCRIBER_QUEUE_SIZE * 20
+    finally:
+        client.close()
+
+def test_unix_socket(pingboy, tmp_path):
+    path = str(tmp_path / 'api.sock')
+    api = ControlApi(pingboy, path)
+    try:
+        client = Client(path)
+        assert client.send({'command': 'status'})['ok'] == True
+        client.close()
+    finally:
+        api.close()
+    assert not (tmp_path / 'api.sock').exists()
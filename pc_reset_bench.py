@@ -0,0 +1,623 @@
+"""
+Benchmarks for the PC reset monitor.
+
+Run one benchmark at a time, for example:
+
+    python pc_reset_bench.py sweep --hosts 1 10 100 500
+    python pc_reset_bench.py ui --cycle-time 1.5
+    python pc_reset_bench.py dashboard --hosts 1000 --interval 2
+    python pc_reset_bench.py charts --days 30 --interval 5
+    python pc_reset_bench.py logging --messages 10000
+    python pc_reset_bench.py schedule --hosts 1000
+    python pc_reset_bench.py restart --hosts 40 --max-concurrent 8 --stagger 2
+    python pc_reset_bench.py startup --repeat 5
+    python pc_reset_bench.py fleet --hosts 1 100 1000 --save fleet.json
+    python pc_reset_bench.py fleet --compare fleet.json
+"""
+import argparse
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+def loopback_targets(count):
+    """Returns count distinct loopback addresses, which all answer pings on Linux."""
+    return ['127.0.{}.{}'.format(index // 250, index % 250 + 1) for index in range(count)]
+
+
+def measure(function, repeat):
+    """Runs function repeat times, returning (best wall time, best CPU time) in SECONDS."""
+    best_wall = best_cpu = None
+    for _ in range(repeat):
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        function()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        best_wall = wall if best_wall is None else min(best_wall, wall)
+        best_cpu = cpu if best_cpu is None else min(best_cpu, cpu)
+    return best_wall, best_cpu
+
+
+def bench_sweep(args):
+    """Compares one ICMP sweep against one probe per host on a worker pool."""
+    from pc_reset_probe import IcmpProber
+
+    try:
+        prober = IcmpProber(timeout=args.timeout)
+    except OSError as error:
+        print("ICMP sockets are not available here: {}".format(error))
+        return 1
+
+    pool = ThreadPoolExecutor(max_workers=args.workers)
+
+    print("{:>6}  {:>12}  {:>12}  {:>12}  {:>12}  {:>8}".format(
+        'hosts', 'sweep ms', 'sweep cpu ms', 'pool ms', 'pool cpu ms', 'answered'))
+    for count in args.hosts:
+        targets = loopback_targets(count)
+
+        answered = sum(result.success for result in prober.sweep(targets))
+        sweep_wall, sweep_cpu = measure(lambda: prober.sweep(targets), args.repeat)
+        pool_wall, pool_cpu = measure(lambda: list(pool.map(prober.probe, targets)), args.repeat)
+
+        print("{:>6}  {:>12.2f}  {:>12.2f}  {:>12.2f}  {:>12.2f}  {:>8}".format(
+            count, sweep_wall * 1000, sweep_cpu * 1000, pool_wall * 1000, pool_cpu * 1000, answered))
+
+    pool.shutdown()
+    prober.close()
+    return 0
+
+
+class SlowPing(object):
+    """Stands in for PingBoy with a ping cycle that blocks like a host that is timing out."""
+    def __init__(self, cycle_time):
+        self.cycle_time = cycle_time
+
+    def ping(self):
+        time.sleep(self.cycle_time)
+
+
+def bench_ui(args):
+    """Measures GUI frame latency while ping cycles block, on the GUI thread and on the probe worker."""
+    from pc_reset_ui import FrameLatencyMonitor, ProbeWorker
+    from PyQt5.QtCore import QCoreApplication, QThread, QTimer
+
+    app = QCoreApplication.instance() or QCoreApplication(sys.argv)
+    slow_ping = SlowPing(args.cycle_time)
+
+    print("{:>8}  {:>10}  {:>10}  {:>10}  {:>8}".format('mode', 'p50 ms', 'p99 ms', 'max ms', 'skipped'))
+    for mode in ('gui', 'worker'):
+        monitor = FrameLatencyMonitor()
+        ping_timer = QTimer()
+        skipped = [0]
+        in_progress = [False]
+
+        if mode == 'gui':
+            ping_timer.timeout.connect(slow_ping.ping)
+        else:
+            thread = QThread()
+            worker = ProbeWorker(slow_ping)
+            worker.moveToThread(thread)
+            thread.start()
+
+            def cycle_done():
+                in_progress[0] = False
+            worker.sig_cycle_done.connect(cycle_done)
+
+            def tick():
+                if in_progress[0]:
+                    skipped[0] += 1
+                    return
+                in_progress[0] = True
+                QTimer.singleShot(0, worker.run_cycle)
+            ping_timer.timeout.connect(tick)
+
+        ping_timer.start(int(args.interval * 1000))
+        QTimer.singleShot(int(args.duration * 1000), app.quit)
+        app.exec_()
+        ping_timer.stop()
+        monitor.stop()
+
+        if mode == 'worker':
+            thread.quit()
+            thread.wait()
+
+        latencies = sorted(monitor.latencies)
+        print("{:>8}  {:>10.1f}  {:>10.1f}  {:>10.1f}  {:>8}".format(
+            mode, monitor.percentile(50) * 1000, monitor.percentile(99) * 1000,
+            (latencies[-1] if latencies else 0) * 1000, skipped[0]))
+    return 0
+
+
+def bench_dashboard(args):
+    """Measures GUI frame latency and the cost of a table refresh while every host's row changes."""
+    import random
+    from pc_reset_downsample import BucketSeries
+    from pc_reset_ui import FrameLatencyMonitor
+    from pc_reset_widgets import HOST_STATE_FAILING, HOST_STATE_UP, HostDashboard, HostTableModel
+    from PyQt5.QtCore import QTimer
+    from PyQt5.QtWidgets import QApplication
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    generator = random.Random(args.seed)
+    names = ['pc{}'.format(index) for index in range(args.hosts)]
+    trends = {name: BucketSeries(60, 60) for name in names}
+    rows = {name: (name, HOST_STATE_UP, 0.001, 0.0, 0, None, None) for name in names}
+
+    model = HostTableModel(lambda name: rows[name], trends.get)
+    model.set_hosts(names)
+    dashboard = HostDashboard(model)
+    dashboard.resize(900, 600)
+    dashboard.show()
+
+    flush_times = []
+    flush = model.flush
+
+    def timed_flush():
+        start = time.perf_counter()
+        flush()
+        # Include the repaint of the rows that changed.
+        dashboard.table.viewport().repaint()
+        flush_times.append(time.perf_counter() - start)
+    model.flush_timer.timeout.disconnect()
+    model.flush_timer.timeout.connect(timed_flush)
+
+    def update():
+        # Every host is pinged, in one cycle, and a few of them start failing.
+        now = time.time()
+        for name in names:
+            failing = generator.random() < 0.02
+            rtt = None if failing else generator.uniform(0.0002, 0.005)
+            trend = trends[name]
+            trend.add(now, not failing, rtt)
+            rows[name] = (name, HOST_STATE_FAILING if failing else HOST_STATE_UP, rtt,
+                          generator.uniform(0, 10), 1 if failing else 0, None, (trend.peak(), trend.version))
+        model.invalidate(names)
+
+    monitor = FrameLatencyMonitor()
+    update_timer = QTimer()
+    update_timer.timeout.connect(update)
+    update_timer.start(int(args.interval * 1000))
+    QTimer.singleShot(int(args.duration * 1000), app.quit)
+    app.exec_()
+    update_timer.stop()
+    monitor.stop()
+
+    flush_times.sort()
+    latencies = sorted(monitor.latencies)
+    print("{:>6}  {:>10}  {:>10}  {:>10}  {:>14}  {:>14}".format(
+        'hosts', 'p50 ms', 'p99 ms', 'max ms', 'refresh p50 ms', 'refresh max ms'))
+    print("{:>6}  {:>10.1f}  {:>10.1f}  {:>10.1f}  {:>14.1f}  {:>14.1f}".format(
+        args.hosts, monitor.percentile(50) * 1000, monitor.percentile(99) * 1000,
+        (latencies[-1] if latencies else 0) * 1000,
+        percentile(flush_times, 50) * 1000 if flush_times else 0, (flush_times[-1] if flush_times else 0) * 1000))
+    return 0
+
+
+def bench_charts(args):
+    """Times reading, bucketing and drawing a chart of a month of pings, from raw samples and from the history."""
+    import math
+    import random
+    from pc_reset_downsample import BucketSeries
+    from pc_reset_tsdb import TimeSeriesStore
+
+    generator = random.Random(args.seed)
+    window = args.days * 86400.0
+    count = int(window / args.interval)
+    end = time.time()
+    times = [end - window + index * args.interval for index in range(count)]
+    rtts = [None if generator.random() < 0.01 else generator.lognormvariate(math.log(0.001), 0.5)
+            for _ in range(count)]
+    raw = {'times': times,
+           'pings': [1] * count,
+           'failures': [1 if rtt is None else 0 for rtt in rtts],
+           'rtt_low': [math.inf if rtt is None else rtt for rtt in rtts],
+           'rtt_high': [-math.inf if rtt is None else rtt for rtt in rtts]}
+
+    store = TimeSeriesStore()
+    for sent_at, rtt in zip(times, rtts):
+        store.add('pc', sent_at, rtt is not None, rtt)
+
+    series = BucketSeries(window / args.buckets, args.buckets)
+    print("{:<28}  {:>10}  {:>10}".format('step', 'points', 'best ms'))
+    wall, _ = measure(lambda: series.load(end=end, **raw), args.repeat)
+    print("{:<28}  {:>10}  {:>10.2f}".format('bucket raw samples', count, wall * 1000))
+
+    points = store.points('pc', end - window, end)
+    wall, _ = measure(lambda: store.points('pc', end - window, end), args.repeat)
+    print("{:<28}  {:>10}  {:>10.2f}".format('read history', len(points['times']), wall * 1000))
+    wall, _ = measure(lambda: series.load(end=end, **points), args.repeat)
+    print("{:<28}  {:>10}  {:>10.2f}".format('bucket history', len(points['times']), wall * 1000))
+
+    try:
+        from PyQt5.QtGui import QImage
+        from PyQt5.QtWidgets import QApplication
+    except ImportError:
+        return 0
+    from pc_reset_widgets import HostChart
+    app = QApplication.instance() or QApplication(sys.argv)
+    chart = HostChart(lambda name, start, stop: store.points(name, start, stop), buckets=args.buckets)
+    chart.resize(args.buckets + 8, 200)
+    image = QImage(chart.size(), QImage.Format_RGB32)
+    wall, _ = measure(lambda: chart.show_host('pc', window), args.repeat)
+    print("{:<28}  {:>10}  {:>10.2f}".format('chart reload', len(points['times']), wall * 1000))
+    wall, _ = measure(lambda: chart.render(image), args.repeat)
+    print("{:<28}  {:>10}  {:>10.2f}".format('chart paint', len(chart.series.buckets), wall * 1000))
+    return 0
+
+
+def percentile(ordered, percent):
+    """Returns the given percentile of an already sorted list."""
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def bench_logging(args):
+    """Compares the latency of a log call on the ping path with synchronous and asynchronous logging."""
+    import os
+    import tempfile
+    from my_logger import CustomLogger
+
+    print("{:>6}  {:>10}  {:>10}  {:>10}  {:>10}  {:>10}".format(
+        'mode', 'mean us', 'p50 us', 'p99 us', 'max us', 'close ms'))
+    with tempfile.TemporaryDirectory() as directory:
+        for asynchronous in (False, True):
+            mode = 'async' if asynchronous else 'sync'
+
+            # Keep the console handler from flooding the terminal.
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                my_logger = CustomLogger(os.path.join(directory, 'bench_' + mode),
+                                         asynchronous=asynchronous,
+                                         queue_size=args.queue_size,
+                                         full_policy=args.policy)
+                latencies = []
+                for count in range(args.messages):
+                    start = time.perf_counter()
+                    my_logger.logger.error("192.168.1.39 did not respond! Response = 1 Consecutive fails = {}"
+                                           .format(count))
+                    latencies.append(time.perf_counter() - start)
+
+                close_start = time.perf_counter()
+                my_logger.close()
+                close_time = time.perf_counter() - close_start
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+
+            latencies.sort()
+            print("{:>6}  {:>10.1f}  {:>10.1f}  {:>10.1f}  {:>10.1f}  {:>10.1f}".format(
+                mode, sum(latencies) / len(latencies) * 1e6, percentile(latencies, 50) * 1e6,
+                percentile(latencies, 99) * 1e6, latencies[-1] * 1e6, close_time * 1000))
+    return 0
+
+
+def bench_schedule(args):
+    """Compares time-to-detect and probe count of the fixed cadence against the adaptive schedule."""
+    import random
+    from pc_reset_schedule import ProbeScheduler, STATE_HEALTHY, STATE_SUSPECT
+
+    # Every host goes down once at a random time and stays down.
+    rng = random.Random(args.seed)
+    outages = {'host{}'.format(index): rng.uniform(0, args.horizon) for index in range(args.hosts)}
+
+    strategies = [('fixed', args.wait, args.wait),
+                  ('adaptive', args.healthy, args.confirm)]
+
+    print("{:>9}  {:>10}  {:>10}  {:>10}  {:>10}".format(
+        'schedule', 'mean ttd s', 'p95 ttd s', 'max ttd s', 'probes'))
+    for name, healthy_interval, confirm_interval in strategies:
+        clock = [0.0]
+        scheduler = ProbeScheduler(healthy_interval, confirm_interval, healthy_interval,
+                                   clock=lambda: clock[0])
+        fail_counts = dict.fromkeys(outages, 0)
+        times_to_detect = []
+        for host in outages:
+            scheduler.add(host)
+
+        while len(times_to_detect) < len(outages):
+            clock[0] = scheduler.next_deadline()
+            for host in scheduler.due():
+                if clock[0] < outages[host]:
+                    fail_counts[host] = 0
+                    scheduler.schedule(host, STATE_HEALTHY)
+                    continue
+
+                fail_counts[host] += 1
+                if fail_counts[host] >= args.fails:
+                    times_to_detect.append(clock[0] - outages[host])
+                    scheduler.remove(host)
+                else:
+                    scheduler.schedule(host, STATE_SUSPECT)
+
+        times_to_detect.sort()
+        print("{:>9}  {:>10.1f}  {:>10.1f}  {:>10.1f}  {:>10}".format(
+            name, sum(times_to_detect) / len(times_to_detect), percentile(times_to_detect, 95),
+            times_to_detect[-1], scheduler.stats()['probes']))
+    return 0
+
+
+def bench_restart(args):
+    """Compares how long a whole rack takes to recover when restarted all at once or staggered."""
+    from pc_reset_gpio import SimulatedBackend
+    from pc_reset_restart import PHASE_RECOVERING, RestartEngine, RestartScheduler
+
+    strategies = [('all', 0, 0.0),
+                  ('staggered', args.max_concurrent, args.stagger)]
+
+    print("{:>10}  {:>10}  {:>10}  {:>10}  {:>10}  {:>10}  {:>10}".format(
+        'strategy', 'rack s', 'mean s', 'max wait s', 'relays', 'booting', 'writes'))
+    for name, max_concurrent, stagger in strategies:
+        clock = [0.0]
+        booting = {}
+        recovered = {}
+        peaks = {'booting': 0}
+
+        # Relay writes go to simulated GPIO, a rack of relays that change together in one write.
+        gpio = SimulatedBackend(clock=lambda: clock[0])
+        gpio.setup_relays(range(args.hosts))
+
+        def on_phase(machine, phase):
+            if phase == PHASE_RECOVERING:
+                booting[machine.name] = args.boot_time
+                peaks['booting'] = max(peaks['booting'], len(booting))
+
+        engine = RestartEngine(gpio.set_relay, clock=lambda: clock[0], background=False,
+                               set_relays=gpio.set_relays)
+        scheduler = RestartScheduler(engine, on_phase, max_concurrent, stagger, recovery_timeout=float('inf'))
+        for index in range(args.hosts):
+            scheduler.request('host{}'.format(index), index, args.hold, args.wait)
+
+        # PCs booting together share the storage, which slows every one of them down.
+        while len(recovered) < args.hosts:
+            slowdown = 1 + args.contention * max(0, len(booting) - 1)
+            deadlines = [engine.next_deadline()]
+            if booting:
+                deadlines.append(clock[0] + min(booting.values()) * slowdown)
+            now = min(deadline for deadline in deadlines if deadline is not None)
+
+            for host in booting:
+                booting[host] -= (now - clock[0]) / slowdown
+            clock[0] = now
+            engine.run_due(now)
+
+            for host in [host for host, remaining in booting.items() if remaining <= 1e-9]:
+                del booting[host]
+                recovered[host] = now
+                scheduler.host_responded(host)
+
+        closed = set()
+        peak_relays = 0
+        for _, channel, is_closed in gpio.changes:
+            (closed.add if is_closed else closed.discard)(channel)
+            peak_relays = max(peak_relays, len(closed))
+
+        times = sorted(recovered.values())
+        print("{:>10}  {:>10.1f}  {:>10.1f}  {:>10.1f}  {:>10}  {:>10}  {:>10}".format(
+            name, times[-1], sum(times) / len(times), scheduler.stats()['max_wait'],
+            peak_relays, peaks['booting'], gpio.writes))
+    return 0
+
+
+# Code run in a fresh interpreter to start each mode and shut it down again.
+STARTUP_MODES = [
+    ('daemon', "import pc_reset_daemon\n"
+               "pingboy = pc_reset_daemon.PingBoy()\n"
+               "pingboy.close()\n"),
+    ('ui', "import pc_reset_ui\n"
+           "app = pc_reset_ui.QApplication([])\n"
+           "window = pc_reset_ui.PcResetMainWindow()\n"
+           "window.close()\n"),
+]
+
+
+def bench_startup(args):
+    """Compares cold start time and peak memory of the headless daemon and the GUI."""
+    import os
+    import subprocess
+
+    print("{:>8}  {:>10}  {:>10}".format('mode', 'start ms', 'max RSS MB'))
+    for name, code in STARTUP_MODES:
+        times = []
+        peak_rss = 0
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.DEVNULL)
+            _, status, usage = os.wait4(process.pid, 0)
+            times.append(time.perf_counter() - start)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            if process.returncode != 0:
+                print("{:>8}  failed with exit status {}".format(name, process.returncode))
+                break
+            # Linux reports ru_maxrss in kilobytes.
+            peak_rss = max(peak_rss, usage.ru_maxrss)
+        else:
+            print("{:>8}  {:>10.0f}  {:>10.1f}".format(name, min(times) * 1000, peak_rss / 1024))
+    return 0
+
+
+def simulate_fleet(hosts, duration, seed):
+    """Simulates a fleet in this process and returns its figures, including this process's peak memory."""
+    import resource
+    from pc_reset_sim import FleetSimulation, random_fleet
+
+    simulation = FleetSimulation(random_fleet(hosts, duration, seed))
+    try:
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        report = simulation.run(duration)
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+    finally:
+        simulation.close()
+
+    figures = report.as_dict()
+    figures.update({'hosts': hosts,
+                    'wall': wall,
+                    'cpu': cpu,
+                    'probes_per_second': report.probes / wall if wall else None,
+                    'cpu_per_probe': cpu / report.probes if report.probes else None,
+                    # Linux reports ru_maxrss in kilobytes.
+                    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024})
+    return figures
+
+
+# Figures compared against a saved run, and whether bigger is better.
+FLEET_REGRESSION_CHECKS = [('probes_per_second', True),
+                           ('cpu_per_probe', False),
+                           ('peak_rss_mb', False)]
+
+
+def fleet_regressions(results, baseline, tolerance):
+    """Returns a line for every figure that got worse than the baseline by more than tolerance."""
+    regressions = []
+    saved = {figures['hosts']: figures for figures in baseline}
+    for figures in results:
+        old = saved.get(figures['hosts'])
+        if old is None:
+            continue
+        for key, bigger_is_better in FLEET_REGRESSION_CHECKS:
+            if not old.get(key) or figures.get(key) is None:
+                continue
+            change = figures[key] / old[key] - 1
+            if (-change if bigger_is_better else change) > tolerance:
+                regressions.append("{} hosts: {} {:.4g} -> {:.4g} ({:+.0%})".format(
+                    figures['hosts'], key, old[key], figures[key], change))
+        # Outcomes are deterministic for a seed, so any change in them is a change in behaviour.
+        for key in ('false_restarts', 'missed'):
+            if figures[key] > old[key]:
+                regressions.append("{} hosts: {} {} -> {}".format(figures['hosts'], key, old[key], figures[key]))
+        for key in ('time_to_detect', 'time_to_recover'):
+            if old[key]['mean'] is not None and figures[key]['mean'] is not None and \
+                    figures[key]['mean'] > old[key]['mean'] * (1 + tolerance):
+                regressions.append("{} hosts: mean {} {:.1f} -> {:.1f}".format(
+                    figures['hosts'], key, old[key]['mean'], figures[key]['mean']))
+    return regressions
+
+
+def bench_fleet(args):
+    """Runs the monitor against a simulated fleet on virtual time and reports detection, recovery and cost."""
+    import json
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    def seconds(value):
+        return '-' if value is None else '{:.1f}'.format(value)
+
+    print("{:>6}  {:>8}  {:>9}  {:>8}  {:>8}  {:>9}  {:>9}  {:>6}  {:>6}  {:>8}  {:>9}".format(
+        'hosts', 'wall s', 'probes/s', 'detect s', 'max s', 'recover s', 'max s', 'false', 'missed',
+        'cpu us/p', 'RSS MB'))
+    results = []
+    for hosts in args.hosts:
+        # A fresh interpreter for every size, so its peak memory is its own.
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+            figures = pool.submit(simulate_fleet, hosts, args.duration, args.seed).result()
+        results.append(figures)
+        print("{:>6}  {:>8.1f}  {:>9.0f}  {:>8}  {:>8}  {:>9}  {:>9}  {:>6}  {:>6}  {:>8.1f}  {:>9.1f}".format(
+            hosts, figures['wall'], figures['probes_per_second'],
+            seconds(figures['time_to_detect']['mean']), seconds(figures['time_to_detect']['max']),
+            seconds(figures['time_to_recover']['mean']), seconds(figures['time_to_recover']['max']),
+            figures['false_restarts'], figures['missed'], figures['cpu_per_probe'] * 1e6, figures['peak_rss_mb']))
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump({'duration': args.duration, 'seed': args.seed, 'results': results}, file, indent=1)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if (baseline['duration'], baseline['seed']) != (args.duration, args.seed):
+            print("{} was run with another duration or seed.".format(args.compare))
+            return 1
+        regressions = fleet_regressions(results, baseline['results'], args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    sweep_parser = subparsers.add_parser('sweep', help=bench_sweep.__doc__)
+    sweep_parser.add_argument('--hosts', type=int, nargs='+', default=[1, 10, 100, 500])
+    sweep_parser.add_argument('--repeat', type=int, default=5)
+    sweep_parser.add_argument('--timeout', type=float, default=1)
+    sweep_parser.add_argument('--workers', type=int, default=32)
+    sweep_parser.set_defaults(function=bench_sweep)
+
+    ui_parser = subparsers.add_parser('ui', help=bench_ui.__doc__)
+    ui_parser.add_argument('--cycle-time', type=float, default=1.5,
+                           help="time each ping cycle blocks (SECONDS)")
+    ui_parser.add_argument('--interval', type=float, default=1,
+                           help="time between ping ticks (SECONDS)")
+    ui_parser.add_argument('--duration', type=float, default=10)
+    ui_parser.set_defaults(function=bench_ui)
+
+    dashboard_parser = subparsers.add_parser('dashboard', help=bench_dashboard.__doc__)
+    dashboard_parser.add_argument('--hosts', type=int, default=1000)
+    dashboard_parser.add_argument('--interval', type=float, default=2,
+                                  help="time between updates of every host (SECONDS)")
+    dashboard_parser.add_argument('--duration', type=float, default=10)
+    dashboard_parser.add_argument('--seed', type=int, default=1)
+    dashboard_parser.set_defaults(function=bench_dashboard)
+
+    charts_parser = subparsers.add_parser('charts', help=bench_charts.__doc__)
+    charts_parser.add_argument('--days', type=float, default=30)
+    charts_parser.add_argument('--interval', type=float, default=5, help="time between pings (SECONDS)")
+    charts_parser.add_argument('--buckets', type=int, default=300)
+    charts_parser.add_argument('--repeat', type=int, default=5)
+    charts_parser.add_argument('--seed', type=int, default=1)
+    charts_parser.set_defaults(function=bench_charts)
+
+    logging_parser = subparsers.add_parser('logging', help=bench_logging.__doc__)
+    logging_parser.add_argument('--messages', type=int, default=10000)
+    logging_parser.add_argument('--queue-size', type=int, default=1000)
+    logging_parser.add_argument('--policy', choices=['drop', 'block'], default='block')
+    logging_parser.set_defaults(function=bench_logging)
+
+    schedule_parser = subparsers.add_parser('schedule', help=bench_schedule.__doc__)
+    schedule_parser.add_argument('--hosts', type=int, default=1000)
+    schedule_parser.add_argument('--horizon', type=float, default=3600,
+                                 help="outages start at random within this time (SECONDS)")
+    schedule_parser.add_argument('--wait', type=float, default=5, help="fixed wait_between_pings (SECONDS)")
+    schedule_parser.add_argument('--healthy', type=float, default=10, help="adaptive healthy interval (SECONDS)")
+    schedule_parser.add_argument('--confirm', type=float, default=1, help="adaptive confirm interval (SECONDS)")
+    schedule_parser.add_argument('--fails', type=int, default=4, help="ping_fails_needed_for_restart")
+    schedule_parser.add_argument('--seed', type=int, default=1)
+    schedule_parser.set_defaults(function=bench_schedule)
+
+    restart_parser = subparsers.add_parser('restart', help=bench_restart.__doc__)
+    restart_parser.add_argument('--hosts', type=int, default=40)
+    restart_parser.add_argument('--max-concurrent', type=int, default=8)
+    restart_parser.add_argument('--stagger', type=float, default=2, help="time between starts (SECONDS)")
+    restart_parser.add_argument('--hold', type=float, default=3, help="hold_power_switch (SECONDS)")
+    restart_parser.add_argument('--wait', type=float, default=30, help="wait_before_shutdown (SECONDS)")
+    restart_parser.add_argument('--boot-time', type=float, default=60, help="boot time of a lone PC (SECONDS)")
+    restart_parser.add_argument('--contention', type=float, default=0.25,
+                                help="extra boot time per other PC booting at the same time")
+    restart_parser.set_defaults(function=bench_restart)
+
+    startup_parser = subparsers.add_parser('startup', help=bench_startup.__doc__)
+    startup_parser.add_argument('--repeat', type=int, default=5)
+    startup_parser.set_defaults(function=bench_startup)
+
+    fleet_parser = subparsers.add_parser('fleet', help=bench_fleet.__doc__)
+    fleet_parser.add_argument('--hosts', type=int, nargs='+', default=[1, 100, 1000])
+    fleet_parser.add_argument('--duration', type=float, default=3600, help="virtual time simulated (SECONDS)")
+    fleet_parser.add_argument('--seed', type=int, default=1)
+    fleet_parser.add_argument('--save', help="write the results to this JSON file")
+    fleet_parser.add_argument('--compare', help="fail if worse than the results in this JSON file")
+    fleet_parser.add_argument('--tolerance', type=float, default=0.25,
+                              help="fraction a figure may get worse by before it counts as a regression")
+    fleet_parser.set_defaults(function=bench_fleet)
+
+    args = parser.parse_args(argv)
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
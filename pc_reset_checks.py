@@ -0,0 +1,361 @@
+"""
+Health checks that look past ICMP at the services running on a PC.
+
+A host's checks are configured as an expression of check specs joined with
+& (all must pass) and | (any may pass), for example:
+
+    checks = icmp & (tcp:22 | http:8080/health)
+
+Check specs are icmp, tcp:PORT, udp:PORT[:REQUEST] and http:PORT[/PATH].
+"""
+import asyncio
+import codecs
+import re
+import threading
+import time
+
+from pc_reset_probe import ERROR_SOCKET, ERROR_TIMEOUT, ERROR_UNREACHABLE, ProbeResult
+
+ERROR_REFUSED = 'refused'
+ERROR_PROTOCOL = 'protocol'
+ERROR_STATUS = 'status'
+
+class Check(object):
+    """A single way of asking a PC whether it is healthy."""
+
+    async def run(self, hostname, timeout):
+        """Returns a ProbeResult for hostname within timeout (SECONDS)."""
+        start = time.monotonic()
+        try:
+            return await asyncio.wait_for(self.check(hostname, start), timeout)
+        except asyncio.TimeoutError:
+            await self.reset()
+            return ProbeResult.failed(hostname, ERROR_TIMEOUT)
+        except ConnectionRefusedError:
+            await self.reset()
+            return ProbeResult.failed(hostname, ERROR_REFUSED)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            # A malformed reply leaves the connection part way through it, so it is dropped.
+            await self.reset()
+            return ProbeResult.failed(hostname, ERROR_PROTOCOL)
+        except OSError:
+            await self.reset()
+            return ProbeResult.failed(hostname, ERROR_UNREACHABLE)
+
+    async def check(self, hostname, start):
+        """Performs the check, raising on failure.  Start is when the check began."""
+        raise NotImplementedError
+
+    async def reset(self):
+        """Drops anything kept for reuse after a failure."""
+        pass
+
+    async def close(self):
+        await self.reset()
+
+class IcmpCheck(Check):
+    """Pings the PC with the PingBoy prober."""
+
+    def __init__(self, prober):
+        self.prober = prober
+
+    async def check(self, hostname, start):
+        return await asyncio.get_running_loop().run_in_executor(None, self.prober.probe, hostname)
+
+    def __str__(self):
+        return 'icmp'
+
+class TcpCheck(Check):
+    """Passes when a TCP connection to the port is accepted."""
+
+    def __init__(self, port):
+        self.port = port
+
+    async def check(self, hostname, start):
+        _, writer = await asyncio.open_connection(hostname, self.port)
+        rtt = time.monotonic() - start
+        writer.close()
+        await writer.wait_closed()
+        return ProbeResult.ok(hostname, rtt)
+
+    def __str__(self):
+        return 'tcp:{}'.format(self.port)
+
+class _DatagramClient(asyncio.DatagramProtocol):
+    """Hands each datagram that arrives to whoever is waiting for one."""
+
+    def __init__(self):
+        self.waiter = None
+
+    def datagram_received(self, data, address):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(data)
+
+    def error_received(self, error):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_exception(error)
+
+class UdpCheck(Check):
+    """Passes when a UDP request to the port gets any reply."""
+
+    def __init__(self, port, request=b''):
+        self.port = port
+        self.request = request
+        self.transport = None
+        self.protocol = None
+
+    async def check(self, hostname, start):
+        loop = asyncio.get_running_loop()
+
+        # The endpoint is kept open and reused for every check.
+        if self.transport is None:
+            self.transport, self.protocol = await loop.create_datagram_endpoint(
+                _DatagramClient, remote_addr=(hostname, self.port))
+
+        self.protocol.waiter = loop.create_future()
+        self.transport.sendto(self.request)
+        await self.protocol.waiter
+        return ProbeResult.ok(hostname, time.monotonic() - start)
+
+    async def reset(self):
+        if self.transport is not None:
+            self.transport.close()
+        self.transport = None
+        self.protocol = None
+
+    def __str__(self):
+        return 'udp:{}'.format(self.port)
+
+class HttpCheck(Check):
+    """
+    Passes when a GET of the path answers with a status below 400.  The
+    connection is kept alive and reused between checks.
+    """
+    def __init__(self, port=80, path='/'):
+        self.port = port
+        self.path = path
+        self.reader = None
+        self.writer = None
+
+        # Number of connections opened, which shows whether they are reused.
+        self.connections_opened = 0
+
+    async def check(self, hostname, start):
+        reused = self.writer is not None
+        try:
+            return await self.__get(hostname, start)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            # The server may have closed a kept-alive connection, so try a fresh one.
+            if not reused:
+                raise
+            await self.reset()
+            return await self.__get(hostname, start)
+
+    async def __get(self, hostname, start):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(hostname, self.port)
+            self.connections_opened += 1
+
+        self.writer.write("GET {} HTTP/1.1\r\nHost: {}\r\nConnection: keep-alive\r\n\r\n"
+                          .format(self.path, hostname).encode('ascii'))
+        await self.writer.drain()
+
+        status_line = await self.reader.readuntil(b'\r\n')
+        match = re.match(rb'HTTP/1\.[01] (\d{3})', status_line)
+        if match is None:
+            await self.reset()
+            return ProbeResult.failed(hostname, ERROR_PROTOCOL)
+        status = int(match.group(1))
+
+        headers = {}
+        while True:
+            line = await self.reader.readuntil(b'\r\n')
+            if line == b'\r\n':
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        # Read the body so the connection can be used for the next request.
+        if headers.get('transfer-encoding') == 'chunked':
+            while True:
+                size = int((await self.reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                await self.reader.readexactly(size + 2)
+                if size == 0:
+                    break
+        elif 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        else:
+            await self.reader.read()
+            await self.reset()
+
+        if headers.get('connection') == 'close':
+            await self.reset()
+
+        if status >= 400:
+            return ProbeResult(hostname, False, time.monotonic() - start, ERROR_STATUS, status)
+        return ProbeResult.ok(hostname, time.monotonic() - start)
+
+    async def reset(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    def __str__(self):
+        return 'http:{}{}'.format(self.port, self.path)
+
+class AllOf(Check):
+    """Passes when every check passes.  The checks run concurrently."""
+
+    operator = ' & '
+
+    def __init__(self, checks):
+        self.checks = checks
+
+    async def run(self, hostname, timeout):
+        results = await asyncio.gather(*[check.run(hostname, timeout) for check in self.checks])
+        return self.combine(hostname, results)
+
+    def combine(self, hostname, results):
+        failed = [result for result in results if not result.success]
+        if failed:
+            return ProbeResult(hostname, False, None, failed[0].error, failed[0].code)
+        return ProbeResult.ok(hostname, max(result.rtt or 0.0 for result in results))
+
+    async def close(self):
+        for check in self.checks:
+            await check.close()
+
+    def __str__(self):
+        return '(' + self.operator.join(str(check) for check in self.checks) + ')'
+
+class AnyOf(AllOf):
+    """Passes when at least one check passes.  The checks run concurrently."""
+
+    operator = ' | '
+
+    def combine(self, hostname, results):
+        passed = [result for result in results if result.success]
+        if passed:
+            return ProbeResult.ok(hostname, min(result.rtt or 0.0 for result in passed))
+        return ProbeResult(hostname, False, None, results[0].error, results[0].code)
+
+def parse_check_spec(spec, prober):
+    """Creates the check for one spec such as tcp:22."""
+    kind, _, argument = spec.partition(':')
+    kind = kind.strip().lower()
+
+    try:
+        if kind == 'icmp' and not argument:
+            return IcmpCheck(prober)
+        if kind == 'tcp':
+            return TcpCheck(int(argument))
+        if kind == 'udp':
+            port, _, request = argument.partition(':')
+            return UdpCheck(int(port), codecs.decode(request, 'unicode_escape').encode('latin-1'))
+        if kind == 'http':
+            port, slash, path = argument.partition('/')
+            return HttpCheck(int(port) if port else 80, slash + path if slash else '/')
+    except ValueError:
+        pass
+    raise ValueError("Bad check: {}".format(spec))
+
+def parse_checks(expression, prober):
+    """
+    Parses a check expression.  & binds tighter than | and parentheses
+    group, so 'icmp & tcp:22 | http:80' means '(icmp & tcp:22) | http:80'.
+    """
+    tokens = [token.strip() for token in re.split(r'([&|()])', expression) if token.strip()]
+    position = [0]
+
+    def peek():
+        return tokens[position[0]] if position[0] < len(tokens) else None
+
+    def take():
+        token = peek()
+        position[0] += 1
+        return token
+
+    def parse_any():
+        checks = [parse_all()]
+        while peek() == '|':
+            take()
+            checks.append(parse_all())
+        return checks[0] if len(checks) == 1 else AnyOf(checks)
+
+    def parse_all():
+        checks = [parse_term()]
+        while peek() == '&':
+            take()
+            checks.append(parse_term())
+        return checks[0] if len(checks) == 1 else AllOf(checks)
+
+    def parse_term():
+        token = take()
+        if token == '(':
+            check = parse_any()
+            if take() != ')':
+                raise ValueError("Missing ) in checks: {}".format(expression))
+            return check
+        if token is None or token in '&|)':
+            raise ValueError("Bad checks: {}".format(expression))
+        return parse_check_spec(token, prober)
+
+    check = parse_any()
+    if peek() is not None:
+        raise ValueError("Bad checks: {}".format(expression))
+    return check
+
+class CheckRunner(object):
+    """
+    Runs health checks concurrently on an asyncio loop in a background
+    thread, so connections stay open between ping cycles.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='CheckRunner', daemon=True)
+        self.thread.start()
+        self.checks = set()
+
+    def submit(self, jobs):
+        """
+        Starts the checks for a list of (check, hostname, timeout) jobs and
+        returns a concurrent future of their ProbeResults in the same order.
+        """
+        for check, _, _ in jobs:
+            self.checks.add(check)
+        return asyncio.run_coroutine_threadsafe(self.__run_all(jobs), self.loop)
+
+    def run(self, jobs):
+        """Runs the checks for a list of (check, hostname, timeout) jobs and returns their ProbeResults."""
+        return self.submit(jobs).result()
+
+    def prune(self, current):
+        """Closes and forgets every check that is not in current, such as the ones a new config replaced."""
+        current = set(current)
+        stale = self.checks - current
+        if not stale:
+            return
+        self.checks &= current
+
+        async def close_stale():
+            for check in stale:
+                await check.close()
+        asyncio.run_coroutine_threadsafe(close_stale(), self.loop).result()
+
+    async def __run_all(self, jobs):
+        results = await asyncio.gather(*[check.run(hostname, timeout) for check, hostname, timeout in jobs],
+                                       return_exceptions=True)
+        # A check that blew up counts as failed rather than stopping the cycle.
+        return [result if isinstance(result, ProbeResult) else ProbeResult.failed(hostname, ERROR_SOCKET)
+                for result, (_, hostname, _) in zip(results, jobs)]
+
+    def close(self):
+        """Closes every kept connection and stops the loop."""
+        async def close_all():
+            for check in self.checks:
+                await check.close()
+        asyncio.run_coroutine_threadsafe(close_all(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,185 @@
+import asyncio
+import pytest
+import socket
+import threading
+
+import pc_reset_checks
+
+from pc_reset_checks import AnyOf, CheckRunner, HttpCheck, TcpCheck, UdpCheck, parse_checks
+from pc_reset_probe import ProbeResult, SubprocessProber
+
+class StandInServers(object):
+    """TCP, keep-alive HTTP and UDP echo servers on localhost, run in their own thread."""
+
+    def __init__(self):
+        self.http_connections = 0
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.__start(), self.loop).result()
+
+    async def __start(self):
+        self.tcp_server = await asyncio.start_server(self.__handle_tcp, '127.0.0.1', 0)
+        self.tcp_port = self.tcp_server.sockets[0].getsockname()[1]
+
+        self.http_server = await asyncio.start_server(self.__handle_http, '127.0.0.1', 0)
+        self.http_port = self.http_server.sockets[0].getsockname()[1]
+
+        class Echo(asyncio.DatagramProtocol):
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def datagram_received(self, data, address):
+                self.transport.sendto(data, address)
+
+        self.udp_transport, _ = await self.loop.create_datagram_endpoint(Echo, local_addr=('127.0.0.1', 0))
+        self.udp_port = self.udp_transport.get_extra_info('sockname')[1]
+
+    async def __handle_tcp(self, reader, writer):
+        writer.close()
+
+    async def __handle_http(self, reader, writer):
+        self.http_connections += 1
+        try:
+            while True:
+                request_line = await reader.readuntil(b'\r\n')
+                while await reader.readuntil(b'\r\n') != b'\r\n':
+                    pass
+                path = request_line.split()[1]
+                if path == b'/garbled':
+                    writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: lots\r\n\r\n')
+                    await writer.drain()
+                    continue
+                status = b'200 OK' if path == b'/health' else b'503 Service Unavailable'
+                writer.write(b'HTTP/1.1 ' + status + b'\r\nContent-Length: 2\r\n\r\nok')
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+
+    def close(self):
+        async def stop():
+            self.tcp_server.close()
+            self.http_server.close()
+            self.udp_transport.close()
+        asyncio.run_coroutine_threadsafe(stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+@pytest.fixture()
+def servers():
+    servers = StandInServers()
+    yield servers
+    servers.close()
+
+@pytest.fixture()
+def runner():
+    runner = CheckRunner()
+    yield runner
+    runner.close()
+
+def closed_port():
+    """Returns a localhost TCP port that nothing listens on."""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def test_parse_precedence():
+    """& binds tighter than | and parentheses group."""
+    prober = SubprocessProber()
+
+    assert str(parse_checks('icmp & tcp:22 | http:80', prober)) == '((icmp & tcp:22) | http:80/)'
+    assert str(parse_checks('icmp & (tcp:22 | http:8080/health)', prober)) == \
+        '(icmp & (tcp:22 | http:8080/health))'
+    assert isinstance(parse_checks('udp:53', prober), UdpCheck)
+
+@pytest.mark.parametrize('expression', ['', 'tcp', 'tcp:x', 'icmp &', '(icmp', 'icmp)', 'smtp:25'])
+def test_parse_bad_expression(expression):
+    """Malformed expressions are rejected when the config is read."""
+    with pytest.raises(ValueError):
+        parse_checks(expression, SubprocessProber())
+
+def test_tcp_check(servers, runner):
+    """A listening port passes and a closed one is reported as refused."""
+    passed, refused = runner.run([(TcpCheck(servers.tcp_port), '127.0.0.1', 1),
+                                  (TcpCheck(closed_port()), '127.0.0.1', 1)])
+
+    assert passed.success == True
+    assert passed.rtt is not None
+    assert refused.success == False
+    assert refused.error == pc_reset_checks.ERROR_REFUSED
+
+def test_http_check_reuses_connection(servers, runner):
+    """Repeated checks go over one kept-alive connection."""
+    check = HttpCheck(servers.http_port, '/health')
+
+    for _ in range(5):
+        assert runner.run([(check, '127.0.0.1', 1)])[0].success == True
+
+    assert check.connections_opened == 1
+    assert servers.http_connections == 1
+
+def test_http_check_bad_status(servers, runner):
+    """An error status fails the check and carries the status as its code."""
+    result = runner.run([(HttpCheck(servers.http_port, '/'), '127.0.0.1', 1)])[0]
+
+    assert result.success == False
+    assert result.error == pc_reset_checks.ERROR_STATUS
+    assert result.code == 503
+
+def test_udp_check(servers, runner):
+    """Any reply to the request passes a UDP check."""
+    check = UdpCheck(servers.udp_port, b'ping')
+
+    assert runner.run([(check, '127.0.0.1', 1)])[0].success == True
+    assert runner.run([(check, '127.0.0.1', 1)])[0].success == True
+
+def test_combined_checks(servers, runner, mocker):
+    """All of the checks of an & must pass, any one of an | will do."""
+    prober = mocker.Mock(spec=SubprocessProber)
+    prober.probe.return_value = ProbeResult.ok('127.0.0.1', 0.001)
+    healthy = 'icmp & (tcp:{} | tcp:{})'.format(closed_port(), servers.tcp_port)
+    broken = 'icmp & tcp:{}'.format(closed_port())
+
+    results = runner.run([(parse_checks(healthy, prober), '127.0.0.1', 1),
+                          (parse_checks(broken, prober), '127.0.0.1', 1)])
+
+    assert results[0].success == True
+    assert results[1].success == False
+    assert results[1].error == pc_reset_checks.ERROR_REFUSED
+
+def test_check_timeout(runner):
+    """A check that does not finish in time fails with a timeout."""
+    class Hang(pc_reset_checks.Check):
+        async def check(self, hostname, start):
+            await asyncio.sleep(10)
+
+    result = runner.run([(AnyOf([Hang()]), 'pc', 0.05)])[0]
+
+    assert result.success == False
+    assert result.error == pc_reset_checks.ERROR_TIMEOUT
+
+def test_http_check_malformed_reply(servers, runner):
+    """A reply that cannot be parsed fails the check and its connection is not reused."""
+    check = HttpCheck(servers.http_port, '/garbled')
+
+    result = runner.run([(check, '127.0.0.1', 1)])[0]
+
+    assert result.success == False
+    assert result.error == pc_reset_checks.ERROR_PROTOCOL
+    assert check.writer is None
+    check.path = '/health'
+    assert runner.run([(check, '127.0.0.1', 1)])[0].success == True
+    assert check.connections_opened == 2
+
+def test_prune_closes_replaced_checks(servers, runner):
+    """Checks that are no longer used have their connections closed and are forgotten."""
+    old = HttpCheck(servers.http_port, '/health')
+    new = HttpCheck(servers.http_port, '/health')
+    runner.run([(old, '127.0.0.1', 1), (new, '127.0.0.1', 1)])
+
+    runner.prune([new])
+
+    assert runner.checks == {new}
+    assert old.writer is None
+    assert new.writer is not None
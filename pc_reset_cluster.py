@@ -0,0 +1,523 @@
+"""
+Several monitors sharing one fleet, so no one Pi has to stay up and the pings are spread out.
+
+    [Cluster]
+    node = pi1
+    listen = 192.168.1.10:9470
+    peers = pi2=192.168.1.11:9470, pi3=192.168.1.12:9470
+    heartbeat_interval = 1
+    lease_duration = 10
+    fence_file =
+
+Every node has the same fleet in its config and can drive every relay.
+The nodes send each other a JSON datagram over UDP every
+heartbeat_interval, and a node that has not been heard from for
+PEER_TIMEOUT_HEARTBEATS of them is taken to be down.  The PCs are shared
+out on a consistent hash ring of the nodes that are up, so when a node goes
+down only its PCs move, spread over the others, and come back when it does.
+
+A node only closes a relay while it holds the lease on it.  Relay leases
+are handed out by a leader, which holds a lease of its own from a majority
+of the nodes, so there is only ever one leader and a relay is never leased
+to two nodes at once.  No relay lease outlasts the leader lease it was
+granted under, and a new leader can only be chosen once that has run out.
+Every grant carries a fencing token that is higher than any before it, and
+a relay is only closed with a token at least as new as the newest one seen
+for it, so a node that stalled past the end of its lease cannot press a
+switch another node now owns.  fence_file, on storage every node sees,
+fences the relays across the nodes; without it each node only fences
+itself.
+
+A majority of two nodes is both of them, so with two nodes restarts stop
+while either is down.  Run three or more.
+"""
+import bisect
+import fcntl
+import hashlib
+import itertools
+import json
+import os
+import random
+import socket
+import threading
+import time
+
+from pc_reset_events import Signal
+
+# Points each node has on the hash ring, which evens out the share of PCs each gets.
+VIRTUAL_NODES = 64
+
+# Heartbeats a peer may miss before it is taken to be down.
+PEER_TIMEOUT_HEARTBEATS = 3
+
+# Share of a lease a holder gives up in case its clock runs faster than the granter's.
+CLOCK_DRIFT = 0.05
+
+# Largest datagram read (bytes).
+MAX_MESSAGE_SIZE = 65536
+
+def parse_address(text):
+    """Returns (host, port) for HOST:PORT."""
+    host, _, port = text.strip().rpartition(':')
+    if not host or not port.isdigit():
+        raise ValueError("Bad cluster address: {}".format(text))
+    return host, int(port)
+
+def parse_peers(text):
+    """Returns {name: (host, port)} for 'name=HOST:PORT, ...'."""
+    peers = {}
+    for entry in text.split(','):
+        if not entry.strip():
+            continue
+        name, separator, address = entry.partition('=')
+        if not separator or not name.strip():
+            raise ValueError("Bad cluster peer: {}".format(entry.strip()))
+        peers[name.strip()] = parse_address(address)
+    return peers
+
+def ring_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing(object):
+    """Consistent hashing of keys onto members.  Taking a member out only moves the keys it owned."""
+    def __init__(self, members, points=VIRTUAL_NODES):
+        self.members = tuple(sorted(members))
+        ring = sorted((ring_hash('{}#{}'.format(member, index)), member)
+                      for member in self.members for index in range(points))
+        self.hashes = [point for point, _ in ring]
+        self.owners = [member for _, member in ring]
+
+    def owner(self, key):
+        """Returns the member that owns key, or None when there are no members."""
+        if not self.hashes:
+            return None
+        index = bisect.bisect(self.hashes, ring_hash(key))
+        return self.owners[index % len(self.owners)]
+
+class RelayFence(object):
+    """
+    Refuses to let a relay be closed with an older fencing token than the
+    newest one it has admitted for that relay.  With a path the newest
+    tokens are kept in that file, locked while it is read and written, so
+    every process using it shares one fence.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.tokens = {}
+
+    def admit(self, channel, token):
+        """Returns True, remembering the token, when it is at least as new as any seen for the channel."""
+        with self.lock:
+            if not self.path:
+                return self.__admit(self.tokens, str(channel), token)
+            with open(self.path, 'a+') as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                file.seek(0)
+                text = file.read()
+                tokens = json.loads(text) if text.strip() else {}
+                if not self.__admit(tokens, str(channel), token):
+                    return False
+                file.seek(0)
+                file.truncate()
+                json.dump(tokens, file)
+                file.flush()
+                os.fsync(file.fileno())
+                return True
+
+    def __admit(self, tokens, channel, token):
+        if token < tokens.get(channel, -1):
+            return False
+        tokens[channel] = token
+        return True
+
+class Lease(object):
+    """A relay lease.  The leader keeps one per relay it has granted, a holder one per relay it holds."""
+    __slots__ = ('node', 'token', 'expires')
+
+    def __init__(self, node, token, expires):
+        self.node = node
+        self.token = token
+        # On the clock of whoever keeps the lease (SECONDS).
+        self.expires = expires
+
+class ClusterNode(object):
+    """
+    One node of the cluster.  Heartbeats, elections and lease renewals run
+    on a thread of its own.  acquire blocks the caller for up to a
+    heartbeat_interval while the leader is asked.
+    """
+    def __init__(self, name, listen, peers, heartbeat_interval=1.0, lease_duration=10.0, fence_file=None,
+                 clock=time.monotonic):
+        """
+        Listen is this node's HOST:PORT and peers are {name: (host, port)}
+        of the others.  Times are in SECONDS.
+        """
+        if lease_duration <= 2 * heartbeat_interval:
+            raise ValueError("lease_duration must be more than two heartbeat intervals")
+        self.name = name
+        self.peers = dict(peers)
+        self.heartbeat_interval = heartbeat_interval
+        self.lease_duration = lease_duration
+        self.clock = clock
+        self.fence = RelayFence(fence_file)
+        self.majority = (len(self.peers) + 1) // 2 + 1
+
+        # Emitted with the sorted names of the nodes that are up whenever they change.
+        self.sig_members_changed = Signal()
+        # Emitted with the relay channel when a lease held by this node ran out before it was released.
+        self.sig_lease_lost = Signal()
+
+        self.lock = threading.Lock()
+        self.random = random.Random()
+        self.requests = itertools.count(1)
+
+        # Peer name -> when it was last heard from.
+        self.peer_seen = {}
+        self.members = (name,)
+        self.ring = HashRing(self.members)
+        # Goes up whenever the members change, so owners can be worked out again.
+        self.version = 0
+
+        # Highest election epoch seen, and the node, epoch and end of the vote this node last gave.
+        self.epoch = 0
+        self.promise = None
+        # The leader heard from, its epoch and when.
+        self.leader = None
+        self.leader_epoch = 0
+        self.leader_seen = None
+        # The election or lease renewal this node is running as {'id', 'epoch', 'sent_at', 'votes'}.
+        self.candidacy = None
+        self.next_election = clock() + self.random.uniform(1, 2) * heartbeat_interval
+        # While this node is leader, when its lease ends and when to renew it.
+        self.leader_until = None
+        self.renew_at = None
+
+        # Leases granted while leader, as relay channel -> Lease.
+        self.granted = {}
+        self.sequence = 0
+        # Leases this node holds, as relay channel -> Lease.
+        self.held = {}
+        # Request id -> (relay channel, when asked, Event) of leases asked of the leader.
+        self.waiting = {}
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(parse_address(listen))
+        self.socket.settimeout(heartbeat_interval / 4)
+        self.running = True
+        self.thread = threading.Thread(target=self.__run, name='ClusterNode', daemon=True)
+        self.thread.start()
+
+    def owner(self, key):
+        """Returns the node that owns key, a PC name, among the nodes that are up."""
+        return self.ring.owner(key)
+
+    def owns(self, key):
+        return self.ring.owner(key) == self.name
+
+    def is_leader(self):
+        with self.lock:
+            return self.__leading(self.clock())
+
+    def status(self):
+        """Returns the members, the leader and the relays held by this node."""
+        with self.lock:
+            now = self.clock()
+            return {'node': self.name,
+                    'members': list(self.members),
+                    'leader': self.name if self.__leading(now) else self.__known_leader(now),
+                    'epoch': self.epoch,
+                    'held': sorted(channel for channel, lease in self.held.items() if lease.expires > now)}
+
+    def acquire(self, channel):
+        """
+        Gets the lease on a relay, or extends it when already held.  Returns
+        its fencing token, or None when the relay is leased to another node
+        or no leader answered in time.
+        """
+        sent_at = self.clock()
+        with self.lock:
+            if self.__leading(sent_at):
+                token, duration = self.__grant(self.name, channel, sent_at)
+                return self.__hold(channel, token, duration, sent_at)
+            leader, request, answered = self.__ask(channel, sent_at)
+        if leader is None:
+            return None
+        self.__send(leader, request)
+
+        answered.wait(self.heartbeat_interval)
+        with self.lock:
+            self.waiting.pop(request['id'], None)
+            lease = self.held.get(channel)
+            return lease.token if lease is not None and lease.expires > self.clock() else None
+
+    def release(self, channel):
+        """Gives up the lease on a relay so another node can have it straight away."""
+        with self.lock:
+            if self.held.pop(channel, None) is None:
+                return
+            if self.__leading(self.clock()):
+                self.__revoke(self.name, channel)
+                return
+            leader = self.__known_leader(self.clock())
+        if leader is not None:
+            self.__send(leader, {'type': 'release', 'relay': channel})
+
+    def fenced(self, states):
+        """
+        Splits {channel: closed} relay changes into the ones that may be made
+        and the ones that may not.  Opening a relay is always allowed.
+        Closing one needs a lease that has not run out and a token the
+        fence admits.
+        """
+        allowed = {}
+        refused = {}
+        now = self.clock()
+        for channel, closed in states.items():
+            with self.lock:
+                lease = self.held.get(channel)
+            if not closed or (lease is not None and lease.expires > now and self.fence.admit(channel, lease.token)):
+                allowed[channel] = closed
+            else:
+                refused[channel] = closed
+        return allowed, refused
+
+    def close(self):
+        """Stops taking part.  Leases held run out by themselves."""
+        self.running = False
+        self.thread.join()
+        self.socket.close()
+
+    def __run(self):
+        next_tick = self.clock()
+        while self.running:
+            try:
+                data, _ = self.socket.recvfrom(MAX_MESSAGE_SIZE)
+            except socket.timeout:
+                data = None
+            except OSError:
+                if not self.running:
+                    break
+                data = None
+            if data:
+                try:
+                    message = json.loads(data.decode('utf-8'))
+                except ValueError:
+                    message = None
+                if isinstance(message, dict) and message.get('node') in self.peers:
+                    try:
+                        self.__handle(message)
+                    except (KeyError, TypeError, ValueError):
+                        pass
+            if self.clock() >= next_tick:
+                next_tick = self.clock() + self.heartbeat_interval
+                self.__tick()
+
+    def __tick(self):
+        """Sends heartbeats, runs elections, renews leases and notices peers and leases that are gone."""
+        now = self.clock()
+        lost = []
+        renewals = []
+        with self.lock:
+            leading = self.__leading(now)
+            if self.leader_until is not None and not leading:
+                self.leader_until = None
+                self.granted.clear()
+            heartbeat = {'type': 'heartbeat', 'epoch': self.epoch, 'leader': leading,
+                         'leader_epoch': self.leader_epoch if leading else None}
+
+            # Run for leader when none has been heard from, and renew the lease while leader.
+            votes = None
+            if leading:
+                if now >= self.renew_at and self.candidacy is None:
+                    votes = self.__stand(self.leader_epoch, now)
+            elif self.__known_leader(now) is None and now >= self.next_election:
+                if self.promise is None or self.promise[2] <= now:
+                    self.epoch += 1
+                    votes = self.__stand(self.epoch, now)
+                self.next_election = now + self.random.uniform(1, 3) * self.heartbeat_interval
+            if self.candidacy is not None and now - self.candidacy['sent_at'] > self.heartbeat_interval:
+                # A vote this node gave itself in a lost election is not held against the others.
+                if not leading and self.promise is not None and self.promise[0] == self.name:
+                    self.promise = (self.name, self.promise[1], now)
+                self.candidacy = None
+
+            for request_id, (_, sent_at, answered) in list(self.waiting.items()):
+                if now - sent_at > self.heartbeat_interval:
+                    del self.waiting[request_id]
+                    answered.set()
+            for channel, lease in list(self.held.items()):
+                if lease.expires <= now:
+                    del self.held[channel]
+                    lost.append(channel)
+                elif lease.expires - now < self.lease_duration / 2:
+                    if leading:
+                        token, duration = self.__grant(self.name, channel, now)
+                        self.__hold(channel, token, duration, now)
+                    elif not any(waiting[0] == channel for waiting in self.waiting.values()):
+                        renewals.append(self.__ask(channel, now))
+            members_changed = self.__update_members(now)
+            members = self.members
+
+        for peer in self.peers:
+            self.__send(peer, heartbeat)
+            if votes is not None:
+                self.__send(peer, votes)
+        for leader, request, _ in renewals:
+            if leader is not None:
+                self.__send(leader, request)
+        if members_changed:
+            self.sig_members_changed.emit(list(members))
+        for channel in lost:
+            self.sig_lease_lost.emit(channel)
+
+    def __stand(self, epoch, now):
+        """Starts an election, or the renewal of this node's lease, voting for itself.  Returns the request."""
+        self.promise = (self.name, epoch, now + self.lease_duration)
+        self.candidacy = {'id': next(self.requests), 'epoch': epoch, 'sent_at': now, 'votes': {self.name}}
+        self.__count_votes()
+        return {'type': 'vote_request', 'id': self.candidacy['id'], 'epoch': epoch}
+
+    def __count_votes(self):
+        """Takes the lease once a majority has voted, timed from when the votes were asked for."""
+        candidacy = self.candidacy
+        if len(candidacy['votes']) < self.majority:
+            return
+        sent_at = candidacy['sent_at']
+        if self.leader_until is None or candidacy['epoch'] != self.leader_epoch:
+            self.granted.clear()
+            self.sequence = 0
+        self.leader = self.name
+        self.leader_epoch = candidacy['epoch']
+        self.leader_seen = sent_at
+        self.leader_until = sent_at + self.lease_duration * (1 - CLOCK_DRIFT)
+        self.renew_at = sent_at + self.lease_duration / 2
+        self.candidacy = None
+
+    def __handle(self, message):
+        now = self.clock()
+        node = message['node']
+        kind = message.get('type')
+        replies = []
+        with self.lock:
+            self.peer_seen[node] = now
+            epoch = message.get('epoch', 0)
+            self.epoch = max(self.epoch, epoch)
+
+            if kind == 'heartbeat':
+                leader_epoch = message.get('leader_epoch')
+                if message.get('leader') and (leader_epoch > self.leader_epoch or
+                                              (leader_epoch == self.leader_epoch and not self.__leading(now))):
+                    self.leader_until = None
+                    self.granted.clear()
+                    self.leader = node
+                    self.leader_epoch = leader_epoch
+                    self.leader_seen = now
+
+            elif kind == 'vote_request':
+                promise = self.promise
+                granted = (promise is None or
+                           (promise[2] <= now and epoch >= promise[1] and
+                            (epoch > promise[1] or promise[0] == node)) or
+                           (promise[2] > now and promise[0] == node and promise[1] == epoch))
+                if granted:
+                    self.promise = (node, epoch, now + self.lease_duration)
+                replies.append({'type': 'vote', 'id': message['id'], 'epoch': epoch, 'granted': granted})
+
+            elif kind == 'vote':
+                candidacy = self.candidacy
+                if (message.get('granted') and candidacy is not None and candidacy['id'] == message['id'] and
+                        candidacy['epoch'] == epoch):
+                    candidacy['votes'].add(node)
+                    self.__count_votes()
+
+            elif kind == 'acquire':
+                token, duration = (self.__grant(node, message['relay'], now) if self.__leading(now)
+                                   else (None, 0))
+                replies.append({'type': 'lease', 'id': message['id'], 'relay': message['relay'],
+                                'token': token, 'duration': duration})
+
+            elif kind == 'release':
+                if self.__leading(now):
+                    self.__revoke(node, message['relay'])
+
+            elif kind == 'lease':
+                waiting = self.waiting.pop(message['id'], None)
+                if waiting is not None:
+                    channel, sent_at, answered = waiting
+                    self.__hold(channel, message.get('token'), message.get('duration', 0), sent_at)
+                    answered.set()
+
+        for reply in replies:
+            self.__send(node, reply)
+
+    def __grant(self, node, channel, now):
+        """
+        Leases a relay to a node, keeping the token of a lease it already
+        holds.  Returns (token, duration), or (None, 0) when another node
+        holds it.  No lease outlasts this node's own.
+        """
+        lease = self.granted.get(channel)
+        duration = min(self.lease_duration, self.leader_until - now)
+        if lease is not None and lease.node != node and lease.expires > now:
+            return None, 0
+        if lease is None or lease.node != node or lease.expires <= now:
+            self.sequence += 1
+            lease = self.granted[channel] = Lease(node, (self.leader_epoch << 32) | self.sequence, 0)
+        lease.expires = now + duration
+        return lease.token, duration
+
+    def __revoke(self, node, channel):
+        lease = self.granted.get(channel)
+        if lease is not None and lease.node == node:
+            del self.granted[channel]
+
+    def __ask(self, channel, now):
+        """
+        Gets ready to ask the leader for a relay lease.  Returns the leader,
+        the request to send it and an Event set once it is answered, or
+        Nones when no leader is known.
+        """
+        leader = self.__known_leader(now)
+        if leader is None:
+            return None, None, None
+        request_id = next(self.requests)
+        answered = threading.Event()
+        self.waiting[request_id] = (channel, now, answered)
+        return leader, {'type': 'acquire', 'id': request_id, 'relay': channel}, answered
+
+    def __hold(self, channel, token, duration, sent_at):
+        """Records a granted lease, timed from when it was asked for.  Returns the token."""
+        if token is None:
+            return None
+        self.held[channel] = Lease(self.name, token, sent_at + duration * (1 - CLOCK_DRIFT))
+        return token
+
+    def __leading(self, now):
+        return self.leader == self.name and self.leader_until is not None and now < self.leader_until
+
+    def __known_leader(self, now):
+        """Returns another node heard from as leader within a lease, or None."""
+        if (self.leader is None or self.leader == self.name or self.leader_seen is None or
+                now - self.leader_seen > self.lease_duration):
+            return None
+        return self.leader
+
+    def __update_members(self, now):
+        """Works out which nodes are up.  Returns True when that changed."""
+        timeout = PEER_TIMEOUT_HEARTBEATS * self.heartbeat_interval
+        members = tuple(sorted([self.name] + [peer for peer, seen in self.peer_seen.items()
+                                              if now - seen < timeout]))
+        if members == self.members:
+            return False
+        self.members = members
+        self.ring = HashRing(members)
+        self.version += 1
+        return True
+
+    def __send(self, peer, message):
+        message = dict(message, node=self.name)
+        try:
+            self.socket.sendto(json.dumps(message, separators=(',', ':')).encode('utf-8'), self.peers[peer])
+        except OSError:
+            pass
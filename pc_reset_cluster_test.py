@@ -0,0 +1,254 @@
+import os
+import pytest
+import shutil
+import socket
+import time
+
+from pc_reset_cluster import ClusterNode, HashRing, parse_peers, RelayFence
+from pc_reset_ping import PingBoy, write_config_file
+from pc_reset_probe import ERROR_TIMEOUT, ProbeResult
+from pc_reset_restart import REQUEST_LEASE_REFUSED
+
+HEARTBEAT_INTERVAL = 0.05
+LEASE_DURATION = 0.6
+
+def free_ports(count):
+    """Returns count UDP ports on localhost that nothing is using."""
+    sockets = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM) for _ in range(count)]
+    for udp in sockets:
+        udp.bind(('127.0.0.1', 0))
+    ports = [udp.getsockname()[1] for udp in sockets]
+    for udp in sockets:
+        udp.close()
+    return ports
+
+def wait_for(condition, timeout=5.0):
+    """Polls condition until it is true, failing the test if it takes longer than timeout (SECONDS)."""
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.01)
+
+def addresses(names):
+    return {name: ('127.0.0.1', port) for name, port in zip(names, free_ports(len(names)))}
+
+def settled(nodes):
+    """True once every node sees all of them and they agree on one leader."""
+    statuses = [node.status() for node in nodes]
+    leaders = set(status['leader'] for status in statuses)
+    return (all(len(status['members']) == len(nodes) for status in statuses) and
+            len(leaders) == 1 and None not in leaders and sum(node.is_leader() for node in nodes) == 1)
+
+@pytest.fixture()
+def cluster():
+    """Three cluster nodes on localhost, closed afterwards."""
+    names = ['pi1', 'pi2', 'pi3']
+    peers = addresses(names)
+    nodes = [ClusterNode(name, '127.0.0.1:{}'.format(peers[name][1]),
+                         {peer: address for peer, address in peers.items() if peer != name},
+                         HEARTBEAT_INTERVAL, LEASE_DURATION) for name in names]
+    wait_for(lambda: settled(nodes))
+    yield nodes
+    for node in nodes:
+        if node.running:
+            node.close()
+
+def test_parse_peers():
+    assert parse_peers('pi2=192.168.1.11:9470, pi3 = 192.168.1.12:9471') == {'pi2': ('192.168.1.11', 9470),
+                                                                             'pi3': ('192.168.1.12', 9471)}
+    assert parse_peers('') == {}
+    with pytest.raises(ValueError):
+        parse_peers('pi2=192.168.1.11')
+    with pytest.raises(ValueError):
+        parse_peers('192.168.1.11:9470')
+
+def test_hash_ring_only_moves_keys_of_a_member_that_leaves():
+    keys = ['rack{}-node{}'.format(rack, node) for rack in range(10) for node in range(40)]
+    ring = HashRing(['pi1', 'pi2', 'pi3'])
+    owners = {key: ring.owner(key) for key in keys}
+    shares = [list(owners.values()).count(member) for member in ('pi1', 'pi2', 'pi3')]
+    assert min(shares) > len(keys) / 6
+
+    smaller = HashRing(['pi1', 'pi3'])
+    moved = [key for key in keys if smaller.owner(key) != owners[key]]
+    assert moved and all(owners[key] == 'pi2' for key in moved)
+    assert HashRing([]).owner('pc') is None
+
+def test_fence_refuses_older_tokens(tmp_path):
+    fence = RelayFence()
+    assert fence.admit(5, 10)
+    assert fence.admit(5, 10)
+    assert not fence.admit(5, 9)
+    assert fence.admit(6, 1)
+
+    # Fences on the same file are one fence.
+    path = str(tmp_path / 'fence.json')
+    assert RelayFence(path).admit(5, 10)
+    assert not RelayFence(path).admit(5, 9)
+    assert RelayFence(path).admit(5, 11)
+
+def test_one_leader_and_shared_owners(cluster):
+    leaders = set(node.status()['leader'] for node in cluster)
+    assert len(leaders) == 1
+    for key in ('pc{}'.format(index) for index in range(50)):
+        owners = set(node.owner(key) for node in cluster)
+        assert len(owners) == 1
+        assert sum(node.owns(key) for node in cluster) == 1
+
+def test_relay_leased_to_one_node_at_a_time(cluster):
+    first, second, _ = cluster
+    token = first.acquire(5)
+    assert token is not None
+    assert second.acquire(5) is None
+    # Asking again while holding it keeps the same token.
+    assert first.acquire(5) == token
+
+    first.release(5)
+    wait_for(lambda: second.acquire(5) is not None)
+    assert second.status()['held'] == [5]
+    assert second.acquire(5) > token
+
+def test_leases_are_renewed(cluster):
+    holder = cluster[1]
+    holder.acquire(7)
+    time.sleep(LEASE_DURATION * 2)
+    assert holder.status()['held'] == [7]
+    assert holder.fenced({7: True}) == ({7: True}, {})
+
+def test_fence_stops_closing_without_a_lease(cluster):
+    node = cluster[0]
+    assert node.fenced({3: True, 4: False}) == ({4: False}, {3: True})
+
+    # A newer token for the relay fences off an older one.
+    token = node.acquire(3)
+    node.fence.admit(3, token + 1)
+    assert node.fenced({3: True}) == ({}, {3: True})
+
+def test_new_leader_when_leader_stops(cluster):
+    old_leader = next(node for node in cluster if node.is_leader())
+    holder = next(node for node in cluster if node is not old_leader)
+    old_token = holder.acquire(5)
+    lost = []
+    holder.sig_lease_lost.connect(lost.append)
+
+    old_leader.close()
+    others = [node for node in cluster if node is not old_leader]
+    wait_for(lambda: settled(others))
+    assert all(node.status()['members'] == sorted(other.name for other in others) for node in others)
+
+    # The lease granted by the old leader ran out and the new leader's tokens are newer.
+    wait_for(lambda: lost == [5])
+    wait_for(lambda: holder.acquire(5) is not None)
+    assert holder.acquire(5) > old_token
+
+def test_no_leader_without_a_majority(cluster):
+    survivor = cluster[0]
+    for node in cluster[1:]:
+        node.close()
+    wait_for(lambda: survivor.status()['members'] == [survivor.name])
+    time.sleep(LEASE_DURATION * 2)
+    assert not survivor.is_leader()
+    assert survivor.acquire(5) is None
+
+class FleetProber(object):
+    """Answers pings from every PC except the ones that are down."""
+    def __init__(self, down=()):
+        self.down = set(down)
+        self.pinged = []
+
+    def probe(self, hostname):
+        self.pinged.append(hostname)
+        if hostname in self.down:
+            return ProbeResult.failed(hostname, ERROR_TIMEOUT)
+        return ProbeResult.ok(hostname, 0.001)
+
+    def sweep(self, hostnames):
+        return [self.probe(hostname) for hostname in hostnames]
+
+    def close(self):
+        pass
+
+@pytest.fixture()
+def watchdogs(tmp_path):
+    """Three monitors on localhost sharing twelve PCs on simulated GPIO, each with its own directory."""
+    names = ['pi1', 'pi2', 'pi3']
+    peers = addresses(names)
+    config = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pc_reset_config.ini')
+    pingboys = {}
+    for name in names:
+        directory = tmp_path / name
+        directory.mkdir()
+        config_file = str(directory / 'pc_reset_config.ini')
+        shutil.copy(config, config_file)
+        updates = {('Channel', 'backend'): 'simulated',
+                   ('Timing', 'ping_fails_needed_for_restart'): 1,
+                   ('State', 'file'): str(directory / 'state'),
+                   ('History', 'file'): '',
+                   ('EventLog', 'directory'): str(directory / 'events'),
+                   ('Cluster', 'node'): name,
+                   ('Cluster', 'listen'): '127.0.0.1:{}'.format(peers[name][1]),
+                   ('Cluster', 'peers'): ', '.join('{}=127.0.0.1:{}'.format(peer, address[1])
+                                                   for peer, address in peers.items() if peer != name),
+                   ('Cluster', 'heartbeat_interval'): HEARTBEAT_INTERVAL,
+                   ('Cluster', 'lease_duration'): LEASE_DURATION,
+                   ('Cluster', 'fence_file'): str(tmp_path / 'fence.json')}
+        for index in range(12):
+            section = 'Host:pc{}'.format(index)
+            updates[(section, 'hostname')] = '10.0.0.{}'.format(index)
+            updates[(section, 'relay_channel')] = index
+            updates[(section, 'switch_channel')] = 100 + index
+        write_config_file(config_file, updates)
+        pingboy = PingBoy(config_file, log_file=str(directory / 'pc_reset.log'))
+        pingboy.prober.close()
+        pingboy.prober = FleetProber()
+        pingboys[name] = pingboy
+
+    wait_for(lambda: settled([pingboy.cluster for pingboy in pingboys.values()]))
+    yield pingboys
+    for pingboy in pingboys.values():
+        pingboy.close()
+
+def test_watchdogs_share_the_fleet(watchdogs):
+    for pingboy in watchdogs.values():
+        pingboy.ping()
+    pinged = [set(pingboy.prober.pinged) for pingboy in watchdogs.values()]
+    assert set.union(*pinged) == set('10.0.0.{}'.format(index) for index in range(12))
+    assert sum(len(hostnames) for hostnames in pinged) == 12
+
+    owners = [[status['owner'] for status in pingboy.host_status()] for pingboy in watchdogs.values()]
+    assert all(owner == owners[0] for owner in owners)
+    assert set(owners[0]) <= set(watchdogs)
+
+def test_only_owner_restarts_a_pc(watchdogs):
+    for pingboy in watchdogs.values():
+        pingboy.prober.down = {'10.0.0.4'}
+        pingboy.ping()
+    owner = watchdogs['pi1'].cluster.owner('pc4')
+    wait_for(lambda: watchdogs[owner].gpio.closed_relays() == {4})
+    assert watchdogs[owner].hosts_by_name['pc4'].flag_restarting
+    for name, pingboy in watchdogs.items():
+        if name != owner:
+            assert pingboy.gpio.closed_relays() == set()
+            assert not pingboy.hosts_by_name['pc4'].flag_restarting
+
+    # Another node pressing the PC's switch cannot restart it while the owner holds the relay.
+    other = next(pingboy for name, pingboy in watchdogs.items() if name != owner)
+    assert other.restart_host('pc4') == REQUEST_LEASE_REFUSED
+    assert other.gpio.closed_relays() == set()
+
+def test_pcs_move_when_a_watchdog_stops(watchdogs):
+    for pingboy in watchdogs.values():
+        pingboy.ping()
+    stopped = watchdogs['pi1'].cluster.owner('pc0')
+    moved = set(host.config['hostname'] for host in watchdogs[stopped].hosts
+                if watchdogs[stopped].cluster.owns(host.name))
+    watchdogs.pop(stopped).close()
+    remaining = list(watchdogs.values())
+    wait_for(lambda: settled([pingboy.cluster for pingboy in remaining]))
+
+    for pingboy in remaining:
+        pingboy.prober.pinged = []
+        pingboy.ping()
+    pinged = [set(pingboy.prober.pinged) for pingboy in remaining]
+    assert set.union(*pinged) == moved
+    assert not pinged[0] & pinged[1]
@@ -0,0 +1,88 @@
+"""
+Runs the PC reset monitor headless, without importing Qt.
+
+    python pc_reset_daemon.py [config_file]
+
+SIGTERM and SIGINT stop the monitor cleanly, opening every relay and
+cleaning up the GPIO pins.  SIGHUP reopens the log file after it has been
+rotated and reloads the config file.  Config file changes are also picked
+up by themselves between ping cycles.
+"""
+import argparse
+import signal
+import sys
+import threading
+
+from pc_reset_ping import PingBoy
+
+# Shortest wait after a ping cycle that failed, so an error that keeps
+# happening does not spin the loop (SECONDS).
+ERROR_WAIT = 1.0
+
+class Daemon(object):
+    """Runs ping cycles on the main thread until it is asked to stop."""
+    def __init__(self, pingboy):
+        self.pingboy = pingboy
+
+        # Set to cut the wait for the next ping short.  The signal handlers
+        # only set flags, the work is done by the loop in run.
+        self.wakeup = threading.Event()
+        self.stop_requested = False
+        self.reopen_requested = False
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.request_stop())
+        signal.signal(signal.SIGINT, lambda signum, frame: self.request_stop())
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.request_reopen())
+
+    def request_stop(self):
+        self.stop_requested = True
+        self.wakeup.set()
+
+    def request_reopen(self):
+        self.reopen_requested = True
+        self.wakeup.set()
+
+    def run(self):
+        """
+        Pings the PCs that are due then waits until the next one is, until
+        stopped.  A cycle that fails is logged and the PCs are watched on,
+        only a stop request ends the loop.
+        """
+        try:
+            while not self.stop_requested:
+                wait = None
+                try:
+                    if self.reopen_requested:
+                        self.reopen_requested = False
+                        self.pingboy.my_logger.reopen()
+                        self.pingboy.my_logger.logger.info("Log file reopened.")
+                        self.pingboy.request_reload()
+
+                    self.pingboy.ping()
+                except Exception:
+                    self.pingboy.my_logger.logger.exception("Ping cycle failed.")
+                    wait = ERROR_WAIT
+
+                time_until_next = self.pingboy.time_until_next_ping()
+                if wait is not None and time_until_next is not None:
+                    wait = max(wait, time_until_next)
+                self.wakeup.wait(time_until_next if wait is None else wait)
+                self.wakeup.clear()
+        finally:
+            self.pingboy.close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the PC reset monitor without a GUI.")
+    parser.add_argument('config_file', nargs='?', default='pc_reset_config.ini')
+    args = parser.parse_args(argv)
+
+    daemon = Daemon(PingBoy(args.config_file))
+    daemon.install_signal_handlers()
+    daemon.run()
+
+    print("\nHe be gone, he be outta here!")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
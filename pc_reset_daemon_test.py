@@ -0,0 +1,81 @@
+import os
+import pytest
+import signal
+import subprocess
+import sys
+import threading
+
+from pc_reset_daemon import Daemon
+
+@pytest.fixture()
+def pingboy(mocker):
+    """A PingBoy that is always 10 seconds away from its next ping."""
+    pingboy = mocker.Mock()
+    pingboy.time_until_next_ping.return_value = 10
+    return pingboy
+
+@pytest.fixture()
+def restore_signal_handlers():
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)}
+    yield
+    for signum, handler in handlers.items():
+        signal.signal(signum, handler)
+
+def test_stop_closes_pingboy(pingboy):
+    """Asking the daemon to stop ends the loop and cleans up."""
+    daemon = Daemon(pingboy)
+    pingboy.ping.side_effect = daemon.request_stop
+
+    daemon.run()
+
+    pingboy.ping.assert_called_once_with()
+    pingboy.close.assert_called_once_with()
+
+def test_failed_cycle_does_not_stop_monitoring(pingboy, mocker):
+    """A cycle that raises is logged and the next one still runs."""
+    daemon = Daemon(pingboy)
+    pingboy.time_until_next_ping.return_value = 0
+    calls = []
+    def ping():
+        calls.append(True)
+        if len(calls) == 1:
+            raise OSError("network is down")
+        daemon.request_stop()
+    pingboy.ping.side_effect = ping
+    mocker.patch('pc_reset_daemon.ERROR_WAIT', 0.01)
+
+    daemon.run()
+
+    assert len(calls) == 2
+    pingboy.my_logger.logger.exception.assert_called_once_with("Ping cycle failed.")
+    pingboy.close.assert_called_once_with()
+
+def test_hangup_reopens_log_and_reloads(pingboy):
+    """The log file is reopened on the loop rather than in the signal handler, and the config reloaded."""
+    daemon = Daemon(pingboy)
+    daemon.request_reopen()
+    pingboy.ping.side_effect = daemon.request_stop
+
+    daemon.run()
+
+    pingboy.my_logger.reopen.assert_called_once_with()
+    pingboy.request_reload.assert_called_once_with()
+
+def test_sigterm_interrupts_wait(pingboy, restore_signal_handlers):
+    """SIGTERM stops the daemon without waiting for the next ping to be due."""
+    daemon = Daemon(pingboy)
+    daemon.install_signal_handlers()
+    threading.Timer(0.1, os.kill, (os.getpid(), signal.SIGTERM)).start()
+
+    daemon.run()
+
+    assert pingboy.ping.call_count == 1
+    pingboy.close.assert_called_once_with()
+
+def test_daemon_does_not_import_qt():
+    """The headless monitor never loads PyQt5."""
+    output = subprocess.check_output([sys.executable, '-c',
+                                      "import sys, pc_reset_daemon; print('PyQt5' in sys.modules)"],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    assert output.strip() == b'False'
@@ -0,0 +1,309 @@
+"""
+Failure detectors that decide when a PC is down, and a harness that replays
+recorded probe traces through them.
+
+Compare detectors on a trace recorded with [Detect] trace_file:
+
+    python pc_reset_detect.py probes.csv --detector consecutive loss phi
+"""
+import argparse
+import array
+import csv
+import math
+import sys
+
+DETECTOR_CONSECUTIVE = 'consecutive'
+DETECTOR_LOSS = 'loss'
+DETECTOR_PHI = 'phi'
+
+class ProbeHistory(object):
+    """
+    Compact ring of the most recent probes of one host.
+
+    Times and RTTs (SECONDS) live in typed arrays so a history costs a few
+    bytes per probe no matter how long the monitor runs.  Failed probes have
+    an RTT of NaN.
+    """
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.times = array.array('d', bytes(8 * capacity))
+        self.rtts = array.array('d', bytes(8 * capacity))
+        self.successes = array.array('b', bytes(capacity))
+        self.count = 0
+        self.next_index = 0
+
+        # Failures since the last successful probe.
+        self.consecutive_failures = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, time, success, rtt=None):
+        """Records the outcome of a probe sent at time."""
+        index = self.next_index
+        self.times[index] = time
+        self.rtts[index] = rtt if (success and rtt is not None) else math.nan
+        self.successes[index] = 1 if success else 0
+        self.next_index = (index + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+        if success:
+            self.consecutive_failures = 0
+        else:
+            self.consecutive_failures += 1
+
+    def clear(self):
+        """Forgets every probe, for example once a PC has been restarted."""
+        self.count = 0
+        self.next_index = 0
+        self.consecutive_failures = 0
+
+    def recent(self, count=None):
+        """Returns (time, success, rtt) of the newest count probes, oldest first."""
+        if count is None or count > self.count:
+            count = self.count
+        start = self.next_index - count
+        return [(self.times[index], bool(self.successes[index]), self.rtts[index])
+                for index in (position % self.capacity for position in range(start, self.next_index))]
+
+    def loss_ratio(self, count=None):
+        """Returns the fraction of the newest count probes that failed."""
+        probes = self.recent(count)
+        if not probes:
+            return 0.0
+        return sum(1 for _, success, _ in probes if not success) / len(probes)
+
+    def last_success(self):
+        """Returns (time, rtt) of the newest successful probe, or None."""
+        for probe_time, success, rtt in reversed(self.recent()):
+            if success:
+                return probe_time, rtt
+        return None
+
+class FailureDetector(object):
+    """
+    Decides from the probe history of a host whether it is down.
+
+    Detectors hold no per-host state so one detector serves every host.
+    """
+
+    name = None
+
+    def is_down(self, history, now, fails_needed):
+        """
+        Returns True when the host should be considered dead.  Fails_needed
+        is the host's ping_fails_needed_for_restart.
+        """
+        raise NotImplementedError
+
+class ConsecutiveFailureDetector(FailureDetector):
+    """Down after fails_needed failed probes in a row."""
+
+    name = DETECTOR_CONSECUTIVE
+
+    def is_down(self, history, now, fails_needed):
+        return history.consecutive_failures >= fails_needed
+
+class LossRatioDetector(FailureDetector):
+    """
+    Down when too many of the recent probes failed.  A lucky reply from a
+    dying PC lowers the loss ratio a little instead of resetting the count,
+    while a link that only drops the odd probe never gets near the threshold.
+    """
+
+    name = DETECTOR_LOSS
+
+    def __init__(self, window=8, threshold=0.5):
+        """
+        The loss ratio is taken over the last window probes and is only
+        trusted once there are at least fails_needed of them.
+        """
+        self.window = window
+        self.threshold = threshold
+
+    def is_down(self, history, now, fails_needed):
+        if history.consecutive_failures == 0 or len(history) < fails_needed:
+            return False
+        return history.loss_ratio(self.window) >= self.threshold
+
+class PhiAccrualDetector(FailureDetector):
+    """
+    Phi accrual detector (Hayashibara et al.) fed by successful replies.
+
+    Reply arrival times (probe time plus RTT) are treated as heartbeats.
+    Phi grows with the time since the last reply compared with the usual
+    gap between replies, so a host that normally answers like clockwork is
+    suspected sooner than one with a jittery link.
+    """
+
+    name = DETECTOR_PHI
+
+    def __init__(self, threshold=8.0, min_std_ratio=0.5, min_samples=5):
+        """
+        The standard deviation of the gaps is never taken as less than
+        min_std_ratio of their mean.  Otherwise a PC that answers like
+        clockwork would be declared down after a single lost ping.  Until
+        min_samples gaps are known, the host is down after fails_needed
+        consecutive failures.
+        """
+        self.threshold = threshold
+        self.min_std_ratio = min_std_ratio
+        self.min_samples = min_samples
+
+    def phi(self, history, now):
+        """Returns phi for the host at time now, or None without enough replies."""
+        arrivals = [probe_time + (0.0 if math.isnan(rtt) else rtt)
+                    for probe_time, success, rtt in history.recent() if success]
+        gaps = [later - earlier for earlier, later in zip(arrivals, arrivals[1:])]
+        if len(gaps) < self.min_samples:
+            return None
+
+        mean = sum(gaps) / len(gaps)
+        std = max(mean * self.min_std_ratio, math.sqrt(sum((gap - mean) ** 2 for gap in gaps) / len(gaps)),
+                  1e-3)
+
+        # Logistic approximation of the normal CDF, as used by Akka.
+        y = (now - arrivals[-1] - mean) / std
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if y > 0:
+            return -math.log10(e / (1.0 + e))
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+    def is_down(self, history, now, fails_needed):
+        if history.consecutive_failures == 0:
+            return False
+        phi = self.phi(history, now)
+        if phi is None:
+            return history.consecutive_failures >= fails_needed
+        return phi >= self.threshold
+
+def make_detector(kind, window=8, loss_threshold=0.5, phi_threshold=8.0):
+    """Creates a failure detector of the given kind."""
+    if kind == DETECTOR_CONSECUTIVE:
+        return ConsecutiveFailureDetector()
+    if kind == DETECTOR_LOSS:
+        return LossRatioDetector(window, loss_threshold)
+    if kind == DETECTOR_PHI:
+        return PhiAccrualDetector(phi_threshold)
+    raise ValueError("Unknown failure detector: {}".format(kind))
+
+class TraceRecorder(object):
+    """Appends every probe to a CSV file that can be replayed later."""
+    def __init__(self, path):
+        self.file = open(path, 'a', newline='')
+        self.writer = csv.writer(self.file)
+
+    def record(self, time, host, success, rtt):
+        self.writer.writerow(['{:.3f}'.format(time), host, int(success),
+                              '' if rtt is None else '{:.6f}'.format(rtt)])
+        # Flushed per probe like the state journal, so a crash loses nothing already probed.
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def load_trace(path):
+    """
+    Reads a probe trace.  Each row is time,host,success,rtt with an optional
+    fifth down column that marks probes sent while the host really was down.
+    """
+    trace = []
+    with open(path, newline='') as trace_file:
+        for row in csv.reader(trace_file):
+            if not row or row[0].startswith('#'):
+                continue
+            down = bool(int(row[4])) if len(row) > 4 and row[4] != '' else None
+            trace.append((float(row[0]), row[1], row[2] == '1',
+                          float(row[3]) if row[3] else None, down))
+
+    # Replaying and scoring both work through the probes in time order.
+    trace.sort(key=lambda probe: probe[0])
+    return trace
+
+def replay(trace, detector, fails_needed, capacity=64):
+    """
+    Feeds a trace through a detector the way PingBoy does and returns the
+    list of (time, host, really_down) at which a restart would be requested.
+    """
+    histories = {}
+    restarting = set()
+    detections = []
+    for probe_time, host, success, rtt, down in trace:
+        history = histories.setdefault(host, ProbeHistory(capacity))
+
+        # Probes of a PC being restarted do not feed the detector.
+        if host in restarting:
+            if success:
+                restarting.discard(host)
+                history.clear()
+            continue
+
+        history.add(probe_time, success, rtt)
+        if not success and detector.is_down(history, probe_time, fails_needed):
+            detections.append((probe_time, host, down))
+            restarting.add(host)
+    return detections
+
+def summarize(trace, detections):
+    """
+    Returns counts of restarts, false restarts (host was not really down)
+    and missed outages, and the detection delays, for a labelled trace.
+    """
+    # Host -> start time of its current outage, or None once it has been detected.
+    outages = {}
+    delays = []
+    false_restarts = 0
+    missed = 0
+    detections = sorted(detections)
+    index = 0
+
+    for probe_time, host, _, _, down in trace:
+        if down and host not in outages:
+            outages[host] = probe_time
+        elif down is False and host in outages:
+            # The outage ended, with or without a restart.
+            if outages.pop(host) is not None:
+                missed += 1
+
+        # Work through the detections in time order alongside the trace.
+        while index < len(detections) and detections[index][0] <= probe_time:
+            detection_time, detection_host, really_down = detections[index]
+            if really_down is False:
+                false_restarts += 1
+            elif outages.get(detection_host) is not None:
+                delays.append(detection_time - outages[detection_host])
+                outages[detection_host] = None
+            index += 1
+
+    return {'restarts': len(detections),
+            'false_restarts': false_restarts,
+            'missed': missed + sum(1 for start in outages.values() if start is not None),
+            'mean_delay': sum(delays) / len(delays) if delays else None,
+            'max_delay': max(delays) if delays else None}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replays a probe trace through failure detectors.")
+    parser.add_argument('trace')
+    parser.add_argument('--detector', nargs='+', default=[DETECTOR_CONSECUTIVE, DETECTOR_LOSS, DETECTOR_PHI],
+                        choices=[DETECTOR_CONSECUTIVE, DETECTOR_LOSS, DETECTOR_PHI])
+    parser.add_argument('--fails', type=int, default=4, help="ping_fails_needed_for_restart")
+    parser.add_argument('--window', type=int, default=8)
+    parser.add_argument('--loss-threshold', type=float, default=0.5)
+    parser.add_argument('--phi-threshold', type=float, default=8.0)
+    args = parser.parse_args(argv)
+
+    trace = load_trace(args.trace)
+
+    print("{:>12}  {:>9}  {:>9}  {:>9}  {:>12}  {:>12}".format(
+        'detector', 'restarts', 'false', 'missed', 'mean delay s', 'max delay s'))
+    for kind in args.detector:
+        detector = make_detector(kind, args.window, args.loss_threshold, args.phi_threshold)
+        summary = summarize(trace, replay(trace, detector, args.fails))
+        print("{:>12}  {:>9}  {:>9}  {:>9}  {:>12}  {:>12}".format(
+            kind, summary['restarts'], summary['false_restarts'], summary['missed'],
+            '-' if summary['mean_delay'] is None else '{:.1f}'.format(summary['mean_delay']),
+            '-' if summary['max_delay'] is None else '{:.1f}'.format(summary['max_delay'])))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import pytest
+
+from pc_reset_detect import (ConsecutiveFailureDetector, LossRatioDetector, PhiAccrualDetector, ProbeHistory,
+                             TraceRecorder, load_trace, make_detector, replay, summarize)
+
+def history_of(pattern, interval=5.0, rtt=0.001):
+    """Builds a history from a string of '1' (reply) and '0' (no reply) probes."""
+    history = ProbeHistory()
+    for index, outcome in enumerate(pattern):
+        history.add(index * interval, outcome == '1', rtt)
+    return history
+
+def test_history_wraps():
+    """Only the newest probes are kept once the ring is full."""
+    history = ProbeHistory(capacity=4)
+    for index in range(6):
+        history.add(float(index), index % 2 == 0, 0.001)
+
+    assert len(history) == 4
+    assert [probe[0] for probe in history.recent()] == [2.0, 3.0, 4.0, 5.0]
+    assert history.loss_ratio() == 0.5
+    assert history.consecutive_failures == 1
+
+def test_history_clear():
+    """Clearing forgets the probes and the failure count."""
+    history = history_of('1100')
+    history.clear()
+
+    assert len(history) == 0
+    assert history.consecutive_failures == 0
+    assert history.last_success() is None
+
+def test_consecutive_detector():
+    """The counter only looks at failures in a row."""
+    detector = ConsecutiveFailureDetector()
+
+    assert detector.is_down(history_of('10000'), 20, 4) == True
+    assert detector.is_down(history_of('0001000'), 30, 4) == False
+
+def test_loss_detector_ignores_flaky_link():
+    """Losing the odd probe never adds up to a restart."""
+    detector = LossRatioDetector(window=8, threshold=0.5)
+
+    assert detector.is_down(history_of('11011101101'), 50, 4) == False
+
+def test_loss_detector_catches_dying_host():
+    """A lucky reply does not reset a host that mostly stopped answering."""
+    detector = LossRatioDetector(window=8, threshold=0.5)
+    history = history_of('1111000100')
+
+    assert ConsecutiveFailureDetector().is_down(history, 45, 4) == False
+    assert detector.is_down(history, 45, 4) == True
+
+def test_phi_regular_host_suspected_soon():
+    """A host that always answers on time is down shortly after replies stop."""
+    detector = PhiAccrualDetector(threshold=8)
+    history = history_of('1' * 10)
+    last_reply = 45.001
+
+    history.add(50, False)
+    assert detector.is_down(history, last_reply + 5, 4) == False
+    history.add(55, False)
+    assert detector.is_down(history, last_reply + 10, 4) == False
+    history.add(65, False)
+    assert detector.is_down(history, last_reply + 20, 4) == True
+
+def test_phi_jittery_host_given_slack():
+    """A host whose replies arrive irregularly is given more time than a regular one."""
+    detector = PhiAccrualDetector(threshold=8)
+    regular = ProbeHistory()
+    jittery = ProbeHistory()
+    for index in range(9):
+        regular.add(index * 5, True, 0)
+    for probe_time in (0, 1, 10, 11, 20, 21, 30, 31, 40):
+        jittery.add(probe_time, True, 0)
+    regular.add(59, False)
+    jittery.add(59, False)
+
+    # Both have gaps of 5 seconds on average and have been silent for 19.
+    assert detector.is_down(regular, 59, 4) == True
+    assert detector.is_down(jittery, 59, 4) == False
+
+def test_phi_falls_back_to_counter():
+    """Without enough replies to learn from, consecutive failures decide."""
+    detector = PhiAccrualDetector()
+
+    assert detector.is_down(history_of('000'), 10, 4) == False
+    assert detector.is_down(history_of('0000'), 15, 4) == True
+
+def test_make_detector_unknown():
+    """Unknown detectors are rejected."""
+    with pytest.raises(ValueError):
+        make_detector('tea-leaves')
+
+def test_replay_and_summarize(tmp_path):
+    """A recorded trace replays to the same restarts and is scored against its labels."""
+    trace_path = tmp_path / 'trace.csv'
+    recorder = TraceRecorder(str(trace_path))
+    for index in range(20):
+        recorder.record(index * 5.0, 'pc1', index < 10, 0.001 if index < 10 else None)
+    recorder.close()
+
+    # Label the outage so the delay can be measured.
+    trace = [probe[:4] + (probe[0] >= 50,) for probe in load_trace(str(trace_path))]
+
+    detections = replay(trace, make_detector('consecutive'), 4)
+    summary = summarize(trace, detections)
+
+    assert detections == [(65.0, 'pc1', True)]
+    assert summary['restarts'] == 1
+    assert summary['false_restarts'] == 0
+    assert summary['missed'] == 0
+    assert summary['mean_delay'] == 15.0
+
+def test_trace_written_before_close(tmp_path):
+    """Every probe is on disk as soon as it is recorded, so a crash loses none of the trace."""
+    trace_path = tmp_path / 'trace.csv'
+    recorder = TraceRecorder(str(trace_path))
+    recorder.record(5.0, 'pc1', False, None)
+
+    assert load_trace(str(trace_path)) == [(5.0, 'pc1', False, None, None)]
+    recorder.close()
@@ -0,0 +1,101 @@
+"""
+Min/max bucketing of ping history, so charts draw as many points as they have pixels.
+
+Every bucket keeps the lowest and highest round trip time and the pings and
+failed pings within it, so a spike or an outage still shows however far a
+chart is zoomed out.  Buckets are aligned to multiples of their width, which
+means a new ping only ever touches the newest bucket and the older ones
+never have to be worked out or drawn again.
+
+    series = BucketSeries(width=60, count=60)
+    series.load(**store.points('rack1-node1', now - 3600, now))
+    series.add(now, True, 0.0012)
+"""
+import bisect
+import collections
+import math
+
+class Bucket(object):
+    """Pings within [start, start + width).  Round trip times are inf and -inf while none are known."""
+    __slots__ = ('start', 'low', 'high', 'pings', 'failures')
+
+    def __init__(self, start, low=math.inf, high=-math.inf, pings=0, failures=0):
+        self.start = start
+        self.low = low
+        self.high = high
+        self.pings = pings
+        self.failures = failures
+
+    def has_rtt(self):
+        return self.low <= self.high
+
+class BucketSeries(object):
+    """The newest count buckets of width SECONDS, oldest first, leaving out empty ones."""
+    def __init__(self, width, count):
+        self.width = width
+        self.count = count
+        self.buckets = collections.deque()
+
+        # Goes up with every change, so a drawing knows when it is out of date.
+        self.version = 0
+
+    def bucket_start(self, time):
+        return time - time % self.width
+
+    def end(self):
+        """Returns the end of the newest bucket, or None when there is none."""
+        return self.buckets[-1].start + self.width if self.buckets else None
+
+    def load(self, times, pings, failures, rtt_low, rtt_high, end=None, **unused):
+        """
+        Replaces the buckets with the points of TimeSeriesStore.points up to
+        end, which defaults to the newest point.  Times must be in order.
+        The points of each bucket are found with a bisect and reduced with
+        min, max and sum over slices, so a month of pings every 5 seconds
+        loads in milliseconds.
+        """
+        self.buckets.clear()
+        if times:
+            newest = self.bucket_start(times[-1] if end is None else end)
+            oldest = max(self.bucket_start(times[0]), newest - (self.count - 1) * self.width)
+            low = bisect.bisect_left(times, oldest)
+            for index in range(int(round((newest - oldest) / self.width)) + 1):
+                start = oldest + index * self.width
+                high = bisect.bisect_left(times, start + self.width, low)
+                if high > low:
+                    self.buckets.append(Bucket(start, min(rtt_low[low:high]), max(rtt_high[low:high]),
+                                               sum(pings[low:high]), sum(failures[low:high])))
+                low = high
+        self.version += 1
+
+    def add(self, time, success, rtt=None):
+        """
+        Records a ping.  Returns True when it started a new bucket, which
+        moves the whole series along, and False when it only changed the
+        newest one.  Pings older than the newest bucket are ignored.
+        """
+        start = self.bucket_start(time)
+        started = False
+        if not self.buckets or start > self.buckets[-1].start:
+            self.buckets.append(Bucket(start))
+            oldest = start - (self.count - 1) * self.width
+            while self.buckets[0].start < oldest:
+                self.buckets.popleft()
+            started = True
+        elif start < self.buckets[-1].start:
+            return False
+
+        bucket = self.buckets[-1]
+        bucket.pings += 1
+        if not success:
+            bucket.failures += 1
+        elif rtt is not None:
+            bucket.low = min(bucket.low, rtt)
+            bucket.high = max(bucket.high, rtt)
+        self.version += 1
+        return started
+
+    def peak(self):
+        """Returns the highest round trip time of any bucket, or None when none is known."""
+        peak = max((bucket.high for bucket in self.buckets), default=-math.inf)
+        return peak if peak > -math.inf else None
@@ -0,0 +1,57 @@
+import math
+
+from pc_reset_downsample import BucketSeries
+
+def points(times, rtts):
+    """Points as TimeSeriesStore.points gives them, None being a lost ping."""
+    return {'times': times,
+            'pings': [1] * len(times),
+            'failures': [1 if rtt is None else 0 for rtt in rtts],
+            'rtt_low': [math.inf if rtt is None else rtt for rtt in rtts],
+            'rtt_high': [-math.inf if rtt is None else rtt for rtt in rtts]}
+
+def test_load_keeps_lowest_highest_and_losses():
+    series = BucketSeries(60, 10)
+    series.load(**points([0, 10, 20, 70, 80, 130], [0.001, 0.009, None, None, None, 0.002]))
+
+    assert [(bucket.start, bucket.low, bucket.high, bucket.pings, bucket.failures) for bucket in series.buckets] == [
+        (0, 0.001, 0.009, 3, 1), (60, math.inf, -math.inf, 2, 2), (120, 0.002, 0.002, 1, 0)]
+    assert not series.buckets[1].has_rtt()
+    assert series.peak() == 0.009
+
+def test_load_keeps_only_the_newest_buckets():
+    series = BucketSeries(60, 2)
+    series.load(**points([0, 60, 120, 180], [0.001, 0.002, 0.003, 0.004]))
+
+    assert [bucket.start for bucket in series.buckets] == [120, 180]
+
+def test_load_a_month_of_pings():
+    """A month of pings every 5 seconds goes into 300 buckets with nothing lost."""
+    count = 30 * 86400 // 5
+    times = [index * 5.0 for index in range(count)]
+    rtts = [0.001] * count
+    rtts[count // 2] = 0.25
+    series = BucketSeries(30 * 86400 / 300, 300)
+    series.load(**points(times, rtts))
+
+    assert len(series.buckets) == 300
+    assert sum(bucket.pings for bucket in series.buckets) == count
+    assert series.peak() == 0.25
+
+def test_add_only_touches_the_newest_bucket():
+    series = BucketSeries(60, 3)
+    assert series.add(10, True, 0.001) == True
+    version = series.version
+    assert series.add(20, False) == False
+    assert series.version == version + 1
+    assert series.buckets[-1].failures == 1
+
+    # Moving along drops the buckets that fall out of the window.
+    for start in (60, 120, 180):
+        assert series.add(start, True, 0.002) == True
+    assert [bucket.start for bucket in series.buckets] == [60, 120, 180]
+    assert series.end() == 240
+
+    # A ping from before the newest bucket is ignored.
+    assert series.add(100, True, 0.5) == False
+    assert series.peak() == 0.002
@@ -0,0 +1,359 @@
+"""
+Structured log of what happened to every PC, kept for good and quick to query.
+
+    [EventLog]
+    directory = pc_reset_events
+    segment_size = 1048576
+
+Every event is a JSON object with at least its 'time' (SECONDS since the
+epoch), 'event' and 'host', one per line of the active segment.  A segment
+is closed once it is a day old or segment_size bytes long, then compressed
+by a background thread into blocks that are each a gzip member of their own,
+so the file still reads with zcat.  Next to it goes an index of the time
+range, hosts, kinds of event and byte range of every block, and
+catalog.jsonl gets a line with the same for the whole segment.  A query
+reads the catalog, skips every segment and block that cannot hold a match
+and only decompresses the rest.
+
+    python pc_reset_eventlog.py pc_reset_events --since 30d --host rack1-node1 --event recovered
+    python pc_reset_eventlog.py pc_reset_events --since 30d --summary
+"""
+import argparse
+import glob
+import gzip
+import json
+import os
+import queue
+import re
+import sys
+import threading
+import time
+import zlib
+
+CATALOG_NAME = 'catalog.jsonl'
+SEGMENT_PATTERN = re.compile(r'^events-(\d+)\.jsonl$')
+
+# Events of each compressed block.  Small blocks mean less is decompressed
+# for a narrow query, big ones compress better.
+BLOCK_EVENTS = 256
+
+def segment_name(start):
+    return 'events-{:d}.jsonl'.format(int(start * 1000))
+
+def encode(event):
+    return json.dumps(event, separators=(',', ':'), sort_keys=True) + '\n'
+
+def matches(event, start, end, hosts, kinds):
+    """Returns True when an event is within [start, end) and of one of the hosts and kinds, None being any."""
+    return ((start is None or event['time'] >= start) and (end is None or event['time'] < end) and
+            (hosts is None or event.get('host') in hosts) and (kinds is None or event.get('event') in kinds))
+
+def overlaps(first, last, start, end):
+    return (start is None or last >= start) and (end is None or first < end)
+
+def compress_segment(directory, name):
+    """
+    Compresses a closed segment into blocks with an index, adds it to the
+    catalog and removes the raw segment.  Safe to run again after a crash.
+    """
+    raw_path = os.path.join(directory, name)
+    with open(raw_path, 'rb') as raw:
+        events = []
+        for line in raw:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # A line torn by a crash.
+                continue
+
+    blocks = []
+    offset = 0
+    temporary_path = raw_path + '.gz.tmp'
+    with open(temporary_path, 'wb') as compressed:
+        for index in range(0, len(events), BLOCK_EVENTS):
+            block = events[index:index + BLOCK_EVENTS]
+            data = gzip.compress(''.join(encode(event) for event in block).encode('utf-8'))
+            compressed.write(data)
+            times = [event['time'] for event in block]
+            blocks.append([min(times), max(times), offset, len(data),
+                           sorted(set(event.get('host') for event in block if event.get('host') is not None)),
+                           sorted(set(event.get('event') for event in block))])
+            offset += len(data)
+        compressed.flush()
+        os.fsync(compressed.fileno())
+    os.replace(temporary_path, raw_path + '.gz')
+
+    index_path = raw_path + '.idx'
+    with open(index_path + '.tmp', 'w') as index_file:
+        json.dump({'blocks': blocks}, index_file, separators=(',', ':'))
+    os.replace(index_path + '.tmp', index_path)
+
+    hosts = {}
+    kinds = {}
+    for event in events:
+        if event.get('host') is not None:
+            hosts[event['host']] = hosts.get(event['host'], 0) + 1
+        kinds[event.get('event')] = kinds.get(event.get('event'), 0) + 1
+    times = [event['time'] for event in events]
+    entry = {'segment': name,
+             'first': min(times) if times else 0.0,
+             'last': max(times) if times else 0.0,
+             'count': len(events),
+             'hosts': hosts,
+             'kinds': kinds}
+    with open(os.path.join(directory, CATALOG_NAME), 'a') as catalog:
+        catalog.write(json.dumps(entry, separators=(',', ':')) + '\n')
+        catalog.flush()
+        os.fsync(catalog.fileno())
+    os.remove(raw_path)
+
+def read_catalog(directory):
+    """Returns the catalog entry of every compressed segment, oldest first."""
+    entries = {}
+    try:
+        with open(os.path.join(directory, CATALOG_NAME)) as catalog:
+            for line in catalog:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                # A segment compressed twice after a crash is only counted once.
+                entries[entry['segment']] = entry
+    except FileNotFoundError:
+        pass
+    return sorted(entries.values(), key=lambda entry: entry['segment'])
+
+def read_segment(directory, entry, start=None, end=None, hosts=None, kinds=None):
+    """Yields the events of a compressed segment from the blocks that can hold matches."""
+    path = os.path.join(directory, entry['segment'])
+    with open(path + '.idx') as index_file:
+        blocks = json.load(index_file)['blocks']
+    with open(path + '.gz', 'rb') as compressed:
+        for first, last, offset, length, block_hosts, block_kinds in blocks:
+            if not overlaps(first, last, start, end):
+                continue
+            if hosts is not None and not hosts.intersection(block_hosts):
+                continue
+            if kinds is not None and not kinds.intersection(block_kinds):
+                continue
+            compressed.seek(offset)
+            data = zlib.decompress(compressed.read(length), 16 + zlib.MAX_WBITS)
+            for line in data.decode('utf-8').splitlines():
+                yield json.loads(line)
+
+def read_raw(path):
+    """Yields the events of an uncompressed segment, skipping a line torn by a crash."""
+    try:
+        with open(path, 'rb') as raw:
+            for line in raw:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        return
+
+def query(directory, start=None, end=None, hosts=None, kinds=None):
+    """
+    Returns the events within [start, end) of the hosts and kinds given, in
+    time order.  None means no limit.  Reads the log of a running monitor
+    too, including its active segment.
+    """
+    hosts = None if hosts is None else set(hosts)
+    kinds = None if kinds is None else set(kinds)
+    found = []
+
+    compressed = set()
+    for entry in read_catalog(directory):
+        compressed.add(entry['segment'])
+        if not entry['count'] or not overlaps(entry['first'], entry['last'], start, end):
+            continue
+        if hosts is not None and not hosts.intersection(entry['hosts']):
+            continue
+        if kinds is not None and not kinds.intersection(entry['kinds']):
+            continue
+        found.extend(event for event in read_segment(directory, entry, start, end, hosts, kinds)
+                     if matches(event, start, end, hosts, kinds))
+
+    # Segments still waiting to be compressed, and the active one.
+    for path in sorted(glob.glob(os.path.join(directory, 'events-*.jsonl'))):
+        name = os.path.basename(path)
+        if name in compressed or not SEGMENT_PATTERN.match(name):
+            continue
+        found.extend(event for event in read_raw(path) if matches(event, start, end, hosts, kinds))
+
+    found.sort(key=lambda event: event['time'])
+    return found
+
+def summarize(events):
+    """
+    Returns {host: {'restarts': n, 'recoveries': n, 'mean_recovery': s,
+    'max_recovery': s}} from restart and recovered events.
+    """
+    summary = {}
+    for event in events:
+        host = summary.setdefault(event.get('host'), {'restarts': 0, 'recoveries': 0, 'recovery_times': []})
+        if event['event'] == 'restart':
+            host['restarts'] += 1
+        elif event['event'] == 'recovered':
+            host['recoveries'] += 1
+            if event.get('time_to_recovery') is not None:
+                host['recovery_times'].append(event['time_to_recovery'])
+    for host in summary.values():
+        times = host.pop('recovery_times')
+        host['mean_recovery'] = sum(times) / len(times) if times else None
+        host['max_recovery'] = max(times) if times else None
+    return summary
+
+class EventLog(object):
+    """Appends events to the active segment and has closed ones compressed in the background."""
+    def __init__(self, directory, segment_size=1024 * 1024, segment_age=86400.0, clock=time.time):
+        """Segments are closed once they are segment_size bytes or segment_age SECONDS old."""
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.clock = clock
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        # Segments are compressed one at a time by a background thread.
+        self.to_compress = queue.Queue()
+        self.compressor = threading.Thread(target=self.__compress_segments, name='EventLogCompressor',
+                                           daemon=True)
+        self.compressor.start()
+
+        # Segments left behind by a crash are compressed first.
+        compressed = set(entry['segment'] for entry in read_catalog(directory))
+        for path in sorted(glob.glob(os.path.join(directory, 'events-*.jsonl'))):
+            name = os.path.basename(path)
+            if name in compressed:
+                os.remove(path)
+            elif SEGMENT_PATTERN.match(name):
+                self.to_compress.put(name)
+
+        self.file = None
+        self.__open_segment(self.clock())
+
+    def append(self, event, host=None, **fields):
+        """Records an event of a host now, with any other fields."""
+        record = dict(fields, time=self.clock(), event=event)
+        if host is not None:
+            record['host'] = host
+        line = encode(record).encode('utf-8')
+        with self.lock:
+            if self.file is None:
+                return
+            if self.size and (self.size + len(line) > self.segment_size or
+                              record['time'] - self.started >= self.segment_age):
+                self.__close_segment()
+                self.__open_segment(record['time'])
+            self.file.write(line)
+            self.file.flush()
+            self.size += len(line)
+
+    def query(self, start=None, end=None, hosts=None, kinds=None):
+        """See the module's query."""
+        return query(self.directory, start, end, hosts, kinds)
+
+    def rotate(self):
+        """Closes the active segment now, so it is compressed."""
+        with self.lock:
+            if self.file is not None and self.size:
+                self.__close_segment()
+                self.__open_segment(self.clock())
+
+    def flush(self):
+        """Waits until every closed segment has been compressed."""
+        self.to_compress.join()
+
+    def close(self):
+        """Closes the active segment, leaving it to be compressed on the next start, and stops compressing."""
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        self.to_compress.put(None)
+        self.compressor.join()
+
+    def __open_segment(self, start):
+        """Must hold the lock, or be starting up."""
+        name = segment_name(start)
+        # Two segments started in the same millisecond must not share a file.
+        while os.path.exists(os.path.join(self.directory, name)):
+            start += 0.001
+            name = segment_name(start)
+        self.name = name
+        self.started = start
+        self.file = open(os.path.join(self.directory, name), 'ab')
+        self.size = 0
+
+    def __close_segment(self):
+        """Must hold the lock."""
+        self.file.close()
+        self.file = None
+        self.to_compress.put(self.name)
+
+    def __compress_segments(self):
+        while True:
+            name = self.to_compress.get()
+            try:
+                if name is None:
+                    return
+                try:
+                    compress_segment(self.directory, name)
+                except (OSError, ValueError) as error:
+                    sys.stderr.write("Event log segment {} not compressed: {}\n".format(name, error))
+            finally:
+                self.to_compress.task_done()
+
+def parse_time(text, now=None):
+    """Parses a time as SECONDS since the epoch, an ISO date and time, or an age like 30d, 12h or 15m."""
+    now = time.time() if now is None else now
+    match = re.match(r'^(\d+(?:\.\d+)?)([smhd])$', text)
+    if match:
+        return now - float(match.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    import datetime
+    return datetime.datetime.fromisoformat(text).timestamp()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Queries the structured event log of the PC reset monitor.")
+    parser.add_argument('directory', nargs='?', default='pc_reset_events')
+    parser.add_argument('--since', help="start of the time range: epoch seconds, ISO time or an age like 30d")
+    parser.add_argument('--until', help="end of the time range, in the same forms")
+    parser.add_argument('--host', action='append', help="only events of this host, may be repeated")
+    parser.add_argument('--event', action='append', help="only events of this kind, may be repeated")
+    parser.add_argument('--count', action='store_true', help="print the number of events only")
+    parser.add_argument('--summary', action='store_true',
+                        help="print restarts and recovery times per host")
+    args = parser.parse_args(argv)
+
+    try:
+        start = parse_time(args.since) if args.since else None
+        end = parse_time(args.until) if args.until else None
+    except ValueError as error:
+        parser.error(str(error))
+
+    if args.summary:
+        events = query(args.directory, start, end, args.host, ['restart', 'recovered'])
+        print("{:<24}  {:>8}  {:>10}  {:>10}  {:>10}".format('host', 'restarts', 'recovered', 'mean s', 'max s'))
+        for host, figures in sorted(summarize(events).items(), key=lambda item: str(item[0])):
+            print("{:<24}  {:>8}  {:>10}  {:>10}  {:>10}".format(
+                str(host), figures['restarts'], figures['recoveries'],
+                '-' if figures['mean_recovery'] is None else '{:.1f}'.format(figures['mean_recovery']),
+                '-' if figures['max_recovery'] is None else '{:.1f}'.format(figures['max_recovery'])))
+        return 0
+
+    events = query(args.directory, start, end, args.host, args.event)
+    if args.count:
+        print(len(events))
+    else:
+        for event in events:
+            sys.stdout.write(encode(event))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+import gzip
+import json
+import os
+import pytest
+
+import pc_reset_eventlog
+from pc_reset_eventlog import EventLog, main, parse_time, query, summarize
+
+class FakeClock(object):
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture()
+def clock():
+    return FakeClock()
+
+@pytest.fixture()
+def event_log(tmp_path, clock):
+    event_log = EventLog(str(tmp_path), segment_size=4096, clock=clock)
+    yield event_log
+    event_log.close()
+
+def test_events_read_back_in_order(event_log, clock):
+    """Events of the active segment are found straight away."""
+    for index in range(5):
+        event_log.append('restart', 'pc{}'.format(index % 2), reason='auto')
+        clock.now += 10
+
+    events = event_log.query()
+    assert [event['host'] for event in events] == ['pc0', 'pc1', 'pc0', 'pc1', 'pc0']
+    assert [event['time'] for event in events] == [1000.0, 1010.0, 1020.0, 1030.0, 1040.0]
+    assert events[0]['reason'] == 'auto'
+
+def test_full_segment_compressed_and_indexed(event_log, clock, tmp_path):
+    """A segment past its size is compressed into gzip blocks, with an index and a catalog entry."""
+    for _ in range(200):
+        event_log.append('probe_failed', 'pc', fails=1)
+        clock.now += 1
+    event_log.flush()
+
+    catalog = pc_reset_eventlog.read_catalog(str(tmp_path))
+    assert len(catalog) >= 2
+    entry = catalog[0]
+    assert entry['hosts'] == {'pc': entry['count']}
+    assert entry['first'] == 1000.0
+    assert not os.path.exists(str(tmp_path / entry['segment']))
+
+    # Every block is a gzip member, so the whole segment reads with zcat.
+    with gzip.open(str(tmp_path / (entry['segment'] + '.gz')), 'rt') as compressed:
+        assert len(compressed.readlines()) == entry['count']
+
+    assert len(event_log.query()) == 200
+
+def test_query_by_time_host_and_kind(event_log, clock):
+    """Only matching events come back, from compressed and active segments alike."""
+    for index in range(300):
+        event_log.append('restart' if index % 10 == 0 else 'phase', 'pc{}'.format(index % 3))
+        clock.now += 60
+    event_log.rotate()
+    event_log.append('restart', 'pc0')
+    event_log.flush()
+
+    events = event_log.query(1000.0 + 60 * 100, 1000.0 + 60 * 200, hosts=['pc1'], kinds=['restart'])
+    assert [event['time'] for event in events] == [1000.0 + 60 * index for index in range(100, 200)
+                                                   if index % 10 == 0 and index % 3 == 1]
+    assert len(event_log.query(kinds=['restart'], hosts=['pc0'])) == 11
+
+def test_query_reads_only_overlapping_blocks(tmp_path, clock, monkeypatch):
+    """A narrow query does not decompress blocks outside its time range."""
+    monkeypatch.setattr(pc_reset_eventlog, 'BLOCK_EVENTS', 10)
+    event_log = EventLog(str(tmp_path), clock=clock)
+    for _ in range(100):
+        event_log.append('phase', 'pc')
+        clock.now += 1
+    event_log.close()
+    # Compressed when the log is opened again.
+    EventLog(str(tmp_path), clock=clock).close()
+
+    decompressed = []
+    original = pc_reset_eventlog.zlib.decompress
+    monkeypatch.setattr(pc_reset_eventlog.zlib, 'decompress',
+                        lambda data, wbits: decompressed.append(data) or original(data, wbits))
+
+    assert len(query(str(tmp_path), 1025.0, 1035.0)) == 10
+    assert len(decompressed) == 2
+
+def test_segment_closed_once_a_day_old(event_log, clock, tmp_path):
+    """A quiet log still gets a segment per day, so old days are never read for new queries."""
+    event_log.append('restart', 'pc')
+    clock.now += 86400
+    event_log.append('restart', 'pc')
+    event_log.flush()
+
+    catalog = pc_reset_eventlog.read_catalog(str(tmp_path))
+    assert [entry['count'] for entry in catalog] == [1]
+
+def test_torn_line_skipped(tmp_path, clock):
+    """A line cut short by a crash is left out when the segment is compressed."""
+    event_log = EventLog(str(tmp_path), clock=clock)
+    event_log.append('restart', 'pc')
+    event_log.close()
+    with open(str(tmp_path / pc_reset_eventlog.segment_name(1000.0)), 'a') as raw:
+        raw.write('{"time": 10')
+
+    assert [event['event'] for event in query(str(tmp_path))] == ['restart']
+    EventLog(str(tmp_path), clock=clock).close()
+    assert [event['event'] for event in query(str(tmp_path))] == ['restart']
+
+def test_summary_of_recoveries():
+    events = [{'time': 1.0, 'event': 'restart', 'host': 'pc'},
+              {'time': 2.0, 'event': 'recovered', 'host': 'pc', 'time_to_recovery': 90.0},
+              {'time': 3.0, 'event': 'restart', 'host': 'pc'},
+              {'time': 4.0, 'event': 'recovered', 'host': 'pc', 'time_to_recovery': 110.0}]
+
+    assert summarize(events) == {'pc': {'restarts': 2, 'recoveries': 2, 'mean_recovery': 100.0,
+                                        'max_recovery': 110.0}}
+
+def test_parse_time():
+    assert parse_time('30d', now=100 * 86400.0) == 70 * 86400.0
+    assert parse_time('15m', now=1000.0) == 100.0
+    assert parse_time('1234.5') == 1234.5
+
+def test_cli_prints_matching_events(event_log, clock, tmp_path, capsys):
+    event_log.append('restart', 'pc0')
+    event_log.append('restart', 'pc1')
+
+    assert main([str(tmp_path), '--host', 'pc1']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert [json.loads(line)['host'] for line in lines] == ['pc1']
+
+    assert main([str(tmp_path), '--count']) == 0
+    assert capsys.readouterr().out == '2\n'
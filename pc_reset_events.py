@@ -0,0 +1,26 @@
+import threading
+
+class Signal(object):
+    """
+    A minimal replacement for pyqtSignal that needs no Qt.
+
+    Callbacks are called in the thread that emits, in the order they were
+    connected.  A GUI has to move the call onto its own thread itself,
+    which pc_reset_ui does by forwarding to a real pyqtSignal.
+    """
+    def __init__(self):
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    def connect(self, callback):
+        with self.lock:
+            self.callbacks = self.callbacks + [callback]
+
+    def disconnect(self, callback):
+        with self.lock:
+            self.callbacks = [connected for connected in self.callbacks if connected != callback]
+
+    def emit(self, *args):
+        # The list is replaced rather than changed, so it can be walked without the lock.
+        for callback in self.callbacks:
+            callback(*args)
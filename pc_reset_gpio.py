@@ -0,0 +1,255 @@
+"""
+Relays and switches behind one interface, so the monitor runs on more than a Pi.
+
+    [Channel]
+    backend = rpi
+
+Backends are rpi (RPi.GPIO), gpiod (the Linux GPIO character device through
+libgpiod, which drives a whole relay bank in one write) and simulated (in
+memory, for tests and benchmarks on any Linux box).  Channels are BCM pin
+numbers for rpi and line offsets on the chip for gpiod.  A relay closes on
+low output, a switch is pulled down and pressed when it goes high.
+"""
+import threading
+import time
+
+BACKEND_RPI = 'rpi'
+BACKEND_GPIOD = 'gpiod'
+BACKEND_SIMULATED = 'simulated'
+
+# Switch presses closer together than this are bounces (SECONDS).
+SWITCH_BOUNCE_TIME = 0.3
+
+class GpioBackend(object):
+    """Drives the relays and watches the switches."""
+
+    def setup_relays(self, channels):
+        """Makes channels relay outputs, with their relays open."""
+        raise NotImplementedError
+
+    def setup_switches(self, channels, callback):
+        """Watches switch channels, calling callback(channel) from another thread as soon as one is pressed."""
+        raise NotImplementedError
+
+    def remove_switches(self, channels):
+        """Stops watching switch channels."""
+        raise NotImplementedError
+
+    def set_relay(self, channel, closed):
+        """Closes or opens a relay."""
+        self.set_relays({channel: closed})
+
+    def set_relays(self, states):
+        """Closes or opens many relays at once, as {channel: closed}."""
+        for channel, closed in states.items():
+            self.set_relay(channel, closed)
+
+    def close(self):
+        """Opens every relay and lets go of the pins."""
+        pass
+
+class RpiGpioBackend(GpioBackend):
+    """RPi.GPIO on BCM pin numbers."""
+    def __init__(self):
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        # Using BCM mode because I think it is less confusing.
+        GPIO.setmode(GPIO.BCM)
+
+    def setup_relays(self, channels):
+        for channel in sorted(channels):
+            self.GPIO.setup(channel, self.GPIO.OUT)
+            self.GPIO.output(channel, self.GPIO.HIGH)
+
+    def setup_switches(self, channels, callback):
+        for channel in sorted(channels):
+            self.GPIO.setup(channel, self.GPIO.IN, pull_up_down=self.GPIO.PUD_DOWN)
+            self.GPIO.add_event_detect(channel, self.GPIO.RISING, callback=callback,
+                                       bouncetime=int(SWITCH_BOUNCE_TIME * 1000))
+
+    def remove_switches(self, channels):
+        for channel in channels:
+            self.GPIO.remove_event_detect(channel)
+
+    def set_relay(self, channel, closed):
+        self.GPIO.output(channel, self.GPIO.LOW if closed else self.GPIO.HIGH)
+
+    def close(self):
+        self.GPIO.cleanup()
+
+class GpiodBackend(GpioBackend):
+    """
+    The GPIO character device through libgpiod 2.  Every relay is one line
+    of a single request, so a batch of relays is switched with one ioctl.
+    Switch edges are read by a thread of its own.
+    """
+    def __init__(self, chip='/dev/gpiochip0', consumer='pc_reset'):
+        import gpiod
+        self.gpiod = gpiod
+        self.chip = chip
+        self.consumer = consumer
+        self.lock = threading.Lock()
+
+        # Relay channel -> closed, and the request that holds every relay line.
+        self.relays = {}
+        self.relay_request = None
+
+        # Switch channel -> callback, and the request that holds every switch line.
+        self.switches = {}
+        self.switch_request = None
+        self.watcher = None
+        self.stopping = False
+
+    def setup_relays(self, channels):
+        with self.lock:
+            for channel in channels:
+                self.relays.setdefault(channel, False)
+            self.relay_request = self.__request_relays()
+
+    def setup_switches(self, channels, callback):
+        with self.lock:
+            for channel in channels:
+                self.switches[channel] = callback
+            self.switch_request = self.__request_switches()
+        if self.watcher is None:
+            self.watcher = threading.Thread(target=self.__watch, name='GpiodSwitches', daemon=True)
+            self.watcher.start()
+
+    def remove_switches(self, channels):
+        with self.lock:
+            for channel in channels:
+                self.switches.pop(channel, None)
+            self.switch_request = self.__request_switches()
+
+    def set_relays(self, states):
+        Value = self.gpiod.line.Value
+        with self.lock:
+            self.relays.update(states)
+            # Active low, so a closed relay is an active line.
+            self.relay_request.set_values({channel: Value.ACTIVE if closed else Value.INACTIVE
+                                           for channel, closed in states.items()})
+
+    def close(self):
+        self.stopping = True
+        if self.watcher is not None:
+            self.watcher.join()
+        with self.lock:
+            for request in (self.relay_request, self.switch_request):
+                if request is not None:
+                    request.release()
+            self.relay_request = self.switch_request = None
+
+    def __request_relays(self):
+        """Requests every relay line again, keeping the relays as they are.  Must hold the lock."""
+        line = self.gpiod.line
+        if self.relay_request is not None:
+            self.relay_request.release()
+        if not self.relays:
+            return None
+        config = {channel: self.gpiod.LineSettings(direction=line.Direction.OUTPUT, active_low=True,
+                                                    output_value=line.Value.ACTIVE if closed else line.Value.INACTIVE)
+                  for channel, closed in self.relays.items()}
+        return self.gpiod.request_lines(self.chip, consumer=self.consumer, config=config)
+
+    def __request_switches(self):
+        """Requests every switch line again.  Must hold the lock."""
+        import datetime
+        line = self.gpiod.line
+        if self.switch_request is not None:
+            self.switch_request.release()
+        if not self.switches:
+            return None
+        settings = self.gpiod.LineSettings(direction=line.Direction.INPUT, edge_detection=line.Edge.RISING,
+                                           bias=line.Bias.PULL_DOWN,
+                                           debounce_period=datetime.timedelta(seconds=SWITCH_BOUNCE_TIME))
+        return self.gpiod.request_lines(self.chip, consumer=self.consumer, config={tuple(self.switches): settings})
+
+    def __watch(self):
+        """Calls back for every switch press until closed."""
+        while not self.stopping:
+            with self.lock:
+                request = self.switch_request
+                events = (request.read_edge_events()
+                          if request is not None and request.wait_edge_events(0) else [])
+                callbacks = [(self.switches.get(event.line_offset), event.line_offset) for event in events]
+            for callback, channel in callbacks:
+                if callback is not None:
+                    callback(channel)
+            if not callbacks:
+                # The lock is not held while waiting, so relays can be switched meanwhile.
+                time.sleep(0.01)
+
+class SimulatedBackend(GpioBackend):
+    """
+    Relays and switches in memory.  Every relay change is recorded with the
+    time it happened, and press simulates a switch press.
+    """
+    def __init__(self, clock=time.monotonic, listener=None):
+        """Listener(time, channel, closed) is called after every relay change, outside the lock."""
+        self.clock = clock
+        self.listener = listener
+        self.lock = threading.Lock()
+
+        # Relay channel -> closed.
+        self.relays = {}
+        # Switch channel -> callback.
+        self.switches = {}
+        # Every relay change as (time, channel, closed), and how many writes they took.
+        self.changes = []
+        self.writes = 0
+
+    def setup_relays(self, channels):
+        with self.lock:
+            for channel in channels:
+                self.relays[channel] = False
+
+    def setup_switches(self, channels, callback):
+        with self.lock:
+            for channel in channels:
+                self.switches[channel] = callback
+
+    def remove_switches(self, channels):
+        with self.lock:
+            for channel in channels:
+                self.switches.pop(channel, None)
+
+    def set_relays(self, states):
+        with self.lock:
+            now = self.clock()
+            self.writes += 1
+            for channel, closed in states.items():
+                if channel not in self.relays:
+                    raise ValueError("Channel {} is not set up as a relay".format(channel))
+                self.relays[channel] = closed
+                self.changes.append((now, channel, closed))
+        if self.listener is not None:
+            for channel, closed in states.items():
+                self.listener(now, channel, closed)
+
+    def press(self, channel):
+        """Presses a switch, calling its callback on this thread."""
+        with self.lock:
+            callback = self.switches.get(channel)
+        if callback is not None:
+            callback(channel)
+
+    def closed_relays(self):
+        """Returns the channels of the relays that are closed."""
+        with self.lock:
+            return set(channel for channel, closed in self.relays.items() if closed)
+
+    def close(self):
+        with self.lock:
+            for channel in self.relays:
+                self.relays[channel] = False
+            self.switches.clear()
+
+def make_gpio_backend(name, chip='/dev/gpiochip0'):
+    """Returns the GPIO backend called name."""
+    if name == BACKEND_RPI:
+        return RpiGpioBackend()
+    if name == BACKEND_GPIOD:
+        return GpiodBackend(chip)
+    if name == BACKEND_SIMULATED:
+        return SimulatedBackend()
+    raise ValueError("Unknown GPIO backend: {}".format(name))
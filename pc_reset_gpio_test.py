@@ -0,0 +1,82 @@
+import pytest
+import sys
+import types
+
+from pc_reset_gpio import GpiodBackend, RpiGpioBackend, SimulatedBackend, make_gpio_backend
+
+@pytest.fixture()
+def simulated():
+    clock = [10.0]
+    backend = SimulatedBackend(clock=lambda: clock[0])
+    backend.clock_value = clock
+    return backend
+
+def test_simulated_records_relay_changes(simulated):
+    simulated.setup_relays({5, 6})
+    simulated.set_relay(5, True)
+    simulated.clock_value[0] = 13.0
+    simulated.set_relays({5: False, 6: True})
+
+    assert simulated.changes == [(10.0, 5, True), (13.0, 5, False), (13.0, 6, True)]
+    assert simulated.writes == 2
+    assert simulated.closed_relays() == {6}
+
+def test_simulated_rejects_unknown_relay(simulated):
+    with pytest.raises(ValueError):
+        simulated.set_relay(7, True)
+
+def test_simulated_switch_press(simulated):
+    pressed = []
+    simulated.setup_switches({23}, pressed.append)
+
+    simulated.press(23)
+    simulated.remove_switches({23})
+    simulated.press(23)
+
+    assert pressed == [23]
+
+def test_simulated_close_opens_relays(simulated):
+    simulated.setup_relays({5})
+    simulated.set_relay(5, True)
+    simulated.close()
+
+    assert simulated.closed_relays() == set()
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        make_gpio_backend('parport')
+
+def test_rpi_relay_closes_on_low(mocker):
+    """The RPi.GPIO backend drives a closed relay low and watches switches for a rising edge."""
+    gpio = mocker.Mock()
+    rpi = types.ModuleType('RPi')
+    rpi.GPIO = gpio
+    mocker.patch.dict(sys.modules, {'RPi': rpi, 'RPi.GPIO': gpio})
+    callback = mocker.Mock()
+
+    backend = RpiGpioBackend()
+    backend.setup_relays({5})
+    backend.setup_switches({23}, callback)
+    backend.set_relay(5, True)
+
+    gpio.setmode.assert_called_once_with(gpio.BCM)
+    gpio.output.assert_any_call(5, gpio.HIGH)
+    gpio.output.assert_called_with(5, gpio.LOW)
+    gpio.add_event_detect.assert_called_once_with(23, gpio.RISING, callback=callback, bouncetime=300)
+
+def test_gpiod_bank_written_in_one_call(mocker):
+    """The gpiod backend keeps every relay in one request and writes a batch of them together."""
+    gpiod = mocker.Mock()
+    mocker.patch.dict(sys.modules, {'gpiod': gpiod})
+    request = gpiod.request_lines.return_value
+
+    backend = GpiodBackend('/dev/gpiochip1')
+    backend.setup_relays({5, 6, 7})
+    backend.set_relays({5: True, 6: True, 7: False})
+    backend.close()
+
+    assert gpiod.request_lines.call_count == 1
+    assert set(gpiod.request_lines.call_args[1]['config']) == {5, 6, 7}
+    request.set_values.assert_called_once_with({5: gpiod.line.Value.ACTIVE, 6: gpiod.line.Value.ACTIVE,
+                                                7: gpiod.line.Value.INACTIVE})
+    request.release.assert_called_once_with()
@@ -0,0 +1,237 @@
+"""
+Counters and histograms of the monitor, served in the Prometheus text format.
+
+    [Metrics]
+    listen = 127.0.0.1:9464
+
+listen is either HOST:PORT or the path of a Unix socket.  The server runs on
+a thread of its own, and the numbers are only turned into text when they are
+scraped, so recording them on the ping path is a few additions under a lock.
+"""
+import bisect
+import math
+import os
+import socketserver
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets (SECONDS).
+RTT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+PHASE_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Why a restart was triggered.
+RESTART_AUTO = 'auto'
+RESTART_MANUAL = 'manual'
+
+# Parts of the monitor whose running time is counted.
+SECTION_PROBE_LOOP = 'probe_loop'
+SECTION_GPIO = 'gpio'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def escape(value):
+    """Escapes a label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_value(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if not value.is_integer():
+            return repr(value)
+    return str(int(value))
+
+class Histogram(object):
+    """Counts values into fixed buckets.  Only the counts are cumulated, when rendered."""
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        # One count per bucket and one for everything above the last bound.
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        """Returns the lines of the histogram, labels being the 'key="value",' prefix of every label set."""
+        lines = []
+        total = 0
+        for bound, count in zip(self.bounds, self.counts):
+            total += count
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, format_value(bound), total))
+        total += self.counts[-1]
+        lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(name, labels, total))
+        labels = '{' + labels.rstrip(',') + '}' if labels else ''
+        lines.append('{}_sum{} {}'.format(name, labels, format_value(self.sum)))
+        lines.append('{}_count{} {}'.format(name, labels, total))
+        return lines
+
+class HostMetrics(object):
+    """The counters of one PC."""
+    __slots__ = ('sent', 'failed', 'rtt')
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.rtt = Histogram(RTT_BUCKETS)
+
+class MonitorMetrics(object):
+    """
+    Everything the monitor counts.  Safe to update from the ping cycle, the
+    GPIO callbacks and the restart engine at the same time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+
+        # Host name -> HostMetrics.
+        self.hosts = {}
+        # Restarts triggered, by why.
+        self.restarts = {RESTART_AUTO: 0, RESTART_MANUAL: 0}
+        # Restart phase -> Histogram of how long it took.
+        self.phases = {}
+        # Section -> [time spent (SECONDS), times entered].
+        self.sections = {SECTION_PROBE_LOOP: [0.0, 0], SECTION_GPIO: [0.0, 0]}
+        # Values read only when scraped, as (name, type, help, function).
+        self.callbacks = []
+
+    def record_probe(self, name, success, rtt):
+        """Counts a ping of a PC, and its round trip time (SECONDS) when known."""
+        with self.lock:
+            host = self.hosts.get(name)
+            if host is None:
+                host = self.hosts[name] = HostMetrics()
+            host.sent += 1
+            if not success:
+                host.failed += 1
+            elif rtt is not None:
+                host.rtt.observe(rtt)
+
+    def record_restart(self, reason):
+        """Counts a restart that was triggered, either RESTART_AUTO or RESTART_MANUAL."""
+        with self.lock:
+            self.restarts[reason] += 1
+
+    def record_phases(self, phase_durations):
+        """Adds how long each phase of a finished restart took, as {phase: SECONDS}."""
+        with self.lock:
+            for phase, duration in phase_durations.items():
+                histogram = self.phases.get(phase)
+                if histogram is None:
+                    histogram = self.phases[phase] = Histogram(PHASE_BUCKETS)
+                histogram.observe(duration)
+
+    def add_time(self, section, seconds):
+        """Adds time spent in a section of the monitor (SECONDS)."""
+        with self.lock:
+            totals = self.sections[section]
+            totals[0] += seconds
+            totals[1] += 1
+
+    def add_callback(self, name, kind, help_text, function):
+        """Reports the number function returns as a 'counter' or 'gauge' whenever the metrics are scraped."""
+        self.callbacks.append((name, kind, help_text, function))
+
+    def remove_host(self, name):
+        with self.lock:
+            self.hosts.pop(name, None)
+
+    def render(self):
+        """Returns every metric in the Prometheus text format."""
+        lines = []
+        with self.lock:
+            lines += ['# HELP pc_reset_probes_total Pings sent to each PC.',
+                      '# TYPE pc_reset_probes_total counter']
+            lines += ['pc_reset_probes_total{{host="{}"}} {}'.format(escape(name), host.sent)
+                      for name, host in sorted(self.hosts.items())]
+            lines += ['# HELP pc_reset_probe_failures_total Pings that got no reply.',
+                      '# TYPE pc_reset_probe_failures_total counter']
+            lines += ['pc_reset_probe_failures_total{{host="{}"}} {}'.format(escape(name), host.failed)
+                      for name, host in sorted(self.hosts.items())]
+
+            lines += ['# HELP pc_reset_rtt_seconds Round trip time of the pings that got a reply.',
+                      '# TYPE pc_reset_rtt_seconds histogram']
+            for name, host in sorted(self.hosts.items()):
+                lines += host.rtt.render('pc_reset_rtt_seconds', 'host="{}",'.format(escape(name)))
+
+            lines += ['# HELP pc_reset_restarts_total Restarts triggered, automatically or by the switch.',
+                      '# TYPE pc_reset_restarts_total counter']
+            lines += ['pc_reset_restarts_total{{reason="{}"}} {}'.format(reason, count)
+                      for reason, count in sorted(self.restarts.items())]
+
+            lines += ['# HELP pc_reset_restart_phase_seconds Time each phase of a finished restart took.',
+                      '# TYPE pc_reset_restart_phase_seconds histogram']
+            for phase, histogram in sorted(self.phases.items()):
+                lines += histogram.render('pc_reset_restart_phase_seconds', 'phase="{}",'.format(escape(phase)))
+
+            lines += ['# HELP pc_reset_busy_seconds_total Time spent in each part of the monitor.',
+                      '# TYPE pc_reset_busy_seconds_total counter']
+            lines += ['pc_reset_busy_seconds_total{{section="{}"}} {}'.format(section, format_value(totals[0]))
+                      for section, totals in sorted(self.sections.items())]
+            lines += ['# HELP pc_reset_busy_calls_total Times each part of the monitor was entered.',
+                      '# TYPE pc_reset_busy_calls_total counter']
+            lines += ['pc_reset_busy_calls_total{{section="{}"}} {}'.format(section, totals[1])
+                      for section, totals in sorted(self.sections.items())]
+
+        for name, kind, help_text, function in self.callbacks:
+            lines += ['# HELP {} {}'.format(name, help_text),
+                      '# TYPE {} {}'.format(name, kind),
+                      '{} {}'.format(name, format_value(function()))]
+
+        return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Answers GET /metrics with the server's metrics."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """Scrapes are not logged.  A Unix socket client has no address to log anyway."""
+        pass
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class MetricsServer(object):
+    """Serves metrics over HTTP from a background thread."""
+    def __init__(self, metrics, listen):
+        """Listen is HOST:PORT, or the path of a Unix socket when it has a '/' in it."""
+        self.socket_path = None
+        if '/' in listen:
+            self.socket_path = listen
+            if os.path.exists(listen):
+                os.unlink(listen)
+            self.server = UnixHTTPServer(listen, MetricsHandler)
+        else:
+            host, _, port = listen.rpartition(':')
+            self.server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), MetricsHandler)
+            self.server.daemon_threads = True
+        self.server.metrics = metrics
+
+        self.thread = threading.Thread(target=self.server.serve_forever, name='MetricsServer', daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self):
+        return self.server.server_address
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
@@ -0,0 +1,72 @@
+import http.client
+import socket
+import urllib.request
+
+from pc_reset_metrics import (Histogram, MetricsServer, MonitorMetrics, RESTART_MANUAL, SECTION_GPIO,
+                              format_value)
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram((0.001, 0.01))
+    for value in (0.0005, 0.001, 0.005, 0.5):
+        histogram.observe(value)
+
+    assert histogram.render('rtt', 'host="pc",') == ['rtt_bucket{host="pc",le="0.001"} 2',
+                                                     'rtt_bucket{host="pc",le="0.01"} 3',
+                                                     'rtt_bucket{host="pc",le="+Inf"} 4',
+                                                     'rtt_sum{host="pc"} 0.5065',
+                                                     'rtt_count{host="pc"} 4']
+
+def test_format_value():
+    assert format_value(3) == '3'
+    assert format_value(2.0) == '2'
+    assert format_value(0.25) == '0.25'
+    assert format_value(float('inf')) == '+Inf'
+
+def test_render():
+    """Every kind of metric ends up in the text, with labels escaped."""
+    metrics = MonitorMetrics()
+    metrics.record_probe('rack"1', True, 0.002)
+    metrics.record_probe('rack"1', False, None)
+    metrics.record_restart(RESTART_MANUAL)
+    metrics.record_phases({'shutdown_wait': 30.0})
+    metrics.add_time(SECTION_GPIO, 0.5)
+    metrics.add_callback('pc_reset_queue', 'gauge', "Queued.", lambda: 7)
+
+    text = metrics.render()
+
+    assert 'pc_reset_probes_total{host="rack\\"1"} 2\n' in text
+    assert 'pc_reset_probe_failures_total{host="rack\\"1"} 1\n' in text
+    assert 'pc_reset_rtt_seconds_count{host="rack\\"1"} 1\n' in text
+    assert 'pc_reset_restarts_total{reason="manual"} 1\n' in text
+    assert 'pc_reset_restarts_total{reason="auto"} 0\n' in text
+    assert 'pc_reset_restart_phase_seconds_bucket{phase="shutdown_wait",le="30"} 1\n' in text
+    assert 'pc_reset_busy_seconds_total{section="gpio"} 0.5\n' in text
+    assert '# TYPE pc_reset_queue gauge\npc_reset_queue 7\n' in text
+
+def test_served_over_tcp():
+    metrics = MonitorMetrics()
+    metrics.record_probe('pc', True, 0.001)
+    server = MetricsServer(metrics, '127.0.0.1:0')
+    try:
+        host, port = server.address
+        with urllib.request.urlopen('http://{}:{}/metrics'.format(host, port)) as response:
+            assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+            assert b'pc_reset_probes_total{host="pc"} 1' in response.read()
+    finally:
+        server.close()
+
+def test_served_over_unix_socket(tmp_path):
+    path = str(tmp_path / 'metrics.sock')
+    server = MetricsServer(MonitorMetrics(), path)
+    try:
+        connection = http.client.HTTPConnection('localhost')
+        connection.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.sock.connect(path)
+        connection.request('GET', '/metrics')
+        response = connection.getresponse()
+        assert response.status == 200
+        assert b'pc_reset_busy_calls_total' in response.read()
+        connection.close()
+    finally:
+        server.close()
+    assert not (tmp_path / 'metrics.sock').exists()
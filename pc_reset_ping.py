@@ -1,58 +1,475 @@
 import configparser
 import os
-import RPi.GPIO as GPIO
+import re
+import sys
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from my_logger import CustomLogger
-from PyQt5.QtCore import pyqtSignal, QObject, QThread
+from pc_reset_detect import make_detector, ProbeHistory, TraceRecorder
+from pc_reset_eventlog import EventLog
+from pc_reset_events import Signal
+from pc_reset_gpio import make_gpio_backend
+from pc_reset_metrics import (MetricsServer, MonitorMetrics, RESTART_AUTO, RESTART_MANUAL, SECTION_GPIO,
+                              SECTION_PROBE_LOOP)
+from pc_reset_probe import make_prober
+from pc_reset_profile import format_summary, NULL_PROFILER, PROFILE_ENV, Profiler
+from pc_reset_restart import (PHASE_CANCELLED, PHASE_DONE, PHASE_FAILED, PHASE_POWER_OFF_PRESS, PHASE_POWER_ON_PRESS,
+                              PHASE_RECOVERING, PHASE_SHUTDOWN_WAIT, REQUEST_DUPLICATE, REQUEST_LEASE_REFUSED,
+                              REQUEST_QUEUED, REQUEST_RATE_LIMITED, REQUEST_STARTED, RestartEngine,
+                              RestartScheduler)
+from pc_reset_schedule import ProbeScheduler, STATE_HEALTHY, STATE_RECOVERING, STATE_SUSPECT
+from pc_reset_state import StateStore
+from pc_reset_tsdb import TimeSeriesStore
 
-class PingBoy(QObject):
+# Prefix of the config sections that each describe one PC in fleet mode.
+HOST_SECTION_PREFIX = 'Host:'
 
-    sig_pinged_pc = pyqtSignal()
-    sig_restart_in_progress = pyqtSignal()
-    sig_successful_restart = pyqtSignal()
+# Timing values that a host section may override.
+HOST_TIMING_KEYS = ('ping_fails_needed_for_restart', 'wait_before_shutdown', 'hold_power_switch')
 
-    def __init__(self):
-        super(PingBoy, self).__init__()
+# Config values that are only used at start up, so changing them needs a restart.
+STARTUP_ONLY_KEYS = ('probe_backend', 'probe_workers', 'log_asynchronous', 'log_queue_size',
+                     'log_queue_full_policy', 'trace_file', 'state_file', 'history_file',
+                     'history_raw_pings', 'history_minute_buckets', 'history_hour_buckets',
+                     'metrics_listen', 'api_listen', 'event_log_directory', 'event_log_segment_size',
+                     'gpio_backend', 'gpio_chip', 'profile_enabled', 'profile_file', 'profile_summary_interval',
+                     'cluster_node', 'cluster_listen', 'cluster_peers', 'cluster_heartbeat_interval',
+                     'cluster_lease_duration', 'cluster_fence_file')
+
+# Key of the state store record that holds the monitor's own counters.  Host
+# names are never empty so it cannot clash with one.
+MONITOR_STATE_KEY = ''
+
+class ConfigWatcher(object):
+    """
+    Notices when the config file changes.  A stat of the file costs next to
+    nothing once per ping cycle and works everywhere, unlike inotify.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.signature = self.__signature()
+
+    def changed(self):
+        """Returns True once after every change to the file."""
+        signature = self.__signature()
+        if signature == self.signature:
+            return False
+        self.signature = signature
+        return True
+
+    def __signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+def write_config_file(path, updates):
+    """
+    Sets {(section, key): value} in an ini file, keeping its comments and
+    layout.  Keys that are not in the file yet are added to their section.
+    The file is replaced in one go so a reader never sees half of it.
+    """
+    with open(path) as config_file:
+        lines = config_file.read().splitlines()
+
+    remaining = dict(updates)
+    output = []
+    section = None
+
+    def add_remaining(section):
+        """Adds the keys still missing from a section before its trailing blank lines."""
+        blanks = []
+        while output and not output[-1].strip():
+            blanks.append(output.pop())
+        for (key_section, key), value in list(remaining.items()):
+            if key_section == section:
+                output.append("{} = {}".format(key, value))
+                del remaining[(key_section, key)]
+        output.extend(blanks)
+
+    for line in lines:
+        header = re.match(r'\s*\[([^\]]+)\]', line)
+        if header:
+            add_remaining(section)
+            section = header.group(1)
+        else:
+            match = re.match(r'\s*([^#;=\s][^=]*?)\s*=', line)
+            if match and (section, match.group(1)) in remaining:
+                line = "{} = {}".format(match.group(1), remaining.pop((section, match.group(1))))
+        output.append(line)
+    add_remaining(section)
+
+    for section in sorted(set(key_section for key_section, _ in remaining)):
+        output.extend(['', '[{}]'.format(section)])
+        add_remaining(section)
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as config_file:
+        config_file.write('\n'.join(output) + '\n')
+    os.replace(temporary_path, path)
+
+def check_config_values(config_values):
+    """Raises ValueError if a config value is out of range."""
+    positive = ('wait_between_pings', 'confirm_interval', 'recovery_interval', 'probe_timeout',
+                'history_save_interval', 'event_log_segment_size', 'profile_summary_interval',
+                'cluster_heartbeat_interval', 'cluster_lease_duration', 'restart_recovery_timeout',
+                'history_raw_pings', 'history_minute_buckets', 'history_hour_buckets')
+    for key in positive:
+        if config_values[key] <= 0:
+            raise ValueError("{} must be more than 0".format(key))
+    if config_values['restart_max_concurrent'] < 0 or config_values['restart_limit'] < 0:
+        raise ValueError("Restart limits cannot be negative")
+
+    for host_config in config_values['hosts']:
+        if host_config['ping_fails_needed_for_restart'] < 1:
+            raise ValueError("{} ping_fails_needed_for_restart must be at least 1".format(host_config['name']))
+        if host_config['wait_before_shutdown'] < 0 or host_config['hold_power_switch'] <= 0:
+            raise ValueError("{} restart timing out of range".format(host_config['name']))
+
+class MonitoredHost(object):
+    """A single PC that is pinged and restarted through its own relay."""
+    def __init__(self, config):
+        """
+        Config holds the host's name, hostname, relay_channel, switch_channel
+        and timing values.
+        """
+        self.name = config['name']
+        self.config = config
+
+        # Recent pings that the failure detector looks at.
+        self.history = ProbeHistory()
+
+        # When the first ping of the current run of failures was sent.
+        self.first_fail_time = None
+
+        # Flag to indicate when the PC is restarting.
+        self.flag_restarting = False
+
+        # Health checks to run instead of a plain ping, if any are configured.
+        self.check = None
+
+        # The newest ProbeResult of the PC, or None before it is first pinged.
+        self.last_result = None
+
+        # Scheduler clock time until which the PC is left alone for maintenance, or None.
+        self.paused_until = None
+
+    @property
+    def flag_ping_fail_count(self):
+        """Counter to keep track of consecutive ping failures."""
+        return self.history.consecutive_failures
+
+    @flag_ping_fail_count.setter
+    def flag_ping_fail_count(self, count):
+        self.history.consecutive_failures = count
+
+class PingBoy(object):
+    """
+    Pings the PCs and restarts the ones that stop responding.  Nothing here
+    needs Qt, so the monitor can run headless.
+    """
+    def __init__(self, config_file='pc_reset_config.ini', clock=None, log_file='PC_reset_log.log'):
+        """
+        Clock returns the time (SECONDS) that pings and restarts are timed
+        on.  When one is given restarts only move on when
+        restart_engine.run_due is called, so a simulation can run the
+        monitor on virtual time.
+        """
+        self.config_file = config_file
+        self.clock = time.monotonic if clock is None else clock
+
+        # Emitted once per ping cycle with the list of ProbeResults.
+        self.sig_pinged_pc = Signal()
+        # Emitted with the host name when a restart is initiated.
+        self.sig_restart_in_progress = Signal()
+        # Emitted with the host name when a restarted PC responds again.
+        self.sig_successful_restart = Signal()
+        # Emitted with the host name when a PC came back before it was powered on again, or its
+        # restart was given up.
+        self.sig_restart_cancelled = Signal()
+        # Emitted with the new config values whenever the config has been reloaded.
+        self.sig_config_applied = Signal()
+        # Emitted with the host name and phase whenever a restart moves on, from the restart engine's thread.
+        self.sig_restart_phase = Signal()
+
+        # Values set from the GUI that take precedence over the config file,
+        # as {(section, key): value}.  Guarded by config_lock.
+        self.config_overrides = {}
+        self.config_lock = threading.Lock()
+        self.reload_requested = False
 
-        # Create a logger.
-        self.my_logger = CustomLogger("PC_reset_log.log")
-        
         self.get_config_values()
+        check_config_values(self.config_values)
+        self.config_watcher = ConfigWatcher(self.config_file)
+
+        # Times every part of the ping cycle when [Profile] enabled or PC_RESET_PROFILE is set.
+        self.profiler = (Profiler(self.config_values['profile_file'],
+                                  summary_interval=self.config_values['profile_summary_interval'])
+                         if self.config_values['profile_enabled'] else NULL_PROFILER)
+
+        # Create a logger.
+        self.my_logger = CustomLogger(log_file,
+                                      asynchronous=self.config_values['log_asynchronous'],
+                                      queue_size=self.config_values['log_queue_size'],
+                                      full_policy=self.config_values['log_queue_full_policy'])
+        self.my_logger.handler.profiler = self.profiler
+
+        # Prepare the prober used to ping the PCs.
+        self.prober = make_prober(self.config_values['probe_backend'],
+                                  self.config_values['probe_timeout'],
+                                  self.my_logger.logger)
+
+        # Counters and timings of the monitor, served to Prometheus when [Metrics] listen is set.
+        self.metrics = MonitorMetrics()
+
+        # Held while a restart is requested so the switch callbacks and the
+        # ping cycle never start the same restart twice.
+        self.restart_lock = threading.RLock()
+        # Set under the restart lock once closing, so a late switch press starts nothing.
+        self.closing = False
+
+        self.__init_hosts()
         self.__init_GPIO()
-        self.__init_flags()
 
-        # Prepare the thread that will restart the PC.
-        self.restart_thread = RestartThread(self.config_values['relay_channel'],
-                                            self.config_values['hold_power_switch'],
-                                            self.config_values['wait_before_shutdown'])
+        # Power cycles every PC that needs restarting from a single thread.
+        self.restart_engine = RestartEngine(self.__set_relay, clock=self.clock, background=clock is None,
+                                            set_relays=self.__set_relays)
 
-    def __init_flags(self):
-        """Initializes flags that are used when monitoring pings and restarting the PC."""
-        # Counter to keep track of consecutive ping failures.
-        self.flag_ping_fail_count = 0
+        # Keeps a rack that went down together from being powered on all at once.
+        self.restart_scheduler = RestartScheduler(self.restart_engine, self.__restart_phase,
+                                                  self.config_values['restart_max_concurrent'],
+                                                  self.config_values['restart_stagger'],
+                                                  self.config_values['restart_recovery_timeout'],
+                                                  self.config_values['restart_limit'],
+                                                  self.config_values['restart_limit_period'])
 
-        # Flags to indicate when the PC is restarting.
-        self.flag_restarting = False
+        # Restarts, detections and pauses of every PC, kept for good in a form that is quick to query.
+        self.event_log = None
+        if self.config_values['event_log_directory']:
+            try:
+                self.event_log = EventLog(self.config_values['event_log_directory'],
+                                          self.config_values['event_log_segment_size'])
+            except OSError as error:
+                self.my_logger.logger.error("Event log not kept: {}".format(error))
+
+        # Shares the fleet with other monitors when [Cluster] node is set.  Running alone
+        # would power cycle PCs another node owns, so a node that cannot join does not start.
+        self.cluster = None
+        # Names of the PCs this node watches, worked out again whenever the cluster's members change.
+        self.owned_names = set()
+        self.cluster_version = None
+        if self.config_values['cluster_node']:
+            from pc_reset_cluster import ClusterNode, parse_peers
+            try:
+                self.cluster = ClusterNode(self.config_values['cluster_node'],
+                                           self.config_values['cluster_listen'],
+                                           parse_peers(self.config_values['cluster_peers']),
+                                           self.config_values['cluster_heartbeat_interval'],
+                                           self.config_values['cluster_lease_duration'],
+                                           self.config_values['cluster_fence_file'] or None)
+            except (OSError, ValueError) as error:
+                self.my_logger.logger.error("Cluster not joined: {}".format(error))
+                self.restart_scheduler.close()
+                self.my_logger.close()
+                raise
+            self.cluster.sig_members_changed.connect(self.__members_changed)
+            self.cluster.sig_lease_lost.connect(self.__lease_lost)
+
+        # Counters shown by the GUI, kept in the state store with everything else.
+        self.successful_restarts = 0
+        self.last_restart_time = None
+
+        # Keeps fail counts and restarts in progress across a crash or reboot of the Pi.
+        self.state_store = (StateStore(self.config_values['state_file'])
+                            if self.config_values['state_file'] else None)
+        self.__resume_state()
+
+        # Round trip times, lost pings and restarts of every PC, saved every history_save_interval.
+        self.history_store = None
+        if self.config_values['history_file']:
+            self.history_store = TimeSeriesStore(self.config_values['history_raw_pings'],
+                                                 self.config_values['history_minute_buckets'],
+                                                 self.config_values['history_hour_buckets'])
+            self.__load_history(self.config_values['history_file'])
+        self.history_saved_at = time.monotonic()
+
+        # Pings to many PCs are sent concurrently so a cycle only takes as long as the slowest one.
+        self.probe_pool = ThreadPoolExecutor(max_workers=self.config_values['probe_workers'])
+
+        # Decides from the recent pings of a PC whether it is down.
+        self.detector = make_detector(self.config_values['detector'],
+                                      self.config_values['detector_window'],
+                                      self.config_values['loss_threshold'],
+                                      self.config_values['phi_threshold'])
+
+        # Optionally record every ping so detectors can be compared on it later.
+        self.trace_recorder = (TraceRecorder(self.config_values['trace_file'])
+                               if self.config_values['trace_file'] else None)
+
+        self.metrics.add_callback('pc_reset_log_write_seconds_total', 'counter',
+                                  "Time spent writing the log file.",
+                                  lambda: self.my_logger.handler.busy_seconds)
+        self.metrics.add_callback('pc_reset_restart_queue_depth', 'gauge',
+                                  "Restarts waiting for a free slot.",
+                                  lambda: self.restart_scheduler.queue_depth())
+        if self.cluster is not None:
+            self.metrics.add_callback('pc_reset_cluster_members', 'gauge',
+                                      "Monitors of the cluster that are up.",
+                                      lambda: len(self.cluster.members))
+            self.metrics.add_callback('pc_reset_cluster_leader', 'gauge',
+                                      "1 while this monitor hands out the relay leases.",
+                                      lambda: int(self.cluster.is_leader()))
+        self.metrics_server = None
+        if self.config_values['metrics_listen']:
+            try:
+                self.metrics_server = MetricsServer(self.metrics, self.config_values['metrics_listen'])
+            except (OSError, ValueError) as error:
+                self.my_logger.logger.error("Metrics not served: {}".format(error))
+
+        # Lets scripts ask for status and restarts.  Asyncio is only loaded when it is enabled.
+        self.control_api = None
+        if self.config_values['api_listen']:
+            from pc_reset_api import ControlApi
+            try:
+                self.control_api = ControlApi(self, self.config_values['api_listen'])
+            except (OSError, ValueError) as error:
+                self.my_logger.logger.error("Control API not served: {}".format(error))
+
+    def __init_hosts(self):
+        """Creates the state that is kept for every monitored PC."""
+        self.hosts = [MonitoredHost(host_config) for host_config in self.config_values['hosts']]
+        self.hosts_by_name = {host.name: host for host in self.hosts}
+
+        # PCs with health checks are checked on an asyncio loop instead of just pinged.
+        self.check_runner = None
+        for host in self.hosts:
+            host.check = self.__parse_checks(host.config['checks'])
+        self.__start_check_runner()
+
+        # Decides when each PC is pinged next.  Every PC is due straight away.
+        self.scheduler = ProbeScheduler(self.config_values['wait_between_pings'],
+                                        self.config_values['confirm_interval'],
+                                        self.config_values['recovery_interval'],
+                                        clock=self.clock)
+        for host in self.hosts:
+            self.scheduler.add(host.name)
+
+    def __resume_state(self):
+        """
+        Picks up where the monitor left off before it last stopped.  A PC that
+        was being restarted is not powered off again.  If its power switch had
+        been pressed to shut it down the rest of the shutdown wait is sat out,
+        and if it had already been powered on it is only waited for.
+        """
+        if self.state_store is None:
+            return
+
+        monitor = self.state_store.get(MONITOR_STATE_KEY)
+        self.successful_restarts = monitor.get('successful_restarts', 0)
+        self.last_restart_time = monitor.get('last_restart_time')
+
+        names = set(self.hosts_by_name)
+        for name in self.state_store.keys():
+            if name != MONITOR_STATE_KEY and name not in names:
+                self.state_store.delete(name)
+
+        now = time.time()
+        for host in self.hosts:
+            state = self.state_store.get(host.name)
+            host.flag_ping_fail_count = state.get('fails', 0)
+            if not state.get('restarting'):
+                continue
+
+            hostname = host.config['hostname']
+            if self.cluster is not None:
+                # Its relay lease has run out, so the restart is left to whichever node owns the PC now.
+                self.my_logger.logger.warning("{} was being restarted when the monitor stopped, "
+                                   "leaving it to the cluster.".format(hostname))
+                self.__save_state(host.name, True, fails=0, restarting=False, phase=None)
+                continue
+
+            phase = state.get('phase')
+            # The Pi's clock may have been set back while it was off.
+            elapsed = max(0.0, now - state.get('phase_started', now))
+            with self.restart_lock:
+                host.flag_restarting = True
+                if phase in (PHASE_POWER_OFF_PRESS, PHASE_SHUTDOWN_WAIT):
+                    self.my_logger.logger.warning("{} was being shut down when the monitor stopped, "
+                                       "waiting for it before powering it on.".format(hostname))
+                    self.restart_engine.resume(host.name, host.config['relay_channel'],
+                                               host.config['hold_power_switch'],
+                                               host.config['wait_before_shutdown'], PHASE_SHUTDOWN_WAIT,
+                                               elapsed if phase == PHASE_SHUTDOWN_WAIT else 0.0)
+                elif phase in (PHASE_POWER_ON_PRESS, PHASE_RECOVERING):
+                    self.my_logger.logger.warning("{} was being restarted when the monitor stopped, "
+                                       "waiting for it to respond.".format(hostname))
+                    self.restart_engine.resume(host.name, host.config['relay_channel'],
+                                               host.config['hold_power_switch'],
+                                               host.config['wait_before_shutdown'], PHASE_RECOVERING,
+                                               elapsed if phase == PHASE_RECOVERING else 0.0)
+                else:
+                    # The restart had not started yet, so ask for it again.
+                    self.my_logger.logger.warning("{} was waiting to be restarted when the monitor stopped."
+                                       .format(hostname))
+                    self.__restart(host, self.clock())
+
+    def __save_state(self, name, durable=False, **fields):
+        """Records state that has to survive a crash, if there is a state store."""
+        if self.state_store is not None:
+            self.state_store.update(name, durable, **fields)
+
+    def __parse_checks(self, checks):
+        """Returns the health check for a check expression, or None to just ping."""
+        if not checks:
+            return None
+        # Asyncio is slow to import so it is only loaded when checks are configured.
+        from pc_reset_checks import parse_checks
+        return parse_checks(checks, self.prober)
+
+    def __start_check_runner(self):
+        """Starts the loop that runs health checks once any PC has them."""
+        if self.check_runner is None and any(host.check for host in self.hosts):
+            from pc_reset_checks import CheckRunner
+            self.check_runner = CheckRunner()
 
     def __init_GPIO(self):
-        """Initializes the Raspberry Pi GPIO pins."""
-        # Using BCM mode because I think it is less confusing.
-        GPIO.setmode(GPIO.BCM)
+        """Initializes the relay and switch channels through the configured GPIO backend."""
+        self.gpio = make_gpio_backend(self.config_values['gpio_backend'], self.config_values['gpio_chip'])
+
+        self.__setup_channels(*self.__channels(self.config_values['hosts']))
+
+    def __channels(self, host_configs):
+        """Returns the sets of relay and switch channels used by the hosts."""
+        return (set(host_config['relay_channel'] for host_config in host_configs),
+                set(host_config['switch_channel'] for host_config in host_configs))
 
-        # This output drives the relay.  The relay is always opened initially.
-        GPIO.setup(self.config_values['relay_channel'], GPIO.OUT)
-        GPIO.output(self.config_values['relay_channel'], GPIO.HIGH)
+    def __setup_channels(self, relay_channels, switch_channels):
+        """Sets up GPIO channels that are not in use yet."""
+        # These outputs drive the relays.  The relays are always opened initially.
+        if relay_channels:
+            self.gpio.setup_relays(relay_channels)
 
-        # This input detects a switch press.  The switch is normally low.
-        GPIO.setup(self.config_values['switch_channel'], GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-        GPIO.add_event_detect(self.config_values['switch_channel'], GPIO.RISING, bouncetime=300)
+        # These inputs detect a switch press.  The switches are normally low.
+        # A press calls switch_pressed straight away from the GPIO thread.
+        if switch_channels:
+            self.gpio.setup_switches(switch_channels, self.switch_pressed)
 
     def get_config_values(self):
         """Obtains initial values for configurable inputs from an .ini file."""
         # Read the config file.
         config_parser = configparser.RawConfigParser()
-        config_parser.read('pc_reset_config.ini')
+        config_parser.read(self.config_file)
+
+        # Values set from the GUI win over the file.
+        with self.config_lock:
+            overrides = dict(self.config_overrides)
+        for (section, key), value in overrides.items():
+            if not config_parser.has_section(section):
+                config_parser.add_section(section)
+            config_parser.set(section, key, value)
 
         self.config_values = {}
 
@@ -76,9 +493,34 @@ class PingBoy(QObject):
                                                     'hold_power_switch',
                                                     fallback=3))
 
+        # Delay between pings once a ping has failed, to confirm the PC is down quickly (SECONDS).
+        self.config_values['confirm_interval'] = float(config_parser.get('Timing',
+                                                    'confirm_interval',
+                                                    fallback=self.config_values['wait_between_pings']))
+
+        # Delay between pings while a PC is restarting (SECONDS).
+        self.config_values['recovery_interval'] = float(config_parser.get('Timing',
+                                                    'recovery_interval',
+                                                    fallback=self.config_values['wait_between_pings']))
+
+        # Time to wait for a ping reply before it counts as failed (SECONDS).
+        self.config_values['probe_timeout'] = float(config_parser.get('Timing',
+                                                    'probe_timeout',
+                                                    fallback=1))
+
+        # How pings are sent, either 'icmp' (in process) or 'subprocess' (ping command).
+        self.config_values['probe_backend'] = config_parser.get('Comm',
+                                            'probe_backend',
+                                            fallback='icmp')
+
+        # Maximum number of pings that are in flight at the same time.
+        self.config_values['probe_workers'] = int(config_parser.get('Comm',
+                                            'probe_workers',
+                                            fallback=32))
+
         # Address of the PC to ping.
         self.config_values['hostname'] = config_parser.get('Comm',
-                                        'hostname', 
+                                        'hostname',
                                         fallback=None)
 
         # Channel that the relay is connected to.  Relay closes on low output.
@@ -91,109 +533,972 @@ class PingBoy(QObject):
                                                 'switch_channel',
                                                 fallback=23))
 
+        # Write log messages from a background thread instead of on the ping path.
+        self.config_values['log_asynchronous'] = config_parser.getboolean('Logging',
+                                                'asynchronous',
+                                                fallback=False)
+
+        # Number of log messages that can wait for the background thread.
+        self.config_values['log_queue_size'] = int(config_parser.get('Logging',
+                                                'queue_size',
+                                                fallback=1000))
+
+        # Either 'drop' log messages or 'block' the caller when the queue is full.
+        self.config_values['log_queue_full_policy'] = config_parser.get('Logging',
+                                                    'queue_full_policy',
+                                                    fallback='drop')
+
+        # How a PC is declared down: 'consecutive', 'loss' or 'phi'.
+        self.config_values['detector'] = config_parser.get('Detect',
+                                        'detector',
+                                        fallback='consecutive')
+
+        # Number of recent pings the 'loss' detector looks at.
+        self.config_values['detector_window'] = int(config_parser.get('Detect',
+                                                'window',
+                                                fallback=8))
+
+        # Fraction of recent pings that must fail for the 'loss' detector.
+        self.config_values['loss_threshold'] = float(config_parser.get('Detect',
+                                                'loss_threshold',
+                                                fallback=0.5))
+
+        # Suspicion level at which the 'phi' detector declares a PC down.
+        self.config_values['phi_threshold'] = float(config_parser.get('Detect',
+                                                'phi_threshold',
+                                                fallback=8))
+
+        # CSV file every ping is appended to for replaying later.  Empty to disable.
+        self.config_values['trace_file'] = config_parser.get('Detect',
+                                            'trace_file',
+                                            fallback='')
+
+        # Journal that fail counts and restarts in progress are kept in.  Empty to disable.
+        self.config_values['state_file'] = config_parser.get('State',
+                                            'file',
+                                            fallback='')
+
+        # Binary file the ping and restart history is kept in.  Empty to not keep any history.
+        self.config_values['history_file'] = config_parser.get('History',
+                                            'file',
+                                            fallback='')
+
+        # Newest pings of each PC kept exactly in the history.
+        self.config_values['history_raw_pings'] = int(config_parser.get('History',
+                                                'raw_pings',
+                                                fallback=2048))
+
+        # Minute and hour buckets of each PC kept in the history, a day and a month by default.
+        self.config_values['history_minute_buckets'] = int(config_parser.get('History',
+                                                    'minute_buckets',
+                                                    fallback=1440))
+        self.config_values['history_hour_buckets'] = int(config_parser.get('History',
+                                                    'hour_buckets',
+                                                    fallback=720))
+
+        # Time between saves of the history file (SECONDS).
+        self.config_values['history_save_interval'] = float(config_parser.get('History',
+                                                    'save_interval',
+                                                    fallback=300))
+
+        # Directory the structured event log is kept in.  Empty to not keep one.
+        self.config_values['event_log_directory'] = config_parser.get('EventLog',
+                                                    'directory',
+                                                    fallback='')
+
+        # Size an event log segment grows to before it is compressed (BYTES).
+        self.config_values['event_log_segment_size'] = int(config_parser.get('EventLog',
+                                                        'segment_size',
+                                                        fallback=1048576))
+
+        # Whether to time every part of the ping cycle and every restart phase.
+        self.config_values['profile_enabled'] = config_parser.getboolean('Profile',
+                                                'enabled',
+                                                fallback=False)
+
+        # Chrome trace-event JSON file the timings are written to.  Empty to only log their summary.
+        self.config_values['profile_file'] = config_parser.get('Profile',
+                                            'file',
+                                            fallback='pc_reset_profile.json')
+
+        # Time between summaries of the timings in the log (SECONDS).
+        self.config_values['profile_summary_interval'] = float(config_parser.get('Profile',
+                                                        'summary_interval',
+                                                        fallback=60))
+
+        # PC_RESET_PROFILE turns profiling on without editing the config, naming the file unless it is just 1.
+        profile_env = os.environ.get(PROFILE_ENV, '')
+        if profile_env and profile_env != '0':
+            self.config_values['profile_enabled'] = True
+            if profile_env != '1':
+                self.config_values['profile_file'] = profile_env
+
+        # HOST:PORT or Unix socket path the metrics are served on.  Empty to not serve them.
+        self.config_values['metrics_listen'] = config_parser.get('Metrics',
+                                                'listen',
+                                                fallback='')
+
+        # HOST:PORT or Unix socket path the control API listens on.  Empty to not serve it.
+        self.config_values['api_listen'] = config_parser.get('Api',
+                                            'listen',
+                                            fallback='')
+
+        # Name of this monitor in its cluster.  Empty to watch every PC alone.
+        self.config_values['cluster_node'] = config_parser.get('Cluster',
+                                            'node',
+                                            fallback='')
+
+        # HOST:PORT the cluster's datagrams are received on.
+        self.config_values['cluster_listen'] = config_parser.get('Cluster',
+                                            'listen',
+                                            fallback='')
+
+        # The other monitors of the cluster as name=HOST:PORT, separated by commas.
+        self.config_values['cluster_peers'] = config_parser.get('Cluster',
+                                            'peers',
+                                            fallback='')
+
+        # Time between heartbeats to the other monitors (SECONDS).
+        self.config_values['cluster_heartbeat_interval'] = float(config_parser.get('Cluster',
+                                                        'heartbeat_interval',
+                                                        fallback=1))
+
+        # Time the leader and relay leases last without being renewed (SECONDS).
+        self.config_values['cluster_lease_duration'] = float(config_parser.get('Cluster',
+                                                    'lease_duration',
+                                                    fallback=10))
+
+        # File every monitor sees that fences the relays across the cluster.  Empty to fence only this one.
+        self.config_values['cluster_fence_file'] = config_parser.get('Cluster',
+                                                'fence_file',
+                                                fallback='')
+
+        # How the relays and switches are driven: 'rpi', 'gpiod' or 'simulated'.
+        self.config_values['gpio_backend'] = config_parser.get('Channel',
+                                            'backend',
+                                            fallback='rpi')
+
+        # GPIO character device used by the 'gpiod' backend.
+        self.config_values['gpio_chip'] = config_parser.get('Channel',
+                                        'chip',
+                                        fallback='/dev/gpiochip0')
+
+        # Maximum number of PCs that are restarted at the same time.  0 for no limit.
+        self.config_values['restart_max_concurrent'] = int(config_parser.get('Restart',
+                                                        'max_concurrent',
+                                                        fallback=0))
+
+        # Minimum time between the start of two restarts (SECONDS).
+        self.config_values['restart_stagger'] = float(config_parser.get('Restart',
+                                                'stagger',
+                                                fallback=0))
+
+        # Time a restarted PC has to respond before its restart is given up, so it
+        # stops counting against max_concurrent and may be restarted again (SECONDS).
+        self.config_values['restart_recovery_timeout'] = float(config_parser.get('Restart',
+                                                        'recovery_timeout',
+                                                        fallback=300))
+
+        # Number of times a PC may be restarted within limit_period.  0 for no limit.
+        self.config_values['restart_limit'] = int(config_parser.get('Restart',
+                                                'limit',
+                                                fallback=0))
+
+        # Period that restarts are counted over for the limit (SECONDS).
+        self.config_values['restart_limit_period'] = float(config_parser.get('Restart',
+                                                    'limit_period',
+                                                    fallback=3600))
+
+        # Every PC that is monitored.
+        self.config_values['hosts'] = self.get_host_configs(config_parser)
+
         return self.config_values
 
+    def get_host_configs(self, config_parser):
+        """
+        Returns the config of every monitored PC.
+
+        In fleet mode each PC has its own [Host:<name>] section.  Without any
+        host sections the single PC from [Comm] and [Channel] is monitored.
+        """
+        host_sections = [section for section in config_parser.sections()
+                         if section.startswith(HOST_SECTION_PREFIX)]
+
+        if not host_sections:
+            host_config = {'name': self.config_values['hostname'],
+                           'hostname': self.config_values['hostname'],
+                           'relay_channel': self.config_values['relay_channel'],
+                           'switch_channel': self.config_values['switch_channel'],
+                           'checks': config_parser.get('Comm', 'checks', fallback=''),
+                           'check_timeout': float(config_parser.get('Comm', 'check_timeout',
+                                                  fallback=self.config_values['probe_timeout'])),
+                           'restart_priority': 0,
+                           'depends_on': ()}
+            for key in HOST_TIMING_KEYS:
+                host_config[key] = self.config_values[key]
+            return [host_config]
+
+        host_configs = []
+        for section in host_sections:
+            name = section[len(HOST_SECTION_PREFIX):].strip()
+            host_config = {'name': name,
+                           'hostname': config_parser.get(section, 'hostname', fallback=name),
+                           'relay_channel': int(config_parser.get(section, 'relay_channel')),
+                           'switch_channel': int(config_parser.get(section, 'switch_channel')),
+                           # Health check expression, empty to just ping the PC.
+                           'checks': config_parser.get(section, 'checks', fallback=''),
+                           # Time each health check has to pass (SECONDS).
+                           'check_timeout': float(config_parser.get(section, 'check_timeout',
+                                                  fallback=self.config_values['probe_timeout'])),
+                           # PCs with a higher priority are restarted first.
+                           'restart_priority': int(config_parser.get(section, 'restart_priority',
+                                                   fallback=0)),
+                           # Names of the PCs that must finish restarting before this one starts.
+                           'depends_on': tuple(name.strip() for name in
+                                               config_parser.get(section, 'depends_on', fallback='').split(',')
+                                               if name.strip())}
+
+            # Timing values default to the ones in [Timing].
+            for key in HOST_TIMING_KEYS:
+                host_config[key] = int(config_parser.get(section, key,
+                                                         fallback=self.config_values[key]))
+            host_configs.append(host_config)
+
+        return host_configs
+
     def close(self):
         """Can use this to force anything that needs to be done before exiting."""
-        GPIO.cleanup()
+        if self.control_api is not None:
+            self.control_api.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        # No switch press may reach the restart scheduler or state store once they are closed.
+        self.gpio.remove_switches(self.__channels(self.config_values['hosts'])[1])
+        with self.restart_lock:
+            self.closing = True
+        if self.cluster is not None:
+            self.cluster.close()
+        # Restarts in progress are abandoned with their relays open.
+        self.restart_scheduler.close()
+        self.probe_pool.shutdown(wait=True)
+        if self.check_runner is not None:
+            self.check_runner.close()
+        self.prober.close()
+        if self.trace_recorder is not None:
+            self.trace_recorder.close()
+        if self.state_store is not None:
+            self.state_store.close()
+        self.__save_history()
+        if self.event_log is not None:
+            self.event_log.close()
+        self.gpio.close()
+        try:
+            self.profiler.close()
+        except OSError as error:
+            self.my_logger.logger.error("Profile not saved: {}".format(error))
+
+        # Make sure every queued log message reaches the file.
+        self.my_logger.close()
+
+    def request_config_update(self, overrides, save=False):
+        """
+        Asks for {(section, key): value} to be applied at the start of the
+        next ping cycle.  With save the values are also written to the
+        config file, otherwise they only last until the monitor stops.
+        """
+        with self.config_lock:
+            if save:
+                write_config_file(self.config_file, overrides)
+                for key in overrides:
+                    self.config_overrides.pop(key, None)
+            else:
+                self.config_overrides.update(overrides)
+            self.reload_requested = True
+
+    def request_reload(self):
+        """Asks for the config file to be read again at the start of the next ping cycle."""
+        with self.config_lock:
+            self.reload_requested = True
+
+    def reload_config(self):
+        """
+        Reads the config again and applies it to the running monitor.  Fail
+        counts, histories and restarts in progress are kept.  Nothing is
+        changed if the new config is not valid.  Returns True when applied.
+        """
+        old_values = self.config_values
+        try:
+            new_values = self.get_config_values()
+            check_config_values(new_values)
+
+            # Parse the checks first so a bad expression changes nothing.
+            old_checks = {host.name: (host.config['checks'], host.check) for host in self.hosts}
+            checks = {}
+            for host_config in new_values['hosts']:
+                old_spec, old_check = old_checks.get(host_config['name'], (None, None))
+                checks[host_config['name']] = (old_check if host_config['checks'] == old_spec
+                                               else self.__parse_checks(host_config['checks']))
+        except (ValueError, configparser.Error) as error:
+            self.config_values = old_values
+            self.my_logger.logger.error("Config not applied: {}".format(error))
+            return False
+
+        with self.restart_lock:
+            self.__apply_config(old_values, new_values, checks)
+        self.my_logger.logger.info("Config reloaded.")
+        self.sig_config_applied.emit(new_values)
+        return True
+
+    def __apply_config(self, old_values, new_values, checks):
+        """Pushes new config values into the scheduler, detector, restart scheduler and hosts."""
+        for key in STARTUP_ONLY_KEYS:
+            if old_values[key] != new_values[key]:
+                self.my_logger.logger.warning("{} changed, restart the monitor to apply it.".format(key))
+
+        self.scheduler.set_intervals(new_values['wait_between_pings'],
+                                     new_values['confirm_interval'],
+                                     new_values['recovery_interval'])
+        self.detector = make_detector(new_values['detector'],
+                                      new_values['detector_window'],
+                                      new_values['loss_threshold'],
+                                      new_values['phi_threshold'])
+        self.restart_scheduler.configure(new_values['restart_max_concurrent'],
+                                         new_values['restart_stagger'],
+                                         new_values['restart_recovery_timeout'],
+                                         new_values['restart_limit'],
+                                         new_values['restart_limit_period'])
+
+        # PCs that are no longer in the config stop being monitored.
+        names = set(host_config['name'] for host_config in new_values['hosts'])
+        for host in self.hosts:
+            if host.name not in names:
+                self.scheduler.remove(host.name)
+                self.restart_scheduler.cancel(host.name)
+                if self.state_store is not None:
+                    self.state_store.delete(host.name)
+                if self.history_store is not None:
+                    self.history_store.remove(host.name)
+                self.metrics.remove_host(host.name)
+
+        # Existing PCs keep their state, new ones are pinged straight away.
+        hosts = []
+        for host_config in new_values['hosts']:
+            host = self.hosts_by_name.get(host_config['name'])
+            if host is None:
+                host = MonitoredHost(host_config)
+                self.scheduler.add(host.name)
+            host.config = host_config
+            host.check = checks[host.name]
+            hosts.append(host)
+        self.hosts = hosts
+        self.hosts_by_name = {host.name: host for host in hosts}
+        # Checks that were replaced or removed keep no connections open.
+        if self.check_runner is not None:
+            self.check_runner.prune(host.check for host in hosts if host.check is not None)
+        self.__start_check_runner()
+        # New PCs are shared out on the next ping cycle.
+        self.cluster_version = None
+
+        old_relays, old_switches = self.__channels(old_values['hosts'])
+        new_relays, new_switches = self.__channels(new_values['hosts'])
+        if old_switches - new_switches:
+            self.gpio.remove_switches(old_switches - new_switches)
+        self.__setup_channels(new_relays - old_relays, new_switches - old_switches)
+
+    def time_until_next_ping(self):
+        """Returns the time until the next PC is due to be pinged (SECONDS), or None."""
+        return self.scheduler.time_until_next()
 
     def ping(self):
         """
-        Handles the pinging of the remote PC, initiating a restart,
-        and confirming a successful restart.
-        """ 
-        # I am not going to ping or look for the switch input if the thread
-        # that restarts the PC is running.
-        if(not self.restart_thread.isRunning()):
-            request_restart = False
-            
-            # Ping the PC.
-            response = os.system("ping -c 1 " + self.config_values['hostname'])
-            self.sig_pinged_pc.emit()
-        
-            # We are restarting the PC.
-            if (self.flag_restarting == True):
-                # Ping succeeded so assume that the restart was successful.
-                if(response == 0):
+        Handles the pinging of the remote PCs that are due, initiating restarts,
+        and confirming successful restarts.
+        """
+        profiler = self.profiler
+
+        # Config changes are applied between ping cycles so a cycle never sees half of them.
+        with self.config_lock:
+            reload = self.reload_requested
+            self.reload_requested = False
+        if self.config_watcher.changed() or reload:
+            with profiler.span('cycle.reload_config'):
+                self.reload_config()
+
+        # PCs that are being restarted are still pinged, so a PC that comes
+        # back during the shutdown wait is not powered on again.
+        with profiler.span('cycle.schedule'):
+            if self.cluster is not None:
+                self.__rebalance()
+            hosts = self.__unpaused(self.__owned([self.hosts_by_name[name] for name in self.scheduler.due()]))
+        if not hosts:
+            return
+        started = time.perf_counter()
+
+        # The due PCs are out of the schedule until they are put back, so
+        # whatever goes wrong in the cycle every one of them is put back.
+        unscheduled = {host.name: host for host in hosts}
+        try:
+            with profiler.span('cycle', hosts=len(hosts)):
+                # Ping the PCs.
+                with profiler.span('cycle.probe', hosts=len(hosts)):
+                    results = self.__probe_hosts(hosts)
+                with profiler.span('cycle.signal'):
+                    self.sig_pinged_pc.emit(results)
+
+                now = self.scheduler.clock()
+                sent_at = time.time()
+                with profiler.span('cycle.record'):
+                    for host, result in zip(hosts, results):
+                        if self.trace_recorder is not None:
+                            self.trace_recorder.record(now, host.name, result.success, result.rtt)
+                        if self.history_store is not None:
+                            self.history_store.add(host.name, sent_at, result.success, result.rtt)
+                        self.metrics.record_probe(host.name, result.success, result.rtt)
+                        host.last_result = result
+                with profiler.span('cycle.handle'):
+                    for host, result in zip(hosts, results):
+                        # One PC that cannot be handled does not stop the others being handled.
+                        try:
+                            with self.restart_lock:
+                                request_restart = self.__handle_result(host, result, now)
+                            # Handle any pending restart requests.
+                            if request_restart:
+                                self.__request_restart(host, self.clock(), RESTART_AUTO)
+                        except Exception:
+                            self.my_logger.logger.exception("{} ping not handled."
+                                                            .format(host.config['hostname']))
+                        self.scheduler.schedule(host.name, self.__schedule_state(host), now)
+                        del unscheduled[host.name]
+        finally:
+            for host in unscheduled.values():
+                self.scheduler.schedule(host.name, self.__schedule_state(host))
+        self.metrics.add_time(SECTION_PROBE_LOOP, time.perf_counter() - started)
+
+        if time.monotonic() - self.history_saved_at >= self.config_values['history_save_interval']:
+            with profiler.span('cycle.save_history'):
+                self.__save_history()
+
+        self.__report_profile()
+
+    def host_status(self, window=None):
+        """
+        Returns a dict per PC of its name, hostname, consecutive fails,
+        whether it is restarting and in which phase, whether it is paused and
+        for how many more seconds (None until resumed) and its newest ping.
+        With a window (SECONDS) its history over that window is added.
+        """
+        now = self.scheduler.clock()
+        statuses = []
+        with self.restart_lock:
+            for host in self.hosts:
+                machine = self.restart_engine.active(host.name)
+                result = host.last_result
+                status = {'name': host.name,
+                          'hostname': host.config['hostname'],
+                          'fails': host.flag_ping_fail_count,
+                          'restarting': host.flag_restarting,
+                          'phase': machine.phase if machine is not None else None,
+                          'paused': host.paused_until is not None and now < host.paused_until,
+                          'owner': self.cluster.owner(host.name) if self.cluster is not None else None,
+                          'pause_left': (host.paused_until - now if host.paused_until is not None and
+                                         now < host.paused_until < float('inf') else None),
+                          'last_result': (None if result is None else
+                                          {'success': result.success, 'rtt': result.rtt, 'error': result.error})}
+                statuses.append(status)
+        if window is not None:
+            for status in statuses:
+                status['history'] = self.query_history(status['name'], window)
+        return statuses
+
+    def restart_host(self, name):
+        """
+        Restarts a PC as if its switch was pressed.  Returns the request
+        status, REQUEST_DUPLICATE when its restart is queued or its relay is
+        being cycled.  Raises KeyError for an unknown PC.
+        """
+        host = self.hosts_by_name[name]
+        self.my_logger.logger.info("{} remote restart request.".format(host.config['hostname']))
+        return self.__request_restart(host, self.clock(), RESTART_MANUAL)
+
+    def cancel_restart(self, name):
+        """
+        Stops a queued or running restart of a PC, opening its relay.
+        Returns False when it was not restarting.  Raises KeyError for an
+        unknown PC.
+        """
+        host = self.hosts_by_name[name]
+        with self.restart_lock:
+            if not host.flag_restarting:
+                return False
+            self.restart_scheduler.cancel(name)
+            self.my_logger.logger.info("{} restart cancelled on request.".format(host.config['hostname']))
+            self.__log_event('cancel_requested', name)
+            host.flag_restarting = False
+            self.__release_relay(host)
+            host.history.clear()
+            self.__save_state(host.name, True, fails=0, restarting=False, phase=None)
+        self.sig_restart_cancelled.emit(name)
+        return True
+
+    def pause(self, names=None, duration=None):
+        """
+        Stops pinging and restarting PCs, all of them when names is None,
+        for duration (SECONDS) or until resumed.  Raises KeyError for an
+        unknown PC.
+        """
+        hosts = self.hosts if names is None else [self.hosts_by_name[name] for name in names]
+        until = float('inf') if duration is None else self.scheduler.clock() + duration
+        for host in hosts:
+            host.paused_until = until
+            self.my_logger.logger.info("{} paused for maintenance.".format(host.config['hostname']))
+            self.__log_event('paused', host.name, duration=duration)
+
+    def resume(self, names=None):
+        """
+        Ends the pause of PCs, all of them when names is None, from their
+        next ping.  Raises KeyError for an unknown PC.
+        """
+        hosts = self.hosts if names is None else [self.hosts_by_name[name] for name in names]
+        # The ping cycle owns the scheduler, so it is left to notice the pause has ended.
+        now = self.scheduler.clock()
+        for host in hosts:
+            if host.paused_until is not None:
+                host.paused_until = now
+
+    def query_history(self, name, window, end=None):
+        """
+        Summarizes the pings of a PC over the last window (SECONDS) up to end,
+        or now, None when no history is kept.  See TimeSeriesStore.query.
+        """
+        if self.history_store is None:
+            return None
+        end = time.time() if end is None else end
+        return self.history_store.query(name, end - window, end)
+
+    def history_points(self, name, start, end):
+        """
+        Returns the pings of a PC within [start, end) for drawing, None when
+        no history is kept.  See TimeSeriesStore.points.
+        """
+        if self.history_store is None:
+            return None
+        return self.history_store.points(name, start, end)
+
+    def query_events(self, start=None, end=None, names=None, kinds=None):
+        """
+        Returns the logged events within [start, end) (SECONDS since the
+        epoch) of the PCs and kinds given, None being any, oldest first.
+        See pc_reset_eventlog.query.
+        """
+        if self.event_log is None:
+            return []
+        return self.event_log.query(start, end, names, kinds)
+
+    def __log_event(self, event, name, **fields):
+        """Adds an event of a PC to the event log, if there is one."""
+        if self.event_log is not None:
+            self.event_log.append(event, name, **fields)
+
+    def __report_profile(self):
+        """Logs the timings of the last summary interval once it is over, and writes the trace file."""
+        try:
+            summary = self.profiler.report()
+        except OSError as error:
+            self.my_logger.logger.error("Profile not saved: {}".format(error))
+            return
+        if summary:
+            for line in format_summary(summary):
+                self.my_logger.logger.info("Profile: {}".format(line))
+
+    def __load_history(self, path):
+        """
+        Reads the history file.  One that cannot be read is moved aside
+        rather than overwritten by the next save.
+        """
+        try:
+            self.history_store.load(path)
+        except (OSError, ValueError) as error:
+            try:
+                os.replace(path, path + '.old')
+            except OSError:
+                self.my_logger.logger.warning("History not loaded: {}".format(error))
+            else:
+                self.my_logger.logger.warning("History not loaded, the file is kept as {}: {}"
+                                   .format(path + '.old', error))
+
+    def __save_history(self):
+        """Writes the ping and restart history to its file, if there is one."""
+        self.history_saved_at = time.monotonic()
+        if self.history_store is None:
+            return
+        try:
+            self.history_store.save(self.config_values['history_file'])
+        except OSError as error:
+            self.my_logger.logger.error("History not saved: {}".format(error))
+
+    def switch_pressed(self, channel):
+        """
+        Called by the GPIO event thread when a manual switch is pressed.
+        Restarts every PC wired to that switch unless its relay is already
+        being cycled.
+        """
+        requested_at = self.clock()
+        for host in self.hosts:
+            if self.closing:
+                return
+            if host.config['switch_channel'] != channel:
+                continue
+            hostname = host.config['hostname']
+            self.my_logger.logger.info("{} manual restart request.".format(hostname))
+            if self.__request_restart(host, requested_at, RESTART_MANUAL) == REQUEST_DUPLICATE:
+                self.my_logger.logger.info("{} manual restart request ignored, already restarting."
+                                .format(hostname))
+
+    def __request_restart(self, host, requested_at, reason):
+        """
+        Restarts a PC unless its restart is queued or its relay is being
+        cycled, which returns REQUEST_DUPLICATE.  On a RESTART_MANUAL request
+        a PC that is only being waited for after its power cycle, perhaps
+        because it failed to boot, is power cycled again.
+
+        In a cluster the lease on the PC's relay is taken first.  That waits
+        on the leader, so it is done before the restart lock is taken and the
+        PC's state is looked at again under the lock.
+        """
+        if self.cluster is not None and self.cluster.acquire(host.config['relay_channel']) is None:
+            self.my_logger.logger.warning("{} relay is leased to another node or no leader is known, "
+                               "not restarting it.".format(host.config['hostname']))
+            self.__log_event('lease_refused', host.name, reason=reason)
+            return REQUEST_LEASE_REFUSED
+
+        # A PC that is already restarting keeps the lease, it was taken for that restart.
+        with self.restart_lock:
+            if host.flag_restarting:
+                machine = self.restart_engine.active(host.name)
+                if reason != RESTART_MANUAL or machine is None or machine.phase != PHASE_RECOVERING:
+                    return REQUEST_DUPLICATE
+                self.restart_scheduler.cancel(host.name)
+                host.flag_restarting = False
+            return self.__restart(host, requested_at, reason)
+
+    def __rebalance(self):
+        """
+        Works out which PCs this node watches once the cluster's members
+        have changed.  PCs it has just taken over are pinged straight away,
+        starting with a clean history.
+        """
+        version = self.cluster.version
+        if version == self.cluster_version:
+            return
+        self.cluster_version = version
+        owned = set(name for name in self.hosts_by_name if self.cluster.owns(name))
+        for name in owned - self.owned_names:
+            self.hosts_by_name[name].history.clear()
+            self.scheduler.add(name)
+        self.owned_names = owned
+        self.my_logger.logger.info("Watching {} of {} PCs.".format(len(owned), len(self.hosts)))
+
+    def __owned(self, hosts):
+        """
+        Returns the due hosts this node watches, which is all of them
+        outside a cluster.  A PC this node is restarting is watched until
+        the restart is over, whoever owns it now.
+        """
+        if self.cluster is None:
+            return hosts
+        now = self.scheduler.clock()
+        owned = []
+        for host in hosts:
+            if host.name in self.owned_names or host.flag_restarting:
+                owned.append(host)
+            else:
+                self.scheduler.schedule(host.name, STATE_HEALTHY, now)
+        return owned
+
+    def __members_changed(self, members):
+        """Called from the cluster's thread.  The ping cycle shares the PCs out again."""
+        self.my_logger.logger.info("Cluster members: {}.".format(', '.join(members)))
+
+    def __lease_lost(self, channel):
+        """
+        Called from the cluster's thread when the lease on a relay ran out
+        mid restart.  The restart is abandoned, so another node can take it on.
+        """
+        for host in self.hosts:
+            if host.config['relay_channel'] != channel:
+                continue
+            with self.restart_lock:
+                if not host.flag_restarting:
+                    continue
+                self.restart_scheduler.cancel(host.name)
+                self.my_logger.logger.warning("{} restart abandoned, the lease on its relay ran out."
+                                   .format(host.config['hostname']))
+                self.__log_event('lease_lost', host.name)
+                host.flag_restarting = False
+                host.history.clear()
+                self.__save_state(host.name, True, fails=0, restarting=False, phase=None)
+            self.sig_restart_cancelled.emit(host.name)
+
+    def __release_relay(self, host):
+        """Gives up the lease on a PC's relay once its restart is over, if in a cluster."""
+        if self.cluster is not None:
+            self.cluster.release(host.config['relay_channel'])
+
+    def __unpaused(self, hosts):
+        """
+        Returns the due hosts that are not paused.  Paused ones are looked at
+        again when their pause ends, with their fail count cleared.
+        """
+        now = self.scheduler.clock()
+        unpaused = []
+        for host in hosts:
+            if host.paused_until is None:
+                unpaused.append(host)
+            elif now < host.paused_until:
+                self.scheduler.schedule(host.name, STATE_HEALTHY, now)
+            else:
+                host.paused_until = None
+                with self.restart_lock:
+                    if not host.flag_restarting:
+                        host.history.clear()
+                        self.__save_state(host.name, fails=0)
+                self.my_logger.logger.info("{} resumed.".format(host.config['hostname']))
+                self.__log_event('resumed', host.name)
+                unpaused.append(host)
+        return unpaused
+
+    def __schedule_state(self, host):
+        """Returns the state that decides how soon a host is pinged again."""
+        if host.flag_restarting:
+            return STATE_RECOVERING
+        if host.flag_ping_fail_count > 0:
+            return STATE_SUSPECT
+        return STATE_HEALTHY
+
+    def __probe_hosts(self, hosts):
+        """
+        Checks every host concurrently and returns the results in the same order.
+        Hosts with health checks have them run while the others are pinged.
+        """
+        checked = [index for index, host in enumerate(hosts) if host.check is not None]
+        if not checked:
+            return self.__ping_hosts(hosts)
+
+        future = self.check_runner.submit([(hosts[index].check, hosts[index].config['hostname'],
+                                            hosts[index].config['check_timeout']) for index in checked])
+
+        results = [None] * len(hosts)
+        pinged = [index for index, host in enumerate(hosts) if host.check is None]
+        if pinged:
+            for index, result in zip(pinged, self.__ping_hosts([hosts[index] for index in pinged])):
+                results[index] = result
+        for index, result in zip(checked, future.result()):
+            results[index] = result
+        return results
+
+    def __ping_hosts(self, hosts):
+        """Pings every host concurrently and returns the results in the same order."""
+        if len(hosts) == 1:
+            return [self.prober.probe(hosts[0].config['hostname'])]
+
+        # The ICMP prober can ping every host from one socket in a single sweep.
+        if hasattr(self.prober, 'sweep'):
+            return self.prober.sweep([host.config['hostname'] for host in hosts])
+
+        return list(self.probe_pool.map(lambda host: self.prober.probe(host.config['hostname']),
+                                        hosts))
+
+    def __handle_result(self, host, result, now):
+        """
+        Updates the state of a host from the result of its ping.  Returns
+        True when the host is down and has to be restarted.
+        """
+        request_restart = False
+        hostname = host.config['hostname']
+        response = result.code
+
+        # We are restarting the PC.
+        if (host.flag_restarting == True):
+            # Ping succeeded so assume that the restart was successful.
+            if(response == 0):
+                phase = self.restart_scheduler.host_responded(host.name)
+                if phase in (None, PHASE_DONE):
                     self.my_logger.logger.info("{} successfully restarted! Response = {}"
-                                   .format(self.config_values['hostname'], response))
-                    self.flag_restarting = False
-                    self.flag_ping_fail_count = 0
-                    self.sig_successful_restart.emit()
-                
-                # Ping failed so just log a message to track how long it takes to restart.
-                else:
-                    self.my_logger.logger.info("{} is restarting but not back yet. Response = {}"
-                                    .format(self.config_values['hostname'], response))
-            # We are not restarting.
+                                   .format(hostname, response))
+                    host.flag_restarting = False
+                    host.history.clear()
+                    self.__release_relay(host)
+                    self.successful_restarts += 1
+                    self.last_restart_time = time.time()
+                    self.__save_state(host.name, True, fails=0, restarting=False, phase=None)
+                    self.__save_state(MONITOR_STATE_KEY, True, successful_restarts=self.successful_restarts,
+                                      last_restart_time=self.last_restart_time)
+                    self.sig_successful_restart.emit(host.name)
+
+                # The PC came back by itself before it was powered on again.
+                elif phase == PHASE_CANCELLED:
+                    self.my_logger.logger.info("{} responded before it was powered on again, restart cancelled."
+                                   .format(hostname))
+                    host.flag_restarting = False
+                    host.history.clear()
+                    self.__release_relay(host)
+                    self.__save_state(host.name, True, fails=0, restarting=False, phase=None)
+                    self.sig_restart_cancelled.emit(host.name)
+
+                # Otherwise the power switch is still being held or the PC has not gone down yet.
+
+            # Ping failed so just log a message to track how long it takes to restart.
             else:
-                # The ping failed.
-                if(response != 0):
-                    self.flag_ping_fail_count += 1
-                    # Do not restart the PC until the ping fails enough times consecutively.
-                    if (self.flag_ping_fail_count < self.config_values['ping_fails_needed_for_restart']):
-                        self.my_logger.logger.error("{} did not respond! Response = {} Consecutive fails = {}"
-                                        .format(self.config_values['hostname'], response, self.flag_ping_fail_count))
-                                               
-                    # The ping has failed enough times consecutively so restart the PC.
-                    else:
-                        request_restart = True
-                        self.my_logger.logger.error("{} is down, requesting auto restart! Response = {}"
-                                        .format(self.config_values['hostname'], response))
-                        
-                # The ping succeeded so reset the consecutive number of failures.
+                self.restart_scheduler.host_failed(host.name)
+                self.my_logger.logger.info("{} is restarting but not back yet. Response = {}"
+                                .format(hostname, response))
+        # We are not restarting.
+        else:
+            # A successful ping resets the consecutive number of failures.
+            host.history.add(now, response == 0, result.rtt)
+            # Only written when the count changes, so healthy PCs cost no writes.
+            self.__save_state(host.name, fails=host.flag_ping_fail_count)
+
+            # The ping failed.
+            if(response != 0):
+                if host.flag_ping_fail_count == 1:
+                    host.first_fail_time = now
+                # Do not restart the PC until the failure detector says it is down.
+                if not self.detector.is_down(host.history, now, host.config['ping_fails_needed_for_restart']):
+                    self.my_logger.logger.error("{} did not respond! Response = {} Consecutive fails = {}"
+                                    .format(hostname, response, host.flag_ping_fail_count))
+
+                # The ping has failed enough times so restart the PC.
                 else:
-                    self.flag_ping_fail_count = 0
-
-            # Request a restart of the PC if the manual switch was pressed.
-            if GPIO.event_detected(self.config_values['switch_channel']):
-                request_restart = True
-                self.my_logger.logger.info("{} manual restart request.".format(self.config_values['hostname']))
-
-            # Handle any pending restart requests.
-            if(request_restart == True):
-                self.restart_thread.start()
-                self.my_logger.logger.info("{} is restarting!".format(self.config_values['hostname']))
-                self.flag_restarting = True
-                self.sig_restart_in_progress.emit()
-                
-
-
-class RestartThread(QThread):
-    """Thread used to restart a PC via the power switch."""
-    def __init__(self, relay_channel, hold_power_switch, wait_before_shutdown):
-        QThread.__init__(self)
-        self.relay_channel = relay_channel
-        self.hold_power_switch = hold_power_switch
-        self.wait_before_shutdown = wait_before_shutdown
-        
-    def __del__(self):
-        self.wait()
-
-    def run(self):    
-        # Close relay to initiate power down.
-        GPIO.output(self.relay_channel, GPIO.LOW)
-        time.sleep(self.hold_power_switch)
-        GPIO.output(self.relay_channel, GPIO.HIGH)
-
-        # Wait a while to give the PC some time to shutdown.
-        time.sleep(self.wait_before_shutdown)
-
-        # Close the relay to initiate power up.
-        GPIO.output(self.relay_channel, GPIO.LOW)
-        time.sleep(self.hold_power_switch)
-        GPIO.output(self.relay_channel, GPIO.HIGH)
+                    request_restart = True
+                    self.my_logger.logger.error("{} is down, requesting auto restart! Response = {}"
+                                    .format(hostname, response))
 
-if __name__ == '__main__':
-    try:
-        my_pingboy = PingBoy()
+                    time_to_detect = None
+                    if host.first_fail_time is not None:
+                        time_to_detect = now - host.first_fail_time
+                        self.scheduler.record_detection(time_to_detect)
+                        self.my_logger.logger.debug("{} detected down {:.1f} seconds after the first failed ping."
+                                        .format(hostname, time_to_detect))
+                    self.__log_event('down', host.name, fails=host.flag_ping_fail_count,
+                                     time_to_detect=time_to_detect)
 
-        while True:
-            # This executes a ping then waits before repeating it again.
-            my_pingboy.ping()
-            time.sleep(my_pingboy.config_values['wait_between_pings'])
+        return request_restart
 
-    except KeyboardInterrupt:
-        GPIO.cleanup()
+    def __restart(self, host, requested_at, reason=RESTART_AUTO):
+        """
+        Asks for a PC to be restarted, either RESTART_AUTO or RESTART_MANUAL.
+        Must be called with the restart lock held and, in a cluster, the
+        lease on the PC's relay.
+        """
+        hostname = host.config['hostname']
+        status = self.restart_scheduler.request(host.name, host.config['relay_channel'],
+                                                host.config['hold_power_switch'],
+                                                host.config['wait_before_shutdown'], requested_at,
+                                                host.config['restart_priority'], host.config['depends_on'],
+                                                reason == RESTART_MANUAL)
+        if status == REQUEST_RATE_LIMITED:
+            self.my_logger.logger.warning("{} has been restarted too often, not restarting it again yet."
+                               .format(hostname))
+            self.__log_event('rate_limited', host.name, reason=reason)
+            self.__release_relay(host)
+            return status
+
+        self.metrics.record_restart(reason)
+        if status == REQUEST_QUEUED:
+            self.my_logger.logger.info("{} restart queued, {} restarts waiting."
+                            .format(hostname, self.restart_scheduler.queue_depth()))
+        else:
+            self.my_logger.logger.info("{} is restarting!".format(hostname))
+        host.flag_restarting = True
+        self.__save_state(host.name, True, restarting=True)
+        if self.history_store is not None:
+            self.history_store.add_restart(host.name, time.time())
+        self.__log_event('restart', host.name, reason=reason, status=status)
+        self.sig_restart_in_progress.emit(host.name)
+        return status
+
+    def __set_relay(self, relay_channel, closed):
+        """Closes or opens a relay.  The relay closes on low output."""
+        if self.cluster is not None and not self.__fenced({relay_channel: closed}):
+            return
+        started = time.perf_counter()
+        with self.profiler.span('gpio.set_relays', relays=1):
+            self.gpio.set_relay(relay_channel, closed)
+        self.metrics.add_time(SECTION_GPIO, time.perf_counter() - started)
+
+    def __set_relays(self, states):
+        """Closes or opens many relays in one go, as {channel: closed}."""
+        if self.cluster is not None:
+            states = self.__fenced(states)
+            if not states:
+                return
+        started = time.perf_counter()
+        with self.profiler.span('gpio.set_relays', relays=len(states)):
+            self.gpio.set_relays(states)
+        self.metrics.add_time(SECTION_GPIO, time.perf_counter() - started)
+
+    def __fenced(self, states):
+        """Returns the relay changes allowed by the cluster's leases and fence, logging the rest."""
+        allowed, refused = self.cluster.fenced(states)
+        for channel in refused:
+            self.my_logger.logger.error("Relay {} not closed, this node no longer holds its lease."
+                             .format(channel))
+        return allowed
+
+    def __restart_phase(self, machine, phase):
+        """Logs and records the progress of a restart.  Called from the restart engine's thread."""
+        host = self.hosts_by_name.get(machine.name)
+        if host is None:
+            return
+        hostname = host.config['hostname']
 
-        print("\nHe be gone, he be outta here!")
+        # Finished restarts are recorded when the PC's ping is handled.
+        if phase in (PHASE_DONE, PHASE_CANCELLED, PHASE_FAILED):
+            self.metrics.record_phases(machine.phase_durations)
+            self.profiler.record_phases(machine.name, machine.phase_durations)
+        else:
+            # Phases are timed on the engine's clock, which does not survive a reboot of the Pi.
+            phase_started = time.time() - (self.restart_engine.clock() - machine.phase_started_at)
+            self.__save_state(machine.name, True, phase=phase, phase_started=phase_started)
+
+        if phase == PHASE_POWER_OFF_PRESS:
+            self.my_logger.logger.info("{} relay closed {:.1f} ms after the restart was requested."
+                            .format(hostname, machine.relay_latency() * 1000))
+        elif phase == PHASE_DONE:
+            self.my_logger.logger.info("{} recovered {:.1f} seconds after the restart began. Phases: {}"
+                            .format(hostname, machine.time_to_recovery,
+                                    ', '.join('{} {:.1f} s'.format(name, duration)
+                                              for name, duration in machine.phase_durations.items())))
+        elif phase == PHASE_FAILED:
+            self.my_logger.logger.error("{} did not respond within {:.0f} seconds of being powered on again, "
+                             "it may be restarted again.".format(hostname, machine.phase_durations[PHASE_RECOVERING]))
+        else:
+            self.my_logger.logger.debug("{} restart phase {}.".format(hostname, phase))
+
+        # A PC that never came back is no longer restarting, so the next failed pings restart it again.
+        if phase == PHASE_FAILED:
+            with self.restart_lock:
+                host.flag_restarting = False
+                host.history.clear()
+                self.__release_relay(host)
+                self.__save_state(host.name, True, fails=0, restarting=False, phase=None)
+
+        if phase == PHASE_DONE:
+            self.__log_event('recovered', machine.name, time_to_recovery=machine.time_to_recovery,
+                             phases=machine.phase_durations)
+        elif phase == PHASE_CANCELLED:
+            self.__log_event('cancelled', machine.name, phases=machine.phase_durations)
+        elif phase == PHASE_FAILED:
+            self.__log_event('failed', machine.name, phases=machine.phase_durations)
+        else:
+            self.__log_event('phase', machine.name, phase=phase)
+        self.sig_restart_phase.emit(machine.name, phase)
+        if phase == PHASE_FAILED:
+            self.sig_restart_cancelled.emit(host.name)
+
+
+
+if __name__ == '__main__':
+    import pc_reset_daemon
+    sys.exit(pc_reset_daemon.main())
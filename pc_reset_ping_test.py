@@ -1,7 +1,16 @@
+import json
+import os
 import pytest
 import pc_reset_ping
+import pc_reset_restart
+import shutil
+import threading
+import time
 
-from pc_reset_ping import PingBoy
+from pc_reset_ping import PingBoy, write_config_file
+from pc_reset_detect import LossRatioDetector
+from pc_reset_probe import IcmpProber, ProbeResult, SubprocessProber
+from unittest.mock import ANY, Mock
 
 @pytest.fixture(autouse=True)
 def mock_my_logger(pingboy, mocker):
@@ -24,41 +33,43 @@ def mock_ping_fail(mocker):
     return mock_os_system
 
 @pytest.fixture(autouse=True)
-def mock_restart_thread(pingboy, mocker):
-    """Mocks the thread that restarts the PC.  It defaults to thread not running."""
-    mock_thread = mocker.patch.object(pingboy, 'restart_thread')
-    mock_thread.isRunning.return_value = False
-    return mock_thread
+def mock_restart_scheduler(pingboy, mocker):
+    """Mocks the scheduler that restarts the PC.  It defaults to restarts starting straight away."""
+    mock_scheduler = mocker.patch.object(pingboy, 'restart_scheduler')
+    mock_scheduler.request.return_value = pc_reset_restart.REQUEST_STARTED
+    mock_scheduler.host_responded.return_value = None
+    return mock_scheduler
 
 @pytest.fixture()
-def mock_switch_event_detected(mocker):
-    """Mocks the manual switch input.  It defaults to switch pressed."""
-    mock_event = mocker.patch('RPi.GPIO.event_detected')
-    mock_event.return_value = True
-    return mock_event
-
-@pytest.fixture(autouse=True)
-def mock_switch_event_not_detected(mocker):
-    """Mocks the manual switch input.  It defaults to switch not pressed."""
-    mock_event = mocker.patch('RPi.GPIO.event_detected')
-    mock_event.return_value = False
-    return mock_event
+def work_dir(tmp_path, monkeypatch):
+    """
+    Runs in an empty directory with the default config on simulated GPIO,
+    so no test sees state saved by another.
+    """
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pc_reset_config.ini'), str(tmp_path))
+    write_config_file(str(tmp_path / 'pc_reset_config.ini'), {('Channel', 'backend'): 'simulated'})
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
 
 @pytest.yield_fixture()
-def pingboy():
+def pingboy(work_dir):
     """Creates a default PingBoy for each test to use."""
     pingboy = PingBoy()
 
     # Default values.
     pingboy.config_values['wait_between_pings'] = 5
-    pingboy.config_values['ping_fails_needed_for_restart'] = 4
-    pingboy.config_values['wait_before_shutdown'] = 30
-    pingboy.config_values['hold_power_switch'] = 3
-    pingboy.config_values['hostname'] = "192.168.1.39"
-    pingboy.config_values['relay_channel'] = 5
-    pingboy.config_values['switch_channel'] = 5
-    pingboy.flag_ping_fail_count = 0
-    pingboy.flag_restarting = False
+    host = pingboy.hosts[0]
+    host.config['ping_fails_needed_for_restart'] = 4
+    host.config['wait_before_shutdown'] = 30
+    host.config['hold_power_switch'] = 3
+    host.config['hostname'] = "192.168.1.39"
+    host.config['relay_channel'] = 5
+    host.config['switch_channel'] = 5
+    host.flag_ping_fail_count = 0
+    host.flag_restarting = False
+
+    # Use the ping command so that os.system can be mocked.
+    pingboy.prober = SubprocessProber()
 
     # Waits here until test is done.
     yield pingboy
@@ -66,96 +77,101 @@ def pingboy():
     # Force GPIO cleanup.
     pingboy.close()
 
+@pytest.fixture()
+def host(pingboy):
+    """The single PC monitored by the default PingBoy."""
+    return pingboy.hosts[0]
+
 def test_ping_occurs(pingboy, mock_ping_succeed):
     """Confirms that a ping occurs."""
     pingboy.ping()
 
     mock_ping_succeed.assert_called_once_with('ping -c 1 192.168.1.39')
 
-def test_ping_restart_successful_log(pingboy, mock_my_logger):
+def test_ping_restart_successful_log(pingboy, host, mock_my_logger):
     """A successful ping occurs during a restart."""
-    pingboy.flag_ping_fail_count = 99
-    pingboy.flag_restarting = True
+    host.flag_ping_fail_count = 99
+    host.flag_restarting = True
 
     pingboy.ping()
     
     mock_my_logger.logger.info.assert_called_once_with(
         "192.168.1.39 successfully restarted! Response = 0")
-    assert pingboy.flag_ping_fail_count == 0
-    assert pingboy.flag_restarting == False
+    assert host.flag_ping_fail_count == 0
+    assert host.flag_restarting == False
 
-def test_ping_restart_successful_flag_ping_fail_count(pingboy):
+def test_ping_restart_successful_flag_ping_fail_count(pingboy, host):
     """A successful ping occurs during a restart."""
-    pingboy.flag_ping_fail_count = 99
-    pingboy.flag_restarting = True
+    host.flag_ping_fail_count = 99
+    host.flag_restarting = True
 
     pingboy.ping()
     
-    assert pingboy.flag_ping_fail_count == 0
-    assert pingboy.flag_restarting == False
+    assert host.flag_ping_fail_count == 0
+    assert host.flag_restarting == False
 
-def test_ping_restart_successful_flag_restarting(pingboy):
+def test_ping_restart_successful_flag_restarting(pingboy, host):
     """A successful ping occurs during a restart."""
-    pingboy.flag_ping_fail_count = 99
-    pingboy.flag_restarting = True
+    host.flag_ping_fail_count = 99
+    host.flag_restarting = True
 
     pingboy.ping()
     
-    assert pingboy.flag_restarting == False
+    assert host.flag_restarting == False
 
-def test_ping_restart_in_progress_log(pingboy, mock_ping_fail, mock_my_logger):
+def test_ping_restart_in_progress_log(pingboy, host, mock_ping_fail, mock_my_logger):
     """A ping fails during a restart."""
-    pingboy.flag_ping_fail_count = 99
-    pingboy.flag_restarting = True
+    host.flag_ping_fail_count = 99
+    host.flag_restarting = True
 
     pingboy.ping()
     
     mock_my_logger.logger.info.assert_called_once_with(
         "192.168.1.39 is restarting but not back yet. Response = 1")
 
-def test_ping_restart_in_progress_flag_ping_fail_count(pingboy, mock_ping_fail):
+def test_ping_restart_in_progress_flag_ping_fail_count(pingboy, host, mock_ping_fail):
     """A ping fails during a restart."""
-    pingboy.flag_ping_fail_count = 99
-    pingboy.flag_restarting = True
+    host.flag_ping_fail_count = 99
+    host.flag_restarting = True
 
     pingboy.ping()
     
-    assert pingboy.flag_ping_fail_count == 99
+    assert host.flag_ping_fail_count == 99
 
-def test_ping_restart_in_progress_flag_restarting(pingboy, mock_ping_fail):
+def test_ping_restart_in_progress_flag_restarting(pingboy, host, mock_ping_fail):
     """A ping fails during a restart."""
-    pingboy.flag_ping_fail_count = 99
-    pingboy.flag_restarting = True
+    host.flag_ping_fail_count = 99
+    host.flag_restarting = True
 
     pingboy.ping()
     
-    assert pingboy.flag_restarting == True
+    assert host.flag_restarting == True
 
-def test_ping_failure_under_threshold_log(pingboy, mock_ping_fail, mock_my_logger):
+def test_ping_failure_under_threshold_log(pingboy, host, mock_ping_fail, mock_my_logger):
     """A ping fails but the fail counter does not indicate a need for restart."""
-    pingboy.flag_ping_fail_count = 0
-    pingboy.config_values['ping_fails_needed_for_restart'] = 2
+    host.flag_ping_fail_count = 0
+    host.config['ping_fails_needed_for_restart'] = 2
 
     pingboy.ping()
 
     mock_my_logger.logger.error.assert_called_once_with(
         "192.168.1.39 did not respond! Response = 1 Consecutive fails = 1")
-    assert pingboy.flag_ping_fail_count == 1
+    assert host.flag_ping_fail_count == 1
 
-def test_ping_failure_under_threshold_flag_ping_fail_count(pingboy, mock_ping_fail):
+def test_ping_failure_under_threshold_flag_ping_fail_count(pingboy, host, mock_ping_fail):
     """A ping fails but the fail counter does not indicate a need for restart."""
-    pingboy.flag_ping_fail_count = 0
-    pingboy.config_values['ping_fails_needed_for_restart'] = 2
+    host.flag_ping_fail_count = 0
+    host.config['ping_fails_needed_for_restart'] = 2
 
     pingboy.ping()
 
-    assert pingboy.flag_ping_fail_count == 1
+    assert host.flag_ping_fail_count == 1
 
-def test_ping_failure_over_threshold_log(pingboy, mock_ping_fail, mock_my_logger):
+def test_ping_failure_over_threshold_log(pingboy, host, mock_ping_fail, mock_my_logger):
     """A ping fails and the fail counter indicates a need for restart."""
-    pingboy.flag_ping_fail_count = 1
-    pingboy.flag_restarting = False
-    pingboy.config_values['ping_fails_needed_for_restart'] = 2
+    host.flag_ping_fail_count = 1
+    host.flag_restarting = False
+    host.config['ping_fails_needed_for_restart'] = 2
     
     pingboy.ping()
 
@@ -163,84 +179,809 @@ def test_ping_failure_over_threshold_log(pingboy, mock_ping_fail, mock_my_logger
         "192.168.1.39 is down, requesting auto restart! Response = 1")
     mock_my_logger.logger.info.assert_called_once_with("192.168.1.39 is restarting!")
 
-def test_ping_failure_over_threshold_restart_thread(pingboy, mock_ping_fail, mock_restart_thread):
+def test_ping_failure_over_threshold_restart_request(pingboy, host, mock_ping_fail, mock_restart_scheduler):
     """A ping fails and the fail counter indicates a need for restart."""
-    pingboy.flag_ping_fail_count = 1
-    pingboy.flag_restarting = False
-    pingboy.config_values['ping_fails_needed_for_restart'] = 2
+    host.flag_ping_fail_count = 1
+    host.flag_restarting = False
+    host.config['ping_fails_needed_for_restart'] = 2
     
     pingboy.ping()
 
-    mock_restart_thread.start.assert_called_once_with()
+    mock_restart_scheduler.request.assert_called_once_with(host.name, 5, 3, 30, ANY, 0, (), False)
 
-def test_ping_failure_over_threshold_flag_ping_fail_count(pingboy, mock_ping_fail):
+def test_ping_failure_over_threshold_flag_ping_fail_count(pingboy, host, mock_ping_fail):
     """A ping fails and the fail counter indicates a need for restart."""
-    pingboy.flag_ping_fail_count = 1
-    pingboy.flag_restarting = False
-    pingboy.config_values['ping_fails_needed_for_restart'] = 2
+    host.flag_ping_fail_count = 1
+    host.flag_restarting = False
+    host.config['ping_fails_needed_for_restart'] = 2
     
     pingboy.ping()
 
-    assert pingboy.flag_ping_fail_count == 3
+    assert host.flag_ping_fail_count == 2
 
-def test_ping_failure_over_threshold_flag_restarting(pingboy, mock_ping_fail):
+def test_ping_failure_over_threshold_flag_restarting(pingboy, host, mock_ping_fail):
     """A ping fails and the fail counter indicates a need for restart."""
-    pingboy.flag_ping_fail_count = 1
-    pingboy.flag_restarting = False
-    pingboy.config_values['ping_fails_needed_for_restart'] = 2
+    host.flag_ping_fail_count = 1
+    host.flag_restarting = False
+    host.config['ping_fails_needed_for_restart'] = 2
     
     pingboy.ping()
 
-    assert pingboy.flag_restarting == True
+    assert host.flag_restarting == True
 
-def test_manual_restart_event_detected(pingboy, mock_switch_event_detected):
+def test_manual_restart_log(pingboy, host, mock_my_logger):
     """A manual restart request is made via the switch input."""
-    pingboy.flag_ping_fail_count = 0
-    pingboy.flag_restarting = False
-    pingboy.config_values['ping_fails_needed_for_restart'] = 2
-    pingboy.config_values['relay_channel'] = 5
-    pingboy.config_values['switch_channel'] = 6
+    host.flag_ping_fail_count = 0
+    host.flag_restarting = False
+    host.config['ping_fails_needed_for_restart'] = 2
+    host.config['relay_channel'] = 5
+    host.config['switch_channel'] = 6
 
-    pingboy.ping()
+    pingboy.switch_pressed(6)
+
+    mock_my_logger.logger.info.assert_any_call("192.168.1.39 manual restart request.")
+    mock_my_logger.logger.info.assert_any_call("192.168.1.39 is restarting!")
 
-    mock_switch_event_detected.assert_called_once_with(6)
 
-def test_manual_restart_log(pingboy, mock_my_logger, mock_switch_event_detected):
+def test_manual_restart_request(pingboy, host, mock_restart_scheduler):
     """A manual restart request is made via the switch input."""
-    pingboy.flag_ping_fail_count = 0
-    pingboy.flag_restarting = False
-    pingboy.config_values['ping_fails_needed_for_restart'] = 2
-    pingboy.config_values['relay_channel'] = 5
-    pingboy.config_values['switch_channel'] = 6
+    host.flag_ping_fail_count = 0
+    host.flag_restarting = False
+    host.config['ping_fails_needed_for_restart'] = 2
+    host.config['relay_channel'] = 5
+    host.config['switch_channel'] = 6
 
-    pingboy.ping()
+    pingboy.switch_pressed(6)
 
-    mock_my_logger.logger.info.assert_any_call("192.168.1.39 manual restart request.")
-    mock_my_logger.logger.info.assert_any_call("192.168.1.39 is restarting!")
+    mock_restart_scheduler.request.assert_called_once_with(host.name, 5, 3, 30, ANY, 0, (), True)
 
 
-def test_manual_restart_thread(pingboy, mock_restart_thread, mock_switch_event_detected):
+def test_manual_restart_flag_restarting(pingboy, host):
     """A manual restart request is made via the switch input."""
-    pingboy.flag_ping_fail_count = 0
-    pingboy.flag_restarting = False
-    pingboy.config_values['ping_fails_needed_for_restart'] = 2
-    pingboy.config_values['relay_channel'] = 5
-    pingboy.config_values['switch_channel'] = 6
+    host.flag_ping_fail_count = 0
+    host.flag_restarting = False
+    host.config['ping_fails_needed_for_restart'] = 2
+    host.config['relay_channel'] = 5
+    host.config['switch_channel'] = 6
+
+    pingboy.switch_pressed(6)
+
+    assert host.flag_restarting == True
+
+def test_manual_restart_other_switch(pingboy, host, mock_restart_scheduler):
+    """Pressing a switch that belongs to another PC does nothing."""
+    host.config['switch_channel'] = 6
+
+    pingboy.switch_pressed(7)
+
+    mock_restart_scheduler.request.assert_not_called()
+    assert host.flag_restarting == False
+
+def test_manual_restart_while_restarting(pingboy, host, mock_my_logger, mock_restart_scheduler):
+    """A press while the PC is already restarting does not start a second restart."""
+    host.config['switch_channel'] = 6
+    host.flag_restarting = True
+
+    pingboy.switch_pressed(6)
+
+    mock_restart_scheduler.request.assert_not_called()
+    mock_my_logger.logger.info.assert_any_call("192.168.1.39 manual restart request ignored, already restarting.")
+
+def test_manual_restart_while_relay_cycling(pingboy, host, mocker, mock_restart_scheduler):
+    """A press while the relay is still being cycled is ignored."""
+    host.config['switch_channel'] = 6
+    host.flag_restarting = True
+    mocker.patch.object(pingboy.restart_engine, 'active').return_value = Mock(phase=pc_reset_restart.PHASE_SHUTDOWN_WAIT)
+
+    pingboy.switch_pressed(6)
+
+    mock_restart_scheduler.cancel.assert_not_called()
+    mock_restart_scheduler.request.assert_not_called()
+
+def test_manual_restart_while_recovering(pingboy, host, mocker, mock_my_logger, mock_restart_scheduler):
+    """A press while waiting for a PC that was power cycled power cycles it again."""
+    host.config['switch_channel'] = 6
+    host.flag_restarting = True
+    mocker.patch.object(pingboy.restart_engine, 'active').return_value = Mock(phase=pc_reset_restart.PHASE_RECOVERING)
+
+    pingboy.switch_pressed(6)
+
+    mock_restart_scheduler.cancel.assert_called_once_with(host.name)
+    mock_restart_scheduler.request.assert_called_once_with(host.name, 5, 3, 30, ANY, 0, (), True)
+    assert host.flag_restarting == True
+    mock_my_logger.logger.info.assert_any_call("192.168.1.39 manual restart request.")
+
+def test_manual_restart_registers_callback(work_dir):
+    """Every switch channel calls back into PingBoy as soon as it is pressed."""
+    pingboy = PingBoy()
+    try:
+        assert pingboy.gpio.switches == {23: pingboy.switch_pressed}
+        assert pingboy.gpio.relays == {25: False}
+    finally:
+        pingboy.close()
+
+def test_switch_ignored_once_closed(work_dir, mocker):
+    """A switch press while the monitor shuts down neither starts a restart nor writes state."""
+    pingboy = PingBoy()
+    switch_pressed = pingboy.gpio.switches[23]
+    request = mocker.spy(pingboy.restart_scheduler, 'request')
+
+    pingboy.close()
+    switch_pressed(23)
+
+    assert pingboy.gpio.switches == {}
+    request.assert_not_called()
+    assert pingboy.hosts[0].flag_restarting == False
+
+FLEET_CONFIG = """
+[Channel]
+backend = simulated
+
+[Timing]
+wait_between_pings = 5
+ping_fails_needed_for_restart = 4
+
+[Host:node1]
+hostname = 10.0.0.1
+relay_channel = 5
+switch_channel = 6
+
+[Host:node2]
+hostname = 10.0.0.2
+relay_channel = 12
+switch_channel = 13
+ping_fails_needed_for_restart = 2
+"""
+
+@pytest.fixture()
+def fleet_pingboy(tmp_path, mocker):
+    """Creates a PingBoy that monitors two PCs."""
+    config_file = tmp_path / 'pc_reset_config.ini'
+    config_file.write_text(FLEET_CONFIG)
+    pingboy = PingBoy(str(config_file))
+    mocker.patch.object(pingboy, 'my_logger')
+
+    yield pingboy
+
+    pingboy.close()
+
+def test_fleet_host_configs(fleet_pingboy):
+    """Every host section becomes a host and missing timing values come from [Timing]."""
+    node1, node2 = fleet_pingboy.hosts
+
+    assert (node1.name, node1.config['hostname'], node1.config['relay_channel']) == ('node1', '10.0.0.1', 5)
+    assert node1.config['ping_fails_needed_for_restart'] == 4
+    assert (node2.name, node2.config['switch_channel']) == ('node2', 13)
+    assert node2.config['ping_fails_needed_for_restart'] == 2
+
+def test_fleet_fail_counts_are_per_host(fleet_pingboy, mocker):
+    """Only the host that failed to respond counts a failure."""
+    fleet_pingboy.prober = mocker.Mock(spec=SubprocessProber)
+    fleet_pingboy.prober.probe.side_effect = lambda hostname: (
+        ProbeResult.ok(hostname, 0.001) if hostname == '10.0.0.1' else ProbeResult.failed(hostname, 'timeout'))
+
+    clock = [100.0]
+    fleet_pingboy.scheduler.clock = lambda: clock[0]
+
+    fleet_pingboy.ping()
+    clock[0] += 10
+    fleet_pingboy.ping()
+
+    node1, node2 = fleet_pingboy.hosts
+    assert node1.flag_ping_fail_count == 0
+    assert node1.flag_restarting == False
+    assert node2.flag_ping_fail_count == 2
+    assert node2.flag_restarting == True
+    assert fleet_pingboy.restart_engine.active('node1') is None
+    assert fleet_pingboy.restart_engine.active('node2') is not None
+
+def test_fleet_pings_are_concurrent(fleet_pingboy, mocker):
+    """A cycle takes about as long as the slowest ping rather than the sum of them."""
+    def slow_probe(hostname):
+        time.sleep(0.3)
+        return ProbeResult.ok(hostname, 0.3)
+    fleet_pingboy.prober = mocker.Mock(spec=SubprocessProber)
+    fleet_pingboy.prober.probe.side_effect = slow_probe
+
+    start = time.monotonic()
+    fleet_pingboy.ping()
+
+    assert time.monotonic() - start < 0.5
+    assert fleet_pingboy.prober.probe.call_count == 2
+
+def test_fleet_switch_restarts_its_own_host(fleet_pingboy):
+    """Each switch channel restarts only the PC it is wired to."""
+    node1, node2 = fleet_pingboy.hosts
+
+    fleet_pingboy.switch_pressed(13)
+    fleet_pingboy.switch_pressed(13)
+
+    assert fleet_pingboy.restart_engine.active('node1') is None
+    assert fleet_pingboy.restart_engine.active('node2').relay_channel == 12
+    assert node2.flag_restarting == True
+
+def test_fleet_restart_order(tmp_path, mocker):
+    """Priorities and dependencies are read per host and the restart cap holds the rest back."""
+    config_file = tmp_path / 'pc_reset_config.ini'
+    config_file.write_text(FLEET_CONFIG.replace('switch_channel = 6\n',
+                                                'switch_channel = 6\ndepends_on = node2\n')
+                           + '[Restart]\nmax_concurrent = 1\n')
+    pingboy = PingBoy(str(config_file))
+    mocker.patch.object(pingboy, 'my_logger')
+    try:
+        node1, node2 = pingboy.hosts
+        assert node1.config['depends_on'] == ('node2',)
+        assert node2.config['restart_priority'] == 0
+
+        pingboy.switch_pressed(6)
+        pingboy.switch_pressed(13)
+
+        assert pingboy.restart_engine.active('node1') is not None
+        assert pingboy.restart_engine.active('node2') is None
+        assert node2.flag_restarting == True
+        assert pingboy.restart_scheduler.queue_depth() == 1
+    finally:
+        pingboy.close()
+
+def test_fleet_queued_manual_restart_of_healthy_pc(tmp_path, mocker):
+    """A manual restart that has to wait for its turn is not dropped because the PC still answers."""
+    config_file = tmp_path / 'pc_reset_config.ini'
+    config_file.write_text(FLEET_CONFIG + '[Restart]\nmax_concurrent = 1\n')
+    pingboy = PingBoy(str(config_file))
+    mocker.patch.object(pingboy, 'my_logger')
+    pingboy.prober = mocker.Mock(spec=SubprocessProber)
+    pingboy.prober.probe.side_effect = lambda hostname: ProbeResult.ok(hostname, 0.001)
+    try:
+        assert pingboy.restart_host('node1') == pc_reset_restart.REQUEST_STARTED
+        assert pingboy.restart_host('node2') == pc_reset_restart.REQUEST_QUEUED
+
+        pingboy.ping()
+
+        assert pingboy.hosts_by_name['node2'].flag_restarting == True
+        assert pingboy.restart_scheduler.queue_depth() == 1
+    finally:
+        pingboy.close()
+
+def test_fleet_error_in_one_host_does_not_stop_others(fleet_pingboy, mocker):
+    """A PC whose ping cannot be handled is logged and the other PCs are still handled and scheduled."""
+    fleet_pingboy.prober = mocker.Mock(spec=SubprocessProber)
+    fleet_pingboy.prober.probe.side_effect = lambda hostname: ProbeResult.failed(hostname, 'timeout')
+    node1, node2 = fleet_pingboy.hosts
+    node1.flag_ping_fail_count = 3
+    mocker.patch.object(fleet_pingboy, '_PingBoy__request_restart',
+                        side_effect=lambda host, *args: 1 / 0 if host is node1 else None)
+
+    fleet_pingboy.ping()
+
+    assert node2.flag_ping_fail_count == 1
+    fleet_pingboy.my_logger.logger.exception.assert_called_once_with("10.0.0.1 ping not handled.")
+    assert set(fleet_pingboy.scheduler.deadlines) == {'node1', 'node2'}
+
+def test_fleet_hosts_rescheduled_when_cycle_fails(fleet_pingboy, mocker):
+    """A cycle that blows up still puts every due PC back in the schedule."""
+    fleet_pingboy.prober = mocker.Mock(spec=SubprocessProber)
+    fleet_pingboy.prober.probe.side_effect = lambda hostname: ProbeResult.ok(hostname, 0.001)
+    fleet_pingboy.sig_pinged_pc.connect(lambda results: 1 / 0)
+
+    with pytest.raises(ZeroDivisionError):
+        fleet_pingboy.ping()
+
+    assert set(fleet_pingboy.scheduler.deadlines) == {'node1', 'node2'}
+    assert fleet_pingboy.time_until_next_ping() > 0
+
+def test_fleet_uses_sweep(fleet_pingboy, mocker):
+    """Probers that can sweep ping every host in a single call."""
+    fleet_pingboy.prober = mocker.Mock(spec=IcmpProber)
+    fleet_pingboy.prober.sweep.return_value = [ProbeResult.ok('10.0.0.1', 0.001),
+                                               ProbeResult.failed('10.0.0.2', 'timeout')]
+
+    fleet_pingboy.ping()
+
+    fleet_pingboy.prober.sweep.assert_called_once_with(['10.0.0.1', '10.0.0.2'])
+    fleet_pingboy.prober.probe.assert_not_called()
+    assert fleet_pingboy.hosts[1].flag_ping_fail_count == 1
+
+def lock_held(lock):
+    """True when any thread, this one included, holds lock."""
+    held = []
+    def try_lock():
+        if lock.acquire(blocking=False):
+            lock.release()
+            held.append(False)
+        else:
+            held.append(True)
+    thread = threading.Thread(target=try_lock)
+    thread.start()
+    thread.join()
+    return held[0]
+
+class FakeCluster(object):
+    """Stands in for a cluster node that owns some of the PCs and grants or refuses every relay lease."""
+    def __init__(self, pingboy, owned, grant=True):
+        self.pingboy = pingboy
+        self.owned = set(owned)
+        self.grant = grant
+        self.version = 1
+        self.acquired = []
+        self.released = []
+
+    def owns(self, name):
+        return name in self.owned
+
+    def owner(self, name):
+        return 'pi1' if name in self.owned else 'pi2'
+
+    def acquire(self, channel):
+        self.acquired.append((channel, lock_held(self.pingboy.restart_lock)))
+        return 1 if self.grant else None
+
+    def release(self, channel):
+        self.released.append(channel)
+
+    def fenced(self, states):
+        return dict(states), {}
+
+    def close(self):
+        pass
+
+@pytest.fixture()
+def cluster_pingboy(fleet_pingboy, mocker):
+    """The fleet PingBoy as a cluster node that owns node2, with node2 down."""
+    fleet_pingboy.cluster = FakeCluster(fleet_pingboy, ['node2'])
+    fleet_pingboy.prober = mocker.Mock(spec=SubprocessProber)
+    fleet_pingboy.prober.probe.side_effect = lambda hostname: (
+        ProbeResult.ok(hostname, 0.001) if hostname == '10.0.0.1' else ProbeResult.failed(hostname, 'timeout'))
+    return fleet_pingboy
+
+def test_cluster_pings_only_owned_pcs(cluster_pingboy):
+    """A node only pings the PCs it owns and takes on the others once the members change."""
+    cluster_pingboy.ping()
+
+    assert cluster_pingboy.owned_names == {'node2'}
+    cluster_pingboy.prober.probe.assert_called_once_with('10.0.0.2')
+
+    cluster_pingboy.cluster.owned = {'node1', 'node2'}
+    cluster_pingboy.cluster.version += 1
+    cluster_pingboy.prober.probe.reset_mock()
+    cluster_pingboy.ping()
+
+    assert sorted(call.args[0] for call in cluster_pingboy.prober.probe.call_args_list) == ['10.0.0.1']
+
+def test_cluster_keeps_pinging_pc_it_is_restarting(cluster_pingboy):
+    """A PC that moved to another node is still pinged until its restart is over."""
+    node1 = cluster_pingboy.hosts_by_name['node1']
+    node1.flag_restarting = True
+
+    cluster_pingboy.ping()
+
+    assert sorted(call.args[0] for call in cluster_pingboy.prober.probe.call_args_list) == ['10.0.0.1',
+                                                                                            '10.0.0.2']
+
+def test_cluster_lease_taken_before_restarting(cluster_pingboy):
+    """The lease on the relay is asked for outside the restart lock, before the PC is restarted."""
+    clock = [100.0]
+    cluster_pingboy.scheduler.clock = lambda: clock[0]
+
+    cluster_pingboy.ping()
+    clock[0] += 10
+    cluster_pingboy.ping()
+
+    node2 = cluster_pingboy.hosts_by_name['node2']
+    assert cluster_pingboy.cluster.acquired == [(12, False)]
+    assert node2.flag_restarting == True
+    assert cluster_pingboy.restart_engine.active('node2') is not None
+
+    # Asking again while it is restarting keeps the lease for the restart.
+    assert cluster_pingboy.restart_host('node2') == pc_reset_restart.REQUEST_DUPLICATE
+    assert cluster_pingboy.cluster.released == []
+
+def test_cluster_lease_refused(cluster_pingboy):
+    """A PC whose relay is leased to another node is not restarted by this one."""
+    cluster_pingboy.cluster.grant = False
+    clock = [100.0]
+    cluster_pingboy.scheduler.clock = lambda: clock[0]
+
+    cluster_pingboy.ping()
+    clock[0] += 10
+    cluster_pingboy.ping()
+
+    node2 = cluster_pingboy.hosts_by_name['node2']
+    assert cluster_pingboy.cluster.acquired == [(12, False)]
+    assert node2.flag_restarting == False
+    assert cluster_pingboy.restart_engine.active('node2') is None
+    assert cluster_pingboy.restart_host('node2') == pc_reset_restart.REQUEST_LEASE_REFUSED
+    cluster_pingboy.my_logger.logger.warning.assert_any_call(
+        "10.0.0.2 relay is leased to another node or no leader is known, not restarting it.")
+
+def test_fleet_runs_health_checks(tmp_path, mocker):
+    """Hosts with checks are checked on the check runner while the others are pinged."""
+    config_file = tmp_path / 'pc_reset_config.ini'
+    config_file.write_text(FLEET_CONFIG.replace('switch_channel = 6\n', 'switch_channel = 6\nchecks = tcp:1\n'))
+    pingboy = PingBoy(str(config_file))
+    mocker.patch.object(pingboy, 'my_logger')
+    try:
+        node1, node2 = pingboy.hosts
+        assert str(node1.check) == 'tcp:1'
+        assert node2.check is None
+
+        pingboy.prober = mocker.Mock(spec=SubprocessProber)
+        pingboy.prober.probe.side_effect = lambda hostname: ProbeResult.ok(hostname, 0.001)
+        future = mocker.Mock()
+        future.result.return_value = [ProbeResult.failed('10.0.0.1', 'refused')]
+        mocker.patch.object(pingboy.check_runner, 'submit', return_value=future)
+
+        pingboy.ping()
+
+        pingboy.check_runner.submit.assert_called_once_with([(node1.check, '10.0.0.1', 1.0)])
+        pingboy.prober.probe.assert_called_once_with('10.0.0.2')
+        assert node1.flag_ping_fail_count == 1
+        assert node2.flag_ping_fail_count == 0
+    finally:
+        pingboy.close()
+
+def test_reload_closes_replaced_checks(tmp_path, mocker):
+    """Checks that a reloaded config replaced are closed and no longer held by the check runner."""
+    config_file = tmp_path / 'pc_reset_config.ini'
+    config_file.write_text(FLEET_CONFIG.replace('switch_channel = 6\n', 'switch_channel = 6\nchecks = tcp:1\n'))
+    pingboy = PingBoy(str(config_file))
+    mocker.patch.object(pingboy, 'my_logger')
+    try:
+        node1 = pingboy.hosts[0]
+        old_check = node1.check
+        pingboy.check_runner.run([(old_check, '127.0.0.1', 1.0)])
+        close = mocker.spy(old_check, 'close')
+
+        write_config_file(str(config_file), {('Host:node1', 'checks'): 'tcp:2'})
+        assert pingboy.reload_config()
+
+        assert str(node1.check) == 'tcp:2'
+        assert close.call_count == 1
+        assert old_check not in pingboy.check_runner.checks
+    finally:
+        pingboy.close()
+
+def test_failed_ping_confirmed_quickly(pingboy, host, mock_ping_fail):
+    """After a failed ping the PC is pinged again at the confirmation interval."""
+    clock = [100.0]
+    pingboy.scheduler.clock = lambda: clock[0]
+    pingboy.scheduler.set_intervals(5, 1, 5)
 
     pingboy.ping()
 
-    mock_restart_thread.start.assert_called_once_with()
+    assert pingboy.time_until_next_ping() == 1
 
+def test_healthy_ping_relaxed(pingboy, host, mock_ping_succeed):
+    """A PC that answered is not pinged again until the healthy interval has passed."""
+    clock = [100.0]
+    pingboy.scheduler.clock = lambda: clock[0]
+    pingboy.scheduler.set_intervals(5, 1, 5)
 
-def test_manual_restart_flag_restarting(pingboy, mock_switch_event_detected):
-    """A manual restart request is made via the switch input."""
-    pingboy.flag_ping_fail_count = 0
-    pingboy.flag_restarting = False
-    pingboy.config_values['ping_fails_needed_for_restart'] = 2
-    pingboy.config_values['relay_channel'] = 5
-    pingboy.config_values['switch_channel'] = 6
+    pingboy.ping()
+    clock[0] += 1
+    pingboy.ping()
+
+    assert mock_ping_succeed.call_count == 1
+    assert pingboy.time_until_next_ping() == 4
+
+def test_loss_detector_not_reset_by_lucky_reply(pingboy, host, mock_ping_fail, mock_restart_scheduler):
+    """With the loss detector one reply in a run of failures does not save the PC."""
+    pingboy.detector = LossRatioDetector(window=8, threshold=0.5)
+    host.config['ping_fails_needed_for_restart'] = 4
+    for outcome in (True, True, True, True, False, False, False, True, False):
+        host.history.add(0, outcome, None)
 
     pingboy.ping()
 
-    assert pingboy.flag_restarting == True
-    
+    mock_restart_scheduler.request.assert_called_once()
+    assert host.flag_restarting == True
+
+def test_restart_cancelled_when_pc_comes_back(pingboy, host, mock_my_logger, mock_restart_scheduler):
+    """A PC that answers during the shutdown wait is not powered on again."""
+    host.flag_restarting = True
+    mock_restart_scheduler.host_responded.return_value = pc_reset_restart.PHASE_CANCELLED
+
+    pingboy.ping()
+
+    mock_restart_scheduler.host_responded.assert_called_once_with(host.name)
+    mock_my_logger.logger.info.assert_called_once_with(
+        "192.168.1.39 responded before it was powered on again, restart cancelled.")
+    assert host.flag_restarting == False
+
+def test_failed_ping_while_restarting_reported(pingboy, host, mock_ping_fail, mock_restart_scheduler):
+    """A PC that stops answering during its restart is reported, so a later answer counts as coming back."""
+    host.flag_restarting = True
+
+    pingboy.ping()
+
+    mock_restart_scheduler.host_failed.assert_called_once_with(host.name)
+    mock_restart_scheduler.host_responded.assert_not_called()
+
+def test_reply_while_power_switch_held(pingboy, host, mock_my_logger, mock_restart_scheduler):
+    """A reply while the power switch is still held does not end the restart."""
+    host.flag_restarting = True
+    mock_restart_scheduler.host_responded.return_value = pc_reset_restart.PHASE_POWER_OFF_PRESS
+
+    pingboy.ping()
+
+    mock_my_logger.logger.info.assert_not_called()
+    assert host.flag_restarting == True
+
+def test_restart_queued(pingboy, host, mock_ping_fail, mock_my_logger, mock_restart_scheduler):
+    """A restart that has to wait for its turn still marks the PC as restarting."""
+    host.flag_ping_fail_count = 1
+    host.config['ping_fails_needed_for_restart'] = 2
+    mock_restart_scheduler.request.return_value = pc_reset_restart.REQUEST_QUEUED
+    mock_restart_scheduler.queue_depth.return_value = 3
+
+    pingboy.ping()
+
+    mock_my_logger.logger.info.assert_called_once_with("192.168.1.39 restart queued, 3 restarts waiting.")
+    assert host.flag_restarting == True
+
+def test_restart_rate_limited(pingboy, host, mock_ping_fail, mock_my_logger, mock_restart_scheduler):
+    """A PC that has been restarted too often is left alone."""
+    host.flag_ping_fail_count = 1
+    host.config['ping_fails_needed_for_restart'] = 2
+    mock_restart_scheduler.request.return_value = pc_reset_restart.REQUEST_RATE_LIMITED
+
+    pingboy.ping()
+
+    mock_my_logger.logger.warning.assert_called_once_with(
+        "192.168.1.39 has been restarted too often, not restarting it again yet.")
+    assert host.flag_restarting == False
+
+def test_reload_keeps_fail_counts(fleet_pingboy, tmp_path):
+    """Changing the config file applies new values without losing the state of the PCs."""
+    node1, node2 = fleet_pingboy.hosts
+    node2.flag_ping_fail_count = 1
+    (tmp_path / 'pc_reset_config.ini').write_text(
+        FLEET_CONFIG.replace('wait_between_pings = 5', 'wait_between_pings = 20')
+                    .replace('ping_fails_needed_for_restart = 2', 'ping_fails_needed_for_restart = 3'))
+
+    assert fleet_pingboy.reload_config() == True
+
+    assert fleet_pingboy.hosts == [node1, node2]
+    assert node2.flag_ping_fail_count == 1
+    assert node2.config['ping_fails_needed_for_restart'] == 3
+    assert fleet_pingboy.scheduler.intervals['healthy'] == 20
+
+def test_reload_adds_and_removes_hosts(fleet_pingboy, tmp_path):
+    """PCs added to the config are monitored and removed ones are forgotten."""
+    node1 = fleet_pingboy.hosts[0]
+    (tmp_path / 'pc_reset_config.ini').write_text(
+        FLEET_CONFIG.replace('[Host:node2]', '[Host:node3]'))
+
+    fleet_pingboy.reload_config()
+
+    assert [host.name for host in fleet_pingboy.hosts] == ['node1', 'node3']
+    assert fleet_pingboy.hosts[0] is node1
+    assert 'node2' not in fleet_pingboy.scheduler.deadlines
+    assert 'node3' in fleet_pingboy.scheduler.deadlines
+
+def test_reload_rejects_bad_config(fleet_pingboy, tmp_path):
+    """A config that is not valid is not applied."""
+    (tmp_path / 'pc_reset_config.ini').write_text(
+        FLEET_CONFIG.replace('ping_fails_needed_for_restart = 2', 'ping_fails_needed_for_restart = 0'))
+
+    assert fleet_pingboy.reload_config() == False
+
+    assert fleet_pingboy.hosts[1].config['ping_fails_needed_for_restart'] == 2
+    assert fleet_pingboy.config_values['hosts'][1]['ping_fails_needed_for_restart'] == 2
+
+def test_config_file_change_picked_up_by_ping(fleet_pingboy, tmp_path, mocker):
+    """The config file is checked for changes at the start of every ping cycle."""
+    fleet_pingboy.prober = mocker.Mock(spec=SubprocessProber)
+    fleet_pingboy.prober.probe.side_effect = lambda hostname: ProbeResult.ok(hostname, 0.001)
+    config_file = tmp_path / 'pc_reset_config.ini'
+    config_file.write_text(FLEET_CONFIG.replace('wait_between_pings = 5', 'wait_between_pings = 7'))
+    fleet_pingboy.config_watcher.signature = None
+
+    fleet_pingboy.ping()
+
+    assert fleet_pingboy.config_values['wait_between_pings'] == 7
+
+def test_config_update_override(fleet_pingboy, tmp_path, mocker):
+    """Values from the GUI are applied on the next cycle without touching the file."""
+    fleet_pingboy.prober = mocker.Mock(spec=SubprocessProber)
+    fleet_pingboy.prober.probe.side_effect = lambda hostname: ProbeResult.ok(hostname, 0.001)
+    fleet_pingboy.request_config_update({('Timing', 'ping_fails_needed_for_restart'): '6'})
+
+    fleet_pingboy.ping()
+
+    assert fleet_pingboy.hosts[0].config['ping_fails_needed_for_restart'] == 6
+    assert (tmp_path / 'pc_reset_config.ini').read_text() == FLEET_CONFIG
+
+def test_write_config_file_keeps_comments(tmp_path):
+    """Values are changed in place and missing ones are added to their section."""
+    config_file = tmp_path / 'pc_reset_config.ini'
+    config_file.write_text("# Comment\n[Timing]\nwait_between_pings = 5\n\n[Channel]\nrelay_channel = 25\n")
+
+    write_config_file(str(config_file), {('Timing', 'wait_between_pings'): '9',
+                                         ('Timing', 'hold_power_switch'): '4',
+                                         ('Restart', 'stagger'): '2'})
+
+    assert config_file.read_text() == ("# Comment\n[Timing]\nwait_between_pings = 9\nhold_power_switch = 4\n\n"
+                                       "[Channel]\nrelay_channel = 25\n\n[Restart]\nstagger = 2\n")
+
+def test_restart_counters_survive_monitor_restart(pingboy, host, work_dir):
+    """Successful restarts are still counted after the monitor is started again."""
+    host.flag_restarting = True
+    pingboy.ping()
+    pingboy.close()
+
+    resumed = PingBoy()
+    try:
+        assert resumed.successful_restarts == 1
+        assert resumed.last_restart_time == pingboy.last_restart_time
+        assert resumed.hosts[0].flag_restarting == False
+    finally:
+        resumed.close()
+
+def test_restart_in_progress_resumed_after_crash(tmp_path, mocker):
+    """A PC that was being shut down when the monitor stopped is not powered off a second time."""
+    config_file = tmp_path / 'state.ini'
+    config_file.write_text(FLEET_CONFIG + '[State]\nfile = {}\n'.format(tmp_path / 'state.journal'))
+    pingboy = PingBoy(str(config_file))
+    mocker.patch.object(pingboy, 'my_logger')
+    pingboy.prober = mocker.Mock(spec=SubprocessProber)
+    pingboy.prober.probe.side_effect = lambda hostname: ProbeResult.failed(hostname, 'timeout')
+    pingboy.ping()
+    pingboy.switch_pressed(13)
+    pingboy.close()
+
+    resumed = PingBoy(str(config_file))
+    mocker.patch.object(resumed, 'my_logger')
+    try:
+        node1, node2 = resumed.hosts
+        assert node1.flag_ping_fail_count == 1
+        assert node2.flag_restarting == True
+        assert resumed.restart_engine.active('node2').phase == pc_reset_restart.PHASE_SHUTDOWN_WAIT
+        assert [change for change in resumed.gpio.changes if change[2]] == []
+    finally:
+        resumed.close()
+
+def test_pings_and_restarts_recorded_in_history(pingboy, host, mock_ping_fail):
+    """Every ping and every restart is kept in the history of the PC."""
+    clock = [100.0]
+    pingboy.scheduler.clock = lambda: clock[0]
+    for _ in range(4):
+        pingboy.ping()
+        clock[0] += 5
+
+    summary = pingboy.query_history(host.name, 60)
+    assert summary['pings'] == 4
+    assert summary['loss'] == 1.0
+    assert summary['restarts'] == 1
+
+def test_history_survives_monitor_restart(pingboy, host, work_dir):
+    """The history file is written on close and read back on start up."""
+    pingboy.ping()
+    pingboy.close()
+
+    resumed = PingBoy()
+    try:
+        assert resumed.query_history(host.name, 60)['pings'] == 1
+    finally:
+        resumed.close()
+
+def test_history_sized_from_config(work_dir):
+    """The history tiers take their sizes from [History]."""
+    write_config_file('pc_reset_config.ini', {('History', 'raw_pings'): '100',
+                                              ('History', 'minute_buckets'): '60',
+                                              ('History', 'hour_buckets'): '24'})
+    pingboy = PingBoy()
+    try:
+        assert pingboy.history_store.capacities[:3] == (100, 60, 24)
+    finally:
+        pingboy.close()
+
+def test_history_kept_when_resized(pingboy, host, work_dir):
+    """Changing the history sizes keeps the history the new sizes have room for."""
+    pingboy.ping()
+    pingboy.close()
+    write_config_file('pc_reset_config.ini', {('History', 'minute_buckets'): '60'})
+
+    resumed = PingBoy()
+    try:
+        assert resumed.history_store.capacities[1] == 60
+        assert resumed.query_history(host.name, 60)['pings'] == 1
+    finally:
+        resumed.close()
+
+def test_unreadable_history_moved_aside(work_dir, mocker):
+    """A history file that cannot be read is kept next to the new one instead of being overwritten."""
+    (work_dir / 'pc_reset_history.bin').write_bytes(b'nonsense')
+    warning = mocker.patch('logging.Logger.warning')
+
+    pingboy = PingBoy()
+    pingboy.close()
+
+    assert (work_dir / 'pc_reset_history.bin.old').read_bytes() == b'nonsense'
+    assert any('pc_reset_history.bin.old' in call.args[0] for call in warning.call_args_list)
+
+def test_no_history_without_file(work_dir, mocker):
+    """Without a history file no history is kept at all."""
+    write_config_file('pc_reset_config.ini', {('History', 'file'): ''})
+    pingboy = PingBoy()
+    try:
+        mocker.patch.object(pingboy, 'my_logger')
+        pingboy.prober = mocker.Mock(spec=SubprocessProber)
+        pingboy.prober.probe.return_value = ProbeResult.failed('192.168.1.39', 'timeout')
+        pingboy.hosts[0].flag_ping_fail_count = 3
+        pingboy.ping()
+
+        assert pingboy.history_store is None
+        assert pingboy.hosts[0].flag_restarting == True
+        assert pingboy.query_history(pingboy.hosts[0].name, 60) is None
+        assert pingboy.history_points(pingboy.hosts[0].name, 0, time.time()) is None
+    finally:
+        pingboy.close()
+
+def test_pings_and_restarts_counted_in_metrics(pingboy, host, mock_ping_fail):
+    """Failed pings and the automatic restart they lead to show up in the metrics."""
+    host.flag_ping_fail_count = 3
+
+    pingboy.ping()
+
+    text = pingboy.metrics.render()
+    assert 'pc_reset_probe_failures_total{{host="{}"}} 1\n'.format(host.name) in text
+    assert 'pc_reset_restarts_total{reason="auto"} 1\n' in text
+
+def test_paused_pc_not_pinged(pingboy, host, mock_ping_fail, mock_restart_scheduler):
+    """A PC paused for maintenance is neither pinged nor restarted until the pause ends."""
+    clock = [100.0]
+    pingboy.scheduler.clock = lambda: clock[0]
+    host.flag_ping_fail_count = 3
+    pingboy.pause(duration=60)
+
+    pingboy.ping()
+    assert mock_ping_fail.call_count == 0
+    assert pingboy.host_status()[0]['paused'] == True
+
+    clock[0] += 61
+    pingboy.ping()
+    assert mock_ping_fail.call_count == 1
+    assert host.flag_ping_fail_count == 1
+    mock_restart_scheduler.request.assert_not_called()
+
+def test_remote_restart_and_cancel(pingboy, host, mock_restart_scheduler):
+    """A restart asked for over the API can be cancelled again."""
+    assert pingboy.restart_host(host.name) == pc_reset_restart.REQUEST_STARTED
+    assert pingboy.restart_host(host.name) == pc_reset_restart.REQUEST_DUPLICATE
+    assert host.flag_restarting == True
+
+    assert pingboy.cancel_restart(host.name) == True
+    mock_restart_scheduler.cancel.assert_called_once_with(host.name)
+    assert host.flag_restarting == False
+    assert 'pc_reset_restarts_total{reason="manual"} 1\n' in pingboy.metrics.render()
+
+def test_restarts_recorded_in_event_log(pingboy, host, mock_ping_fail):
+    """Detection and the restart it leads to are kept in the event log, with why it was restarted."""
+    host.flag_ping_fail_count = 3
+
+    pingboy.ping()
+
+    events = pingboy.query_events(names=[host.name])
+    assert [event['event'] for event in events] == ['down', 'restart']
+    assert events[1]['reason'] == 'auto'
+    assert pingboy.query_events(kinds=['restart'], start=time.time() + 60) == []
+
+def test_profiling_turned_on_by_environment(work_dir, monkeypatch):
+    """PC_RESET_PROFILE times every part of the ping cycle and writes them to the file it names."""
+    trace_file = str(work_dir / 'trace.json')
+    monkeypatch.setenv('PC_RESET_PROFILE', trace_file)
+    profiled = PingBoy()
+    try:
+        assert profiled.profiler.enabled
+        profiled.prober = SubprocessProber()
+        profiled.ping()
+        assert {'cycle', 'cycle.probe', 'cycle.record', 'cycle.handle'} <= set(profiled.profiler.summary())
+    finally:
+        profiled.close()
+
+    with open(trace_file) as file:
+        names = {event['name'] for event in json.load(file)['traceEvents']}
+    assert 'cycle.probe' in names
+
+def test_profiling_off_by_default(pingboy):
+    assert not pingboy.profiler.enabled
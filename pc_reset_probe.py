@@ -0,0 +1,384 @@
+import collections
+import itertools
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+# Error kinds reported in a ProbeResult.
+ERROR_TIMEOUT = 'timeout'
+ERROR_UNREACHABLE = 'unreachable'
+ERROR_RESOLVE = 'resolve'
+ERROR_PERMISSION = 'permission'
+ERROR_SOCKET = 'socket'
+ERROR_EXIT = 'exit'
+
+# Response codes that mirror the exit status of the ping utility.
+CODE_SUCCESS = 0
+CODE_NO_REPLY = 1
+CODE_ERROR = 2
+
+ICMP_ECHO_REPLY = 0
+ICMP_DEST_UNREACHABLE = 3
+ICMP_ECHO_REQUEST = 8
+
+# Echo requests sent by a sweep before it drains replies again.
+SWEEP_BURST = 32
+
+# Receive buffer asked for so a sweep of many hosts does not drop replies (BYTES).
+RECEIVE_BUFFER_SIZE = 1024 * 1024
+
+_ICMP_HEADER = struct.Struct('!BBHHH')
+_TIMESTAMP = struct.Struct('!d')
+
+# Identifiers handed out to raw sockets so each one can pick out its own replies.
+_identifiers = itertools.count((os.getpid() * 7919) & 0xFFFF)
+
+
+class ProbeResult(collections.namedtuple('ProbeResult', 'host success rtt error code')):
+    """
+    Outcome of a single probe.
+
+    rtt is the round trip time in SECONDS (None if unknown), error is one of the
+    ERROR_* kinds (None on success) and code mirrors the ping exit status so it
+    can still be logged as the response.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def ok(cls, host, rtt):
+        return cls(host, True, rtt, None, CODE_SUCCESS)
+
+    @classmethod
+    def failed(cls, host, error, code=None):
+        if code is None:
+            code = CODE_NO_REPLY if error == ERROR_TIMEOUT else CODE_ERROR
+        return cls(host, False, None, error, code)
+
+
+def checksum(data):
+    """Returns the internet checksum of data."""
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def build_echo_request(identifier, sequence, payload=b''):
+    """Builds an ICMP echo request packet."""
+    header = _ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, identifier, sequence)
+    packet_checksum = checksum(header + payload)
+    return _ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, packet_checksum, identifier, sequence) + payload
+
+
+def parse_icmp(packet, raw):
+    """
+    Returns (type, identifier, sequence, payload) of an ICMP packet.
+
+    Raw sockets deliver the IP header as well so it is stripped first.  For
+    destination unreachable messages the identifier and sequence are taken from
+    the echo request quoted inside the message.
+    """
+    if raw:
+        packet = packet[(packet[0] & 0x0F) * 4:]
+    if len(packet) < _ICMP_HEADER.size:
+        return None
+    icmp_type, _, _, identifier, sequence = _ICMP_HEADER.unpack_from(packet)
+    payload = packet[_ICMP_HEADER.size:]
+
+    if icmp_type == ICMP_DEST_UNREACHABLE:
+        quoted = payload[4:]
+        if len(quoted) < 20:
+            return None
+        quoted = quoted[(quoted[0] & 0x0F) * 4:]
+        if len(quoted) < _ICMP_HEADER.size:
+            return None
+        _, _, _, identifier, sequence = _ICMP_HEADER.unpack_from(quoted)
+        payload = b''
+
+    return icmp_type, identifier, sequence, payload
+
+
+def open_icmp_socket():
+    """
+    Opens an ICMP socket, returning (socket, raw).
+
+    An unprivileged ICMP datagram socket is tried first (needs the group to be
+    in net.ipv4.ping_group_range), then a raw socket (needs root or CAP_NET_RAW).
+    """
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        raw = False
+    except PermissionError:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        raw = True
+    sock.setblocking(False)
+
+    # The kernel caps this at net.core.rmem_max, which is fine.
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECEIVE_BUFFER_SIZE)
+    except OSError:
+        pass
+    return sock, raw
+
+
+class IcmpProber(object):
+    """
+    Probes hosts with ICMP echo requests from inside the process.
+
+    Each thread gets its own socket so that probes can run concurrently without
+    stealing each other's replies.
+    """
+    def __init__(self, timeout=1):
+        """
+        Timeout is the time to wait for a reply (SECONDS).  Raises OSError if
+        no kind of ICMP socket can be opened.
+        """
+        self.timeout = timeout
+        self._local = threading.local()
+        self._sockets = []
+        self._sockets_lock = threading.Lock()
+        self._sequence = itertools.count(1)
+
+        # Fail early so the caller can choose another backend.
+        self._get_socket()
+
+    def _get_socket(self):
+        """Returns (socket, raw, identifier) for the calling thread."""
+        entry = getattr(self._local, 'entry', None)
+        if entry is None:
+            sock, raw = open_icmp_socket()
+            # The kernel assigns the identifier of datagram sockets itself.
+            identifier = next(_identifiers) & 0xFFFF if raw else 0
+            entry = (sock, raw, identifier)
+            self._local.entry = entry
+            with self._sockets_lock:
+                self._sockets.append(sock)
+        return entry
+
+    def probe(self, hostname, timeout=None):
+        """Sends a single echo request to hostname and returns a ProbeResult."""
+        if timeout is None:
+            timeout = self.timeout
+
+        try:
+            address = socket.gethostbyname(hostname)
+        except (socket.gaierror, UnicodeError):
+            return ProbeResult.failed(hostname, ERROR_RESOLVE)
+
+        try:
+            sock, raw, identifier = self._get_socket()
+        except PermissionError:
+            return ProbeResult.failed(hostname, ERROR_PERMISSION)
+        except OSError:
+            return ProbeResult.failed(hostname, ERROR_SOCKET)
+
+        sequence = next(self._sequence) & 0xFFFF
+        sent = time.monotonic()
+        deadline = sent + timeout
+        packet = build_echo_request(identifier, sequence, _TIMESTAMP.pack(sent))
+
+        try:
+            sock.sendto(packet, (address, 0))
+        except PermissionError:
+            return ProbeResult.failed(hostname, ERROR_PERMISSION)
+        except OSError:
+            return ProbeResult.failed(hostname, ERROR_UNREACHABLE)
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return ProbeResult.failed(hostname, ERROR_TIMEOUT)
+
+            readable, _, _ = select.select([sock], [], [], remaining)
+            if not readable:
+                return ProbeResult.failed(hostname, ERROR_TIMEOUT)
+
+            try:
+                data, source = sock.recvfrom(2048)
+            except BlockingIOError:
+                continue
+            except OSError:
+                # Datagram sockets surface ICMP errors this way.
+                return ProbeResult.failed(hostname, ERROR_UNREACHABLE)
+            received = time.monotonic()
+
+            reply = parse_icmp(data, raw)
+            if reply is None:
+                continue
+            icmp_type, reply_identifier, reply_sequence, _ = reply
+
+            # Raw sockets see every ICMP packet that arrives at the Pi.
+            if raw and reply_identifier != identifier:
+                continue
+            if reply_sequence != sequence:
+                continue
+
+            if icmp_type == ICMP_ECHO_REPLY and source[0] == address:
+                return ProbeResult.ok(hostname, received - sent)
+            if icmp_type == ICMP_DEST_UNREACHABLE:
+                return ProbeResult.failed(hostname, ERROR_UNREACHABLE)
+
+    def sweep(self, hostnames, timeout=None):
+        """
+        Pings every host from a single socket and returns their ProbeResults in
+        the same order.
+
+        All echo requests are sent in one burst and replies are matched back to
+        hosts by identifier and sequence number.  Timeout is one deadline for
+        the whole sweep rather than per host.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        results = [None] * len(hostnames)
+
+        try:
+            sock, raw, identifier = self._get_socket()
+        except PermissionError:
+            return [ProbeResult.failed(hostname, ERROR_PERMISSION) for hostname in hostnames]
+        except OSError:
+            return [ProbeResult.failed(hostname, ERROR_SOCKET) for hostname in hostnames]
+
+        # (sequence number, index, address) of every request still waiting to be sent.
+        to_send = []
+        for index, hostname in enumerate(hostnames):
+            try:
+                address = socket.gethostbyname(hostname)
+            except (socket.gaierror, UnicodeError):
+                results[index] = ProbeResult.failed(hostname, ERROR_RESOLVE)
+                continue
+            to_send.append((next(self._sequence) & 0xFFFF, index, address))
+        to_send.reverse()
+
+        # Sequence number -> (index, address, send time) for every request awaiting a reply.
+        in_flight = {}
+        deadline = time.monotonic() + timeout
+
+        while to_send or in_flight:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            readable, writable, _ = select.select([sock], [sock] if to_send else [], [], remaining)
+
+            # Drain every reply that has arrived before sending more, so the
+            # receive buffer does not overflow during a large burst.
+            while readable and in_flight:
+                try:
+                    data, source = sock.recvfrom(2048)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    # Datagram sockets report ICMP errors without saying which
+                    # request they belong to, so let those hosts time out.
+                    break
+                received = time.monotonic()
+
+                reply = parse_icmp(data, raw)
+                if reply is None:
+                    continue
+                icmp_type, reply_identifier, reply_sequence, _ = reply
+                if raw and reply_identifier != identifier:
+                    continue
+
+                entry = in_flight.get(reply_sequence)
+                if entry is None:
+                    continue
+                index, address, sent = entry
+
+                if icmp_type == ICMP_ECHO_REPLY and source[0] == address:
+                    results[index] = ProbeResult.ok(hostnames[index], received - sent)
+                    del in_flight[reply_sequence]
+                elif icmp_type == ICMP_DEST_UNREACHABLE:
+                    results[index] = ProbeResult.failed(hostnames[index], ERROR_UNREACHABLE)
+                    del in_flight[reply_sequence]
+
+            # Send the next part of the burst.
+            if writable:
+                for _ in range(SWEEP_BURST):
+                    if not to_send:
+                        break
+                    sequence, index, address = to_send[-1]
+                    sent = time.monotonic()
+                    packet = build_echo_request(identifier, sequence, _TIMESTAMP.pack(sent))
+                    try:
+                        sock.sendto(packet, (address, 0))
+                    except BlockingIOError:
+                        break
+                    except PermissionError:
+                        results[index] = ProbeResult.failed(hostnames[index], ERROR_PERMISSION)
+                    except OSError:
+                        results[index] = ProbeResult.failed(hostnames[index], ERROR_UNREACHABLE)
+                    else:
+                        in_flight[sequence] = (index, address, sent)
+                    to_send.pop()
+
+        # Anything left never got an answer.
+        for index, hostname in enumerate(hostnames):
+            if results[index] is None:
+                results[index] = ProbeResult.failed(hostname, ERROR_TIMEOUT)
+
+        return results
+
+    def close(self):
+        """Closes every socket opened by this prober."""
+        with self._sockets_lock:
+            for sock in self._sockets:
+                sock.close()
+            self._sockets = []
+        self._local = threading.local()
+
+
+class SubprocessProber(object):
+    """Probes hosts by running the system ping utility."""
+    def __init__(self, timeout=None):
+        """
+        Timeout is passed to ping as its reply wait time (SECONDS).  When it is
+        None the ping default is used.
+        """
+        self.timeout = timeout
+
+    def probe(self, hostname, timeout=None):
+        """Runs ping once for hostname and returns a ProbeResult."""
+        if timeout is None:
+            timeout = self.timeout
+
+        if timeout is None:
+            command = "ping -c 1 " + hostname
+        else:
+            command = "ping -c 1 -W {} ".format(max(1, int(round(timeout)))) + hostname
+
+        response = os.system(command)
+        if response == 0:
+            return ProbeResult(hostname, True, None, None, response)
+        return ProbeResult(hostname, False, None, ERROR_EXIT, response)
+
+    def close(self):
+        """Nothing to release."""
+        pass
+
+
+def make_prober(backend, timeout, logger=None):
+    """
+    Creates the prober for backend ('icmp' or 'subprocess').
+
+    Falls back to the subprocess backend if no ICMP socket can be opened.
+    """
+    if backend == 'subprocess':
+        return SubprocessProber(timeout)
+
+    if backend != 'icmp':
+        raise ValueError("Unknown probe backend: {}".format(backend))
+
+    try:
+        return IcmpProber(timeout)
+    except OSError as error:
+        if logger is not None:
+            logger.warning("ICMP sockets unavailable ({}), falling back to the ping command."
+                           .format(error))
+        return SubprocessProber(timeout)
@@ -0,0 +1,117 @@
+import pytest
+import socket
+
+import pc_reset_probe
+
+from pc_reset_probe import (IcmpProber, ProbeResult, SubprocessProber, build_echo_request, checksum,
+                            make_prober, parse_icmp)
+
+@pytest.fixture()
+def icmp_prober():
+    """Creates an ICMP prober, skipping the test if ICMP sockets are not allowed here."""
+    try:
+        prober = IcmpProber(timeout=1)
+    except OSError:
+        pytest.skip("ICMP sockets are not available")
+
+    yield prober
+
+    prober.close()
+
+def test_checksum_of_valid_packet_is_zero():
+    """A packet that includes its own checksum sums to zero."""
+    packet = build_echo_request(0x1234, 7, b'payload')
+
+    assert checksum(packet) == 0
+
+def test_parse_echo_request_round_trip():
+    """Identifier, sequence and payload survive building and parsing a packet."""
+    packet = build_echo_request(0x1234, 7, b'payload')
+
+    assert parse_icmp(packet, raw=False) == (8, 0x1234, 7, b'payload')
+
+def test_parse_raw_strips_ip_header():
+    """Raw sockets deliver an IP header that has to be skipped."""
+    ip_header = bytes([0x45]) + bytes(19)
+    packet = build_echo_request(0x1234, 7, b'')
+
+    assert parse_icmp(ip_header + packet, raw=True) == (8, 0x1234, 7, b'')
+
+def test_parse_too_short():
+    """Truncated packets are ignored."""
+    assert parse_icmp(b'\x00\x00', raw=False) is None
+
+def test_failed_result_codes():
+    """Failed results use the ping exit status convention for their code."""
+    assert ProbeResult.failed('pc', pc_reset_probe.ERROR_TIMEOUT).code == 1
+    assert ProbeResult.failed('pc', pc_reset_probe.ERROR_RESOLVE).code == 2
+    assert ProbeResult.ok('pc', 0.001).code == 0
+
+def test_icmp_probe_localhost(icmp_prober):
+    """Localhost always answers."""
+    result = icmp_prober.probe('127.0.0.1')
+
+    assert result.success == True
+    assert result.rtt is not None
+    assert result.error is None
+
+def test_icmp_probe_resolve_error(icmp_prober):
+    """A hostname that cannot be resolved is reported as such."""
+    result = icmp_prober.probe('no-such-host.invalid')
+
+    assert result.success == False
+    assert result.error == pc_reset_probe.ERROR_RESOLVE
+
+def test_subprocess_probe_command(mocker):
+    """The subprocess backend runs the ping command."""
+    mock_os_system = mocker.patch('os.system')
+    mock_os_system.return_value = 0
+
+    result = SubprocessProber().probe('192.168.1.39')
+
+    mock_os_system.assert_called_once_with('ping -c 1 192.168.1.39')
+    assert result.success == True
+    assert result.code == 0
+
+def test_subprocess_probe_timeout(mocker):
+    """The subprocess backend passes the timeout to ping."""
+    mock_os_system = mocker.patch('os.system')
+    mock_os_system.return_value = 256
+
+    result = SubprocessProber(timeout=2).probe('192.168.1.39')
+
+    mock_os_system.assert_called_once_with('ping -c 1 -W 2 192.168.1.39')
+    assert result.success == False
+    assert result.code == 256
+
+def test_make_prober_falls_back(mocker):
+    """The subprocess backend is used when no ICMP socket can be opened."""
+    mocker.patch('pc_reset_probe.open_icmp_socket', side_effect=PermissionError)
+
+    prober = make_prober('icmp', 1)
+
+    assert isinstance(prober, SubprocessProber)
+
+def test_make_prober_unknown_backend():
+    """Unknown backends are rejected."""
+    with pytest.raises(ValueError):
+        make_prober('carrier-pigeon', 1)
+
+def test_icmp_sweep(icmp_prober):
+    """A sweep answers for every host in the order they were given."""
+    hostnames = ['127.0.0.1', 'no-such-host.invalid', '127.0.0.2', '127.0.0.1']
+
+    results = icmp_prober.sweep(hostnames)
+
+    assert [result.host for result in results] == hostnames
+    assert [result.success for result in results] == [True, False, True, True]
+    assert results[1].error == pc_reset_probe.ERROR_RESOLVE
+
+def test_icmp_sweep_timeout(icmp_prober):
+    """Hosts that never answer time out at the single sweep deadline."""
+    # Nothing routes documentation addresses (RFC 5737).
+    results = icmp_prober.sweep(['198.51.100.1', '127.0.0.1'], timeout=0.2)
+
+    assert results[0].success == False
+    assert results[0].error in (pc_reset_probe.ERROR_TIMEOUT, pc_reset_probe.ERROR_UNREACHABLE)
+    assert results[1].success == True
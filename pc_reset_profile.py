@@ -0,0 +1,205 @@
+"""
+Timing spans for the ping cycle, logging, GPIO and restart phases.
+
+    [Profile]
+    enabled = yes
+    file = pc_reset_profile.json
+    summary_interval = 60
+
+or, without touching the config, PC_RESET_PROFILE=1 (or the path of the
+trace file) in the environment.  Every span goes into a bounded ring and
+the ring is written as Chrome trace-event JSON, which chrome://tracing and
+ui.perfetto.dev open, every summary_interval and on exit.  Each interval
+the 50th, 95th and 99th percentile of every kind of span is logged too.
+
+Turned off, the monitor holds a NullProfiler whose span hands back one
+shared do-nothing context manager, so a span costs a method call.
+"""
+import collections
+import json
+import math
+import os
+import threading
+import time
+
+# Environment variable that turns profiling on, naming the trace file unless it is just 1.
+PROFILE_ENV = 'PC_RESET_PROFILE'
+
+# Durations of each kind of span kept per summary interval.
+SUMMARY_SAMPLES = 10000
+
+class NullSpan(object):
+    """A span that records nothing."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_SPAN = NullSpan()
+
+class Span(object):
+    """Times the block it wraps and hands it to its profiler."""
+    __slots__ = ('profiler', 'name', 'args', 'start')
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = self.profiler.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record(self.name, self.start, self.profiler.clock() - self.start, self.args)
+        return False
+
+class NullProfiler(object):
+    """Profiling turned off."""
+    enabled = False
+
+    def span(self, name, **args):
+        """Returns a context manager that times its block as a span called name, with args shown in the trace."""
+        return NULL_SPAN
+
+    def record(self, name, start, duration, args=None, track=None):
+        pass
+
+    def record_phases(self, track, durations):
+        pass
+
+    def summary(self):
+        return {}
+
+    def report(self):
+        return None
+
+    def save(self):
+        pass
+
+    def close(self):
+        pass
+
+NULL_PROFILER = NullProfiler()
+
+class Profiler(NullProfiler):
+    """
+    Keeps the newest max_events spans for the trace file and the durations of
+    every kind of span since the last report for the summary.
+    """
+    enabled = True
+
+    def __init__(self, path=None, max_events=20000, summary_interval=60.0, clock=time.perf_counter):
+        """Spans are timed on clock (SECONDS).  The trace is written to path, if one is given."""
+        self.path = path
+        self.summary_interval = summary_interval
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.started = clock()
+        self.reported_at = self.started
+
+        # (name, start, duration, track, args) of the newest spans.
+        self.events = collections.deque(maxlen=max_events)
+        # Span name -> durations since the last report.
+        self.samples = {}
+        # Thread ident or track name -> (number, name) of its row in the trace.
+        self.tracks = {}
+
+    def span(self, name, **args):
+        return Span(self, name, args)
+
+    def record(self, name, start, duration, args=None, track=None):
+        """
+        Records a span that started at start on the profiler's clock.
+        Spans go on the row of the calling thread unless a track is named.
+        """
+        if track is None:
+            thread = threading.current_thread()
+            key, label = thread.ident, thread.name
+        else:
+            key, label = track, track
+        with self.lock:
+            if key not in self.tracks:
+                self.tracks[key] = (len(self.tracks) + 1, label)
+            self.events.append((name, start, duration, self.tracks[key][0], args))
+            samples = self.samples.get(name)
+            if samples is None:
+                samples = self.samples[name] = collections.deque(maxlen=SUMMARY_SAMPLES)
+            samples.append(duration)
+
+    def record_phases(self, track, durations):
+        """Records the phases of a finished restart, given as {phase: SECONDS} in order, ending now."""
+        start = self.clock() - sum(durations.values())
+        for phase, duration in durations.items():
+            self.record('restart.' + phase, start, duration, track=track)
+            start += duration
+
+    def summary(self):
+        """
+        Returns {span name: {'count', 'p50', 'p95', 'p99', 'max'}} of the
+        spans since the last report, durations in SECONDS.
+        """
+        with self.lock:
+            samples = {name: sorted(durations) for name, durations in self.samples.items() if durations}
+        return {name: {'count': len(durations),
+                       'p50': percentile(durations, 50),
+                       'p95': percentile(durations, 95),
+                       'p99': percentile(durations, 99),
+                       'max': durations[-1]}
+                for name, durations in samples.items()}
+
+    def report(self):
+        """
+        Once every summary_interval returns the summary since the last
+        report, starting a new interval, and writes the trace file.
+        Returns None in between.
+        """
+        now = self.clock()
+        if now - self.reported_at < self.summary_interval:
+            return None
+        summary = self.summary()
+        with self.lock:
+            self.samples = {}
+            self.reported_at = now
+        self.save()
+        return summary
+
+    def save(self):
+        """Writes the spans held to the trace file, replacing it in one step."""
+        if not self.path:
+            return
+        with self.lock:
+            events = list(self.events)
+            tracks = list(self.tracks.values())
+
+        pid = os.getpid()
+        trace = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': number, 'args': {'name': str(label)}}
+                 for number, label in tracks]
+        for name, start, duration, track, args in events:
+            event = {'name': name, 'cat': name.split('.', 1)[0], 'ph': 'X', 'pid': pid, 'tid': track,
+                     'ts': round((start - self.started) * 1e6, 1), 'dur': round(duration * 1e6, 1)}
+            if args:
+                event['args'] = args
+            trace.append(event)
+
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, file, separators=(',', ':'))
+        os.replace(temporary_path, self.path)
+
+    def close(self):
+        self.save()
+
+def percentile(ordered, percent):
+    """Returns the nearest rank percentile of a sorted list."""
+    return ordered[min(len(ordered) - 1, max(0, int(math.ceil(percent / 100 * len(ordered))) - 1))]
+
+def format_summary(summary):
+    """Returns one line per kind of span, slowest p99 first, with times in MILLISECONDS."""
+    return ['{} n={} p50={:.2f} ms p95={:.2f} ms p99={:.2f} ms max={:.2f} ms'.format(
+                name, figures['count'], figures['p50'] * 1000, figures['p95'] * 1000, figures['p99'] * 1000,
+                figures['max'] * 1000)
+            for name, figures in sorted(summary.items(), key=lambda item: -item[1]['p99'])]
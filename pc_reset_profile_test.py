@@ -0,0 +1,99 @@
+import json
+import pytest
+import threading
+
+from pc_reset_profile import format_summary, NULL_PROFILER, NULL_SPAN, percentile, Profiler
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture()
+def clock():
+    return FakeClock()
+
+@pytest.fixture()
+def profiler(tmp_path, clock):
+    return Profiler(str(tmp_path / 'trace.json'), summary_interval=60, clock=clock)
+
+def test_span_times_its_block(profiler, clock):
+    with profiler.span('cycle.probe', hosts=3):
+        clock.now += 0.25
+    summary = profiler.summary()
+    assert summary['cycle.probe']['count'] == 1
+    assert summary['cycle.probe']['max'] == pytest.approx(0.25)
+
+def test_spans_of_each_thread_go_on_their_own_track(profiler):
+    def work():
+        with profiler.span('log.write'):
+            pass
+    thread = threading.Thread(target=work, name='log writer')
+    thread.start()
+    thread.join()
+    with profiler.span('cycle'):
+        pass
+    assert [label for _, label in profiler.tracks.values()] == ['log writer', threading.current_thread().name]
+
+def test_summary_percentiles(profiler):
+    for millisecond in range(1, 101):
+        profiler.record('cycle', 0.0, millisecond / 1000.0)
+    figures = profiler.summary()['cycle']
+    assert figures['count'] == 100
+    assert figures['p50'] == pytest.approx(0.050)
+    assert figures['p95'] == pytest.approx(0.095)
+    assert figures['p99'] == pytest.approx(0.099)
+    assert figures['max'] == pytest.approx(0.100)
+
+def test_percentile_nearest_rank():
+    assert percentile([1, 2, 3], 50) == 2
+    assert percentile([1, 2, 3], 99) == 3
+    assert percentile([7], 0) == 7
+
+def test_report_once_per_interval(profiler, clock):
+    profiler.record('cycle', clock(), 0.01)
+    assert profiler.report() is None
+
+    clock.now += 60
+    summary = profiler.report()
+    assert summary['cycle']['count'] == 1
+    # A new interval starts with no samples, but the trace keeps its spans.
+    assert profiler.summary() == {}
+    assert len(profiler.events) == 1
+
+def test_save_writes_chrome_trace(profiler, clock):
+    with profiler.span('cycle.probe', hosts=2):
+        clock.now += 0.002
+    profiler.record_phases('pc1', {'shutdown_wait': 30.0, 'power_on_press': 0.5})
+    profiler.save()
+
+    with open(profiler.path) as file:
+        trace = json.load(file)['traceEvents']
+    threads = {event['tid']: event['args']['name'] for event in trace if event['ph'] == 'M'}
+    spans = [event for event in trace if event['ph'] == 'X']
+    assert [span['name'] for span in spans] == ['cycle.probe', 'restart.shutdown_wait', 'restart.power_on_press']
+    assert spans[0]['cat'] == 'cycle'
+    assert spans[0]['dur'] == pytest.approx(2000)
+    assert spans[0]['args'] == {'hosts': 2}
+    assert threads[spans[1]['tid']] == 'pc1'
+    # Restart phases follow each other and end now.
+    assert spans[2]['ts'] == pytest.approx(spans[1]['ts'] + 30e6)
+    assert spans[2]['ts'] + spans[2]['dur'] == pytest.approx((clock() - profiler.started) * 1e6)
+
+def test_format_summary_slowest_first(profiler):
+    profiler.record('cycle.signal', 0.0, 0.001)
+    profiler.record('cycle.probe', 0.0, 0.020)
+    lines = format_summary(profiler.summary())
+    assert lines[0].startswith('cycle.probe n=1 p50=20.00 ms')
+    assert lines[1].startswith('cycle.signal')
+
+def test_null_profiler_records_nothing(tmp_path):
+    assert NULL_PROFILER.span('cycle', hosts=1) is NULL_SPAN
+    with NULL_PROFILER.span('cycle'):
+        pass
+    NULL_PROFILER.record_phases('pc1', {'shutdown_wait': 1.0})
+    assert NULL_PROFILER.summary() == {}
+    assert NULL_PROFILER.report() is None
+    NULL_PROFILER.close()
@@ -0,0 +1,578 @@
+import collections
+import heapq
+import itertools
+import math
+import threading
+import time
+
+# The phases a power cycle goes through.  The relay is closed (power switch
+# pressed) during the press phases and open otherwise.
+PHASE_POWER_OFF_PRESS = 'power_off_press'
+PHASE_SHUTDOWN_WAIT = 'shutdown_wait'
+PHASE_POWER_ON_PRESS = 'power_on_press'
+PHASE_RECOVERING = 'recovering'
+PHASE_DONE = 'done'
+PHASE_CANCELLED = 'cancelled'
+# The PC did not answer within the recovery timeout, so it may be restarted again.
+PHASE_FAILED = 'failed'
+# The restart is still waiting in the RestartScheduler's queue.
+PHASE_QUEUED = 'queued'
+
+# What became of a request made to the RestartScheduler.
+REQUEST_STARTED = 'started'
+REQUEST_QUEUED = 'queued'
+REQUEST_DUPLICATE = 'duplicate'
+REQUEST_RATE_LIMITED = 'rate_limited'
+# A restart the monitor did not ask for because another node of its cluster holds the relay.
+REQUEST_LEASE_REFUSED = 'lease_refused'
+
+class RestartMachine(object):
+    """The state of one power cycle of one PC."""
+    def __init__(self, name, relay_channel, hold_power_switch, wait_before_shutdown, requested_at, now):
+        """
+        Hold_power_switch and wait_before_shutdown are in SECONDS.  Requested_at
+        is when the restart was asked for, on the engine's clock.
+        """
+        self.name = name
+        self.relay_channel = relay_channel
+        self.hold_power_switch = hold_power_switch
+        self.wait_before_shutdown = wait_before_shutdown
+        self.requested_at = requested_at
+        self.started_at = now
+
+        self.phase = None
+        self.phase_started_at = now
+
+        # When the current phase times out, or None when it waits for the PC.
+        self.deadline = None
+
+        # How long each finished phase took (SECONDS).
+        self.phase_durations = {}
+
+        # When the relay was first closed, and how long the PC took to answer again.
+        self.relay_closed_at = None
+        self.time_to_recovery = None
+
+        # Whether the PC stopped answering after its power switch was pressed,
+        # so an answer during the shutdown wait means it came back.
+        self.went_down = False
+
+    @property
+    def finished(self):
+        return self.phase in (PHASE_DONE, PHASE_CANCELLED, PHASE_FAILED)
+
+    def relay_latency(self):
+        """Returns the time from the request to the relay closing (SECONDS), or None."""
+        if self.relay_closed_at is None:
+            return None
+        return self.relay_closed_at - self.requested_at
+
+class RestartEngine(object):
+    """
+    Runs the power cycles of any number of PCs from a single thread.
+
+    Each restart is a RestartMachine that moves through the phases on
+    timers instead of sleeping, so a restart costs no thread of its own
+    and can be cancelled at any point.  The deadlines of every machine
+    live in one priority queue.
+    """
+    def __init__(self, set_relay, on_phase=None, clock=time.monotonic, background=True, set_relays=None,
+                 recovery_timeout=None):
+        """
+        Set_relay(channel, closed) drives a relay.  On_phase(machine, phase)
+        is called whenever a machine enters a phase, outside of the engine's
+        lock.  Without a background thread, run_due has to be called instead.
+        With set_relays({channel: closed}) every relay that changes at the
+        same moment, such as a rack whose restarts are due together, is
+        driven in one call instead.  A PC that has not answered
+        recovery_timeout SECONDS after it was powered on again ends in
+        PHASE_FAILED.  None waits for it for ever.
+        """
+        self.set_relay = set_relay
+        self.set_relays = set_relays
+        self.on_phase = on_phase
+        self.clock = clock
+        self.recovery_timeout = recovery_timeout
+
+        # Relay changes waiting to be driven together, as {channel: closed}.
+        self.relay_batch = {}
+
+        # Name -> the machine of every restart in progress.
+        self.machines = {}
+
+        # Entries are (deadline, sequence, name).  Entries that no longer
+        # match the deadline of their machine are stale and skipped.
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+
+        # Entries are (deadline, sequence, callback) of calls made by call_at.
+        self.timers = []
+        self.stopping = False
+
+        self.thread = None
+        if background:
+            self.thread = threading.Thread(target=self.__run, name='RestartEngine', daemon=True)
+            self.thread.start()
+
+    def restart(self, name, relay_channel, hold_power_switch, wait_before_shutdown, requested_at=None):
+        """
+        Starts power cycling a PC and returns its machine, or None when the PC
+        is already being restarted.
+        """
+        with self.condition:
+            if name in self.machines:
+                return None
+            now = self.clock()
+            machine = RestartMachine(name, relay_channel, hold_power_switch, wait_before_shutdown,
+                                     now if requested_at is None else requested_at, now)
+            self.machines[name] = machine
+            changed = [self.__enter(machine, PHASE_POWER_OFF_PRESS, now)]
+            self.__flush_relays()
+            self.condition.notify()
+        self.__report(changed)
+        return machine
+
+    def resume(self, name, relay_channel, hold_power_switch, wait_before_shutdown, phase, elapsed=0.0):
+        """
+        Takes over a restart that was in progress before the monitor stopped,
+        in PHASE_SHUTDOWN_WAIT or PHASE_RECOVERING, which it entered elapsed
+        SECONDS ago.  The relay is left open.  Returns the machine, or None
+        when the PC is already being restarted.
+        """
+        with self.condition:
+            if name in self.machines:
+                return None
+            entered = self.clock() - elapsed
+            machine = RestartMachine(name, relay_channel, hold_power_switch, wait_before_shutdown,
+                                     entered, entered)
+            self.machines[name] = machine
+            changed = [self.__enter(machine, phase, entered)]
+            self.__flush_relays()
+            self.condition.notify()
+        self.__report(changed)
+        return machine
+
+    def active(self, name):
+        """Returns the machine of the PC's restart in progress, or None."""
+        with self.condition:
+            return self.machines.get(name)
+
+    def in_progress(self):
+        """Returns the machines of every restart in progress."""
+        with self.condition:
+            return list(self.machines.values())
+
+    def call_at(self, when, callback):
+        """Calls callback() from the engine's thread once its clock reaches when."""
+        with self.condition:
+            heapq.heappush(self.timers, (when, next(self.sequence), callback))
+            self.condition.notify()
+
+    def host_responded(self, name):
+        """
+        Tells the engine that the PC answered.  A PC that answers while it is
+        recovering has been restarted.  One that answers during the shutdown
+        wait after it went down came back by itself, so its restart is
+        cancelled before it is powered on again.  A PC still answering while
+        it shuts down gracefully is left alone.  Returns the phase of the
+        machine afterwards, or None when the PC is not being restarted.
+        """
+        with self.condition:
+            machine = self.machines.get(name)
+            if machine is None:
+                return None
+            now = self.clock()
+            if machine.phase == PHASE_RECOVERING:
+                machine.time_to_recovery = now - machine.started_at
+                changed = [self.__finish(machine, PHASE_DONE, now)]
+            elif machine.phase == PHASE_SHUTDOWN_WAIT and machine.went_down:
+                changed = [self.__finish(machine, PHASE_CANCELLED, now)]
+            else:
+                return machine.phase
+            self.__flush_relays()
+        self.__report(changed)
+        return machine.phase
+
+    def host_failed(self, name):
+        """Tells the engine that the PC did not answer."""
+        with self.condition:
+            machine = self.machines.get(name)
+            if machine is not None and machine.phase in (PHASE_POWER_OFF_PRESS, PHASE_SHUTDOWN_WAIT):
+                machine.went_down = True
+
+    def cancel(self, name):
+        """Stops the PC's restart, opening its relay if it is closed.  Returns the machine or None."""
+        with self.condition:
+            machine = self.machines.get(name)
+            if machine is None:
+                return None
+            changed = [self.__finish(machine, PHASE_CANCELLED, self.clock())]
+            self.__flush_relays()
+        self.__report(changed)
+        return machine
+
+    def next_deadline(self):
+        """Returns the earliest phase deadline or timer, or None."""
+        with self.condition:
+            return self.__next_wakeup()
+
+    def run_due(self, now=None):
+        """Moves every machine whose phase has timed out on to its next phase."""
+        with self.condition:
+            if now is None:
+                now = self.clock()
+            changed = []
+            while True:
+                deadline = self.__next_deadline()
+                if deadline is None or deadline > now:
+                    break
+                _, _, name = heapq.heappop(self.heap)
+                changed.append(self.__advance(self.machines[name], deadline))
+            self.__flush_relays()
+
+            callbacks = []
+            while self.timers and self.timers[0][0] <= now:
+                callbacks.append(heapq.heappop(self.timers)[2])
+        self.__report(changed)
+        for callback in callbacks:
+            callback()
+
+    def close(self):
+        """Cancels every restart in progress and stops the engine's thread."""
+        with self.condition:
+            now = self.clock()
+            changed = [self.__finish(machine, PHASE_CANCELLED, now) for machine in list(self.machines.values())]
+            self.__flush_relays()
+            self.stopping = True
+            self.condition.notify()
+        self.__report(changed)
+        if self.thread is not None:
+            self.thread.join()
+
+    def __run(self):
+        while True:
+            with self.condition:
+                if self.stopping:
+                    return
+                deadline = self.__next_wakeup()
+                timeout = None if deadline is None else deadline - self.clock()
+                if timeout is None or timeout > 0:
+                    self.condition.wait(timeout)
+                    continue
+            self.run_due()
+
+    def __advance(self, machine, now):
+        """Runs the action at the end of a timed phase.  Phases are timed from their deadline."""
+        if machine.phase == PHASE_POWER_OFF_PRESS:
+            return self.__enter(machine, PHASE_SHUTDOWN_WAIT, now)
+        if machine.phase == PHASE_SHUTDOWN_WAIT:
+            return self.__enter(machine, PHASE_POWER_ON_PRESS, now)
+        if machine.phase == PHASE_RECOVERING:
+            return self.__finish(machine, PHASE_FAILED, now)
+        return self.__enter(machine, PHASE_RECOVERING, now)
+
+    def __enter(self, machine, phase, now):
+        """
+        Switches a machine to a phase, driving its relay, and returns what to
+        report.  Must hold the lock.
+        """
+        if machine.phase is not None:
+            machine.phase_durations[machine.phase] = now - machine.phase_started_at
+        machine.phase = phase
+        machine.phase_started_at = now
+
+        if phase in (PHASE_POWER_OFF_PRESS, PHASE_POWER_ON_PRESS):
+            # Close the relay to press the power switch.
+            self.__drive(machine.relay_channel, True)
+            if machine.relay_closed_at is None:
+                machine.relay_closed_at = self.clock()
+            machine.deadline = now + machine.hold_power_switch
+        else:
+            self.__drive(machine.relay_channel, False)
+            machine.deadline = None
+            if phase == PHASE_SHUTDOWN_WAIT:
+                machine.deadline = now + machine.wait_before_shutdown
+            elif phase == PHASE_RECOVERING and self.recovery_timeout is not None and self.recovery_timeout < math.inf:
+                machine.deadline = now + self.recovery_timeout
+
+        if machine.deadline is not None:
+            heapq.heappush(self.heap, (machine.deadline, next(self.sequence), machine.name))
+        return machine, phase
+
+    def __drive(self, channel, closed):
+        """Drives a relay, or adds it to the batch.  Must hold the lock."""
+        if self.set_relays is None:
+            self.set_relay(channel, closed)
+            return
+        # A relay that changes twice in one batch must still be pressed and released.
+        if channel in self.relay_batch:
+            self.__flush_relays()
+        self.relay_batch[channel] = closed
+
+    def __flush_relays(self):
+        """Drives every batched relay change in one call.  Must hold the lock."""
+        if self.relay_batch:
+            batch = self.relay_batch
+            self.relay_batch = {}
+            self.set_relays(batch)
+
+    def __finish(self, machine, phase, now):
+        """Ends a machine's restart.  Must hold the lock."""
+        del self.machines[machine.name]
+        return self.__enter(machine, phase, now)
+
+    def __next_deadline(self):
+        while self.heap:
+            deadline, _, name = self.heap[0]
+            machine = self.machines.get(name)
+            if machine is not None and machine.deadline == deadline:
+                return deadline
+            heapq.heappop(self.heap)
+        return None
+
+    def __next_wakeup(self):
+        deadlines = [deadline for deadline in (self.__next_deadline(),
+                                               self.timers[0][0] if self.timers else None)
+                     if deadline is not None]
+        return min(deadlines) if deadlines else None
+
+    def __report(self, changes):
+        if self.on_phase is None:
+            return
+        for machine, phase in changes:
+            self.on_phase(machine, phase)
+
+class RestartRequest(object):
+    """A restart waiting in the RestartScheduler's queue."""
+    def __init__(self, name, relay_channel, hold_power_switch, wait_before_shutdown, requested_at,
+                 priority, depends_on, sequence, manual=False):
+        self.name = name
+        self.relay_channel = relay_channel
+        self.hold_power_switch = hold_power_switch
+        self.wait_before_shutdown = wait_before_shutdown
+        self.requested_at = requested_at
+        self.priority = priority
+        self.depends_on = tuple(depends_on)
+        self.sequence = sequence
+
+        # Whether someone asked for the restart rather than the PC being found down,
+        # and whether the PC stopped answering while it waited.
+        self.manual = manual
+        self.went_down = False
+
+    def sort_key(self):
+        """Higher priorities first, then first come first served."""
+        return (-self.priority, self.sequence)
+
+class RestartScheduler(object):
+    """
+    Decides when requested restarts are handed to the RestartEngine.
+
+    When a whole rack goes down at once, powering every PC on together
+    causes inrush current and a boot storm on shared storage.  The
+    scheduler caps how many restarts run at once and spaces their starts
+    apart.  Higher priority PCs go first, and a PC waits for the PCs it
+    depends on (a NAS before the compute nodes that mount it) to finish
+    restarting.  Each PC may only be restarted a limited number of times
+    in a period, which stops a PC that never boots properly from being
+    power cycled forever.
+    """
+    def __init__(self, engine, on_phase=None, max_concurrent=0, stagger=0.0, recovery_timeout=300.0,
+                 limit=0, limit_period=3600.0):
+        """
+        Max_concurrent of 0 means no cap.  Times are in SECONDS.  A restart
+        stops counting against the cap once its PC answers again or it has
+        been recovering for recovery_timeout, when the engine gives it up
+        as PHASE_FAILED.  Limit of 0 means PCs may be
+        restarted any number of times.  The scheduler takes over the
+        engine's phase callback and passes every phase on to on_phase.
+        """
+        self.engine = engine
+        self.engine.on_phase = self.__phase_changed
+        self.engine.recovery_timeout = recovery_timeout
+        self.on_phase = on_phase
+        self.max_concurrent = max_concurrent
+        self.stagger = stagger
+        self.recovery_timeout = recovery_timeout
+        self.limit = limit
+        self.limit_period = limit_period
+
+        self.lock = threading.RLock()
+        self.pending = []
+        self.sequence = itertools.count()
+        self.last_start = None
+        self.wakeup_at = None
+
+        # Name -> times the PC's recent restarts were started.
+        self.starts = collections.defaultdict(collections.deque)
+
+        # Counters that show how long restarts wait for their turn.
+        self.started = 0
+        self.rate_limited = 0
+        self.max_queue_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def configure(self, max_concurrent, stagger, recovery_timeout, limit, limit_period):
+        """Changes the limits.  Queued restarts are looked at again straight away."""
+        with self.lock:
+            self.max_concurrent = max_concurrent
+            self.stagger = stagger
+            self.recovery_timeout = recovery_timeout
+            self.engine.recovery_timeout = recovery_timeout
+            self.limit = limit
+            self.limit_period = limit_period
+            self.dispatch()
+
+    def request(self, name, relay_channel, hold_power_switch, wait_before_shutdown, requested_at=None,
+                priority=0, depends_on=(), manual=False):
+        """
+        Asks for a PC to be restarted and returns REQUEST_STARTED when it
+        started straight away, REQUEST_QUEUED when it has to wait,
+        REQUEST_DUPLICATE when it is already queued or restarting and
+        REQUEST_RATE_LIMITED when it has been restarted too often.  A manual
+        restart is asked for by someone rather than because the PC is down.
+        """
+        with self.lock:
+            now = self.engine.clock()
+            if (self.engine.active(name) is not None or
+                    any(request.name == name for request in self.pending)):
+                return REQUEST_DUPLICATE
+
+            if self.limit:
+                starts = self.starts[name]
+                while starts and starts[0] <= now - self.limit_period:
+                    starts.popleft()
+                if len(starts) >= self.limit:
+                    self.rate_limited += 1
+                    return REQUEST_RATE_LIMITED
+
+            self.pending.append(RestartRequest(name, relay_channel, hold_power_switch, wait_before_shutdown,
+                                               now if requested_at is None else requested_at,
+                                               priority, depends_on, next(self.sequence), manual))
+            self.pending.sort(key=RestartRequest.sort_key)
+            self.dispatch()
+            if any(request.name == name for request in self.pending):
+                self.max_queue_depth = max(self.max_queue_depth, len(self.pending))
+                return REQUEST_QUEUED
+            return REQUEST_STARTED
+
+    def host_responded(self, name):
+        """
+        Tells the scheduler that the PC answered.  A queued restart of a PC
+        that was found down, or went down while it waited, is dropped and
+        PHASE_CANCELLED returned.  A queued manual restart of a PC that is
+        still answering keeps its place and PHASE_QUEUED is returned.
+        Otherwise this is passed on to RestartEngine.host_responded.
+        """
+        with self.lock:
+            request = self.__queued(name)
+            if request is not None:
+                if request.manual and not request.went_down:
+                    return PHASE_QUEUED
+                self.pending.remove(request)
+                return PHASE_CANCELLED
+        return self.engine.host_responded(name)
+
+    def host_failed(self, name):
+        """Tells the scheduler that the PC did not answer.  See RestartEngine.host_failed."""
+        with self.lock:
+            request = self.__queued(name)
+            if request is not None:
+                request.went_down = True
+                return
+        self.engine.host_failed(name)
+
+    def cancel(self, name):
+        """Drops a queued restart or cancels one in progress."""
+        with self.lock:
+            if self.__remove(name):
+                return
+        self.engine.cancel(name)
+
+    def queue_depth(self):
+        """Returns the number of restarts waiting for their turn."""
+        with self.lock:
+            return len(self.pending)
+
+    def dispatch(self):
+        """Starts every queued restart whose turn has come."""
+        with self.lock:
+            now = self.engine.clock()
+            busy = {machine.name: machine for machine in self.engine.in_progress()
+                    if not self.__settled(machine, now)}
+            waiting = {request.name for request in self.pending}
+            wakeup = None
+
+            for request in list(self.pending):
+                if self.max_concurrent and len(busy) >= self.max_concurrent:
+                    break
+                if any(name in busy or name in waiting for name in request.depends_on):
+                    continue
+                if self.stagger and self.last_start is not None and now < self.last_start + self.stagger:
+                    wakeup = self.last_start + self.stagger
+                    break
+
+                self.pending.remove(request)
+                waiting.discard(request.name)
+                self.last_start = now
+                self.starts[request.name].append(now)
+                self.started += 1
+                wait = now - request.requested_at
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                busy[request.name] = self.engine.restart(request.name, request.relay_channel,
+                                                         request.hold_power_switch,
+                                                         request.wait_before_shutdown, request.requested_at)
+
+            # Look again when a recovering PC stops counting against the cap.
+            if self.pending:
+                wakeups = [machine.phase_started_at + self.recovery_timeout for machine in busy.values()
+                           if machine is not None and machine.phase == PHASE_RECOVERING]
+                if wakeup is not None:
+                    wakeups.append(wakeup)
+                wakeup = min(wakeups) if wakeups else None
+
+            if wakeup is not None and wakeup != self.wakeup_at:
+                self.wakeup_at = wakeup
+                self.engine.call_at(wakeup, self.dispatch)
+
+    def close(self):
+        """Drops every queued restart and closes the engine."""
+        with self.lock:
+            del self.pending[:]
+        self.engine.close()
+
+    def stats(self):
+        """Returns the queue depth and wait time figures."""
+        with self.lock:
+            return {'queue_depth': len(self.pending),
+                    'max_queue_depth': self.max_queue_depth,
+                    'started': self.started,
+                    'rate_limited': self.rate_limited,
+                    'mean_wait': self.total_wait / self.started if self.started else None,
+                    'max_wait': self.max_wait if self.started else None}
+
+    def __settled(self, machine, now):
+        """A PC that has been recovering for recovery_timeout no longer counts as restarting."""
+        return machine.phase == PHASE_RECOVERING and now - machine.phase_started_at >= self.recovery_timeout
+
+    def __queued(self, name):
+        return next((request for request in self.pending if request.name == name), None)
+
+    def __remove(self, name):
+        request = self.__queued(name)
+        if request is None:
+            return False
+        self.pending.remove(request)
+        return True
+
+    def __phase_changed(self, machine, phase):
+        if self.on_phase is not None:
+            self.on_phase(machine, phase)
+
+        # A finished restart frees a slot for the next one, and a recovering
+        # one will free its slot after recovery_timeout.
+        if phase in (PHASE_RECOVERING, PHASE_DONE, PHASE_CANCELLED, PHASE_FAILED):
+            self.dispatch()
@@ -0,0 +1,323 @@
+import pytest
+import threading
+
+from pc_reset_restart import (PHASE_CANCELLED, PHASE_DONE, PHASE_FAILED, PHASE_POWER_OFF_PRESS, PHASE_POWER_ON_PRESS,
+                              PHASE_QUEUED, PHASE_RECOVERING, PHASE_SHUTDOWN_WAIT, REQUEST_DUPLICATE, REQUEST_QUEUED,
+                              REQUEST_RATE_LIMITED, REQUEST_STARTED, RestartEngine, RestartScheduler)
+
+@pytest.fixture()
+def clock():
+    return [100.0]
+
+@pytest.fixture()
+def relays():
+    """Records every (channel, closed) the engine drives."""
+    return []
+
+@pytest.fixture()
+def phases():
+    """Records every (name, phase) the engine reports."""
+    return []
+
+@pytest.fixture()
+def engine(clock, relays, phases):
+    engine = RestartEngine(lambda channel, closed: relays.append((channel, closed)),
+                           on_phase=lambda machine, phase: phases.append((machine.name, phase)),
+                           clock=lambda: clock[0], background=False)
+    yield engine
+    engine.close()
+
+def test_full_power_cycle(engine, clock, relays, phases):
+    """The relay is pressed, released, pressed and released again on timers."""
+    machine = engine.restart('pc', 5, 3, 30, requested_at=99.5)
+
+    engine.run_due(102.9)
+    assert machine.phase == PHASE_POWER_OFF_PRESS
+    engine.run_due(103)
+    assert machine.phase == PHASE_SHUTDOWN_WAIT
+    engine.run_due(133)
+    assert machine.phase == PHASE_POWER_ON_PRESS
+    engine.run_due(136)
+    assert machine.phase == PHASE_RECOVERING
+
+    clock[0] = 150.0
+    assert engine.host_responded('pc') == PHASE_DONE
+
+    assert relays == [(5, True), (5, False), (5, True), (5, False), (5, False)]
+    assert [phase for _, phase in phases] == [PHASE_POWER_OFF_PRESS, PHASE_SHUTDOWN_WAIT, PHASE_POWER_ON_PRESS,
+                                              PHASE_RECOVERING, PHASE_DONE]
+    assert machine.phase_durations == {PHASE_POWER_OFF_PRESS: 3, PHASE_SHUTDOWN_WAIT: 30,
+                                       PHASE_POWER_ON_PRESS: 3, PHASE_RECOVERING: 14}
+    assert machine.time_to_recovery == 50
+    assert machine.relay_latency() == 0.5
+    assert engine.active('pc') is None
+
+def test_late_run_catches_up(engine, phases):
+    """Phases that timed out while the engine was not running are all worked through."""
+    engine.restart('pc', 5, 3, 30)
+
+    engine.run_due(200)
+
+    assert [phase for _, phase in phases][-1] == PHASE_RECOVERING
+
+def test_cancelled_when_pc_comes_back_during_wait(engine, clock, relays):
+    """A PC that answers during the shutdown wait is not powered on again."""
+    machine = engine.restart('pc', 5, 3, 30)
+    engine.run_due(110)
+    engine.host_failed('pc')
+
+    clock[0] = 110.0
+    assert engine.host_responded('pc') == PHASE_CANCELLED
+    engine.run_due(200)
+
+    assert machine.phase == PHASE_CANCELLED
+    assert relays == [(5, True), (5, False), (5, False)]
+    assert engine.next_deadline() is None
+
+def test_pc_still_shutting_down_not_cancelled(engine, clock, relays):
+    """A PC that keeps answering for a while into the shutdown wait is still powered on again."""
+    machine = engine.restart('pc', 5, 3, 30)
+    engine.run_due(103)
+    for now in (105.0, 107.0):
+        clock[0] = now
+        assert engine.host_responded('pc') == PHASE_SHUTDOWN_WAIT
+    engine.host_failed('pc')
+
+    engine.run_due(136)
+
+    assert machine.phase == PHASE_RECOVERING
+    assert relays == [(5, True), (5, False), (5, True), (5, False)]
+
+def test_reply_while_pressed_ignored(engine):
+    """A reply while the power switch is held does not end the restart."""
+    engine.restart('pc', 5, 3, 30)
+
+    assert engine.host_responded('pc') == PHASE_POWER_OFF_PRESS
+    assert engine.active('pc') is not None
+
+def test_cancel_opens_relay(engine, relays):
+    """Cancelling while the power switch is held releases it."""
+    engine.restart('pc', 5, 3, 30)
+
+    engine.cancel('pc')
+
+    assert relays[-1] == (5, False)
+    assert engine.active('pc') is None
+
+def test_duplicate_restart_refused(engine):
+    """A PC that is already being restarted is not restarted twice."""
+    assert engine.restart('pc', 5, 3, 30) is not None
+    assert engine.restart('pc', 5, 3, 30) is None
+
+def test_many_concurrent_restarts(engine, relays):
+    """Any number of PCs are power cycled at once without a thread each."""
+    for channel in range(100):
+        engine.restart('pc{}'.format(channel), channel, 3, 30)
+    threads = threading.active_count()
+
+    engine.run_due(136)
+
+    assert threading.active_count() == threads
+    assert all(engine.active('pc{}'.format(channel)).phase == PHASE_RECOVERING for channel in range(100))
+    assert len(relays) == 400
+
+def test_background_thread():
+    """The engine's own thread moves the phases on in real time."""
+    done = threading.Event()
+    engine = RestartEngine(lambda channel, closed: None,
+                           on_phase=lambda machine, phase: phase == PHASE_RECOVERING and done.set())
+    try:
+        engine.restart('pc', 5, 0.01, 0.02)
+        assert done.wait(1)
+    finally:
+        engine.close()
+
+def recover(engine, clock, name):
+    """Runs a PC's restart through to the point where it answers again."""
+    machine = engine.active(name)
+    clock[0] = machine.started_at + machine.hold_power_switch * 2 + machine.wait_before_shutdown
+    engine.run_due(clock[0])
+    assert engine.host_responded(name) == PHASE_DONE
+
+def test_scheduler_caps_concurrent_restarts(engine, clock, phases):
+    """Restarts beyond the cap wait until a running one has finished."""
+    scheduler = RestartScheduler(engine, max_concurrent=2)
+
+    statuses = [scheduler.request('pc{}'.format(index), index, 3, 30) for index in range(4)]
+
+    assert statuses == [REQUEST_STARTED, REQUEST_STARTED, REQUEST_QUEUED, REQUEST_QUEUED]
+    assert scheduler.queue_depth() == 2
+    recover(engine, clock, 'pc0')
+    assert engine.active('pc2') is not None
+    assert engine.active('pc3') is None
+    assert scheduler.queue_depth() == 1
+
+def test_scheduler_staggers_starts(engine, clock):
+    """Starts are spaced at least stagger apart."""
+    scheduler = RestartScheduler(engine, stagger=10)
+    for index in range(3):
+        scheduler.request('pc{}'.format(index), index, 3, 30)
+
+    assert [machine.name for machine in engine.in_progress()] == ['pc0']
+    clock[0] = 110.0
+    engine.run_due(110)
+    assert sorted(machine.name for machine in engine.in_progress()) == ['pc0', 'pc1']
+    clock[0] = 120.0
+    engine.run_due(120)
+    assert engine.active('pc2').started_at == 120
+    assert scheduler.stats()['max_wait'] == 20
+
+def test_scheduler_priority(engine, clock):
+    """Higher priority restarts jump the queue."""
+    scheduler = RestartScheduler(engine, max_concurrent=1)
+    scheduler.request('first', 1, 3, 30)
+    scheduler.request('low', 2, 3, 30, priority=0)
+    scheduler.request('high', 3, 3, 30, priority=5)
+
+    recover(engine, clock, 'first')
+
+    assert engine.active('high') is not None
+    assert engine.active('low') is None
+
+def test_scheduler_dependencies(engine, clock):
+    """A PC waits for the PCs it depends on to finish restarting."""
+    scheduler = RestartScheduler(engine)
+    assert scheduler.request('compute', 1, 3, 30, depends_on=['nas']) == REQUEST_STARTED
+    engine.cancel('compute')
+
+    scheduler.request('nas', 2, 3, 30)
+    assert scheduler.request('compute', 1, 3, 30, depends_on=['nas']) == REQUEST_QUEUED
+
+    recover(engine, clock, 'nas')
+    assert engine.active('compute') is not None
+
+def test_scheduler_recovery_timeout_frees_slot(engine, clock):
+    """A PC that never answers stops holding up the queue after recovery_timeout."""
+    scheduler = RestartScheduler(engine, max_concurrent=1, recovery_timeout=60)
+    scheduler.request('dead', 1, 3, 30)
+    scheduler.request('next', 2, 3, 30)
+
+    engine.run_due(136)
+    assert engine.active('next') is None
+    clock[0] = 196.0
+    engine.run_due(196)
+    assert engine.active('next') is not None
+
+def test_pc_that_never_answers_can_be_restarted_again(engine, clock, phases):
+    """A restart whose PC does not answer within recovery_timeout fails, so the PC is not stuck restarting."""
+    scheduler = RestartScheduler(engine, lambda machine, phase: phases.append((machine.name, phase)),
+                                 recovery_timeout=60)
+    scheduler.request('dead', 1, 3, 30)
+    machine = engine.active('dead')
+
+    engine.run_due(136)
+    assert machine.phase == PHASE_RECOVERING
+    assert scheduler.request('dead', 1, 3, 30) == REQUEST_DUPLICATE
+    clock[0] = 196.0
+    engine.run_due(196)
+
+    assert machine.phase == PHASE_FAILED
+    assert machine.finished
+    assert phases[-1] == ('dead', PHASE_FAILED)
+    assert engine.active('dead') is None
+    assert scheduler.request('dead', 1, 3, 30) == REQUEST_STARTED
+
+def test_resumed_recovery_times_out(engine, clock):
+    """A PC still recovering when the monitor restarted is given up once its recovery timeout is over."""
+    engine.recovery_timeout = 60
+    machine = engine.resume('pc', 5, 3, 30, PHASE_RECOVERING, elapsed=50)
+
+    engine.run_due(109.9)
+    assert machine.phase == PHASE_RECOVERING
+    engine.run_due(110)
+    assert machine.phase == PHASE_FAILED
+
+def test_scheduler_rate_limit(engine, clock):
+    """A PC is not restarted more than limit times in limit_period."""
+    scheduler = RestartScheduler(engine, limit=1, limit_period=3600)
+    scheduler.request('pc', 1, 3, 30)
+    assert scheduler.request('pc', 1, 3, 30) == REQUEST_DUPLICATE
+    recover(engine, clock, 'pc')
+
+    assert scheduler.request('pc', 1, 3, 30) == REQUEST_RATE_LIMITED
+    clock[0] += 3600
+    assert scheduler.request('pc', 1, 3, 30) == REQUEST_STARTED
+    assert scheduler.stats()['rate_limited'] == 1
+
+def test_scheduler_drops_queued_restart_when_pc_answers(engine):
+    """A PC that answers while its restart is queued is not restarted."""
+    scheduler = RestartScheduler(engine, max_concurrent=1)
+    scheduler.request('busy', 1, 3, 30)
+    scheduler.request('pc', 2, 3, 30)
+
+    assert scheduler.host_responded('pc') == PHASE_CANCELLED
+    assert scheduler.queue_depth() == 0
+
+def test_scheduler_keeps_queued_manual_restart_of_healthy_pc(engine, clock):
+    """A manual restart of a PC that keeps answering waits for its turn instead of being dropped."""
+    scheduler = RestartScheduler(engine, max_concurrent=1)
+    scheduler.request('busy', 1, 3, 30)
+    scheduler.request('pc', 2, 3, 30, manual=True)
+
+    assert scheduler.host_responded('pc') == PHASE_QUEUED
+    assert scheduler.queue_depth() == 1
+    recover(engine, clock, 'busy')
+    assert engine.active('pc') is not None
+
+def test_scheduler_drops_queued_manual_restart_of_pc_that_came_back(engine):
+    """A manual restart is still dropped when the PC went down and came back while it waited."""
+    scheduler = RestartScheduler(engine, max_concurrent=1)
+    scheduler.request('busy', 1, 3, 30)
+    scheduler.request('pc', 2, 3, 30, manual=True)
+
+    scheduler.host_failed('pc')
+
+    assert scheduler.host_responded('pc') == PHASE_CANCELLED
+    assert scheduler.queue_depth() == 0
+
+def test_resume_shutdown_wait_does_not_press_again(engine, relays, phases):
+    """A restart resumed during the shutdown wait only powers the PC on once the wait is over."""
+    machine = engine.resume('pc', 5, 3, 30, PHASE_SHUTDOWN_WAIT, elapsed=20)
+
+    engine.run_due(109.9)
+    assert machine.phase == PHASE_SHUTDOWN_WAIT
+    engine.run_due(110)
+
+    assert relays[:2] == [(5, False), (5, True)]
+    assert phases[0] == ('pc', PHASE_SHUTDOWN_WAIT)
+
+def test_resume_recovering(engine, relays):
+    """A restart resumed while recovering just waits for the PC."""
+    engine.resume('pc', 5, 3, 30, PHASE_RECOVERING, elapsed=5)
+
+    engine.run_due(1000)
+
+    assert relays == [(5, False)]
+    assert engine.host_responded('pc') == PHASE_DONE
+
+def test_relays_due_together_driven_in_one_batch(clock):
+    """Restarts whose phases end at the same moment switch their relays in one call."""
+    batches = []
+    engine = RestartEngine(lambda channel, closed: None, clock=lambda: clock[0], background=False,
+                           set_relays=lambda states: batches.append(dict(states)))
+    for channel in (1, 2, 3):
+        engine.restart('pc{}'.format(channel), channel, 3, 30)
+    del batches[:]
+
+    engine.run_due(103)
+
+    assert batches == [{1: False, 2: False, 3: False}]
+    engine.close()
+
+def test_batched_relay_still_pressed_and_released(clock):
+    """A relay that changes twice within one batch is not collapsed into a single change."""
+    batches = []
+    engine = RestartEngine(lambda channel, closed: None, clock=lambda: clock[0], background=False,
+                           set_relays=lambda states: batches.append(dict(states)))
+    engine.restart('pc', 5, 3, 0)
+    del batches[:]
+
+    engine.run_due(106)
+
+    assert batches == [{5: False}, {5: True}, {5: False}]
+    engine.close()
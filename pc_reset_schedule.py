@@ -0,0 +1,105 @@
+import heapq
+import itertools
+import time
+
+# How often a host is probed depends on what state it is in.
+STATE_HEALTHY = 'healthy'
+STATE_SUSPECT = 'suspect'
+STATE_RECOVERING = 'recovering'
+
+class ProbeScheduler(object):
+    """
+    Decides when each host is probed next.
+
+    Healthy hosts are probed at a relaxed interval.  As soon as a probe
+    fails the host is probed again at the short confirmation interval so a
+    dead PC is detected quickly, and a host being restarted is probed at its
+    own recovery interval.  The next deadline of every host lives in one
+    priority queue so any number of hosts share a single timer.
+    """
+    def __init__(self, healthy_interval, confirm_interval, recovery_interval, clock=time.monotonic):
+        """Intervals are in SECONDS.  Clock returns the current time."""
+        self.intervals = {STATE_HEALTHY: healthy_interval,
+                          STATE_SUSPECT: confirm_interval,
+                          STATE_RECOVERING: recovery_interval}
+        self.clock = clock
+
+        # Entries are (deadline, sequence, name).  Entries that no longer match
+        # self.deadlines are stale and skipped when popped.
+        self.heap = []
+        self.deadlines = {}
+        self.sequence = itertools.count()
+
+        # Counters that show how well the schedule is doing.
+        self.probes_scheduled = 0
+        self.detections = 0
+        self.total_time_to_detect = 0.0
+        self.max_time_to_detect = 0.0
+
+    def set_intervals(self, healthy_interval, confirm_interval, recovery_interval):
+        """Changes the intervals used from the next time a host is scheduled."""
+        self.intervals = {STATE_HEALTHY: healthy_interval,
+                          STATE_SUSPECT: confirm_interval,
+                          STATE_RECOVERING: recovery_interval}
+
+    def add(self, name):
+        """Adds a host that is due to be probed straight away."""
+        self.__push(name, 0.0)
+
+    def remove(self, name):
+        """Stops scheduling a host."""
+        self.deadlines.pop(name, None)
+
+    def schedule(self, name, state, now=None):
+        """Schedules the next probe of a host from the state it is in."""
+        if now is None:
+            now = self.clock()
+        self.__push(name, now + self.intervals[state])
+
+    def due(self, now=None):
+        """Removes and returns the names of every host whose probe is due."""
+        if now is None:
+            now = self.clock()
+
+        names = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, _, name = heapq.heappop(self.heap)
+            if self.deadlines.get(name) == deadline:
+                del self.deadlines[name]
+                names.append(name)
+
+        self.probes_scheduled += len(names)
+        return names
+
+    def next_deadline(self):
+        """Returns the earliest deadline, or None when nothing is scheduled."""
+        while self.heap and self.deadlines.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def time_until_next(self, now=None):
+        """Returns the time until the next probe is due (SECONDS), or None."""
+        deadline = self.next_deadline()
+        if deadline is None:
+            return None
+        if now is None:
+            now = self.clock()
+        return max(0.0, deadline - now)
+
+    def record_detection(self, time_to_detect):
+        """Records how long it took to declare a host dead (SECONDS)."""
+        self.detections += 1
+        self.total_time_to_detect += time_to_detect
+        self.max_time_to_detect = max(self.max_time_to_detect, time_to_detect)
+
+    def stats(self):
+        """Returns the probe count and time-to-detect figures."""
+        return {'probes': self.probes_scheduled,
+                'detections': self.detections,
+                'mean_time_to_detect': (self.total_time_to_detect / self.detections
+                                        if self.detections else None),
+                'max_time_to_detect': self.max_time_to_detect if self.detections else None}
+
+    def __push(self, name, deadline):
+        self.deadlines[name] = deadline
+        heapq.heappush(self.heap, (deadline, next(self.sequence), name))
@@ -0,0 +1,59 @@
+import pytest
+
+from pc_reset_schedule import ProbeScheduler, STATE_HEALTHY, STATE_RECOVERING, STATE_SUSPECT
+
+@pytest.fixture()
+def scheduler():
+    """Creates a scheduler on a clock that only moves when a test moves it."""
+    clock = [1000.0]
+    scheduler = ProbeScheduler(10, 1, 5, clock=lambda: clock[0])
+    scheduler.now = clock
+    return scheduler
+
+def test_new_hosts_due_immediately(scheduler):
+    """Hosts are probed as soon as they are added."""
+    scheduler.add('pc1')
+    scheduler.add('pc2')
+
+    assert sorted(scheduler.due()) == ['pc1', 'pc2']
+    assert scheduler.due() == []
+
+def test_interval_depends_on_state(scheduler):
+    """Suspect hosts come round quickly, healthy ones slowly."""
+    scheduler.schedule('healthy', STATE_HEALTHY)
+    scheduler.schedule('suspect', STATE_SUSPECT)
+    scheduler.schedule('recovering', STATE_RECOVERING)
+
+    scheduler.now[0] += 1
+    assert scheduler.due() == ['suspect']
+    scheduler.now[0] += 4
+    assert scheduler.due() == ['recovering']
+    scheduler.now[0] += 5
+    assert scheduler.due() == ['healthy']
+
+def test_reschedule_replaces_deadline(scheduler):
+    """Only the most recent deadline of a host counts."""
+    scheduler.schedule('pc1', STATE_HEALTHY)
+    scheduler.schedule('pc1', STATE_SUSPECT)
+
+    assert scheduler.time_until_next() == 1
+    scheduler.now[0] += 10
+    assert scheduler.due() == ['pc1']
+
+def test_removed_host_not_due(scheduler):
+    """Removed hosts are never returned."""
+    scheduler.add('pc1')
+    scheduler.remove('pc1')
+
+    assert scheduler.due() == []
+    assert scheduler.next_deadline() is None
+
+def test_stats(scheduler):
+    """Probes and detection times are counted."""
+    scheduler.add('pc1')
+    scheduler.due()
+    scheduler.record_detection(3)
+    scheduler.record_detection(5)
+
+    assert scheduler.stats() == {'probes': 1, 'detections': 2,
+                                 'mean_time_to_detect': 4, 'max_time_to_detect': 5}
@@ -0,0 +1,313 @@
+"""
+Runs a real PingBoy against a fleet of virtual PCs on virtual time.
+
+Every virtual PC follows a script of faults: a hang that only a power cycle
+clears, a network outage that clears by itself, or a spell of flapping with
+some of its pings lost.  The PCs are wired to simulated GPIO, so they see
+the relay presses of the restart engine, and answer the pings of a
+simulated prober.  Time only moves when the monitor has something to do,
+so a day of a thousand PCs with 30 second shutdown waits runs in seconds.
+
+    simulation = FleetSimulation([VirtualHost('pc1', [Hang(600)])])
+    report = simulation.run(3600)
+    simulation.close()
+"""
+import os
+import random
+import shutil
+import tempfile
+
+from pc_reset_probe import ERROR_TIMEOUT, ProbeResult
+
+# States of a virtual PC.
+STATE_UP = 'up'
+STATE_HUNG = 'hung'
+STATE_OFF = 'off'
+STATE_BOOTING = 'booting'
+
+class Hang(object):
+    """The PC stops answering at a time and stays that way until it is power cycled."""
+    def __init__(self, at):
+        self.at = at
+
+class Outage(object):
+    """Pings to the PC are lost for duration SECONDS, then it answers again by itself."""
+    def __init__(self, at, duration):
+        self.at = at
+        self.duration = duration
+
+class Flap(object):
+    """Each ping to the PC is lost with probability loss for duration SECONDS."""
+    def __init__(self, at, duration, loss):
+        self.at = at
+        self.duration = duration
+        self.loss = loss
+
+class VirtualClock(object):
+    """Time that only moves when told to (SECONDS)."""
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance_to(self, when):
+        self.now = max(self.now, when)
+
+class VirtualHost(object):
+    """
+    A PC that follows its script of faults.  Holding its power switch for at
+    least force_off_time turns it off even when hung, a shorter press shuts
+    a healthy PC down after shutdown_time, and any press of a PC that is
+    off boots it in boot_time.
+    """
+    def __init__(self, name, faults=(), rtt=0.001, jitter=0.0005, boot_time=60.0, shutdown_time=10.0,
+                 force_off_time=3.0, seed=0):
+        self.name = name
+        self.faults = sorted(faults, key=lambda fault: fault.at)
+        self.rtt = rtt
+        self.jitter = jitter
+        self.boot_time = boot_time
+        self.shutdown_time = shutdown_time
+        self.force_off_time = force_off_time
+        self.random = random.Random(seed)
+
+        self.state = STATE_UP
+        # When the PC hung, until it is power cycled.
+        self.hung_since = None
+        # Scheduled changes of state as (time, state), such as the end of a boot.
+        self.pending = []
+        # When the power switch was pressed, while it is held.
+        self.pressed_at = None
+        # Faults that have started, so outages and flaps can be checked.
+        self.next_fault = 0
+        self.active = []
+
+        # Every hang as [hung at, restart requested at, recovered at].
+        self.incidents = []
+
+    def update(self, now):
+        """Applies every scripted fault and scheduled change up to now."""
+        while True:
+            fault_at = self.faults[self.next_fault].at if self.next_fault < len(self.faults) else None
+            pending_at = self.pending[0][0] if self.pending else None
+            if (fault_at is None or fault_at > now) and (pending_at is None or pending_at > now):
+                break
+            if pending_at is not None and (fault_at is None or pending_at <= fault_at):
+                _, self.state = self.pending.pop(0)
+            else:
+                self.__start(self.faults[self.next_fault])
+                self.next_fault += 1
+        self.active = [fault for fault in self.active if fault.at + fault.duration > now]
+
+    def answers(self, now):
+        """Returns the round trip time of a ping at now, or None when it is lost."""
+        self.update(now)
+        if self.state != STATE_UP:
+            return None
+        for fault in self.active:
+            if isinstance(fault, Outage) or self.random.random() < fault.loss:
+                return None
+        return max(0.0, self.rtt + self.random.uniform(-self.jitter, self.jitter))
+
+    def relay_changed(self, now, closed):
+        """Called when the relay wired to the PC's power switch closes or opens."""
+        self.update(now)
+        if closed:
+            self.pressed_at = now
+            return
+        if self.pressed_at is None:
+            return
+        held = now - self.pressed_at
+        self.pressed_at = None
+
+        if self.state in (STATE_UP, STATE_HUNG):
+            if held >= self.force_off_time:
+                self.state = STATE_OFF
+                self.pending = []
+            elif self.state == STATE_UP and not self.pending:
+                self.pending.append((now + self.shutdown_time, STATE_OFF))
+            if self.state == STATE_OFF:
+                self.hung_since = None
+        elif self.state == STATE_OFF:
+            self.state = STATE_BOOTING
+            self.pending = [(now + self.boot_time, STATE_UP)]
+
+    def __start(self, fault):
+        if isinstance(fault, Hang):
+            if self.state == STATE_UP:
+                self.state = STATE_HUNG
+                self.hung_since = fault.at
+                self.pending = []
+                self.incidents.append([fault.at, None, None])
+        else:
+            self.active.append(fault)
+
+class SimulatedProber(object):
+    """Answers pings for the virtual PCs, taking no time."""
+    def __init__(self, hosts, clock):
+        self.hosts = hosts
+        self.clock = clock
+        self.probes = 0
+
+    def probe(self, hostname):
+        self.probes += 1
+        rtt = self.hosts[hostname].answers(self.clock())
+        if rtt is None:
+            return ProbeResult.failed(hostname, ERROR_TIMEOUT)
+        return ProbeResult.ok(hostname, rtt)
+
+    def sweep(self, hostnames):
+        return [self.probe(hostname) for hostname in hostnames]
+
+    def close(self):
+        pass
+
+class SimulationReport(object):
+    """What happened during a simulation.  Times are in SECONDS."""
+    def __init__(self, hosts, duration, probes, restarts, false_restarts):
+        self.duration = duration
+        self.probes = probes
+        self.restarts = restarts
+        # Restarts of PCs that were not hung.
+        self.false_restarts = false_restarts
+
+        incidents = [incident for host in hosts for incident in host.incidents]
+        self.hangs = len(incidents)
+        self.times_to_detect = sorted(requested - hung for hung, requested, _ in incidents if requested is not None)
+        self.times_to_recover = sorted(recovered - hung for hung, _, recovered in incidents
+                                       if recovered is not None)
+        # Hangs that were never noticed.
+        self.missed = sum(1 for _, requested, _ in incidents if requested is None)
+
+    def as_dict(self):
+        def summary(values):
+            return {'mean': sum(values) / len(values) if values else None,
+                    'max': values[-1] if values else None}
+        return {'duration': self.duration,
+                'probes': self.probes,
+                'restarts': self.restarts,
+                'false_restarts': self.false_restarts,
+                'hangs': self.hangs,
+                'missed': self.missed,
+                'time_to_detect': summary(self.times_to_detect),
+                'time_to_recover': summary(self.times_to_recover)}
+
+class FleetSimulation(object):
+    """A PingBoy watching virtual PCs, on simulated GPIO and virtual time."""
+    def __init__(self, hosts, config=None, directory=None, verbose=False):
+        """
+        Config holds extra {(section, key): value} for the generated config
+        file, such as timing values.  The config and log go in directory, or
+        a temporary one removed on close.
+        """
+        from pc_reset_ping import PingBoy
+
+        self.hosts = {host.name: host for host in hosts}
+        self.own_directory = directory is None
+        self.directory = tempfile.mkdtemp(prefix='pc_reset_sim') if directory is None else directory
+        self.clock = VirtualClock()
+        self.restarts = 0
+        self.false_restarts = 0
+
+        config_file = os.path.join(self.directory, 'sim.ini')
+        self.__write_config(config_file, hosts, config or {})
+        self.pingboy = PingBoy(config_file, clock=self.clock, log_file=os.path.join(self.directory, 'sim.log'))
+        self.pingboy.my_logger.logger.disabled = not verbose
+
+        # Relays drive the virtual PCs' power switches.
+        self.relay_hosts = {host_config['relay_channel']: self.hosts[host_config['name']]
+                            for host_config in self.pingboy.config_values['hosts']}
+        self.pingboy.gpio.clock = self.clock
+        self.pingboy.gpio.listener = self.__relay_changed
+
+        self.pingboy.prober.close()
+        self.prober = self.pingboy.prober = SimulatedProber(self.hosts, self.clock)
+
+        self.pingboy.sig_restart_in_progress.connect(self.__restart_requested)
+        self.pingboy.sig_successful_restart.connect(self.__restart_succeeded)
+
+    def run(self, duration):
+        """Runs the monitor for duration virtual SECONDS and returns a SimulationReport so far."""
+        until = self.clock() + duration
+        scheduler = self.pingboy.scheduler
+        engine = self.pingboy.restart_engine
+        while True:
+            deadlines = [deadline for deadline in (scheduler.next_deadline(), engine.next_deadline())
+                         if deadline is not None]
+            if not deadlines or min(deadlines) > until:
+                break
+            self.clock.advance_to(min(deadlines))
+            engine.run_due(self.clock())
+            self.pingboy.ping()
+        self.clock.advance_to(until)
+        return self.report()
+
+    def report(self):
+        return SimulationReport(self.hosts.values(), self.clock(), self.prober.probes, self.restarts,
+                                self.false_restarts)
+
+    def close(self):
+        self.pingboy.close()
+        if self.own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __write_config(self, config_file, hosts, config):
+        lines = ['[Comm]', 'probe_backend = subprocess', '',
+                 '[Channel]', 'backend = simulated', '',
+                 '[Logging]', 'asynchronous = no', '']
+        sections = {}
+        for (section, key), value in config.items():
+            sections.setdefault(section, []).append('{} = {}'.format(key, value))
+        for section, values in sections.items():
+            lines += ['[{}]'.format(section)] + values + ['']
+        for index, host in enumerate(hosts):
+            lines += ['[Host:{}]'.format(host.name), 'hostname = {}'.format(host.name),
+                      'relay_channel = {}'.format(index), 'switch_channel = {}'.format(len(hosts) + index), '']
+        with open(config_file, 'w') as file:
+            file.write('\n'.join(lines))
+
+    def __relay_changed(self, time, channel, closed):
+        host = self.relay_hosts.get(channel)
+        if host is not None:
+            host.relay_changed(time, closed)
+
+    def __restart_requested(self, name):
+        host = self.hosts[name]
+        host.update(self.clock())
+        self.restarts += 1
+        if host.state != STATE_HUNG:
+            self.false_restarts += 1
+        elif host.incidents and host.incidents[-1][1] is None:
+            host.incidents[-1][1] = self.clock()
+
+    def __restart_succeeded(self, name):
+        host = self.hosts[name]
+        if host.incidents and host.incidents[-1][1] is not None and host.incidents[-1][2] is None:
+            host.incidents[-1][2] = self.clock()
+
+def random_fleet(count, duration, seed=0, hangs_per_day=0.5, outages_per_day=2.0, outage_duration=8.0,
+                 flaps_per_day=1.0, flap_duration=300.0, flap_loss=0.2):
+    """Returns count virtual PCs with faults scattered over duration SECONDS, the same for the same seed."""
+    day = 86400.0
+    hosts = []
+    for index in range(count):
+        generator = random.Random(seed * 1000003 + index)
+
+        def times(rate):
+            return [generator.uniform(0, duration) for _ in range(poisson(generator, rate * duration / day))]
+
+        faults = ([Hang(at) for at in times(hangs_per_day)] +
+                  [Outage(at, outage_duration) for at in times(outages_per_day)] +
+                  [Flap(at, flap_duration, flap_loss) for at in times(flaps_per_day)])
+        hosts.append(VirtualHost('pc{}'.format(index), faults, seed=generator.getrandbits(32)))
+    return hosts
+
+def poisson(generator, mean):
+    """Returns a Poisson distributed count with the given mean."""
+    count = 0
+    remaining = generator.expovariate(1.0) if mean > 0 else None
+    while remaining is not None and remaining < mean:
+        count += 1
+        remaining += generator.expovariate(1.0)
+    return count
@@ -0,0 +1,111 @@
+import pytest
+import time
+
+from pc_reset_sim import (Flap, FleetSimulation, Hang, Outage, STATE_BOOTING, STATE_HUNG, STATE_OFF, STATE_UP,
+                          VirtualHost, random_fleet)
+
+TIMING = {('Timing', 'wait_between_pings'): 5,
+          ('Timing', 'confirm_interval'): 1,
+          ('Timing', 'recovery_interval'): 5,
+          ('Timing', 'ping_fails_needed_for_restart'): 4,
+          ('Timing', 'wait_before_shutdown'): 30,
+          ('Timing', 'hold_power_switch'): 3}
+
+@pytest.fixture()
+def simulate(tmp_path):
+    """Runs a simulation of some virtual PCs and closes it afterwards."""
+    simulations = []
+
+    def simulate(hosts, duration, config=TIMING):
+        simulation = FleetSimulation(hosts, config, str(tmp_path))
+        simulations.append(simulation)
+        return simulation, simulation.run(duration)
+
+    yield simulate
+    for simulation in simulations:
+        simulation.close()
+
+def test_virtual_host_power_cycle():
+    """A hung PC only turns off when its switch is held, and boots on the next press."""
+    host = VirtualHost('pc', [Hang(10)], boot_time=60)
+    assert host.answers(5) is not None
+    assert host.answers(10) is None
+    assert host.state == STATE_HUNG
+
+    host.relay_changed(20, True)
+    host.relay_changed(21, False)
+    assert host.state == STATE_HUNG
+
+    host.relay_changed(30, True)
+    host.relay_changed(33, False)
+    assert host.state == STATE_OFF
+
+    host.relay_changed(63, True)
+    host.relay_changed(66, False)
+    assert host.state == STATE_BOOTING
+    host.update(126)
+    assert host.state == STATE_UP
+
+def test_hang_detected_and_recovered(simulate):
+    """A hang is detected after the confirming pings and the PC is back after a full power cycle."""
+    _, report = simulate([VirtualHost('pc', [Hang(600)])], 3600)
+
+    assert report.hangs == 1
+    assert report.missed == 0
+    assert report.false_restarts == 0
+    # Caught by the ping at 600 and confirmed by three more a second apart.
+    assert report.times_to_detect == [3.0]
+    # Hold 3 s, wait 30 s, hold 3 s, boot 60 s, then the next recovery ping.
+    assert report.times_to_recover == [103.0]
+
+def test_pc_that_never_boots_is_restarted_again(simulate):
+    """A PC that does not come back within the recovery timeout is power cycled again, not left restarting."""
+    config = dict(TIMING)
+    config[('Restart', 'recovery_timeout')] = 300
+    simulation, report = simulate([VirtualHost('pc', [Hang(600)], boot_time=10 ** 9)], 3600, config)
+
+    # Each round is a 36 s power cycle, 300 s of waiting and the pings that find it still down.
+    assert report.restarts == 9
+    assert report.times_to_recover == []
+    assert simulation.pingboy.restart_scheduler.stats()['started'] == report.restarts
+
+def test_manual_restart_of_pc_shutting_down_gracefully(simulate):
+    """A PC that keeps answering while it shuts down is still powered on again, so it is restarted once."""
+    simulation, _ = simulate([VirtualHost('pc0', force_off_time=4.0)], 30)
+    phases = []
+    simulation.pingboy.sig_restart_phase.connect(lambda name, phase: phases.append(phase))
+
+    simulation.pingboy.restart_host('pc0')
+    report = simulation.run(300)
+
+    assert phases == ['power_off_press', 'shutdown_wait', 'power_on_press', 'recovering', 'done']
+    assert report.restarts == 1
+    assert not simulation.pingboy.hosts[0].flag_restarting
+
+def test_short_outage_not_restarted(simulate):
+    """An outage shorter than it takes to confirm a PC is down does not restart it."""
+    simulation, report = simulate([VirtualHost('pc', [Outage(602, 2), Flap(1000, 300, 0.1)], seed=1)], 3600)
+
+    assert report.restarts == 0
+    assert simulation.pingboy.hosts[0].flag_ping_fail_count == 0
+
+def test_long_shutdown_wait_runs_instantly(simulate):
+    """A day of restarts with half hour shutdown waits takes well under a second of real time."""
+    config = dict(TIMING)
+    config[('Timing', 'wait_before_shutdown')] = 1800
+    began = time.perf_counter()
+
+    _, report = simulate([VirtualHost('pc', [Hang(3600 * hour) for hour in range(1, 24, 4)])], 86400, config)
+
+    assert time.perf_counter() - began < 2
+    assert report.hangs == 6
+    assert report.missed == 0
+    assert min(report.times_to_recover) >= 1800
+
+def test_random_fleet_is_deterministic(simulate):
+    """The same seed gives the same faults and so the same outcome."""
+    first = simulate(random_fleet(10, 21600, seed=3, hangs_per_day=4), 21600)[1].as_dict()
+    second = simulate(random_fleet(10, 21600, seed=3, hangs_per_day=4), 21600)[1].as_dict()
+
+    assert first == second
+    assert first['hangs'] > 0
@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+
+class StateStore(object):
+    """
+    Crash-safe store of small records, such as the state of each PC.
+
+    Changes are appended to a journal as one JSON line each, and only the
+    fields that really changed are written, so a healthy fleet causes no
+    writes at all.  Most lines are left to the page cache.  Durable ones,
+    such as the steps of a restart, are synced to disk before returning.
+    The journal is compacted into one line per record when it grows, by
+    writing a new file and renaming it over the old one, so the SD card
+    sees few writes and a crash at any point leaves a readable journal.
+    """
+    def __init__(self, path, compact_after=1000):
+        """
+        The journal is compacted once it holds compact_after lines, or four
+        lines per record if that is more.
+        """
+        self.path = path
+        self.compact_after = compact_after
+        self.lock = threading.Lock()
+
+        # Key -> dict of the record's fields.
+        self.state = {}
+        self.__load()
+
+        # Starting from a compacted journal also drops a line torn by a crash.
+        self.file = None
+        self.compact()
+
+    def get(self, key):
+        """Returns a copy of a record, empty if there is none."""
+        with self.lock:
+            return dict(self.state.get(key, {}))
+
+    def keys(self):
+        with self.lock:
+            return list(self.state)
+
+    def update(self, key, durable=False, **fields):
+        """
+        Sets fields of a record, writing only the ones that changed.  With
+        durable the change is on disk before this returns.  Returns True if
+        anything was written.
+        """
+        with self.lock:
+            record = self.state.setdefault(key, {})
+            changes = {name: value for name, value in fields.items() if record.get(name) != value}
+            if not changes:
+                return False
+            record.update(changes)
+            changes['key'] = key
+            self.__append(changes, durable)
+            return True
+
+    def delete(self, key, durable=False):
+        """Forgets a record."""
+        with self.lock:
+            if self.state.pop(key, None) is not None:
+                self.__append({'key': key, 'deleted': True}, durable)
+
+    def compact(self):
+        """Rewrites the journal with a single line per record."""
+        with self.lock:
+            self.__compact()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def __load(self):
+        try:
+            journal = open(self.path)
+        except FileNotFoundError:
+            return
+
+        with journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                    key = record.pop('key')
+                except (ValueError, KeyError, AttributeError):
+                    # Only the last line can be torn, by a crash while it was written.
+                    break
+                if record.pop('deleted', False):
+                    self.state.pop(key, None)
+                else:
+                    self.state.setdefault(key, {}).update(record)
+
+    def __append(self, record, durable):
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        self.file.flush()
+        if durable:
+            os.fsync(self.file.fileno())
+
+        self.lines += 1
+        if self.lines >= max(self.compact_after, 4 * len(self.state)):
+            self.__compact()
+
+    def __compact(self):
+        if self.file is not None:
+            self.file.close()
+
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as journal:
+            for key, record in self.state.items():
+                journal.write(json.dumps(dict(record, key=key), separators=(',', ':')) + '\n')
+            journal.flush()
+            os.fsync(journal.fileno())
+        os.replace(temporary_path, self.path)
+
+        # Make the rename itself durable.
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+        self.file = open(self.path, 'a')
+        self.lines = len(self.state)
@@ -0,0 +1,65 @@
+import pytest
+
+from pc_reset_state import StateStore
+
+@pytest.fixture()
+def journal(tmp_path):
+    return str(tmp_path / 'state.journal')
+
+def test_state_survives_reopen(journal):
+    """Records read back the same after the store is opened again."""
+    store = StateStore(journal)
+    store.update('pc', fails=3, restarting=True)
+    store.update('pc', fails=0)
+    store.close()
+
+    assert StateStore(journal).get('pc') == {'fails': 0, 'restarting': True}
+
+def test_unchanged_fields_not_written(journal):
+    """Setting a field to the value it already has costs no write."""
+    store = StateStore(journal)
+    assert store.update('pc', fails=0)
+    with open(journal) as file:
+        size = len(file.read())
+
+    assert not store.update('pc', fails=0)
+    with open(journal) as file:
+        assert len(file.read()) == size
+
+def test_torn_line_ignored(journal):
+    """A line cut short by a crash is dropped and the journal stays usable."""
+    store = StateStore(journal)
+    store.update('pc', fails=2)
+    store.close()
+    with open(journal, 'a') as file:
+        file.write('{"key":"pc","fai')
+
+    store = StateStore(journal)
+    store.update('other', fails=1)
+    store.close()
+
+    store = StateStore(journal)
+    assert store.get('pc') == {'fails': 2}
+    assert store.get('other') == {'fails': 1}
+
+def test_journal_compacted(journal):
+    """The journal is rewritten with a line per record once it grows."""
+    store = StateStore(journal, compact_after=10)
+    for count in range(25):
+        store.update('pc', fails=count)
+    store.close()
+
+    with open(journal) as file:
+        assert len(file.readlines()) < 10
+    assert StateStore(journal).get('pc') == {'fails': 24}
+
+def test_delete(journal):
+    """Deleted records stay deleted after the store is opened again."""
+    store = StateStore(journal)
+    store.update('pc', fails=1)
+    store.delete('pc')
+    store.close()
+
+    store = StateStore(journal)
+    assert store.get('pc') == {}
+    assert store.keys() == []
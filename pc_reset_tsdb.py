@@ -0,0 +1,479 @@
+"""
+Per host history of ping round trip times, lost pings, down time and
+restarts, kept in typed arrays of bounded size and saved to a compact binary file.
+
+Every ping goes into a raw ring and is rolled up into one minute and one
+hour buckets, so recent windows are answered exactly and long ones from
+the coarser tiers.  Round trip times in the buckets are counted in a
+histogram with four bins per octave, which keeps percentiles within about
+10% of the real value.
+"""
+import array
+import bisect
+import math
+import os
+import struct
+import threading
+
+# Round trip time histogram: bin 0 is everything below RTT_BASE, bin i above
+# that starts at RTT_BASE * 2 ** ((i - 1) / RTT_BINS_PER_OCTAVE) (SECONDS), and
+# the last bin holds everything that does not fit.
+RTT_BASE = 0.0001
+RTT_BINS_PER_OCTAVE = 4
+RTT_BINS = 58
+
+# Largest value a histogram bin or bucket counter can hold.
+COUNT_MAX = 0xffff
+
+FILE_MAGIC = b'PCTS'
+FILE_VERSION = 2
+
+def rtt_bin(rtt):
+    """Returns the histogram bin of a round trip time (SECONDS)."""
+    if rtt < RTT_BASE:
+        return 0
+    return min(RTT_BINS - 1, 1 + int(math.log2(rtt / RTT_BASE) * RTT_BINS_PER_OCTAVE))
+
+def bin_rtt(index):
+    """Returns the round trip time that stands for a histogram bin, the geometric middle of the bin."""
+    if index == 0:
+        return RTT_BASE / 2
+    return RTT_BASE * 2 ** ((index - 0.5) / RTT_BINS_PER_OCTAVE)
+
+def segments(first, count, capacity):
+    """Returns the (start, stop) index ranges that hold count slots of a ring from slot first."""
+    if count <= 0:
+        return []
+    if first + count <= capacity:
+        return [(first, first + count)]
+    return [(first, capacity), (0, first + count - capacity)]
+
+class RingView(object):
+    """Oldest first view of a ring array, so bisect can search it."""
+    def __init__(self, values, first, count):
+        self.values = values
+        self.first = first
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.values[(self.first + index) % len(self.values)]
+
+class Tier(object):
+    """
+    Ring of up to capacity time buckets.  A bucket_seconds of 0 keeps every
+    ping in a slot of its own, with its exact round trip time instead of a
+    histogram.  The arrays grow a slot at a time until the ring is full, so
+    a PC that has only been watched for a while takes only what it uses.
+    """
+    def __init__(self, bucket_seconds, capacity):
+        self.bucket_seconds = bucket_seconds
+        self.capacity = capacity
+
+        # Start time of each bucket, or the time of each ping in the raw tier.
+        self.starts = array.array('d')
+        # Pings and failed pings in each bucket.
+        self.counts = array.array('H')
+        self.failures = array.array('H')
+        # Time covered by the pings and how much of it the PC was down (SECONDS).
+        self.spans = array.array('f')
+        self.downs = array.array('f')
+        if bucket_seconds:
+            self.rtts = None
+            self.histogram = array.array('H')
+        else:
+            # NaN when the ping failed or its round trip time is not known.
+            self.rtts = array.array('d')
+            self.histogram = None
+
+        # Slot of the newest bucket and number of slots in use.
+        self.newest = -1
+        self.used = 0
+
+    @property
+    def oldest(self):
+        """Returns the slot of the oldest bucket."""
+        return (self.newest - self.used + 1) % self.capacity
+
+    def oldest_start(self):
+        """Returns the start of the oldest bucket, or None when the tier is empty."""
+        return self.starts[self.oldest] if self.used else None
+
+    def add(self, time, success, rtt, span, down):
+        """Records a ping sent at time."""
+        start = time - time % self.bucket_seconds if self.bucket_seconds else time
+        # A clock that went back keeps filling the newest bucket.
+        if not self.used or (self.bucket_seconds == 0 or start > self.starts[self.newest]):
+            self.__new_slot(start)
+
+        slot = self.newest
+        self.counts[slot] = min(COUNT_MAX, self.counts[slot] + 1)
+        if not success:
+            self.failures[slot] = min(COUNT_MAX, self.failures[slot] + 1)
+        self.spans[slot] += span
+        self.downs[slot] += down
+        if self.rtts is not None:
+            self.rtts[slot] = rtt if (success and rtt is not None) else math.nan
+        elif success and rtt is not None:
+            index = slot * RTT_BINS + rtt_bin(rtt)
+            self.histogram[index] = min(COUNT_MAX, self.histogram[index] + 1)
+
+    def window(self, start, end):
+        """Returns the (start, stop) index ranges of the buckets that start within [start, end)."""
+        view = RingView(self.starts, self.oldest, self.used)
+        first = bisect.bisect_left(view, start - start % self.bucket_seconds if self.bucket_seconds else start)
+        last = bisect.bisect_left(view, end)
+        return segments((self.oldest + first) % self.capacity, last - first, self.capacity)
+
+    def summarize(self, ranges):
+        """Returns (pings, failures, span, down, round trip times or histogram) of the buckets in ranges."""
+        pings = failures = 0
+        span = down = 0.0
+        for low, high in ranges:
+            pings += sum(self.counts[low:high])
+            failures += sum(self.failures[low:high])
+            span += sum(self.spans[low:high])
+            down += sum(self.downs[low:high])
+
+        if self.rtts is not None:
+            rtts = [rtt for low, high in ranges for rtt in self.rtts[low:high] if rtt == rtt]
+            return pings, failures, span, down, rtts
+
+        # Every bin is summed across the buckets with a single strided slice.
+        histogram = [0] * RTT_BINS
+        for low, high in ranges:
+            for index in range(RTT_BINS):
+                histogram[index] += sum(self.histogram[low * RTT_BINS + index:high * RTT_BINS:RTT_BINS])
+        return pings, failures, span, down, histogram
+
+    def points(self, ranges):
+        """
+        Returns (starts, pings, failures, lowest, highest) lists of the
+        buckets in ranges, the round trip times being inf and -inf in
+        buckets without any, so min and max skip them.
+        """
+        starts = []
+        pings = []
+        failures = []
+        for low, high in ranges:
+            starts.extend(self.starts[low:high])
+            pings.extend(self.counts[low:high])
+            failures.extend(self.failures[low:high])
+
+        if self.rtts is not None:
+            rtts = [rtt for low, high in ranges for rtt in self.rtts[low:high]]
+            return (starts, pings, failures, [rtt if rtt == rtt else math.inf for rtt in rtts],
+                    [rtt if rtt == rtt else -math.inf for rtt in rtts])
+
+        lowest = []
+        highest = []
+        for low, high in ranges:
+            for slot in range(low, high):
+                bins = self.histogram[slot * RTT_BINS:(slot + 1) * RTT_BINS]
+                used = [index for index, count in enumerate(bins) if count]
+                lowest.append(bin_rtt(used[0]) if used else math.inf)
+                highest.append(bin_rtt(used[-1]) if used else -math.inf)
+        return starts, pings, failures, lowest, highest
+
+    def arrays(self):
+        return [array_ for array_ in (self.starts, self.counts, self.failures, self.spans, self.downs,
+                                      self.rtts, self.histogram) if array_ is not None]
+
+    def allocate(self, slots):
+        """Sizes the arrays for slots zeroed slots, as a tier with that many in use has."""
+        for array_ in self.arrays():
+            size = slots * RTT_BINS if array_ is self.histogram else slots
+            array_[:] = array.array(array_.typecode, bytes(size * array_.itemsize))
+
+    def resized(self, capacity):
+        """Returns a copy of the tier with another capacity, holding as many of the newest buckets as fit."""
+        tier = Tier(self.bucket_seconds, capacity)
+        count = min(self.used, capacity)
+        slots = [(self.oldest + index) % self.capacity for index in range(self.used - count, self.used)]
+        for old, new in zip(self.arrays(), tier.arrays()):
+            width = RTT_BINS if old is self.histogram else 1
+            for slot in slots:
+                new.extend(old[slot * width:(slot + 1) * width])
+        tier.newest = count - 1
+        tier.used = count
+        return tier
+
+    def __new_slot(self, start):
+        slot = (self.newest + 1) % self.capacity
+        if slot == len(self.starts):
+            # The ring is still filling up, so it grows by a zeroed slot.
+            for array_ in self.arrays():
+                array_.extend(array.array(array_.typecode, bytes(
+                    (RTT_BINS if array_ is self.histogram else 1) * array_.itemsize)))
+        self.newest = slot
+        self.used = min(self.used + 1, self.capacity)
+        self.starts[slot] = start
+        self.counts[slot] = self.failures[slot] = 0
+        self.spans[slot] = self.downs[slot] = 0.0
+        if self.histogram is not None:
+            self.histogram[slot * RTT_BINS:(slot + 1) * RTT_BINS] = array.array('H', bytes(2 * RTT_BINS))
+
+class HostSeries(object):
+    """The raw, minute and hour tiers and the restart times of one PC."""
+    def __init__(self, raw_capacity, minute_capacity, hour_capacity, restart_capacity):
+        self.tiers = [Tier(0, raw_capacity), Tier(60, minute_capacity), Tier(3600, hour_capacity)]
+        self.restarts = array.array('d', bytes(8 * restart_capacity))
+        self.restart_newest = -1
+        self.restart_used = 0
+
+        # Time and outcome of the newest ping.
+        self.last_time = None
+        self.last_success = True
+
+    def add(self, time, success, rtt, max_gap):
+        # The time since the previous ping counts as down time when that ping failed.
+        span = down = 0.0
+        if self.last_time is not None and 0 < time - self.last_time <= max_gap:
+            span = time - self.last_time
+            down = 0.0 if self.last_success else span
+        self.last_time = time
+        self.last_success = success
+
+        for tier in self.tiers:
+            tier.add(time, success, rtt, span, down)
+
+    def add_restart(self, time):
+        self.restart_newest = (self.restart_newest + 1) % len(self.restarts)
+        self.restarts[self.restart_newest] = time
+        self.restart_used = min(self.restart_used + 1, len(self.restarts))
+
+    def count_restarts(self, start, end):
+        view = self.__restart_view()
+        return bisect.bisect_left(view, end) - bisect.bisect_left(view, start)
+
+    def restart_times(self, start, end):
+        view = self.__restart_view()
+        return [view[index] for index in range(bisect.bisect_left(view, start), bisect.bisect_left(view, end))]
+
+    def __restart_view(self):
+        return RingView(self.restarts, (self.restart_newest - self.restart_used + 1) % len(self.restarts),
+                        self.restart_used)
+
+    def arrays(self):
+        return [array_ for tier in self.tiers for array_ in tier.arrays()] + [self.restarts]
+
+    def resized(self, raw_capacity, minute_capacity, hour_capacity, restart_capacity):
+        """Returns a copy of the series with other capacities, keeping as much of the newest history as fits."""
+        series = HostSeries(raw_capacity, minute_capacity, hour_capacity, restart_capacity)
+        series.tiers = [tier.resized(capacity) for tier, capacity in
+                        zip(self.tiers, (raw_capacity, minute_capacity, hour_capacity))]
+        view = self.__restart_view()
+        for index in range(max(0, len(view) - restart_capacity), len(view)):
+            series.add_restart(view[index])
+        series.last_time = self.last_time
+        series.last_success = self.last_success
+        return series
+
+def percentile(ordered, percent):
+    """Returns the nearest rank percentile of a sorted list."""
+    return ordered[min(len(ordered) - 1, max(0, int(math.ceil(percent / 100 * len(ordered))) - 1))]
+
+def histogram_percentile(histogram, total, percent):
+    """Returns the percentile of the round trip times counted in a histogram."""
+    rank = max(1, int(math.ceil(percent / 100 * total)))
+    seen = 0
+    for index, count in enumerate(histogram):
+        seen += count
+        if seen >= rank:
+            return bin_rtt(index)
+    return bin_rtt(len(histogram) - 1)
+
+class TimeSeriesStore(object):
+    """
+    Round trip time, loss and restart history of every monitored PC.
+
+    Memory grows with the history held, up to a slot per ping in the raw
+    tier, a minute bucket per slot for a day and an hour bucket per slot
+    for a month by default, and then stays the same.  Queries pick the finest tier that still holds
+    the start of the window and sum slices of its arrays, so they take
+    well under a millisecond whatever the window.
+    """
+    def __init__(self, raw_capacity=2048, minute_capacity=1440, hour_capacity=720, restart_capacity=64,
+                 max_gap=300.0, max_buckets=180):
+        """
+        Pings further apart than max_gap (SECONDS), such as across a restart
+        of the monitor, do not count towards up or down time.  A window that
+        would need more than max_buckets buckets of a tier is answered from
+        the next coarser one.
+        """
+        self.capacities = (raw_capacity, minute_capacity, hour_capacity, restart_capacity)
+        self.max_gap = max_gap
+        self.max_buckets = max_buckets
+        self.lock = threading.Lock()
+
+        # Host name -> HostSeries.
+        self.series = {}
+
+    def add(self, name, time, success, rtt=None):
+        """Records a ping of a PC sent at time (SECONDS since the epoch)."""
+        with self.lock:
+            self.__series(name).add(time, success, rtt, self.max_gap)
+
+    def add_restart(self, name, time):
+        """Records that a PC was restarted at time."""
+        with self.lock:
+            self.__series(name).add_restart(time)
+
+    def remove(self, name):
+        """Forgets the history of a PC."""
+        with self.lock:
+            self.series.pop(name, None)
+
+    def names(self):
+        with self.lock:
+            return list(self.series)
+
+    def query(self, name, start, end, percents=(50, 95, 99)):
+        """
+        Summarizes a PC's pings sent within [start, end).  Returns None when
+        nothing is known about the PC, otherwise a dict of the number of
+        pings, the loss ratio, the fraction of the time the PC was up, the
+        number of restarts, and the round trip time percentiles (SECONDS) as
+        {percent: rtt} with None when no round trip times are known.  The
+        'tier' is the bucket size the answer came from, 0 for exact.
+        """
+        with self.lock:
+            series = self.series.get(name)
+            if series is None:
+                return None
+            tier = self.__pick_tier(series, start, end)
+            pings, failures, span, down, rtts = tier.summarize(tier.window(start, end))
+            restarts = series.count_restarts(start, end)
+
+        if tier.rtts is not None:
+            rtts.sort()
+            rtt_count = len(rtts)
+            percentiles = {percent: percentile(rtts, percent) if rtts else None for percent in percents}
+        else:
+            rtt_count = sum(rtts)
+            percentiles = {percent: histogram_percentile(rtts, rtt_count, percent) if rtt_count else None
+                           for percent in percents}
+
+        return {'pings': pings,
+                'loss': failures / pings if pings else None,
+                'uptime': 1 - down / span if span else None,
+                'restarts': restarts,
+                'rtt_count': rtt_count,
+                'percentiles': percentiles,
+                'tier': tier.bucket_seconds}
+
+    def points(self, name, start, end):
+        """
+        Returns the pings of a PC within [start, end) for drawing, from the
+        finest tier that reaches back to start, or None when nothing is known
+        about the PC.  A dict of the 'tier' bucket size (0 for every ping)
+        and, per bucket or ping, its 'times', 'pings', 'failures' and lowest
+        and highest round trip times 'rtt_low' and 'rtt_high' (SECONDS), which
+        are inf and -inf where none are known.  'restarts' holds the restart
+        times within the window.
+        """
+        with self.lock:
+            series = self.series.get(name)
+            if series is None:
+                return None
+            tier = next((tier for tier in series.tiers
+                         if tier.used < tier.capacity or tier.oldest_start() <= start), series.tiers[-1])
+            times, pings, failures, lowest, highest = tier.points(tier.window(start, end))
+            restarts = series.restart_times(start, end)
+        return {'tier': tier.bucket_seconds,
+                'times': times,
+                'pings': pings,
+                'failures': failures,
+                'rtt_low': lowest,
+                'rtt_high': highest,
+                'restarts': restarts}
+
+    def save(self, path):
+        """Writes every PC's history to a binary file, replacing it in one step."""
+        temporary_path = path + '.tmp'
+        with self.lock, open(temporary_path, 'wb') as file:
+            file.write(FILE_MAGIC + struct.pack('<HIIIII', FILE_VERSION, len(self.series), *self.capacities))
+            for name, series in self.series.items():
+                encoded = name.encode('utf-8')
+                file.write(struct.pack('<H', len(encoded)) + encoded)
+                file.write(struct.pack('<dB', math.nan if series.last_time is None else series.last_time,
+                                       series.last_success))
+                file.write(struct.pack('<ii', series.restart_newest, series.restart_used))
+                for tier in series.tiers:
+                    file.write(struct.pack('<ii', tier.newest, tier.used))
+                for array_ in series.arrays():
+                    array_.tofile(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+
+    def load(self, path):
+        """
+        Reads the history saved by save, replacing what is held.  A file
+        written with other capacities keeps as much of its newest history as
+        fits.  Returns False when there is no file, raises ValueError when it
+        cannot be read.
+        """
+        try:
+            file = open(path, 'rb')
+        except FileNotFoundError:
+            return False
+
+        with file:
+            header = file.read(4 + struct.calcsize('<HIIIII'))
+            if len(header) < 4 or header[:4] != FILE_MAGIC:
+                raise ValueError("{} is not a history file".format(path))
+            version, count, *capacities = struct.unpack('<HIIIII', header[4:])
+            if version not in (1, FILE_VERSION):
+                raise ValueError("{} was written by another version".format(path))
+            capacities = tuple(capacities)
+
+            loaded = {}
+            for _ in range(count):
+                length, = struct.unpack('<H', file.read(2))
+                name = file.read(length).decode('utf-8')
+                series = HostSeries(*capacities)
+                last_time, last_success = struct.unpack('<dB', file.read(struct.calcsize('<dB')))
+                series.last_time = None if math.isnan(last_time) else last_time
+                series.last_success = bool(last_success)
+                series.restart_newest, series.restart_used = struct.unpack('<ii', file.read(8))
+                for tier in series.tiers:
+                    tier.newest, tier.used = struct.unpack('<ii', file.read(8))
+                    if not 0 <= tier.used <= tier.capacity:
+                        raise ValueError("{} is corrupt".format(path))
+                    # The first version held every slot, used or not.
+                    tier.allocate(tier.capacity if version == 1 else tier.used)
+                for array_ in series.arrays():
+                    data = file.read(len(array_) * array_.itemsize)
+                    if len(data) != len(array_) * array_.itemsize:
+                        raise ValueError("{} is cut short".format(path))
+                    array_[:] = array.array(array_.typecode, data)
+                if capacities != self.capacities or version == 1:
+                    series = series.resized(*self.capacities)
+                loaded[name] = series
+
+        with self.lock:
+            self.series = loaded
+        return True
+
+    def __series(self, name):
+        series = self.series.get(name)
+        if series is None:
+            series = self.series[name] = HostSeries(*self.capacities)
+        return series
+
+    def __pick_tier(self, series, start, end):
+        """
+        Returns the finest tier that holds the start of the window, or that
+        has never overwritten a bucket, in at most max_buckets buckets.
+        """
+        for tier in series.tiers:
+            if tier.bucket_seconds and (end - start) / tier.bucket_seconds > self.max_buckets:
+                continue
+            oldest = tier.oldest_start()
+            if oldest is None or oldest <= start or tier.used < tier.capacity:
+                return tier
+        # Nothing reaches back far enough, so answer from the tier that reaches back furthest.
+        return series.tiers[-1]
@@ -0,0 +1,173 @@
+import math
+import pytest
+import time
+
+import pc_reset_tsdb
+
+from pc_reset_tsdb import RTT_BINS, TimeSeriesStore, bin_rtt, rtt_bin
+
+@pytest.fixture()
+def store():
+    return TimeSeriesStore(raw_capacity=100, minute_capacity=120, hour_capacity=48)
+
+def test_rtt_bins_round_trip():
+    """A round trip time comes back from its bin within 10%."""
+    for rtt in (0.0002, 0.001, 0.0137, 0.25):
+        assert abs(bin_rtt(rtt_bin(rtt)) - rtt) / rtt < 0.1
+
+def test_recent_window_is_exact(store):
+    """Windows the raw tier still holds are answered from every ping."""
+    for second in range(10):
+        store.add('pc', 1000.0 + second, second != 3, 0.001 * (second + 1))
+
+    summary = store.query('pc', 1000.0, 1010.0)
+
+    assert summary['tier'] == 0
+    assert summary['pings'] == 10
+    assert summary['loss'] == 0.1
+    assert summary['percentiles'] == pytest.approx({50: 0.006, 95: 0.010, 99: 0.010})
+
+def test_long_window_uses_rollups(store):
+    """Once the raw tier has wrapped, older windows come from the minute buckets."""
+    for second in range(0, 3600, 5):
+        store.add('pc', 60000.0 + second, True, 0.002)
+
+    summary = store.query('pc', 60000.0, 63600.0)
+
+    assert summary['tier'] == 60
+    assert summary['pings'] == 720
+    assert summary['loss'] == 0.0
+    assert summary['percentiles'][50] == pytest.approx(0.002, rel=0.1)
+
+def test_uptime_counts_down_time(store):
+    """The time after a failed ping until the next good one counts as down."""
+    for second, success in enumerate([True, False, False, True, True]):
+        store.add('pc', 1000.0 + 10 * second, success, 0.001)
+
+    assert store.query('pc', 1000.0, 1100.0)['uptime'] == 0.5
+
+def test_restarts_counted(store):
+    store.add('pc', 1000.0, True, 0.001)
+    store.add_restart('pc', 1500.0)
+    store.add_restart('pc', 2500.0)
+
+    assert store.query('pc', 1000.0, 2000.0)['restarts'] == 1
+
+def test_memory_grows_with_history(store):
+    """A tier only holds the buckets it has used until it is full."""
+    for second in range(0, 150, 5):
+        store.add('pc', 1020.0 + second, True, 0.001)
+    raw, minutes, hours = store.series['pc'].tiers
+
+    assert len(raw.starts) == 30
+    assert (len(minutes.counts), len(minutes.histogram)) == (3, 3 * RTT_BINS)
+    assert (len(hours.counts), len(hours.histogram)) == (1, RTT_BINS)
+
+    for second in range(150, 1000, 5):
+        store.add('pc', 1020.0 + second, True, 0.001)
+    assert len(raw.starts) == raw.capacity == 100
+    assert store.query('pc', 1920.0, 2020.0)['pings'] == 20
+
+def test_unknown_host(store):
+    assert store.query('nobody', 0, 1) is None
+
+def test_save_and_load(store, tmp_path):
+    """The history comes back the same from its file."""
+    for second in range(300):
+        store.add('pc', 1000.0 + second, second % 10 != 0, 0.001)
+    store.add_restart('pc', 1100.0)
+    path = str(tmp_path / 'history.bin')
+    store.save(path)
+
+    loaded = TimeSeriesStore(raw_capacity=100, minute_capacity=120, hour_capacity=48)
+    assert loaded.load(path)
+
+    for start, end in ((1250.0, 1300.0), (1000.0, 1300.0)):
+        assert loaded.query('pc', start, end) == store.query('pc', start, end)
+
+def test_load_into_other_capacities(store, tmp_path):
+    """A file written with other capacities keeps the newest history that fits."""
+    for second in range(0, 7200, 5):
+        store.add('pc', 100000.0 + second, second % 100 != 0, 0.001)
+    store.add_restart('pc', 103000.0)
+    path = str(tmp_path / 'history.bin')
+    store.save(path)
+
+    smaller = TimeSeriesStore(raw_capacity=50, minute_capacity=30, hour_capacity=48, restart_capacity=4)
+    assert smaller.load(path)
+
+    raw, minutes, _ = smaller.series['pc'].tiers
+    assert (raw.used, len(raw.starts)) == (50, 50)
+    assert (minutes.used, len(minutes.histogram)) == (30, 30 * RTT_BINS)
+    for start, end in ((107000.0, 107200.0), (105420.0, 107200.0)):
+        assert smaller.query('pc', start, end) == store.query('pc', start, end)
+    assert smaller.query('pc', 100000.0, 107200.0)['restarts'] == 1
+
+    # It keeps on filling from where the file left off.
+    smaller.add('pc', 107200.0, True, 0.001)
+    assert smaller.query('pc', 107150.0, 107205.0)['pings'] == 11
+
+def test_load_first_version(store, tmp_path, monkeypatch):
+    """Files of the first version, which held every slot whether used or not, are still read."""
+    for second in range(30):
+        store.add('pc', 1000.0 + second, True, 0.001)
+    for tier in store.series['pc'].tiers:
+        for array_ in tier.arrays():
+            width = RTT_BINS if array_ is tier.histogram else 1
+            array_.extend([0] * (tier.capacity * width - len(array_)))
+    monkeypatch.setattr(pc_reset_tsdb, 'FILE_VERSION', 1)
+    path = str(tmp_path / 'history.bin')
+    store.save(path)
+    monkeypatch.undo()
+
+    loaded = TimeSeriesStore(raw_capacity=100, minute_capacity=120, hour_capacity=48)
+    assert loaded.load(path)
+    assert loaded.query('pc', 1000.0, 1030.0)['pings'] == 30
+    assert len(loaded.series['pc'].tiers[0].starts) == 30
+
+def test_load_refuses_other_files(tmp_path):
+    path = tmp_path / 'history.bin'
+    path.write_bytes(b'nonsense')
+    with pytest.raises(ValueError):
+        TimeSeriesStore().load(str(path))
+    assert not TimeSeriesStore().load(str(tmp_path / 'missing.bin'))
+
+def test_query_is_fast():
+    """A month of pings every 5 seconds is summarized in well under a millisecond per window."""
+    store = TimeSeriesStore()
+    start = 1000000.0
+    for index in range(0, 30 * 24 * 720):
+        store.add('pc', start + index * 5, index % 50 != 0, 0.001 + (index % 7) * 0.0001)
+    end = start + 30 * 24 * 3600
+
+    windows = [(end - 600, end), (end - 3 * 3600, end), (end - 24 * 3600, end), (start, end)]
+    began = time.perf_counter()
+    for window in windows * 25:
+        store.query('pc', *window)
+    elapsed = (time.perf_counter() - began) / (len(windows) * 25)
+
+    assert elapsed < 0.002
+
+def test_points_for_charts(store):
+    """Points come from the finest tier that reaches back far enough, lost pings having no round trip time."""
+    for second in range(0, 50, 5):
+        store.add('pc', 1000.0 + second, second != 25, 0.001)
+    store.add_restart('pc', 1030.0)
+
+    points = store.points('pc', 1000.0, 1050.0)
+    assert points['tier'] == 0
+    assert points['times'][:2] == [1000.0, 1005.0]
+    assert points['failures'][5] == 1
+    assert points['rtt_low'][5] == math.inf and points['rtt_high'][5] == -math.inf
+    assert points['rtt_high'][0] == 0.001
+    assert points['restarts'] == [1030.0]
+
+    # Too long ago for the raw tier, which has wrapped.
+    for second in range(50, 600, 5):
+        store.add('pc', 1000.0 + second, True, 0.004)
+    points = store.points('pc', 1000.0, 1600.0)
+    assert points['tier'] == 60
+    assert sum(points['pings']) == 120
+    assert points['rtt_low'][0] == pytest.approx(0.001, rel=0.1)
+    assert points['rtt_high'][-1] == pytest.approx(0.004, rel=0.1)
+    assert store.points('other', 0, 1) is None
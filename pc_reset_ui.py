@@ -1,82 +1,243 @@
+import collections
 import datetime
-import RPi.GPIO as GPIO
 import sys
 import time
 
+from pc_reset_downsample import BucketSeries
 from pc_reset_ping import PingBoy
+from pc_reset_widgets import (HOST_STATE_FAILING, HOST_STATE_PAUSED, HOST_STATE_RESTARTING, HOST_STATE_UNKNOWN,
+                              HOST_STATE_UP, HostChartPanel, HostDashboard, HostTableModel, LogView)
 
-from PyQt5.QtCore import Qt, QSettings, QTimer
-from PyQt5.QtWidgets import (QApplication, QFormLayout, QFrame, QLabel, QLineEdit, QMainWindow, QPlainTextEdit,
+from PyQt5.QtCore import pyqtSignal, Qt, QObject, QSettings, QThread, QTimer
+from PyQt5.QtGui import QIntValidator
+from PyQt5.QtWidgets import (QApplication, QCheckBox, QFormLayout, QFrame, QLabel, QLineEdit, QMainWindow,
                              QPushButton, QSplitter, QVBoxLayout, QWidget)
 
+# Shortest wait between the end of one ping cycle and the start of the next (MILLISECONDS).
+MIN_PING_TIMER_MS = 50
+
+# Shortest time between status bar updates (MILLISECONDS).
+STATUS_BAR_INTERVAL_MS = 100
+
+# Buckets of the round trip time trend in the host table, as (width (SECONDS), count).
+TREND_BUCKETS = (60, 60)
+
+# The timing fields in the GUI as (config key, label, lowest allowed value).
+TIMING_FIELDS = (('wait_between_pings', "Ping Time (Sec)", 1),
+                 ('ping_fails_needed_for_restart', "Ping Fail Limit", 1),
+                 ('wait_before_shutdown', "PC Shutdown Delay (Sec)", 0),
+                 ('hold_power_switch', "Power Switch Hold (Sec)", 1))
+
+def host_row(pingboy, name, trend=None):
+    """Returns the row of a PC in the host table, see HostTableModel.  Trend is its BucketSeries."""
+    host = pingboy.hosts_by_name.get(name)
+    if host is None:
+        return (name, None, None, None, None, None, None)
+    result = host.last_result
+    machine = pingboy.restart_engine.active(name)
+
+    if host.paused_until is not None and pingboy.scheduler.clock() < host.paused_until:
+        state = HOST_STATE_PAUSED
+    elif host.flag_restarting:
+        state = HOST_STATE_RESTARTING
+    elif result is None:
+        state = HOST_STATE_UNKNOWN
+    elif host.flag_ping_fail_count > 0:
+        state = HOST_STATE_FAILING
+    else:
+        state = HOST_STATE_UP
+    return (name, state, None if result is None else result.rtt, host.history.loss_ratio() * 100,
+            host.flag_ping_fail_count, None if machine is None else machine.phase,
+            None if trend is None else (trend.peak(), trend.version))
+
+class ProbeWorker(QObject):
+    """
+    Runs ping cycles on its own thread so a slow or failing ping never
+    blocks the GUI event loop.
+    """
+    sig_cycle_done = pyqtSignal()
+
+    def __init__(self, pingboy):
+        super(ProbeWorker, self).__init__()
+        self.pingboy = pingboy
+
+    def run_cycle(self):
+        """Slot that performs one ping cycle."""
+        try:
+            self.pingboy.ping()
+        finally:
+            self.sig_cycle_done.emit()
+
+class PingBoyBridge(QObject):
+    """
+    Forwards the plain callback signals of a PingBoy and its logger to Qt
+    signals, so slots in the GUI run on the GUI thread whichever thread
+    the PingBoy emitted from.
+    """
+    sig_message_logged = pyqtSignal(str)
+    sig_pinged_pc = pyqtSignal(list)
+    sig_restart_in_progress = pyqtSignal(str)
+    sig_successful_restart = pyqtSignal(str)
+    sig_restart_cancelled = pyqtSignal(str)
+    sig_restart_phase = pyqtSignal(str, str)
+    sig_config_applied = pyqtSignal(dict)
+
+    def __init__(self, pingboy):
+        super(PingBoyBridge, self).__init__()
+        pingboy.my_logger.handler.sig_message_logged.connect(self.sig_message_logged.emit)
+        pingboy.sig_pinged_pc.connect(self.sig_pinged_pc.emit)
+        pingboy.sig_restart_in_progress.connect(self.sig_restart_in_progress.emit)
+        pingboy.sig_successful_restart.connect(self.sig_successful_restart.emit)
+        pingboy.sig_restart_cancelled.connect(self.sig_restart_cancelled.emit)
+        pingboy.sig_restart_phase.connect(self.sig_restart_phase.emit)
+        pingboy.sig_config_applied.connect(self.sig_config_applied.emit)
+
+class FrameLatencyMonitor(QObject):
+    """
+    Measures how late the GUI event loop services a fast timer.  Lateness
+    that grows means the GUI thread is blocked by something.
+    """
+    def __init__(self, interval_ms=16, samples=1000):
+        super(FrameLatencyMonitor, self).__init__()
+        self.interval = interval_ms / 1000
+        self.latencies = collections.deque(maxlen=samples)
+        self.last_tick = None
+
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.__slot_tick)
+        self.timer.start(interval_ms)
+
+    def __slot_tick(self):
+        """Records how much later than expected the timer fired."""
+        now = time.perf_counter()
+        if self.last_tick is not None:
+            self.latencies.append(max(0.0, now - self.last_tick - self.interval))
+        self.last_tick = now
+
+    def percentile(self, percent):
+        """Returns the given percentile of recent frame latencies (SECONDS)."""
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, int(len(ordered) * percent / 100))
+        return ordered[index]
+
+    def stop(self):
+        self.timer.stop()
+
 class PcResetMainWindow(QMainWindow):
     """Handles the creation of the GUI."""
 
+    # Asks the probe worker to run a ping cycle.
+    sig_start_cycle = pyqtSignal()
+
     def __init__(self):
         super().__init__()
         self.pingboy = PingBoy()
-        self.pingboy.my_logger.handler.sig_message_logged.connect(self.__slot_message_logged)
-        self.pingboy.sig_pinged_pc.connect(self.__slot_ping)
-        self.pingboy.sig_restart_in_progress.connect(self.__slot_restart_in_progress)
-        self.pingboy.sig_successful_restart.connect(self.__slot_successful_restart)
-        self.config_values = self.pingboy.get_config_values()
+        self.bridge = PingBoyBridge(self.pingboy)
+        self.bridge.sig_message_logged.connect(self.__slot_message_logged)
+        self.bridge.sig_pinged_pc.connect(self.__slot_ping)
+        self.bridge.sig_restart_in_progress.connect(self.__slot_restart_in_progress)
+        self.bridge.sig_successful_restart.connect(self.__slot_successful_restart)
+        self.bridge.sig_restart_cancelled.connect(self.__slot_restart_cancelled)
+        self.bridge.sig_restart_phase.connect(self.__slot_restart_phase)
+        self.bridge.sig_config_applied.connect(self.__slot_config_applied)
         
         self.__init_UI()
         self.__init_status_bar()
+        self.__init_probe_worker()
+
+        self.frame_latency = FrameLatencyMonitor()
 
-        # This needs to always be last.
+        # This needs to always be last.  The timer is started again for the
+        # next PC that is due every time a ping cycle finishes.
         self.ping_timer = QTimer()
-        self.ping_timer.timeout.connect(self.pingboy.ping)
-        self.ping_timer.start(self.config_values['wait_between_pings'] * 1000)
+        self.ping_timer.setSingleShot(True)
+        self.ping_timer.timeout.connect(self.__slot_ping_timer)
+        self.ping_timer.start(0)
 
-    def __generate_timestamp(self):
-        """Returns a timestamp of the current time."""
-        ts = time.time()
+    def __generate_timestamp(self, ts=None):
+        """Returns a timestamp of the given time, or of the current time."""
+        if ts is None:
+            ts = time.time()
         st = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
         return st
 
+    def __init_probe_worker(self):
+        """Moves the ping cycles onto a dedicated thread."""
+        self.cycle_in_progress = False
+
+        self.probe_thread = QThread()
+        self.probe_worker = ProbeWorker(self.pingboy)
+        self.probe_worker.moveToThread(self.probe_thread)
+        self.sig_start_cycle.connect(self.probe_worker.run_cycle)
+        self.probe_worker.sig_cycle_done.connect(self.__slot_cycle_done)
+        self.probe_thread.start()
+
     def __init_status_bar(self):
         """Initializes variables used for the main window's status bar message."""
-        # Variables that will be displayed in the status bar.
+        # Variables that will be displayed in the status bar.  Times are kept
+        # as SECONDS since the epoch and only formatted when shown.
         self.status_bar_ping_time = None
-        self.status_bar_restarting = False
-        self.status_bar_success_restart = 0
-        self.status_bar_restart_time = None
+        # Restart counters carry on from the monitor's saved state.
+        self.status_bar_restarting = any(host.flag_restarting for host in self.pingboy.hosts)
+        self.status_bar_success_restart = self.pingboy.successful_restarts
+        self.status_bar_restart_time = self.pingboy.last_restart_time
+        self.status_bar_hosts_up = None
+        self.status_bar_max_rtt = None
+
+        # The message is rebuilt at most once per interval however many signals arrive.
+        self.status_bar_timer = QTimer(self)
+        self.status_bar_timer.setSingleShot(True)
+        self.status_bar_timer.setInterval(STATUS_BAR_INTERVAL_MS)
+        self.status_bar_timer.timeout.connect(self.__update_status_bar)
 
     def __init_UI(self):
         """Creates UI elements."""
         
-        ping_time_lbl = QLabel("Ping Time (Sec)")
-        ping_time_le = QLineEdit()
-        ping_time_le.setText(str(self.config_values['wait_between_pings']))
+        # The fields only accept whole numbers in range.  Apply pushes them into
+        # the running monitor, optionally saving them to the config file too.
+        timing_config_layout = QFormLayout()
+        self.timing_edits = {}
+        for key, label, bottom in TIMING_FIELDS:
+            line_edit = QLineEdit()
+            line_edit.setValidator(QIntValidator(bottom, 100000, line_edit))
+            timing_config_layout.addRow(QLabel(label), line_edit)
+            self.timing_edits[key] = line_edit
+        self.__show_config(self.pingboy.config_values)
 
-        ping_fail_lbl = QLabel("Ping Fail Limit")
-        ping_fail_le = QLineEdit()
-        ping_fail_le.setText(str(self.config_values['ping_fails_needed_for_restart']))
+        self.save_config_cb = QCheckBox("Save to config file")
+        apply_btn = QPushButton("Apply")
+        apply_btn.clicked.connect(self.__slot_apply_config)
+        timing_config_layout.addRow(self.save_config_cb)
+        timing_config_layout.addRow(apply_btn)
 
-        wait_shutdown_lbl = QLabel("PC Shutdown Delay (Sec)")
-        wait_shutdown_le = QLineEdit()
-        wait_shutdown_le.setText(str(self.config_values['wait_before_shutdown']))
+        timing_config_widget = QWidget()
+        timing_config_widget.setLayout(timing_config_layout)
 
-        hold_power_lbl = QLabel("Power Switch Hold (Sec)")
-        hold_power_le = QLineEdit()
-        hold_power_le.setText(str(self.config_values['hold_power_switch']))
+        # One row per PC, read again from the monitor only for the PCs that changed.
+        self.trends = {}
+        self.host_model = HostTableModel(lambda name: host_row(self.pingboy, name, self.trends.get(name)),
+                                         self.trends.get, parent=self)
+        self.__show_hosts()
+        self.dashboard = HostDashboard(self.host_model)
 
-        timing_config_layout = QFormLayout()
-        timing_config_layout.addRow(ping_time_lbl, ping_time_le)
-        timing_config_layout.addRow(ping_fail_lbl, ping_fail_le)
-        timing_config_layout.addRow(wait_shutdown_lbl, wait_shutdown_le)
-        timing_config_layout.addRow(hold_power_lbl, hold_power_le)
+        # Detail chart of the PC picked in the table.
+        self.chart_panel = HostChartPanel(self.pingboy.history_points)
+        self.dashboard.sig_host_selected.connect(self.chart_panel.show_host)
 
-        timing_config_widget = QWidget()
-        timing_config_widget.setLayout(timing_config_layout)
+        self.log_widget = LogView()
 
-        self.log_widget = QPlainTextEdit()
-        self.log_widget.setReadOnly(True)
+        right_splitter = QSplitter(Qt.Vertical)
+        right_splitter.addWidget(self.dashboard)
+        right_splitter.addWidget(self.chart_panel)
+        right_splitter.addWidget(self.log_widget)
+        right_splitter.setSizes([300, 150, 150])
 
         splitter = QSplitter(Qt.Horizontal)
         splitter.addWidget(timing_config_widget)
-        splitter.addWidget(self.log_widget)
+        splitter.addWidget(right_splitter)
         splitter.setSizes([250, 750])
 
         self.statusBar()
@@ -92,34 +253,136 @@ class PcResetMainWindow(QMainWindow):
         self.setWindowTitle("Reset Yo PC")
         self.show()
 
+    def __show_hosts(self):
+        """Fills the host table with the monitored PCs."""
+        self.names_by_hostname = {host.config['hostname']: host.name for host in self.pingboy.hosts}
+
+        # Trends are read from the history once, then kept up to date ping by ping.
+        now = time.time()
+        width, count = TREND_BUCKETS
+        trends = {}
+        for host in self.pingboy.hosts:
+            trend = self.trends.get(host.name)
+            if trend is None:
+                trend = BucketSeries(width, count)
+                points = self.pingboy.history_points(host.name, now - width * count, now)
+                if points is not None:
+                    trend.load(end=now, **points)
+            trends[host.name] = trend
+        # The model holds on to the dict, so it is updated in place.
+        self.trends.clear()
+        self.trends.update(trends)
+
+        self.host_model.set_hosts([host.name for host in self.pingboy.hosts])
+
+    def __show_config(self, config_values):
+        """Fills the timing fields from config values."""
+        for key, line_edit in self.timing_edits.items():
+            line_edit.setText(str(config_values[key]))
+
+    def __slot_apply_config(self):
+        """Slot for the Apply button.  Sends valid timing values to the monitor."""
+        for key, label, _ in TIMING_FIELDS:
+            if not self.timing_edits[key].hasAcceptableInput():
+                self.statusBar().showMessage("{} is not valid, nothing applied.".format(label))
+                return
+
+        overrides = {('Timing', key): line_edit.text() for key, line_edit in self.timing_edits.items()}
+        self.pingboy.request_config_update(overrides, save=self.save_config_cb.isChecked())
+
+        # Start a cycle now so the new values do not wait for the next PC to be due.
+        if not self.cycle_in_progress:
+            self.ping_timer.start(0)
+
+    def __slot_config_applied(self, config_values):
+        """Slot for the signal generated whenever the config has been reloaded."""
+        self.__show_config(config_values)
+        # PCs may have been added or removed.
+        self.__show_hosts()
+
     def __slot_message_logged(self, message):
         """Slot for the signal generated when a message is logged."""
-        self.log_widget.appendPlainText(message)
+        self.log_widget.append_message(message)
 
-    def __slot_ping(self):
+    def __slot_ping_timer(self):
+        """Starts a ping cycle unless the previous one is still running."""
+        # The timer is only started again once a cycle is done, so a slow
+        # cycle delays the next one rather than queueing it.
+        if self.cycle_in_progress:
+            return
+
+        self.cycle_in_progress = True
+        self.sig_start_cycle.emit()
+
+    def __slot_cycle_done(self):
+        """Slot for the signal generated when the probe worker finishes a cycle."""
+        self.cycle_in_progress = False
+
+        time_until_next = self.pingboy.time_until_next_ping()
+        if time_until_next is not None:
+            self.ping_timer.start(max(MIN_PING_TIMER_MS, int(time_until_next * 1000)))
+
+    def __slot_ping(self, results):
         """Slot for the signal generated whenever a ping occurs."""
-        self.status_bar_ping_time = self.__generate_timestamp()
-        self.__update_status_bar()
+        now = time.time()
+        self.status_bar_ping_time = now
+        self.status_bar_hosts_up = "{}/{}".format(sum(result.success for result in results), len(results))
+        rtts = [result.rtt for result in results if result.rtt is not None]
+        self.status_bar_max_rtt = "{:.1f} ms".format(max(rtts) * 1000) if rtts else None
+        self.__schedule_status_bar()
+
+        names = [self.names_by_hostname.get(result.host) for result in results]
+        for name, result in zip(names, results):
+            trend = self.trends.get(name)
+            if trend is not None:
+                trend.add(now, result.success, result.rtt)
+            self.chart_panel.chart.add_ping(name, now, result.success, result.rtt)
+        self.host_model.invalidate(names)
 
-    def __slot_restart_in_progress(self):
+    def __slot_restart_in_progress(self, name):
         """Slot for the signal generated whenever a restart is initiated."""
         self.status_bar_restarting = True
-        self.__update_status_bar()
+        self.__schedule_status_bar()
+        self.host_model.invalidate([name])
+        self.chart_panel.chart.add_restart(name, time.time())
 
-    def __slot_successful_restart(self):
+    def __slot_successful_restart(self, name):
         """Slot for the signal generated whenever a successful restart occurs."""
-        self.status_bar_restarting = False
-        self.status_bar_success_restart += 1
-        self.status_bar_restart_time = self.__generate_timestamp()
-        self.__update_status_bar()
+        self.status_bar_restarting = any(host.flag_restarting for host in self.pingboy.hosts)
+        self.status_bar_success_restart = self.pingboy.successful_restarts
+        self.status_bar_restart_time = self.pingboy.last_restart_time
+        self.__schedule_status_bar()
+        self.host_model.invalidate([name])
+
+    def __slot_restart_cancelled(self, name):
+        """Slot for the signal generated whenever a PC comes back before its restart finished."""
+        self.status_bar_restarting = any(host.flag_restarting for host in self.pingboy.hosts)
+        self.__schedule_status_bar()
+        self.host_model.invalidate([name])
+
+    def __slot_restart_phase(self, name, phase):
+        """Slot for the signal generated whenever a restart moves on to its next phase."""
+        self.host_model.invalidate([name])
+
+    def __schedule_status_bar(self):
+        """Has the status bar updated with the next refresh."""
+        if not self.status_bar_timer.isActive():
+            self.status_bar_timer.start()
 
     def __update_status_bar(self):
         """Updates the status bar with the current values in the status bar variables."""
-        status_bar_message = "Last Ping: {}  |  Restarting: {}  |  Successful Restarts: {}  |  Last Restart: {}".format(
-                            self.status_bar_ping_time,
+        status_bar_message = ("Last Ping: {}  |  Up: {}  |  Max RTT: {}  |  Restarting: {}  |  "
+                              "Successful Restarts: {}  |  Last Restart: {}  |  "
+                              "UI Lag p99: {:.0f} ms").format(
+                            (self.__generate_timestamp(self.status_bar_ping_time)
+                             if self.status_bar_ping_time is not None else None),
+                            self.status_bar_hosts_up,
+                            self.status_bar_max_rtt,
                             self.status_bar_restarting,
                             self.status_bar_success_restart,
-                            self.status_bar_restart_time)
+                            (self.__generate_timestamp(self.status_bar_restart_time)
+                             if self.status_bar_restart_time is not None else None),
+                            self.frame_latency.percentile(99) * 1000)
         self.statusBar().showMessage(status_bar_message)
 
     def closeEvent(self, event):
@@ -127,8 +390,15 @@ class PcResetMainWindow(QMainWindow):
         # Save the current size and position of the UI so that it can
         # be restored to the same state the next time it runs.
         self.settings.setValue("geometry", self.saveGeometry())
-        
-        GPIO.cleanup()
+
+        # Let any ping cycle in progress finish before cleaning up.
+        self.ping_timer.stop()
+        self.status_bar_timer.stop()
+        self.frame_latency.stop()
+        self.probe_thread.quit()
+        self.probe_thread.wait()
+
+        self.pingboy.close()
 
         super(PcResetMainWindow, self).closeEvent(event)
    
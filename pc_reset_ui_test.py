@@ -0,0 +1,76 @@
+import os
+import pytest
+import shutil
+import threading
+import time
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+pytest.importorskip('PyQt5')
+
+from PyQt5.QtCore import QSettings
+from PyQt5.QtWidgets import QApplication
+from pc_reset_ping import write_config_file
+from pc_reset_ui import PcResetMainWindow, ProbeWorker
+
+@pytest.fixture(scope='module')
+def app():
+    return QApplication.instance() or QApplication([])
+
+@pytest.fixture()
+def window(app, tmp_path, monkeypatch):
+    """The main window on the default config with simulated GPIO, its settings kept in an empty directory."""
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pc_reset_config.ini'), str(tmp_path))
+    write_config_file(str(tmp_path / 'pc_reset_config.ini'), {('Channel', 'backend'): 'simulated'})
+    monkeypatch.chdir(tmp_path)
+    QSettings.setPath(QSettings.NativeFormat, QSettings.UserScope, str(tmp_path))
+
+    window = PcResetMainWindow()
+    yield window
+    window.close()
+
+def process_events(app, seconds):
+    """Runs the event loop for a while."""
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        app.processEvents()
+        time.sleep(0.005)
+
+def test_cycle_done_even_when_ping_fails(app):
+    """The worker reports the end of a cycle that raised, so the next one is still started."""
+    class Failing(object):
+        def ping(self):
+            raise OSError("no route")
+    worker = ProbeWorker(Failing())
+    done = []
+    worker.sig_cycle_done.connect(lambda: done.append(True))
+
+    with pytest.raises(OSError):
+        worker.run_cycle()
+
+    assert done == [True]
+
+def test_slow_cycle_does_not_queue_another(app, window, mocker):
+    """Ticks while a cycle is running start nothing, and the next cycle only starts once it is done."""
+    lock = threading.Lock()
+    running = []
+    overlaps = []
+    def slow_ping():
+        with lock:
+            overlaps.append(len(running))
+            running.append(True)
+        time.sleep(0.3)
+        with lock:
+            running.pop()
+    mocker.patch.object(window.pingboy, 'ping', side_effect=slow_ping)
+    mocker.patch.object(window.pingboy, 'time_until_next_ping', return_value=10.0)
+
+    process_events(app, 0.1)
+    assert window.cycle_in_progress
+    for _ in range(5):
+        window.ping_timer.timeout.emit()
+    process_events(app, 0.5)
+
+    assert window.pingboy.ping.call_count == 1
+    assert overlaps == [0]
+    assert not window.cycle_in_progress
+    assert window.ping_timer.isActive()
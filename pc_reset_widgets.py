@@ -0,0 +1,482 @@
+import collections
+import time
+
+from pc_reset_downsample import BucketSeries
+
+from PyQt5.QtCore import (pyqtSignal, QAbstractTableModel, QLineF, QModelIndex, QRect, QSortFilterProxyModel, Qt,
+                          QTimer)
+from PyQt5.QtGui import QColor, QPainter, QPen
+from PyQt5.QtWidgets import (QAbstractItemView, QCheckBox, QComboBox, QHBoxLayout, QHeaderView, QLabel, QLineEdit,
+                             QPlainTextEdit, QStyledItemDelegate, QTableView, QVBoxLayout, QWidget)
+
+# Columns of the host table, in order.
+HOST_COLUMNS = ('Host', 'State', 'Last RTT', 'Loss %', 'Fails', 'Restart Phase', 'RTT Last Hour')
+(COLUMN_NAME, COLUMN_STATE, COLUMN_RTT, COLUMN_LOSS, COLUMN_FAILS, COLUMN_PHASE,
+ COLUMN_TREND) = range(len(HOST_COLUMNS))
+
+# Starting widths of the columns (PIXELS).  The last one takes what is left.
+HOST_COLUMN_WIDTHS = (140, 80, 70, 60, 45, 110, 120)
+
+# Role that gives the BucketSeries a trend cell draws.
+TREND_ROLE = Qt.UserRole
+
+# Windows the chart can show, as (label, SECONDS).
+CHART_WINDOWS = (('1 hour', 3600), ('24 hours', 86400), ('30 days', 30 * 86400))
+
+# Colours of round trip times, lost pings and restarts in charts.
+RTT_COLOR = QColor(40, 110, 200)
+LOSS_COLOR = QColor(210, 40, 40)
+RESTART_COLOR = QColor(240, 150, 0)
+
+# States of a host in the table.
+HOST_STATE_UNKNOWN = 'unknown'
+HOST_STATE_UP = 'up'
+HOST_STATE_FAILING = 'failing'
+HOST_STATE_RESTARTING = 'restarting'
+HOST_STATE_PAUSED = 'paused'
+
+# Row colours of the states that need attention.
+HOST_STATE_COLORS = {HOST_STATE_FAILING: QColor(255, 235, 156),
+                     HOST_STATE_RESTARTING: QColor(255, 199, 206),
+                     HOST_STATE_PAUSED: QColor(221, 221, 221)}
+
+def sort_key(column, value):
+    """Returns the key a cell sorts on.  Every key of a column has the same type, missing values sorting first."""
+    if column in (COLUMN_RTT, COLUMN_LOSS):
+        return -1.0 if value is None else float(value)
+    if column == COLUMN_TREND:
+        # (peak round trip time, version) of the trend.
+        return -1.0 if value is None or value[0] is None else value[0]
+    if column == COLUMN_FAILS:
+        return -1 if value is None else value
+    return '' if value is None else value
+
+class LogView(QPlainTextEdit):
+    """
+    Read only log display that keeps its memory bounded.
+
+    Messages are added to the widget in batches on a short timer, so a
+    burst of messages costs one relayout instead of one per message.  Only
+    the newest max_blocks lines are kept, both while waiting and rendered.
+    """
+    def __init__(self, max_blocks=2000, flush_interval_ms=100, parent=None):
+        super(LogView, self).__init__(parent)
+        self.setReadOnly(True)
+
+        # Undo history would keep a copy of everything ever appended.
+        self.setUndoRedoEnabled(False)
+        self.setMaximumBlockCount(max_blocks)
+        self.max_blocks = max_blocks
+
+        # Messages that have not been added to the widget yet.
+        self.pending = collections.deque(maxlen=max_blocks)
+
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(flush_interval_ms)
+        self.flush_timer.timeout.connect(self.flush)
+
+    def append_message(self, message):
+        """Queues a message to be shown with the next batch."""
+        self.pending.append(message)
+        if not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def flush(self):
+        """Adds every queued message to the widget in one go."""
+        if not self.pending:
+            return
+        text = '\n'.join(self.pending)
+        self.pending.clear()
+        self.appendPlainText(text)
+
+def draw_buckets(painter, rect, series, start, end, peak, restarts=()):
+    """
+    Draws a BucketSeries between start and end (SECONDS) in rect: a line
+    from the lowest to the highest round trip time of every bucket, scaled
+    to peak, a mark along the bottom as high as the share of lost pings,
+    and a line at every restart time.
+    """
+    span = float(end - start)
+    if span <= 0:
+        return
+    left = rect.left()
+    bottom = rect.bottom()
+    width = rect.width()
+    height = rect.height() - 1
+    scale = height / peak if peak else 0.0
+    step = max(1.0, series.width / span * width)
+
+    rtt_lines = []
+    loss_lines = []
+    for bucket in series.buckets:
+        x = left + (bucket.start - start) / span * width
+        if x < left - step:
+            continue
+        x += step / 2
+        if bucket.has_rtt() and scale:
+            rtt_lines.append(QLineF(x, bottom - min(bucket.low * scale, height),
+                                    x, bottom - min(bucket.high * scale, height) - 1))
+        if bucket.failures:
+            loss_lines.append(QLineF(x, bottom, x, bottom - max(2.0, height * bucket.failures / bucket.pings)))
+
+    painter.setPen(QPen(RTT_COLOR, step))
+    painter.drawLines(rtt_lines)
+    painter.setPen(QPen(LOSS_COLOR, step))
+    painter.drawLines(loss_lines)
+    restart_lines = [QLineF(x, rect.top(), x, bottom)
+                     for x in (left + (restart - start) / span * width for restart in restarts)
+                     if left <= x <= left + width]
+    if restart_lines:
+        painter.setPen(QPen(RESTART_COLOR, 1))
+        painter.drawLines(restart_lines)
+
+class SparklineDelegate(QStyledItemDelegate):
+    """Draws the trend column of the host table as a small chart."""
+    def paint(self, painter, option, index):
+        super(SparklineDelegate, self).paint(painter, option, index)
+        series = index.data(TREND_ROLE)
+        if series is None or not series.buckets:
+            return
+        end = series.end()
+        painter.save()
+        painter.setClipRect(option.rect)
+        draw_buckets(painter, option.rect.adjusted(2, 2, -2, -2), series, end - series.width * series.count, end,
+                     series.peak())
+        painter.restore()
+
+class HostTableModel(QAbstractTableModel):
+    """
+    One row per host of (name, state, last RTT (SECONDS), loss %, fails,
+    restart phase, (peak RTT, version) of its trend), any of them None when
+    not known yet.  The trend itself, a BucketSeries, comes from
+    trend_source(name) when the trend column is drawn.
+
+    Rows are not pushed in.  Hosts are marked as changed with invalidate and
+    their rows are read from row_source(name) once per frame, however many
+    signals arrived meanwhile.  Only rows whose values differ are announced,
+    one dataChanged per run of neighbouring rows, so the view repaints just
+    those.
+
+    The model sorts itself, with one sorted() of its rows, because a proxy
+    moving a thousand changed rows one at a time freezes the GUI.
+    """
+    def __init__(self, row_source, trend_source=None, flush_interval_ms=16, parent=None):
+        super(HostTableModel, self).__init__(parent)
+        self.row_source = row_source
+        self.trend_source = trend_source
+
+        # Row values in host order, and the row of every host name.
+        self.rows = []
+        self.row_of = {}
+
+        # Names of the hosts to read again on the next frame.
+        self.dirty = set()
+
+        # Column the rows are sorted on, or None for the order they were given in.
+        self.sort_column = None
+        self.sort_order = Qt.AscendingOrder
+
+        self.flush_timer = QTimer(self)
+        self.flush_timer.setSingleShot(True)
+        self.flush_timer.setInterval(flush_interval_ms)
+        self.flush_timer.timeout.connect(self.flush)
+
+    def set_hosts(self, names):
+        """Shows these hosts, in this order, from scratch."""
+        self.beginResetModel()
+        self.rows = [tuple(self.row_source(name)) for name in names]
+        self.row_of = {name: row for row, name in enumerate(names)}
+        self.dirty.clear()
+        self.endResetModel()
+        if self.sort_column is not None:
+            self.sort(self.sort_column, self.sort_order)
+
+    def invalidate(self, names):
+        """Marks hosts as changed, to be read again with the next frame."""
+        for name in names:
+            if name in self.row_of:
+                self.dirty.add(name)
+        if self.dirty and not self.flush_timer.isActive():
+            self.flush_timer.start()
+
+    def flush(self):
+        """Reads every changed host again and announces the rows that differ."""
+        if not self.dirty:
+            return
+        # (row, first changed column, last changed column) of every row that differs.
+        changed = []
+        for name in self.dirty:
+            row = self.row_of[name]
+            values = tuple(self.row_source(name))
+            old_values = self.rows[row]
+            if values != old_values:
+                self.rows[row] = values
+                columns = [column for column, (value, old_value) in enumerate(zip(values, old_values))
+                           if value != old_value]
+                changed.append((row, columns[0], columns[-1]))
+        self.dirty.clear()
+
+        # Rows that changed in the sort column may have to move, which repaints the view anyway.
+        if self.sort_column is not None and any(first <= self.sort_column <= last for _, first, last in changed):
+            self.sort(self.sort_column, self.sort_order)
+            return
+
+        # Only the columns that changed are announced, so a proxy sorted on
+        # one that did not has nothing to sort again.
+        changed.sort()
+        start = 0
+        for index in range(1, len(changed) + 1):
+            if index == len(changed) or changed[index][0] != changed[index - 1][0] + 1:
+                run = changed[start:index]
+                self.dataChanged.emit(self.index(run[0][0], min(first for _, first, _ in run)),
+                                      self.index(run[-1][0], max(last for _, _, last in run)))
+                start = index
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """Sorts the rows on a column, keeping the rows of hosts that are equal in their order."""
+        self.sort_column = column if column >= 0 else None
+        self.sort_order = order
+        if self.sort_column is None:
+            return
+
+        self.layoutAboutToBeChanged.emit()
+        old_rows = {values[COLUMN_NAME]: row for row, values in enumerate(self.rows)}
+        self.rows.sort(key=lambda values: sort_key(column, values[column]), reverse=order == Qt.DescendingOrder)
+        self.row_of = {values[COLUMN_NAME]: row for row, values in enumerate(self.rows)}
+
+        # Selections and the current cell follow their host.
+        names = {row: name for name, row in old_rows.items()}
+        old_indexes = self.persistentIndexList()
+        self.changePersistentIndexList(old_indexes,
+                                       [self.index(self.row_of[names[index.row()]], index.column())
+                                        for index in old_indexes])
+        self.layoutChanged.emit()
+
+    def host_state(self, row):
+        return self.rows[row][COLUMN_STATE]
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(HOST_COLUMNS)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        values = self.rows[index.row()]
+        column = index.column()
+        value = values[column]
+
+        if role == Qt.DisplayRole:
+            if value is None or column == COLUMN_TREND:
+                return ''
+            if column == COLUMN_RTT:
+                return '{:.1f} ms'.format(value * 1000)
+            if column == COLUMN_LOSS:
+                return '{:.0f}'.format(value)
+            return str(value)
+
+        if role == TREND_ROLE:
+            return None if self.trend_source is None else self.trend_source(values[COLUMN_NAME])
+
+        if role == Qt.BackgroundRole:
+            return HOST_STATE_COLORS.get(values[COLUMN_STATE])
+
+        if role == Qt.TextAlignmentRole and column in (COLUMN_RTT, COLUMN_LOSS, COLUMN_FAILS):
+            return Qt.AlignRight | Qt.AlignVCenter
+
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return HOST_COLUMNS[section]
+        return None
+
+class HostFilterProxyModel(QSortFilterProxyModel):
+    """
+    Hides the rows of the host table that do not contain the filter text, or
+    that are up when only problems are shown.  Sorting is handed to the
+    HostTableModel, so the proxy keeps its order.
+    """
+    def __init__(self, parent=None):
+        super(HostFilterProxyModel, self).__init__(parent)
+        self.setDynamicSortFilter(True)
+        self.setFilterCaseSensitivity(Qt.CaseInsensitive)
+        # Any column, so typing a state or phase finds those hosts too.
+        self.setFilterKeyColumn(-1)
+        self.problems_only = False
+
+    def set_problems_only(self, problems_only):
+        self.problems_only = problems_only
+        self.invalidateFilter()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sourceModel().sort(column, order)
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if self.problems_only and self.sourceModel().host_state(source_row) == HOST_STATE_UP:
+            return False
+        return super(HostFilterProxyModel, self).filterAcceptsRow(source_row, source_parent)
+
+class HostDashboard(QWidget):
+    """
+    The host table with a filter box and a problems only switch above it.
+    Emits sig_host_selected with the name of the host whose row is picked.
+    """
+    sig_host_selected = pyqtSignal(str)
+
+    def __init__(self, model, parent=None):
+        super(HostDashboard, self).__init__(parent)
+        self.model = model
+        self.proxy = HostFilterProxyModel(self)
+        self.proxy.setSourceModel(model)
+
+        self.filter_edit = QLineEdit()
+        self.filter_edit.setPlaceholderText("Filter hosts")
+        self.filter_edit.setClearButtonEnabled(True)
+        self.filter_edit.textChanged.connect(self.proxy.setFilterFixedString)
+
+        self.problems_cb = QCheckBox("Problems only")
+        self.problems_cb.toggled.connect(self.proxy.set_problems_only)
+
+        self.table = QTableView()
+        self.table.setModel(self.proxy)
+        self.table.setSortingEnabled(True)
+        self.table.sortByColumn(COLUMN_NAME, Qt.AscendingOrder)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.table.setWordWrap(False)
+        # Fixed row heights and column widths, so no update makes the view measure every row.
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self.table.verticalHeader().setDefaultSectionSize(self.table.fontMetrics().height() + 6)
+        self.table.verticalHeader().hide()
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Interactive)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        for column, width in enumerate(HOST_COLUMN_WIDTHS):
+            self.table.horizontalHeader().resizeSection(column, width)
+        self.table.setItemDelegateForColumn(COLUMN_TREND, SparklineDelegate(self.table))
+        self.table.selectionModel().currentRowChanged.connect(self.__slot_current_row_changed)
+
+        filter_layout = QHBoxLayout()
+        filter_layout.addWidget(self.filter_edit)
+        filter_layout.addWidget(self.problems_cb)
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addLayout(filter_layout)
+        layout.addWidget(self.table)
+        self.setLayout(layout)
+
+    def __slot_current_row_changed(self, current, previous):
+        if current.isValid():
+            self.sig_host_selected.emit(self.proxy.index(current.row(), COLUMN_NAME).data())
+
+class HostChart(QWidget):
+    """
+    Round trip times, lost pings and restarts of one host over a window,
+    bucketed to about one bucket per pixel.  The history is read once per
+    host or window, after which every ping only updates the newest bucket
+    and only that bucket is repainted, unless the chart moved along or its
+    scale changed.
+    """
+    def __init__(self, points_source, buckets=300, parent=None):
+        """points_source(name, start, end) returns the TimeSeriesStore.points of a host."""
+        super(HostChart, self).__init__(parent)
+        self.points_source = points_source
+        self.bucket_count = buckets
+        self.name = None
+        self.window = CHART_WINDOWS[0][1]
+        self.series = BucketSeries(self.window / buckets, buckets)
+        self.restarts = []
+        self.end = None
+        self.peak = None
+        self.setMinimumHeight(100)
+
+    def show_host(self, name, window=None):
+        """Shows the history of a host, over a new window (SECONDS) if one is given."""
+        self.name = name
+        if window is not None:
+            self.window = window
+        self.reload()
+
+    def reload(self):
+        """Reads the whole window again from the history."""
+        now = time.time()
+        self.series = BucketSeries(self.window / self.bucket_count, self.bucket_count)
+        self.restarts = []
+        points = self.points_source(self.name, now - self.window, now) if self.name is not None else None
+        if points is not None:
+            self.series.load(end=now, **points)
+            self.restarts = list(points['restarts'])
+        self.end = self.series.bucket_start(now) + self.series.width
+        self.peak = self.series.peak()
+        self.update()
+
+    def add_ping(self, name, sent_at, success, rtt=None):
+        """Adds a ping of a host, repainting as little as possible."""
+        if name != self.name:
+            return
+        started = self.series.add(sent_at, success, rtt)
+        peak = self.series.peak()
+        if started or peak != self.peak:
+            self.end = self.series.end()
+            self.peak = peak
+            self.update()
+        else:
+            self.update(self.__bucket_rect(self.series.buckets[-1]))
+
+    def add_restart(self, name, restarted_at):
+        if name == self.name:
+            self.restarts.append(restarted_at)
+            self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(event.rect(), self.palette().base())
+        if self.end is None:
+            return
+        plot = self.rect().adjusted(4, 16, -4, -4)
+        start = self.end - self.window
+        draw_buckets(painter, plot, self.series, start, self.end, self.peak,
+                     [restart for restart in self.restarts if restart >= start])
+        painter.setPen(self.palette().text().color())
+        painter.drawText(self.rect().adjusted(4, 0, -4, 0), Qt.AlignTop | Qt.AlignLeft,
+                         '' if self.peak is None else 'peak {:.1f} ms'.format(self.peak * 1000))
+
+    def __bucket_rect(self, bucket):
+        """Returns the part of the widget a bucket is drawn in."""
+        width = self.width() - 8
+        step = max(1.0, self.series.width / self.window * width)
+        x = 4 + (bucket.start - (self.end - self.window)) / self.window * width
+        return QRect(int(x) - 1, 0, int(step) + 3, self.height())
+
+class HostChartPanel(QWidget):
+    """A HostChart with the host's name and a choice of window above it."""
+    def __init__(self, points_source, parent=None):
+        super(HostChartPanel, self).__init__(parent)
+        self.chart = HostChart(points_source)
+
+        self.title = QLabel("Pick a host to chart")
+        self.window_combo = QComboBox()
+        for label, seconds in CHART_WINDOWS:
+            self.window_combo.addItem(label, seconds)
+        self.window_combo.currentIndexChanged.connect(self.__slot_window_changed)
+
+        header_layout = QHBoxLayout()
+        header_layout.addWidget(self.title)
+        header_layout.addStretch()
+        header_layout.addWidget(self.window_combo)
+
+        layout = QVBoxLayout()
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addLayout(header_layout)
+        layout.addWidget(self.chart)
+        self.setLayout(layout)
+
+    def show_host(self, name):
+        self.title.setText(name)
+        self.chart.show_host(name)
+
+    def __slot_window_changed(self, index):
+        self.chart.show_host(self.chart.name, self.window_combo.itemData(index))
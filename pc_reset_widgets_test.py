@@ -0,0 +1,145 @@
+import os
+import pytest
+
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+pytest.importorskip('PyQt5')
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage
+from PyQt5.QtWidgets import QApplication
+from pc_reset_widgets import (COLUMN_FAILS, COLUMN_RTT, HOST_STATE_FAILING, HOST_STATE_UP, HostChart,
+                              HostFilterProxyModel, HostTableModel, LogView)
+
+@pytest.fixture(scope='module')
+def app():
+    return QApplication.instance() or QApplication([])
+
+@pytest.fixture()
+def rows():
+    return {name: (name, HOST_STATE_UP, 0.001, 0.0, 0, None, None) for name in ('pc0', 'pc1', 'pc2', 'pc3')}
+
+@pytest.fixture()
+def model(app, rows):
+    model = HostTableModel(lambda name: rows[name])
+    model.set_hosts(sorted(rows))
+    return model
+
+@pytest.fixture()
+def changes(model):
+    """Every dataChanged of the model as (first row, last row, first column, last column)."""
+    changes = []
+    model.dataChanged.connect(lambda top_left, bottom_right, roles=():
+                              changes.append((top_left.row(), bottom_right.row(),
+                                              top_left.column(), bottom_right.column())))
+    return changes
+
+def test_updates_coalesced_until_flush(model, rows, changes):
+    """Hosts marked more than once are read once, on the next frame."""
+    rows['pc1'] = ('pc1', HOST_STATE_UP, 0.002, 0.0, 0, None, None)
+    model.invalidate(['pc1'])
+    model.invalidate(['pc1'])
+    assert changes == []
+    assert model.flush_timer.isActive()
+
+    model.flush()
+
+    assert changes == [(1, 1, COLUMN_RTT, COLUMN_RTT)]
+    assert model.index(1, COLUMN_RTT).data() == '2.0 ms'
+
+def test_only_changed_rows_announced(model, rows, changes):
+    """Unchanged rows are not announced, and neighbouring changed rows go in one signal."""
+    for name in ('pc0', 'pc1', 'pc3'):
+        rows[name] = (name, HOST_STATE_FAILING, None, 25.0, 1, None, None)
+    model.invalidate(rows)
+    model.flush()
+
+    assert sorted(changes) == [(0, 1, 1, COLUMN_FAILS), (3, 3, 1, COLUMN_FAILS)]
+
+def test_sorts_numbers_as_numbers(model, rows):
+    """Sorting on a column orders by its raw values, and a change in that column moves the row."""
+    for index, rtt in enumerate((0.010, 0.002, None, 0.0009)):
+        rows['pc{}'.format(index)] = ('pc{}'.format(index), HOST_STATE_UP, rtt, 0.0, 0, None, None)
+    model.invalidate(rows)
+    model.flush()
+
+    model.sort(COLUMN_RTT, Qt.DescendingOrder)
+    assert [values[0] for values in model.rows] == ['pc0', 'pc1', 'pc3', 'pc2']
+
+    rows['pc2'] = ('pc2', HOST_STATE_UP, 0.5, 0.0, 0, None, None)
+    model.invalidate(['pc2'])
+    model.flush()
+    assert [values[0] for values in model.rows] == ['pc2', 'pc0', 'pc1', 'pc3']
+    assert model.row_of['pc2'] == 0
+
+def test_filter_text_and_problems_only(model, rows):
+    proxy = HostFilterProxyModel()
+    proxy.setSourceModel(model)
+    rows['pc2'] = ('pc2', HOST_STATE_FAILING, None, 50.0, 2, None, None)
+    model.invalidate(['pc2'])
+    model.flush()
+
+    proxy.setFilterFixedString('PC1')
+    assert proxy.rowCount() == 1
+
+    proxy.setFilterFixedString('')
+    proxy.set_problems_only(True)
+    assert [proxy.index(row, 0).data() for row in range(proxy.rowCount())] == ['pc2']
+
+    # A host that recovers leaves the problems only view by itself.
+    rows['pc2'] = ('pc2', HOST_STATE_UP, 0.001, 0.0, 0, None, None)
+    model.invalidate(['pc2'])
+    model.flush()
+    assert proxy.rowCount() == 0
+
+def test_chart_repaints_only_the_newest_bucket(app, monkeypatch):
+    """A ping that changes neither the newest bucket's place nor the scale repaints just that bucket."""
+    now = 3600.0 * 1000 + 35
+    monkeypatch.setattr('pc_reset_widgets.time.time', lambda: now)
+    points = {'tier': 0, 'times': [now - 20, now - 5], 'pings': [1, 1], 'failures': [0, 0],
+              'rtt_low': [0.002, 0.004], 'rtt_high': [0.002, 0.004], 'restarts': [now - 15]}
+    chart = HostChart(lambda name, start, end: points, buckets=360)
+    chart.resize(400, 100)
+    chart.show_host('pc0')
+    assert chart.peak == 0.004
+
+    updates = []
+    monkeypatch.setattr(chart, 'update', lambda *rect: updates.append(rect))
+    chart.add_ping('pc0', now, True, 0.003)
+    assert len(updates) == 1 and len(updates[0]) == 1
+    assert updates[0][0].width() < 10
+
+    chart.add_ping('pc0', now, True, 0.008)
+    assert updates[-1] == ()
+
+    # Pings of other hosts are not drawn.
+    chart.add_ping('pc1', now, True, 0.5)
+    assert chart.peak == 0.008
+
+    image = QImage(400, 100, QImage.Format_RGB32)
+    chart.render(image)
+
+def test_log_burst_added_in_one_go(app, monkeypatch):
+    """A burst of messages is added to the widget once, and only the newest max_blocks lines are kept."""
+    view = LogView(max_blocks=50)
+    appended = []
+    append = view.appendPlainText
+    monkeypatch.setattr(view, 'appendPlainText', lambda text: appended.append(text) or append(text))
+
+    for index in range(120):
+        view.append_message('message {}'.format(index))
+    assert appended == []
+    assert view.flush_timer.isActive()
+
+    view.flush()
+    view.flush()
+
+    assert len(appended) == 1
+    assert view.document().blockCount() == 50
+    assert view.document().lastBlock().text() == 'message 119'
+
+    for index in range(120, 200):
+        view.append_message('message {}'.format(index))
+    view.flush()
+    assert len(appended) == 2
+    assert view.document().blockCount() == 50
+    assert view.document().firstBlock().text() == 'message 150'